@@ -8,5 +8,14 @@
 """A backup utility for FoodX source code."""
 
 # make the main executable path available as an importable function.
+from ._batch import main as backup_source_batch  # noqa: F401
+from ._bundle import main as check_bundle_chain  # noqa: F401
+from ._catalog import main as search_source  # noqa: F401
+from ._diff import main as diff_source  # noqa: F401
 from ._main import main as backup_source  # noqa: F401
+from ._restore import main as restore_source  # noqa: F401
+from ._serve import main as serve_source  # noqa: F401
+from ._snapshot import SnapshotResult, iter_snapshots  # noqa: F401
+from ._store import ObjectStore  # noqa: F401
+from ._verify import main as verify_source  # noqa: F401
 from ._version import __version__  # noqa: F401
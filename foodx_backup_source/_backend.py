@@ -0,0 +1,520 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Git backends to fetch, resolve and archive repositories."""
+
+import abc
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import pathlib
+import signal
+import tempfile
+import threading
+import time
+import typing
+from urllib.parse import urlparse
+
+import git
+
+from ._compress import ChunkReader, compress_tar_file
+from ._governor import TransferGovernor, directory_size, transfer_host
+from ._hash import write_hash_file
+
+try:
+    import dulwich.archive
+    import dulwich.client
+    import dulwich.errors
+    import dulwich.objects
+    import dulwich.objectspec
+    import dulwich.repo
+    import urllib3
+
+    DULWICH_AVAILABLE = True
+except ImportError:
+    DULWICH_AVAILABLE = False
+
+log = logging.getLogger(__name__)
+
+GitBackendName = typing.Literal["gitpython", "subprocess", "dulwich"]
+
+PEELED_SUFFIX = b"^{}"
+DEFAULT_HOST_POOL_SIZE = 10
+
+
+class GitBackendError(Exception):
+    """A git backend is unavailable, or can't complete an operation."""
+
+
+class GitBackend(abc.ABC):
+    """
+    Fetch, resolve and archive git repositories.
+
+    A backend is shared by the snapshots of a run, and governs its transfers
+    with the governor of the run. Transfer failures are raised as
+    ``git.GitCommandError`` so that transient failures are retried the same
+    way for every backend.
+    """
+
+    name: typing.ClassVar[GitBackendName]
+
+    def __init__(self, governor: typing.Optional[TransferGovernor] = None):
+        """
+        Construct ``GitBackend`` object.
+
+        Args:
+            governor: Transfer governor; otherwise transfers are unlimited.
+        """
+        self.governor = governor or TransferGovernor()
+
+    @abc.abstractmethod
+    async def fetch(self, url: str, directory: pathlib.Path) -> None:
+        """
+        Fetch all the branches and tags of a repository.
+
+        Args:
+            url: Repository URL, which may include a token.
+            directory: Directory to create for the repository.
+        """
+
+    @abc.abstractmethod
+    async def resolve(self, directory: pathlib.Path, ref: str) -> str:
+        """
+        Resolve a reference of a fetched repository.
+
+        Args:
+            directory: Fetched repository directory.
+            ref: Branch, tag or commit.
+
+        Returns:
+            Commit SHA.
+        """
+
+    @abc.abstractmethod
+    async def archive(
+        self,
+        directory: pathlib.Path,
+        prefix: str,
+        sha: str,
+        archive_path: pathlib.Path,
+        compression_level: int,
+    ) -> str:
+        """
+        Archive a commit of a fetched repository, and its hash file.
+
+        Args:
+            directory: Fetched repository directory.
+            prefix: Directory name of the archive content.
+            sha: Commit SHA to archive.
+            archive_path: Path of the ``tar.gz`` file to create.
+            compression_level: Deflate level of compressible content.
+
+        Returns:
+            Hex digest of the archive file.
+        """
+
+    def close(self) -> None:
+        """Release resources shared between snapshots, if any."""
+
+
+@contextlib.asynccontextmanager
+async def _governed(
+    governor: TransferGovernor, host: str
+) -> typing.AsyncIterator[None]:
+    """Wait for a host slot without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    context = governor.transfer(host, cancelled.is_set)
+    waiting = loop.run_in_executor(
+        None, contextvars.copy_context().run, context.__enter__
+    )
+    try:
+        await asyncio.shield(waiting)
+    except asyncio.CancelledError:
+        cancelled.set()
+        # release a slot acquired just before the cancellation
+        waiting.add_done_callback(
+            lambda x: (
+                context.__exit__(None, None, None)
+                if not (x.cancelled() or x.exception())
+                else None
+            )
+        )
+        raise
+    try:
+        yield
+    finally:
+        context.__exit__(None, None, None)
+
+
+def _kill_group(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is None:
+        log.info(f"killing git process, {process.pid}")
+        with contextlib.suppress(ProcessLookupError):
+            # git runs transport helpers as its own child processes
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def _compress_descriptor(
+    descriptor: int, archive_path: pathlib.Path, compression_level: int
+) -> typing.Tuple[str, int]:
+    with os.fdopen(descriptor, "rb") as source:
+        return compress_tar_file(source, archive_path, compression_level)
+
+
+class SubprocessBackend(GitBackend):
+    """
+    Git CLI processes run directly on the event loop.
+
+    Processes are awaited rather than waited on executor threads, and the
+    archive output is streamed through a pipe to the compressor so that it
+    is not buffered in Python. Cancelling an operation kills its processes.
+    """
+
+    name = "subprocess"
+
+    async def _run(
+        self,
+        arguments: typing.List[str],
+        cwd: typing.Optional[pathlib.Path] = None,
+        env: typing.Optional[typing.Dict[str, str]] = None,
+        stdout: typing.Any = asyncio.subprocess.DEVNULL,
+    ) -> bytes:
+        process = await asyncio.create_subprocess_exec(
+            "git",
+            *arguments,
+            cwd=str(cwd) if cwd else None,
+            env=dict(os.environ, GIT_TERMINAL_PROMPT="0", **(env or dict())),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        try:
+            output, errors = await process.communicate()
+        except asyncio.CancelledError:
+            _kill_group(process)
+            raise
+        if process.returncode:
+            raise git.GitCommandError(
+                ["git"] + arguments,
+                process.returncode,
+                errors.decode(errors="replace"),
+            )
+
+        return output or b""
+
+    async def fetch(self, url: str, directory: pathlib.Path) -> None:
+        """
+        Fetch all the branches and tags of a repository, as a bare clone.
+
+        Args:
+            url: Repository URL, which may include a token.
+            directory: Directory to create for the repository.
+        """
+        host = transfer_host(url)
+        with tempfile.TemporaryDirectory() as d:
+            trace_path = pathlib.Path(d) / "curl-trace.log"
+            # authorization headers are redacted from the trace by git
+            env = {
+                "GIT_TRACE_CURL": str(trace_path),
+                "GIT_TRACE_CURL_NO_DATA": "1",
+            }
+            async with _governed(self.governor, host):
+                start_time = time.monotonic()
+                try:
+                    await self._run(
+                        [
+                            "clone",
+                            "--bare",
+                            "--quiet",
+                            "--",
+                            url,
+                            str(directory),
+                        ],
+                        env=env,
+                    )
+                except git.GitCommandError as e:
+                    self.governor.throttle_failed(
+                        host, str(e.stderr), trace_path
+                    )
+                    raise
+                self.governor.record(
+                    host, directory_size(directory), start_time
+                )
+
+    async def resolve(self, directory: pathlib.Path, ref: str) -> str:
+        """
+        Resolve a reference of a fetched repository.
+
+        Args:
+            directory: Fetched repository directory.
+            ref: Branch, tag or commit.
+
+        Returns:
+            Commit SHA.
+        Raises:
+            GitBackendError: If the reference does not name a commit.
+        """
+        try:
+            output = await self._run(
+                ["rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}"],
+                cwd=directory,
+                stdout=asyncio.subprocess.PIPE,
+            )
+        except git.GitCommandError as e:
+            raise GitBackendError(f"unknown git reference, {ref}") from e
+
+        return output.decode().strip()
+
+    async def archive(
+        self,
+        directory: pathlib.Path,
+        prefix: str,
+        sha: str,
+        archive_path: pathlib.Path,
+        compression_level: int,
+    ) -> str:
+        """
+        Archive a commit of a fetched repository, and its hash file.
+
+        Args:
+            directory: Fetched repository directory.
+            prefix: Directory name of the archive content.
+            sha: Commit SHA to archive.
+            archive_path: Path of the ``tar.gz`` file to create.
+            compression_level: Deflate level of compressible content.
+
+        Returns:
+            Hex digest of the archive file.
+        """
+        loop = asyncio.get_running_loop()
+        read_descriptor, write_descriptor = os.pipe()
+        compressing = loop.run_in_executor(
+            None,
+            _compress_descriptor,
+            read_descriptor,
+            archive_path,
+            compression_level,
+        )
+        try:
+            running = self._run(
+                ["archive", "--format=tar", f"--prefix={prefix}/", sha],
+                cwd=directory,
+                stdout=write_descriptor,
+            )
+            try:
+                await running
+            finally:
+                # the compressor finishes when the last writer closes
+                os.close(write_descriptor)
+        except BaseException:
+            await asyncio.wait([compressing])
+            raise
+        hash_hexdigest, stored_size = await compressing
+        log.info(
+            f"archive created, {archive_path.name}, "
+            f"{stored_size} bytes stored uncompressed"
+        )
+        write_hash_file(hash_hexdigest, archive_path)
+
+        return hash_hexdigest
+
+
+class DulwichBackend(GitBackend):
+    """
+    Pure Python git, in process on executor threads.
+
+    No git processes are started, and HTTP connections are pooled per host
+    and reused by the fetches of all the snapshots of a run. Archives are
+    created from the repository tree, so export attributes in
+    ``.gitattributes`` are not applied. Operations in progress can't be
+    cancelled.
+    """
+
+    name = "dulwich"
+
+    def __init__(self, governor: typing.Optional[TransferGovernor] = None):
+        """
+        Construct ``DulwichBackend`` object.
+
+        Args:
+            governor: Transfer governor; otherwise transfers are unlimited.
+
+        Raises:
+            GitBackendError: If dulwich is not installed.
+        """
+        if not DULWICH_AVAILABLE:
+            raise GitBackendError(
+                "dulwich backend requires the dulwich package, "
+                "install foodx_backup_source[dulwich]"
+            )
+        super().__init__(governor)
+        self._lock = threading.Lock()
+        self._pools: typing.Dict[str, "urllib3.PoolManager"] = dict()
+
+    def _pool_manager(self, host: str) -> "urllib3.PoolManager":
+        with self._lock:
+            if host not in self._pools:
+                # keep a connection for each concurrent transfer of the host
+                self._pools[host] = urllib3.PoolManager(
+                    maxsize=(
+                        self.governor.max_connections or DEFAULT_HOST_POOL_SIZE
+                    )
+                )
+
+            return self._pools[host]
+
+    def _fetch(self, url: str, directory: pathlib.Path) -> None:
+        host = transfer_host(url)
+        arguments: typing.Dict[str, typing.Any] = dict()
+        if urlparse(url).scheme in {"http", "https"}:
+            arguments["pool_manager"] = self._pool_manager(host)
+        client, path = dulwich.client.get_transport_and_path(url, **arguments)
+        with self.governor.transfer(host):
+            start_time = time.monotonic()
+            with dulwich.repo.Repo.init_bare(
+                str(directory), mkdir=True
+            ) as target:
+                try:
+                    result = client.fetch(path, target)
+                except (
+                    dulwich.errors.GitProtocolError,
+                    urllib3.exceptions.HTTPError,
+                    OSError,
+                ) as e:
+                    # the response headers are not available
+                    if "http resp 429" in str(e):
+                        self.governor.throttle(host, None)
+                    raise git.GitCommandError(
+                        ["dulwich", "fetch", host], 128, str(e)
+                    ) from e
+                for name, sha in result.refs.items():
+                    if (
+                        name.startswith((b"refs/heads/", b"refs/tags/"))
+                        and (not name.endswith(PEELED_SUFFIX))
+                        and sha
+                    ):
+                        target.refs[name] = sha
+            self.governor.record(host, directory_size(directory), start_time)
+
+    async def fetch(self, url: str, directory: pathlib.Path) -> None:
+        """
+        Fetch all the branches and tags of a repository, as a bare repository.
+
+        Args:
+            url: Repository URL, which may include a token.
+            directory: Directory to create for the repository.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None,
+            contextvars.copy_context().run,
+            functools.partial(self._fetch, url, directory),
+        )
+
+    def _resolve(self, directory: pathlib.Path, ref: str) -> str:
+        with dulwich.repo.Repo(str(directory)) as this_repo:
+            try:
+                commit = dulwich.objectspec.parse_commit(this_repo, ref)
+            except KeyError as e:
+                raise GitBackendError(f"unknown git reference, {ref}") from e
+
+            return commit.id.decode()
+
+    async def resolve(self, directory: pathlib.Path, ref: str) -> str:
+        """
+        Resolve a reference of a fetched repository.
+
+        Args:
+            directory: Fetched repository directory.
+            ref: Branch, tag or commit.
+
+        Returns:
+            Commit SHA.
+        Raises:
+            GitBackendError: If the reference does not exist.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self._resolve, directory, ref)
+        )
+
+    def _archive(
+        self,
+        directory: pathlib.Path,
+        prefix: str,
+        sha: str,
+        archive_path: pathlib.Path,
+        compression_level: int,
+    ) -> str:
+        with dulwich.repo.Repo(str(directory)) as this_repo:
+            commit = dulwich.objectspec.parse_commit(this_repo, sha)
+            chunks = dulwich.archive.tar_stream(
+                this_repo.object_store,
+                typing.cast(
+                    "dulwich.objects.Tree", this_repo.object_store[commit.tree]
+                ),
+                commit.commit_time,
+                prefix=f"{prefix}/".encode(),
+            )
+            hash_hexdigest, stored_size = compress_tar_file(
+                typing.cast(typing.BinaryIO, ChunkReader(iter(chunks))),
+                archive_path,
+                compression_level,
+            )
+        log.info(
+            f"archive created, {archive_path.name}, "
+            f"{stored_size} bytes stored uncompressed"
+        )
+        write_hash_file(hash_hexdigest, archive_path)
+
+        return hash_hexdigest
+
+    async def archive(
+        self,
+        directory: pathlib.Path,
+        prefix: str,
+        sha: str,
+        archive_path: pathlib.Path,
+        compression_level: int,
+    ) -> str:
+        """
+        Archive a commit of a fetched repository, and its hash file.
+
+        Args:
+            directory: Fetched repository directory.
+            prefix: Directory name of the archive content.
+            sha: Commit SHA to archive.
+            archive_path: Path of the ``tar.gz`` file to create.
+            compression_level: Deflate level of compressible content.
+
+        Returns:
+            Hex digest of the archive file.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            functools.partial(
+                self._archive,
+                directory,
+                prefix,
+                sha,
+                archive_path,
+                compression_level,
+            ),
+        )
+
+    def close(self) -> None:
+        """Close the pooled HTTP connections."""
+        with self._lock:
+            for x in self._pools.values():
+                x.clear()
+            self._pools.clear()
@@ -0,0 +1,434 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Multi-project batch execution path."""
+
+import asyncio
+import io
+import logging
+import pathlib
+import sys
+import tempfile
+import typing
+
+import click
+
+from ._backend import GitBackendName
+from ._bundle import DEFAULT_BUNDLE_STATE_FILE, BundleState
+from ._encrypt import EncryptionError, encryption_options, load_encryption_key
+from ._families import FamilyRoots, family_roots_path
+from ._file_io import BackupDefinitions
+from ._main import (
+    DEFAULT_OUTPUT_PATH,
+    _load_definitions,
+    _process_gitref_options,
+    bundle_state_option,
+    package_format_option,
+    snapshot_options,
+    store_option,
+    tree_hash_option,
+)
+from ._package import PackageFormat, SnapshotResults, write_package
+from ._profile import profile_option, profile_phase, profile_run
+from ._run import (
+    GitReferences,
+    SnapshotKey,
+    construct_snapshot_options,
+    record_bundles,
+    record_history,
+    record_roots,
+    snapshot_key,
+)
+from ._snapshot import (
+    ExecutorMode,
+    SnapshotError,
+    SnapshotOptions,
+    SnapshotResult,
+    archive_executor_scope,
+    construct_governor,
+    iter_snapshots,
+    rename_snapshot,
+)
+from ._store import ObjectStore, StoreError
+from .schema import ApplicationDefinition
+
+log = logging.getLogger(__name__)
+
+ProjectDirectories = typing.Dict[str, pathlib.Path]
+ProjectDefinitions = typing.Dict[str, BackupDefinitions]
+
+
+def _deduplicate(
+    projects: ProjectDefinitions,
+) -> typing.List[BackupDefinitions]:
+    """
+    Identify the unique repository snapshots needed by all projects.
+
+    Unique snapshots are grouped into rounds such that archive file names
+    (``<name>-<ref>.tar.gz``) are unique within each round.
+    """
+    unique: typing.Dict[SnapshotKey, ApplicationDefinition] = dict()
+    for definitions in projects.values():
+        for x in definitions:
+            unique.setdefault(snapshot_key(x), x)
+
+    rounds: typing.List[BackupDefinitions] = list()
+    round_names: typing.List[typing.Set[typing.Tuple[str, str]]] = list()
+    for x in unique.values():
+        file_names = {(x.name, y) for y in x.configuration.snapshot_refs()}
+        for this_round, names in zip(rounds, round_names):
+            if not (file_names & names):
+                this_round.append(x)
+                names.update(file_names)
+                break
+        else:
+            rounds.append([x])
+            round_names.append(file_names)
+
+    return rounds
+
+
+async def _launch_batch_packaging(
+    project_directories: ProjectDirectories,
+    output_directory: pathlib.Path,
+    token: typing.Optional[str],
+    git_refs: GitReferences,
+    options: SnapshotOptions,
+    bundle_state_path: typing.Optional[pathlib.Path] = None,
+    package_format: PackageFormat = "tar.gz",
+    encryption_key: typing.Optional[bytes] = None,
+    tree_hash: bool = False,
+    store_directory: typing.Optional[pathlib.Path] = None,
+) -> typing.List[pathlib.Path]:
+    if store_directory and encryption_key:
+        raise StoreError("encryption of store objects is not supported")
+    store = ObjectStore(store_directory) if store_directory else None
+    with profile_phase("load-definitions"):
+        loaded = await asyncio.gather(
+            *[
+                _load_definitions(x, git_refs)
+                for x in project_directories.values()
+            ]
+        )
+    projects: ProjectDefinitions = dict(zip(project_directories, loaded))
+
+    rounds = _deduplicate(projects)
+    total_entries = sum(len(x) for x in projects.values())
+    total_unique = sum(len(x) for x in rounds)
+    log.info(
+        f"batch of {len(projects)} projects, {total_entries} entries, "
+        f"{total_unique} unique snapshots"
+    )
+
+    state_path = bundle_state_path or (
+        output_directory / DEFAULT_BUNDLE_STATE_FILE
+    )
+    bundle_state = BundleState.load(state_path)
+    family_roots = FamilyRoots.load(family_roots_path(state_path))
+    options = options.copy(
+        update={
+            "bundle_tips": bundle_state.tips(),
+            "repository_roots": family_roots.roots,
+        }
+    )
+
+    loop = asyncio.get_running_loop()
+    snapshots: typing.Dict[SnapshotKey, SnapshotResult] = dict()
+    remaining = {
+        name: {snapshot_key(x) for x in definitions}
+        for name, definitions in projects.items()
+    }
+    packaging_tasks: typing.List[asyncio.Future] = list()
+
+    def _project_results(
+        name: str, project_directory: pathlib.Path
+    ) -> SnapshotResults:
+        # package members in definition order regardless of completion order
+        results = list()
+        for x in projects[name]:
+            result = snapshots[snapshot_key(x)]
+            if result.name != x.name:
+                project_directory.mkdir(parents=True, exist_ok=True)
+                result = rename_snapshot(result, x.name, project_directory)
+            results.append(result)
+
+        return results
+
+    def _package_project(
+        name: str, project_directory: pathlib.Path
+    ) -> typing.List[pathlib.Path]:
+        results = _project_results(name, project_directory)
+        if store:
+            return store.ingest(name, results)
+
+        return write_package(
+            name,
+            output_directory,
+            results,
+            package_format,
+            encryption_key,
+            tree_hash,
+        )
+
+    with tempfile.TemporaryDirectory() as d:
+        archive_directory = pathlib.Path(d)
+
+        def _start_packaging(name: str) -> None:
+            packaging_tasks.append(
+                loop.run_in_executor(
+                    None,
+                    _package_project,
+                    name,
+                    archive_directory / "projects" / name,
+                )
+            )
+
+        # rounds share one governor so that host limits and throttling apply
+        # to the whole batch
+        governor = construct_governor(options)
+        async with archive_executor_scope(options) as archive_executor:
+
+            async def _take_round(
+                index: int, definitions: BackupDefinitions
+            ) -> None:
+                round_directory = archive_directory / f"{index}"
+                round_directory.mkdir()
+                keys = {
+                    (x.name, x.configuration.release.ref): x
+                    for x in definitions
+                }
+                # rounds share one process pool, if any, so the pool size is
+                # the limit for the whole batch
+                async for result in iter_snapshots(
+                    definitions,
+                    round_directory,
+                    token,
+                    options,
+                    archive_executor,
+                    governor,
+                ):
+                    key = snapshot_key(keys[(result.name, result.ref)])
+                    snapshots[key] = result
+                    # package each project as soon as its snapshots are complete
+                    for name, pending in remaining.items():
+                        if key in pending:
+                            pending.remove(key)
+                            if not pending:
+                                _start_packaging(name)
+
+            await asyncio.gather(
+                *[_take_round(i, x) for i, x in enumerate(rounds)]
+            )
+            for name, pending in remaining.items():
+                if (not pending) and (not projects[name]):
+                    # projects without any dependencies are still packaged
+                    _start_packaging(name)
+
+            packages = await asyncio.gather(*packaging_tasks)
+
+    # bundle chains only advance once the bundles are safely packaged
+    entries = {
+        (x.name, snapshot_key(x)): x for y in projects.values() for x in y
+    }
+    entry_snapshots = [
+        (x, snapshots[snapshot_key(x)]) for x in entries.values()
+    ]
+    if record_bundles(bundle_state, entry_snapshots):
+        bundle_state.save(state_path)
+    record_roots(family_roots, state_path, entry_snapshots)
+    record_history(bundle_state_path, state_path, entry_snapshots)
+
+    return [x for y in packages for x in y]
+
+
+def _process_project_options(
+    project: typing.List[str],
+) -> ProjectDirectories:
+    processed_projects: ProjectDirectories = dict()
+    for x in project:
+        tokens = x.split("=")
+        if len(tokens) != 2:
+            raise RuntimeError(f"Malformed project option, {x}")
+
+        name = tokens[0].strip()
+        directory = pathlib.Path(tokens[1].strip())
+        if not directory.is_dir():
+            raise RuntimeError(f"Project directory does not exist, {x}")
+        if name in processed_projects:
+            raise RuntimeError(f"Duplicate project name, {name}")
+
+        processed_projects[name] = directory
+
+    return processed_projects
+
+
+def main(
+    project: typing.List[str],
+    output_dir: pathlib.Path,
+    git_ref: typing.Optional[typing.List[str]],
+    token_value: typing.Optional[str],
+    options: typing.Optional[SnapshotOptions] = None,
+    bundle_state: typing.Optional[pathlib.Path] = None,
+    profile: typing.Optional[pathlib.Path] = None,
+    package_format: PackageFormat = "tar.gz",
+    encryption_key: typing.Optional[bytes] = None,
+    tree_hash: bool = False,
+    store: typing.Optional[pathlib.Path] = None,
+) -> typing.List[pathlib.Path]:
+    """
+    Package repositories for archiving for multiple projects.
+
+    Args:
+        project: Project definitions in the form ``<name>=<directory>``.
+        output_dir: Directory to output package files.
+        git_ref: User overrides of application git references.
+        token_value: Personal access token for repository access.
+        options: Repository snapshot execution controls.
+        bundle_state: Bundle chain state file; defaults to
+                      ``bundle-state.json`` in the output directory.
+        profile: Directory to write profiling results, if any.
+        package_format: Package file format.
+        encryption_key: Key to encrypt packages with, if any.
+        tree_hash: Also write a chunked tree hash file of each package.
+        store: Snapshot store directory to write instead of packages, if
+               any.
+
+    Returns:
+        List of files created.
+    Raises:
+        SnapshotError: If any repository snapshot failed or timed out.
+        StoreError: If the snapshots can't be stored.
+    """
+    project_directories = _process_project_options(project)
+    processed_refs = _process_gitref_options(git_ref)
+    with profile_run(profile) as profiler:
+        # debug mode reports slow callbacks that block the event loop
+        created_files = asyncio.run(
+            _launch_batch_packaging(
+                project_directories,
+                output_dir,
+                token_value,
+                processed_refs,
+                options or SnapshotOptions(),
+                bundle_state,
+                package_format,
+                encryption_key,
+                tree_hash,
+                store,
+            ),
+            debug=bool(profiler),
+        )
+
+    return created_files
+
+
+@click.command()
+@click.argument("project", nargs=-1, required=True, type=str)
+@click.option(
+    "--output-dir",
+    default=DEFAULT_OUTPUT_PATH,
+    help="Directory path to save output tar files and SHAs.",
+    type=click.Path(
+        dir_okay=True, exists=True, file_okay=False, path_type=pathlib.Path
+    ),
+)
+@click.option(
+    "--git-ref",
+    default=None,
+    help="""Specify a git reference for the named repo.
+
+The reference is specified in the form `<name>=<gitref>` and is applied to the
+named entry in every project.
+""",
+    multiple=True,
+    type=str,
+)
+@click.option(
+    "--token-file",
+    default=None,
+    help="""Personal access token for authenticating against repositories.
+
+A single token must have read access to all the repositories defined in the
+backup.
+""",
+    type=click.File(mode="r"),
+)
+@encryption_options
+@store_option
+@tree_hash_option
+@package_format_option
+@bundle_state_option
+@snapshot_options
+@profile_option
+def click_entry(
+    project: typing.List[str],
+    output_dir: pathlib.Path,
+    git_ref: typing.Optional[typing.List[str]],
+    token_file: typing.Optional[io.TextIOBase],
+    timeout: typing.Optional[float],
+    retries: int,
+    deadline: typing.Optional[float],
+    executor: ExecutorMode,
+    jobs: typing.Optional[int],
+    host_connections: typing.Optional[int],
+    host_rate: typing.Optional[float],
+    git_backend: GitBackendName,
+    detect_families: bool,
+    bundle_state: typing.Optional[pathlib.Path],
+    profile: typing.Optional[pathlib.Path],
+    package_format: PackageFormat,
+    tree_hash: bool,
+    store: typing.Optional[pathlib.Path],
+    encryption_key_file: typing.Optional[pathlib.Path],
+    encryption_key_secret: typing.Optional[str],
+    azure_subscription: typing.Optional[str],
+) -> None:
+    """
+    Package repositories for archiving for multiple projects.
+
+    Each PROJECT is specified in the form `<project name>=<project directory>`.
+    Repositories are snapshot once per unique repository URL and git reference
+    across all the projects, and each snapshot is placed into every project
+    package that depends on it.
+    """
+    try:
+        token_value = None
+        if token_file:
+            token_value = token_file.read().strip()
+
+        encryption_key = load_encryption_key(
+            encryption_key_file, encryption_key_secret, azure_subscription
+        )
+        options = construct_snapshot_options(
+            timeout,
+            retries,
+            deadline,
+            executor,
+            jobs,
+            host_connections,
+            host_rate,
+            git_backend,
+            detect_families,
+        )
+        main(
+            list(project),
+            output_dir,
+            git_ref,
+            token_value,
+            options,
+            bundle_state,
+            profile,
+            package_format,
+            encryption_key,
+            tree_hash,
+            store,
+        )
+    except (EncryptionError, SnapshotError, StoreError) as e:
+        click.echo(f"Backup failed, {str(e)}", err=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        click.echo("User aborted execution. Exiting.")
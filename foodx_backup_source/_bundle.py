@@ -0,0 +1,244 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Incremental git bundle state and bundle chain verification."""
+
+import hashlib
+import logging
+import os
+import pathlib
+import struct
+import sys
+import tempfile
+import typing
+
+import click
+import git
+import pydantic
+
+from ._hash import create_file_hash, read_hash_file
+from .schema import ApplicationDefinition
+
+log = logging.getLogger(__name__)
+
+BUNDLE_SUFFIX = ".bundle"
+DEFAULT_BUNDLE_STATE_FILE = "bundle-state.json"
+
+BUNDLE_SIGNATURE = "# v2 git bundle"
+
+
+class BundleChainError(Exception):
+    """A bundle chain is broken or a bundle is corrupt."""
+
+
+class BundleRecord(pydantic.BaseModel):
+    """A bundle in a repository bundle chain."""
+
+    file_name: str
+    tip: str
+    # tip of the previous bundle in the chain; None for a full bundle
+    prerequisite: typing.Optional[str]
+    sha256: str
+
+
+class BundleState(pydantic.BaseModel):
+    """Bundle chains of repositories, recorded between backup runs."""
+
+    chains: typing.Dict[str, typing.List[BundleRecord]] = dict()
+
+    @classmethod
+    def load(cls, state_path: pathlib.Path) -> "BundleState":
+        """
+        Load bundle state from file.
+
+        Args:
+            state_path: Path to state file.
+
+        Returns:
+            Recorded bundle state; empty if the file does not exist.
+        """
+        if state_path.is_file():
+            log.info(f"loading bundle state, {state_path}")
+            return cls.parse_file(state_path)
+        else:
+            return cls()
+
+    def save(self, state_path: pathlib.Path) -> None:
+        """
+        Save bundle state to file.
+
+        The file is replaced atomically so that an interrupted save does not
+        lose the previously recorded state.
+
+        Args:
+            state_path: Path to state file.
+        """
+        log.info(f"saving bundle state, {state_path}")
+        temporary_path = state_path.parent / f".{state_path.name}.tmp"
+        with temporary_path.open("w") as f:
+            f.write(self.json(indent=2))
+        os.replace(temporary_path, state_path)
+
+    def tips(self) -> typing.Dict[str, str]:
+        """Latest recorded tip of each bundle chain."""
+        return {x: y[-1].tip for x, y in self.chains.items() if y}
+
+    def record(self, key: str, record: BundleRecord) -> None:
+        """
+        Append a bundle to a chain.
+
+        A full bundle starts a new chain.
+
+        Args:
+            key: Bundle chain key.
+            record: Bundle to append.
+        """
+        if not record.prerequisite:
+            self.chains[key] = [record]
+        else:
+            self.chains.setdefault(key, list()).append(record)
+
+
+def bundle_key(definition: ApplicationDefinition) -> str:
+    """
+    Identify the bundle chain of an application definition.
+
+    Args:
+        definition: Application definition.
+
+    Returns:
+        Bundle chain key.
+    """
+    return f"{definition.name}@{definition.configuration.backup.repo_url}"
+
+
+def write_empty_bundle(
+    bundle_path: pathlib.Path, ref_name: str, tip: str
+) -> None:
+    """
+    Write an incremental bundle for a chain with no new commits.
+
+    ``git bundle create`` refuses to create empty bundles, but a bundle whose
+    reference is also its prerequisite, with an empty pack, is valid. Writing
+    one keeps each night's bundle in the chain.
+
+    Args:
+        bundle_path: Path of bundle file to create.
+        ref_name: Full reference name recorded in the bundle.
+        tip: Commit SHA of the unchanged chain tip.
+    """
+    pack_header = b"PACK" + struct.pack(">II", 2, 0)
+    with bundle_path.open(mode="wb") as f:
+        f.write(f"{BUNDLE_SIGNATURE}\n-{tip}\n{tip} {ref_name}\n\n".encode())
+        f.write(pack_header)
+        f.write(hashlib.sha1(pack_header).digest())
+
+
+class BundleCheck(pydantic.BaseModel):
+    """Outcome of checking a bundle in a chain."""
+
+    file_name: str
+    refs: typing.Dict[str, str]
+
+
+def check_bundle_chain(
+    bundle_paths: typing.List[pathlib.Path],
+) -> typing.List[BundleCheck]:
+    """
+    Check that bundles form an unbroken chain.
+
+    Bundles are applied in order to an empty repository; each bundle's
+    prerequisite commits must be provided by the bundles before it. Bundles
+    with a co-located sha256sum file are also checked against their hash.
+
+    Args:
+        bundle_paths: Bundle files, starting with a full bundle.
+
+    Returns:
+        Checked bundles with the references they provide.
+    Raises:
+        BundleChainError: If a bundle is corrupt or the chain is broken.
+    """
+    results: typing.List[BundleCheck] = list()
+    with tempfile.TemporaryDirectory() as d:
+        with git.Repo.init(d, bare=True) as this_repo:
+            for x in bundle_paths:
+                bundle_file = x.resolve()
+                hash_path = x.parent / f"{x.name}.sha256"
+                if hash_path.is_file() and (
+                    read_hash_file(hash_path) != create_file_hash(x)
+                ):
+                    raise BundleChainError(f"bundle hash mismatch, {x}")
+
+                try:
+                    this_repo.git.bundle("verify", str(bundle_file))
+                    this_repo.git.fetch(
+                        str(bundle_file), "+refs/*:refs/bundles/*"
+                    )
+                    heads = this_repo.git.bundle("list-heads", str(bundle_file))
+                except git.GitCommandError as e:
+                    raise BundleChainError(
+                        f"bundle chain broken at {x}, "
+                        f"{str(e.stderr).strip()}"
+                    ) from e
+
+                # list-heads lines are "<sha> <ref name>"
+                refs = {
+                    z: y
+                    for y, z in (
+                        w.split(maxsplit=1) for w in heads.splitlines()
+                    )
+                }
+                log.info(f"bundle verified, {x}, {refs}")
+                results.append(BundleCheck(file_name=x.name, refs=refs))
+
+    return results
+
+
+def main(bundle: typing.List[pathlib.Path]) -> typing.List[BundleCheck]:
+    """
+    Check a chain of git bundles.
+
+    Args:
+        bundle: Bundle files in chain order, starting with a full bundle.
+
+    Returns:
+        Checked bundles with the references they provide.
+    """
+    results = check_bundle_chain(bundle)
+
+    return results
+
+
+@click.command()
+@click.argument(
+    "bundle",
+    nargs=-1,
+    required=True,
+    type=click.Path(
+        dir_okay=False, exists=True, file_okay=True, path_type=pathlib.Path
+    ),
+)
+def click_entry(bundle: typing.List[pathlib.Path]) -> None:
+    """
+    Check a chain of git bundles.
+
+    BUNDLE files are specified in chain order, starting with a full bundle
+    followed by the incremental bundles extracted from subsequent backup
+    packages.
+    """
+    try:
+        results = main(list(bundle))
+
+        for x in results:
+            refs = ", ".join(f"{y} {z}" for y, z in x.refs.items())
+            click.echo(f"{x.file_name}: ok ({refs})")
+    except BundleChainError as e:
+        click.echo(f"Bundle chain check failed, {str(e)}", err=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        click.echo("User aborted execution. Exiting.")
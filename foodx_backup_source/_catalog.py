@@ -0,0 +1,464 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Searchable catalog of the files of backup packages."""
+
+import datetime
+import logging
+import pathlib
+import re
+import sqlite3
+import sys
+import typing
+
+import click
+import pydantic
+
+from ._diff import read_package_manifest
+from ._package import PackageManifest
+from ._snapshot import SnapshotResult
+from ._spool import ArchiveSpool
+from ._verify import archive_file_sizes
+
+log = logging.getLogger(__name__)
+
+# blob id and size, by file path within the repository
+ArchiveFiles = typing.Dict[str, typing.Tuple[str, int]]
+
+# the files of an archive are recorded once, however many packages contain it;
+# archives are keyed by content hash, because path filtered archives only hold
+# part of their commit
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    project_name TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_created ON packages (created);
+CREATE TABLE IF NOT EXISTS members (
+    package_id INTEGER NOT NULL REFERENCES packages (id),
+    file_name TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS members_package ON members (package_id);
+CREATE INDEX IF NOT EXISTS members_sha256 ON members (sha256);
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    sha256 TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS files (
+    archive_id INTEGER NOT NULL REFERENCES archives (id),
+    path TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_blob ON files (blob);
+"""
+
+SEARCH_QUERY = """
+SELECT packages.name, packages.project_name, packages.created,
+    members.repository, members.ref, members.sha, files.path, files.blob,
+    files.size
+FROM files
+JOIN archives ON archives.id = files.archive_id
+JOIN members ON members.sha256 = archives.sha256
+JOIN packages ON packages.id = members.package_id
+"""
+
+GLOB_CHARACTERS = re.compile(r"[*?\[]")
+BLOB_PREFIX = re.compile(r"[0-9a-f]{4,40}")
+
+
+class CatalogError(Exception):
+    """A catalog cannot be updated or searched."""
+
+
+class CatalogEntry(pydantic.BaseModel):
+    """A file of a repository archive in a backup package."""
+
+    package: str
+    project_name: str
+    created: str
+    repository: str
+    ref: str
+    sha: str
+    path: str
+    blob: str
+    size: int
+
+
+class PackageCatalog:
+    """
+    SQLite catalog of backup packages, and the files of their archives.
+
+    Packages record their archives, by repository, reference and commit. The
+    files of each archive are recorded once, by archive content hash, so a
+    catalog of years of daily packages only grows by the archives that
+    changed. Files are indexed by path
+    and blob id, and packages by creation time.
+    """
+
+    def __init__(self, catalog_path: pathlib.Path) -> None:
+        """
+        Construct ``PackageCatalog`` object.
+
+        Args:
+            catalog_path: Path to catalog file; created if it doesn't exist.
+        """
+        self.catalog_path = catalog_path
+        self._connection = sqlite3.connect(str(catalog_path))
+        self._connection.executescript(CATALOG_SCHEMA)
+
+    def __enter__(self) -> "PackageCatalog":
+        """Open the catalog."""
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        """Close the catalog."""
+        self.close()
+
+    def close(self) -> None:
+        """Close the catalog file."""
+        self._connection.close()
+
+    def has_archive(self, sha256: str) -> bool:
+        """Indicate the files of an archive are already recorded."""
+        row = self._connection.execute(
+            "SELECT 1 FROM archives WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+
+        return row is not None
+
+    def add_package(
+        self,
+        package_name: str,
+        manifest: PackageManifest,
+        archive_files: typing.Mapping[str, ArchiveFiles],
+    ) -> bool:
+        """
+        Record a package, its archives and the files of new archives.
+
+        Args:
+            package_name: File name of the package.
+            manifest: Package manifest.
+            archive_files: Files of the archives not yet recorded, by archive
+                           sha256 hash.
+
+        Returns:
+            False if the package was already recorded.
+        """
+        with self._connection:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO packages (name, project_name, created) "
+                "VALUES (?, ?, ?)",
+                (package_name, manifest.project_name, manifest.created),
+            )
+            if not cursor.rowcount:
+                log.info(f"package already catalogued, {package_name}")
+                return False
+            package_id = cursor.lastrowid
+
+            self._connection.executemany(
+                "INSERT INTO members "
+                "(package_id, file_name, repository, ref, sha, sha256) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (package_id, y.file_name, x.name, y.ref, y.sha, y.sha256)
+                    for x in manifest.repositories
+                    for y in x.archives
+                ],
+            )
+            for sha256, files in archive_files.items():
+                cursor = self._connection.execute(
+                    "INSERT OR IGNORE INTO archives (sha256) VALUES (?)",
+                    (sha256,),
+                )
+                if not cursor.rowcount:
+                    continue
+                archive_id = cursor.lastrowid
+                self._connection.executemany(
+                    "INSERT INTO files (archive_id, path, blob, size) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(archive_id, x, y, z) for x, (y, z) in files.items()],
+                )
+        log.info(f"package catalogued, {package_name}")
+
+        return True
+
+    def search(
+        self,
+        path: typing.Optional[str] = None,
+        blob: typing.Optional[str] = None,
+        repository: typing.Optional[str] = None,
+        since: typing.Optional[datetime.datetime] = None,
+        until: typing.Optional[datetime.datetime] = None,
+        limit: typing.Optional[int] = None,
+    ) -> typing.List[CatalogEntry]:
+        """
+        Find the packages containing a file, by path or blob id.
+
+        Args:
+            path: File path within the repository, or a glob pattern of it.
+            blob: Blob id of the file content, or a prefix of it.
+            repository: Only search the archives of this repository.
+            since: Only search packages created at, or after, this time.
+            until: Only search packages created before this time.
+            limit: Maximum number of files to return.
+
+        Returns:
+            Matching files, oldest package first.
+        Raises:
+            CatalogError: If neither a path nor blob id is specified, or the
+                          blob id is malformed.
+        """
+        if not (path or blob):
+            raise CatalogError("search needs a file path or blob id")
+        conditions: typing.List[str] = list()
+        parameters: typing.List[typing.Any] = list()
+        if path:
+            conditions.append(
+                "files.path GLOB ?"
+                if GLOB_CHARACTERS.search(path)
+                else "files.path = ?"
+            )
+            parameters.append(path)
+        if blob:
+            if not BLOB_PREFIX.fullmatch(blob):
+                raise CatalogError(f"malformed blob id, {blob}")
+            # a constant glob prefix is an index range
+            conditions.append("files.blob GLOB ?")
+            parameters.append(f"{blob}*")
+        if repository:
+            conditions.append("members.repository = ?")
+            parameters.append(repository)
+        if since:
+            conditions.append("packages.created >= ?")
+            parameters.append(since.isoformat())
+        if until:
+            conditions.append("packages.created < ?")
+            parameters.append(until.isoformat())
+        query = (
+            f"{SEARCH_QUERY} WHERE {' AND '.join(conditions)} "
+            "ORDER BY packages.created, members.repository, files.path"
+        )
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        return [
+            CatalogEntry(
+                package=x[0],
+                project_name=x[1],
+                created=x[2],
+                repository=x[3],
+                ref=x[4],
+                sha=x[5],
+                path=x[6],
+                blob=x[7],
+                size=x[8],
+            )
+            for x in self._connection.execute(query, parameters)
+        ]
+
+
+def catalog_package(
+    catalog_path: pathlib.Path,
+    package_path: pathlib.Path,
+    snapshot_results: typing.List[SnapshotResult],
+    encryption_key: typing.Optional[bytes] = None,
+    spool: typing.Optional[ArchiveSpool] = None,
+    manifest: typing.Optional[PackageManifest] = None,
+) -> None:
+    """
+    Record a new backup package in a catalog.
+
+    The package manifest is read back from the package, unless it is given.
+    Only the archives that the catalog has not seen are read for their files,
+    from the snapshot archives that were packaged; bundles have no file level
+    detail.
+
+    Args:
+        catalog_path: Path to catalog file.
+        package_path: Path to backup package file.
+        snapshot_results: Repository snapshots of the package.
+        encryption_key: Key to decrypt an encrypted package.
+        spool: Spool holding snapshot archives in memory, if any.
+        manifest: Manifest of the package, if known.
+    Raises:
+        CatalogError: If the catalog can't be updated.
+    """
+    if not manifest:
+        manifest = read_package_manifest(package_path, encryption_key)
+    archive_paths = {
+        y.name: y
+        for x in snapshot_results
+        if x.format == "archive"
+        for y in [x.archive_path] + [z.archive_path for z in x.ref_archives]
+    }
+    try:
+        _record_package(
+            catalog_path, package_path, manifest, archive_paths, spool
+        )
+    except sqlite3.Error as e:
+        raise CatalogError(f"catalog update failed, {catalog_path}, {e}") from e
+
+
+def _record_package(
+    catalog_path: pathlib.Path,
+    package_path: pathlib.Path,
+    manifest: PackageManifest,
+    archive_paths: typing.Dict[str, pathlib.Path],
+    spool: typing.Optional[ArchiveSpool],
+) -> None:
+    with PackageCatalog(catalog_path) as catalog:
+        archive_files: typing.Dict[str, ArchiveFiles] = dict()
+        for x in manifest.repositories:
+            for y in x.archives:
+                archive_path = archive_paths.get(y.file_name)
+                if (
+                    (not archive_path)
+                    or (y.sha256 in archive_files)
+                    or catalog.has_archive(y.sha256)
+                ):
+                    continue
+                log.info(f"cataloguing archive files, {y.file_name}")
+                with (
+                    spool.open(archive_path)
+                    if spool
+                    else archive_path.open(mode="rb")
+                ) as f:
+                    archive_files[y.sha256] = archive_file_sizes(f)
+        catalog.add_package(package_path.name, manifest, archive_files)
+
+
+def catalog_option(function: typing.Callable) -> typing.Callable:
+    """Apply the package catalog option to a click command."""
+    function = click.option(
+        "--catalog",
+        default=None,
+        help="""SQLite catalog file recording the files of each package.
+
+The catalog is created if it doesn't exist, and searched with `search-source`.
+""",
+        type=click.Path(dir_okay=False, file_okay=True, path_type=pathlib.Path),
+    )(function)
+
+    return function
+
+
+def main(
+    catalog_path: pathlib.Path,
+    path: typing.Optional[str] = None,
+    blob: typing.Optional[str] = None,
+    repository: typing.Optional[str] = None,
+    since: typing.Optional[datetime.datetime] = None,
+    until: typing.Optional[datetime.datetime] = None,
+    limit: typing.Optional[int] = None,
+) -> typing.List[CatalogEntry]:
+    """
+    Search a package catalog for a file.
+
+    Args:
+        catalog_path: Path to catalog file.
+        path: File path within the repository, or a glob pattern of it.
+        blob: Blob id of the file content, or a prefix of it.
+        repository: Only search the archives of this repository.
+        since: Only search packages created at, or after, this time.
+        until: Only search packages created before this time.
+        limit: Maximum number of files to return.
+
+    Returns:
+        Matching files, oldest package first.
+    """
+    with PackageCatalog(catalog_path) as catalog:
+        entries = catalog.search(path, blob, repository, since, until, limit)
+
+    return entries
+
+
+@click.command()
+@click.argument(
+    "catalog",
+    type=click.Path(
+        dir_okay=False, exists=True, file_okay=True, path_type=pathlib.Path
+    ),
+)
+@click.option(
+    "--path",
+    default=None,
+    help="""File path within the repository.
+
+A glob pattern, such as `config/*.yaml`, matches several paths.
+""",
+    type=str,
+)
+@click.option(
+    "--blob",
+    default=None,
+    help="Git blob id of the file content, or an abbreviation of it.",
+    type=str,
+)
+@click.option(
+    "--repository",
+    default=None,
+    help="Only search the archives of this repository.",
+    type=str,
+)
+@click.option(
+    "--since",
+    default=None,
+    help="Only search packages created at, or after, this UTC time.",
+    type=click.DateTime(),
+)
+@click.option(
+    "--until",
+    default=None,
+    help="Only search packages created before this UTC time.",
+    type=click.DateTime(),
+)
+@click.option(
+    "--limit",
+    default=None,
+    help="Maximum number of files to list.",
+    type=click.IntRange(min=1),
+)
+def click_entry(
+    catalog: pathlib.Path,
+    path: typing.Optional[str],
+    blob: typing.Optional[str],
+    repository: typing.Optional[str],
+    since: typing.Optional[datetime.datetime],
+    until: typing.Optional[datetime.datetime],
+    limit: typing.Optional[int],
+) -> None:
+    """
+    Find the backup packages containing a file.
+
+    Files of the packages recorded in CATALOG are searched by --path, --blob
+    or both, and listed oldest package first with the repository, reference
+    and commit of their archive.
+    """
+    try:
+        entries = main(catalog, path, blob, repository, since, until, limit)
+
+        for x in entries:
+            click.echo(
+                f"{x.created} {x.package} {x.repository} {x.ref} "
+                f"({x.sha[:12]}) {x.path} {x.blob[:12]} {x.size}"
+            )
+        if not entries:
+            click.echo("No files found")
+    except (CatalogError, sqlite3.DatabaseError) as e:
+        click.echo(f"Search failed, {str(e)}", err=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        click.echo("User aborted execution. Exiting.")
@@ -0,0 +1,406 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Adaptive gzip compression of tar streams."""
+
+import hashlib
+import io
+import logging
+import pathlib
+import struct
+import tarfile
+import typing
+import zlib
+
+from ._spool import ArchiveSpool, SpoolWriter
+
+log = logging.getLogger(__name__)
+
+# same as the git archive tar.gz default
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# file content that is already compressed; stored rather than deflated
+STORED_EXTENSIONS = frozenset(
+    {
+        ".7z",
+        ".bz2",
+        ".docx",
+        ".gif",
+        ".gz",
+        ".jar",
+        ".jpeg",
+        ".jpg",
+        ".mp3",
+        ".mp4",
+        ".nupkg",
+        ".png",
+        ".tgz",
+        ".war",
+        ".webm",
+        ".webp",
+        ".whl",
+        ".woff",
+        ".woff2",
+        ".xlsx",
+        ".xz",
+        ".zip",
+        ".zst",
+    }
+)
+
+SAMPLE_SIZE = 0x10000
+# a sample that fast compression reduces by less than this is stored
+STORE_RATIO = 0.9
+# smaller members are always compressed; sampling them gains nothing
+MINIMUM_SAMPLE_SIZE = 0x1000
+
+COPY_SIZE = 0x40000
+WINDOW_SIZE = 0x8000
+
+_SIZED_TYPES = frozenset(
+    {
+        tarfile.XHDTYPE,
+        tarfile.XGLTYPE,
+        tarfile.SOLARIS_XHDTYPE,
+        tarfile.GNUTYPE_LONGNAME,
+        tarfile.GNUTYPE_LONGLINK,
+    }
+)
+
+
+def is_compressible(name: str, sample: bytes) -> bool:
+    """
+    Estimate whether deflating member content gains anything.
+
+    Args:
+        name: Member name.
+        sample: Leading content of the member.
+
+    Returns:
+        True if the member content should be deflated.
+    """
+    if pathlib.PurePosixPath(name).suffix.lower() in STORED_EXTENSIONS:
+        return False
+    if len(sample) < MINIMUM_SAMPLE_SIZE:
+        return True
+
+    return len(zlib.compress(sample, 1)) < (STORE_RATIO * len(sample))
+
+
+class AdaptiveGzipWriter:
+    """
+    Write a single gzip member whose deflate level changes with the content.
+
+    Each run of content at one level is deflated by its own raw compressor
+    and sync flushed, so the runs concatenate into one valid deflate stream
+    readable by any gzip decompressor. Level 0 runs are stored blocks. A new
+    deflating run is primed with the preceding window of content so that
+    switching levels costs little compression.
+    """
+
+    def __init__(self, fileobj: typing.BinaryIO, level: int) -> None:
+        """
+        Construct ``AdaptiveGzipWriter`` object.
+
+        Args:
+            fileobj: Binary file object to write gzip content to.
+            level: Deflate level of compressible content.
+        """
+        self._fileobj = fileobj
+        self.level = level
+        # zlib does not expose the compressor type
+        self._compressor: typing.Any = None
+        self._compressor_level: typing.Optional[int] = None
+        self._crc = 0
+        self._size = 0
+        self._window = b""
+        self.hash = hashlib.sha256()
+        self.stored_size = 0
+
+        # magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self._write_out(struct.pack("<BBBBIBB", 0x1F, 0x8B, 8, 0, 0, 0, 255))
+
+    def _write_out(self, data: bytes) -> None:
+        if data:
+            self._fileobj.write(data)
+            self.hash.update(data)
+
+    def _switch(self, level: int) -> None:
+        if self._compressor:
+            self._write_out(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        if level and self._window:
+            self._compressor = zlib.compressobj(
+                level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self._window
+            )
+        else:
+            self._compressor = zlib.compressobj(
+                level, zlib.DEFLATED, -zlib.MAX_WBITS
+            )
+        self._compressor_level = level
+
+    def write(
+        self, data: bytes, compress: typing.Optional[bool] = None
+    ) -> None:
+        """
+        Write content.
+
+        Args:
+            data: Content to write.
+            compress: Deflate, or store, the content; None continues with the
+                      current level.
+        """
+        if compress is not None:
+            level = self.level if compress else 0
+            if level != self._compressor_level:
+                self._switch(level)
+        elif not self._compressor:
+            self._switch(self.level)
+        if self._compressor_level == 0:
+            self.stored_size += len(data)
+
+        self._write_out(self._compressor.compress(data))
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        if len(data) >= WINDOW_SIZE:
+            self._window = data[-WINDOW_SIZE:]
+        else:
+            self._window = (self._window + data)[-WINDOW_SIZE:]
+
+    def finish(self) -> str:
+        """
+        Complete the gzip member.
+
+        Returns:
+            Hex digest of the gzip content.
+        """
+        if not self._compressor:
+            self._switch(self.level)
+        self._write_out(self._compressor.flush(zlib.Z_FINISH))
+        self._write_out(
+            struct.pack("<II", self._crc & 0xFFFFFFFF, self._size & 0xFFFFFFFF)
+        )
+
+        return self.hash.hexdigest()
+
+
+def _read_exact(source: typing.BinaryIO, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        this_data = source.read(size - len(data))
+        if not this_data:
+            break
+        data += this_data
+
+    return bytes(data)
+
+
+def _copy(
+    source: typing.BinaryIO, writer: AdaptiveGzipWriter, size: int
+) -> int:
+    remaining = size
+    while remaining:
+        data = source.read(min(remaining, COPY_SIZE))
+        if not data:
+            break
+        writer.write(data)
+        remaining -= len(data)
+
+    return size - remaining
+
+
+def compress_tar_stream(
+    source: typing.BinaryIO, writer: AdaptiveGzipWriter
+) -> None:
+    """
+    Compress a tar stream, choosing to store or deflate each member.
+
+    Tar blocks are passed through unchanged; only the compression of member
+    content varies. Anything that does not parse as a tar header is
+    compressed as is.
+
+    Args:
+        source: Tar stream.
+        writer: Compressed output.
+    """
+    while True:
+        header = _read_exact(source, tarfile.BLOCKSIZE)
+        if len(header) < tarfile.BLOCKSIZE:
+            writer.write(header)
+            return
+        try:
+            info = tarfile.TarInfo.frombuf(
+                header, tarfile.ENCODING, "surrogateescape"
+            )
+        except tarfile.HeaderError:
+            # end of archive marker, or not a tar stream
+            writer.write(header)
+            while _copy(source, writer, COPY_SIZE):
+                pass
+            return
+
+        writer.write(header)
+        if not (
+            info.isreg()
+            or (info.type in _SIZED_TYPES)
+            or (info.type not in tarfile.SUPPORTED_TYPES)
+        ):
+            continue
+        padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        if info.isreg() and info.size:
+            sample = _read_exact(source, min(padded_size, SAMPLE_SIZE))
+            writer.write(sample, is_compressible(info.name, sample))
+            padded_size -= len(sample)
+        _copy(source, writer, padded_size)
+
+
+class ChunkReader(io.RawIOBase):
+    """Present an iterator of byte strings as a readable stream."""
+
+    def __init__(self, chunks: typing.Iterator[bytes]) -> None:
+        """
+        Construct ``ChunkReader`` object.
+
+        Args:
+            chunks: Content, in order.
+        """
+        super().__init__()
+        self._chunks = chunks
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        """Indicate the object supports reading."""
+        return True
+
+    def readinto(self, b: typing.Any) -> int:
+        """Read content into a buffer, returning the number of bytes read."""
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+
+        return size
+
+
+def compress_tar_file(
+    source: typing.BinaryIO,
+    archive_path: pathlib.Path,
+    compression_level: int,
+    spool: typing.Optional[ArchiveSpool] = None,
+) -> typing.Tuple[str, int]:
+    """
+    Compress a tar stream to a file, choosing to store or deflate each member.
+
+    Args:
+        source: Tar stream.
+        archive_path: Path of compressed file to create.
+        compression_level: Deflate level of compressible content.
+        spool: Spool to hold the file in memory, if it fits.
+
+    Returns:
+        Hex digest of the compressed file, and the number of bytes stored
+        uncompressed.
+    """
+    with (
+        spool.writer(archive_path) if spool else archive_path.open(mode="wb")
+    ) as f:
+        try:
+            writer = AdaptiveGzipWriter(f, compression_level)
+            compress_tar_stream(source, writer)
+            # the file is hashed as it is written rather than read back
+            hash_hexdigest = writer.finish()
+        except BaseException:
+            # a partial archive is not held in the spool
+            if isinstance(f, SpoolWriter):
+                f.abort()
+            raise
+
+    return hash_hexdigest, writer.stored_size
+
+
+def _replace_prefix(path: str, prefix: str, new_prefix: str) -> str:
+    if path == prefix:
+        return new_prefix
+    if path.startswith(f"{prefix}/"):
+        return path.replace(prefix, new_prefix, 1)
+
+    return path
+
+
+def _iter_reprefixed_tar(
+    archive: tarfile.TarFile, prefix: str, new_prefix: str
+) -> typing.Iterator[bytes]:
+    members = iter(archive)
+    member = next(members, None)
+    if archive.pax_headers:
+        # the global header of a git archive records the archived commit
+        yield tarfile.TarInfo.create_pax_global_header(archive.pax_headers)
+    while member:
+        member.name = _replace_prefix(member.name, prefix, new_prefix)
+        if member.islnk():
+            member.linkname = _replace_prefix(
+                member.linkname, prefix, new_prefix
+            )
+        # extended paths would otherwise take priority over the new names
+        member.pax_headers = {
+            x: y
+            for x, y in member.pax_headers.items()
+            if x not in {"path", "linkpath"}
+        }
+        yield member.tobuf(
+            tarfile.PAX_FORMAT, tarfile.ENCODING, "surrogateescape"
+        )
+        if member.isreg():
+            content = archive.extractfile(member)
+            if content:
+                for data in iter(lambda: content.read(COPY_SIZE), b""):
+                    yield data
+            remainder = member.size % tarfile.BLOCKSIZE
+            if remainder:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+        member = next(members, None)
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def reprefix_archive(
+    source_path: pathlib.Path,
+    archive_path: pathlib.Path,
+    prefix: str,
+    new_prefix: str,
+    compression_level: int,
+) -> str:
+    """
+    Copy a compressed archive, replacing the leading directory of its members.
+
+    The copy is compressed as ``compress_tar_file`` compresses an archive, and
+    retains the global header of the archive, which records the commit
+    archived by git.
+
+    Args:
+        source_path: Compressed tar archive to copy.
+        archive_path: Path of compressed file to create.
+        prefix: Leading directory of the archive members.
+        new_prefix: Leading directory of the copied members.
+        compression_level: Deflate level of compressible content.
+
+    Returns:
+        Hex digest of the compressed file.
+    """
+    with tarfile.open(source_path, mode="r|gz") as archive:
+        hash_hexdigest, _ = compress_tar_file(
+            typing.cast(
+                typing.BinaryIO,
+                ChunkReader(_iter_reprefixed_tar(archive, prefix, new_prefix)),
+            ),
+            archive_path,
+            compression_level,
+        )
+
+    return hash_hexdigest
@@ -0,0 +1,440 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Compare backup packages by their manifests."""
+
+import concurrent.futures
+import logging
+import pathlib
+import sys
+import tarfile
+import typing
+
+import click
+import pydantic
+
+from ._encrypt import (
+    ENCRYPTED_SUFFIX,
+    EncryptionError,
+    encryption_options,
+    load_encryption_key,
+)
+from ._hash import HashingReader
+from ._package import (
+    PACKAGE_MANIFEST_NAME,
+    BasePackage,
+    ManifestArchive,
+    ManifestRepository,
+    PackageManifest,
+)
+from ._restore import ARCHIVE_SUFFIX, RestoreError, open_decrypter
+from ._verify import archive_blobs
+
+log = logging.getLogger(__name__)
+
+FileStatus = typing.Literal["added", "removed", "modified"]
+ArchiveStatus = typing.Literal["added", "removed", "changed", "unchanged"]
+
+FILE_MARKERS = {"added": "A", "removed": "D", "modified": "M"}
+
+
+class DiffError(Exception):
+    """A backup package cannot be compared."""
+
+
+class FileChange(pydantic.BaseModel):
+    """A file that differs between the archives of a reference."""
+
+    path: str
+    status: FileStatus
+
+
+class ArchiveChange(pydantic.BaseModel):
+    """Archives of a repository reference in two packages."""
+
+    name: str
+    old: typing.Optional[ManifestArchive] = None
+    new: typing.Optional[ManifestArchive] = None
+    # only compared when file level detail is requested
+    files: typing.List[FileChange] = list()
+
+    @property
+    def status(self) -> ArchiveStatus:
+        """Compare the archives by their commit and hash."""
+        if not self.old:
+            return "added"
+        if not self.new:
+            return "removed"
+        if (self.old.sha, self.old.sha256) != (self.new.sha, self.new.sha256):
+            return "changed"
+
+        return "unchanged"
+
+
+def _open_package(
+    package_path: pathlib.Path,
+    package_file: typing.BinaryIO,
+    encryption_key: typing.Optional[bytes],
+) -> tarfile.TarFile:
+    reader = HashingReader(package_file)
+    try:
+        decrypter = open_decrypter(package_path, reader, encryption_key)
+    except RestoreError as e:
+        raise DiffError(str(e)) from e
+
+    return tarfile.open(fileobj=decrypter or reader, mode="r|*")
+
+
+def read_package_manifest(
+    package_path: pathlib.Path,
+    encryption_key: typing.Optional[bytes] = None,
+) -> PackageManifest:
+    """
+    Read the manifest of a backup package.
+
+    The manifest is the last member of a package; the archives of an
+    uncompressed package are skipped over, but a compressed or encrypted
+    package is read through to the manifest. The manifest of an encrypted
+    package is decrypted, but not authenticated; that requires reading the
+    whole package.
+
+    Args:
+        package_path: Path to backup package file.
+        encryption_key: Key to decrypt an encrypted package.
+
+    Returns:
+        Package manifest.
+    Raises:
+        DiffError: If the package has no manifest.
+    """
+    with package_path.open(mode="rb") as f:
+        with (
+            _open_package(package_path, f, encryption_key)
+            if package_path.name.endswith(ENCRYPTED_SUFFIX)
+            # the archives of an uncompressed package are seeked over
+            else tarfile.open(fileobj=f, mode="r:*")
+        ) as package:
+            for member in package:
+                if (
+                    pathlib.PurePosixPath(member.name).name
+                    == PACKAGE_MANIFEST_NAME
+                ):
+                    member_file = package.extractfile(member)
+                    if member_file:
+                        return PackageManifest.parse_raw(member_file.read())
+
+    raise DiffError(f"package has no manifest, {package_path}")
+
+
+def read_base_package(
+    base_path: pathlib.Path,
+    encryption_key: typing.Optional[bytes] = None,
+) -> BasePackage:
+    """
+    Read the base package of a differential package.
+
+    The base is either a package, or its manifest; only manifests that name
+    their package can stand in for it.
+
+    Args:
+        base_path: Path to backup package file, or its manifest file.
+        encryption_key: Key to decrypt an encrypted package.
+
+    Returns:
+        Base package.
+    Raises:
+        DiffError: If the base package has no manifest, or the manifest does
+                   not name its package.
+    """
+    if base_path.name.endswith(".json"):
+        try:
+            manifest = PackageManifest.parse_file(base_path)
+        except pydantic.ValidationError as e:
+            raise DiffError(f"malformed package manifest, {base_path}") from e
+        if not manifest.package_name:
+            raise DiffError(
+                f"package manifest does not name its package, {base_path}"
+            )
+
+        return BasePackage(name=manifest.package_name, manifest=manifest)
+
+    return BasePackage(
+        name=base_path.name,
+        manifest=read_package_manifest(base_path, encryption_key),
+    )
+
+
+def _archive_changes(
+    old_manifest: PackageManifest, new_manifest: PackageManifest
+) -> typing.List[ArchiveChange]:
+    """Pair the archives of repositories by release, and other references."""
+    old_repositories = {x.name: x for x in old_manifest.repositories}
+    new_repositories = {x.name: x for x in new_manifest.repositories}
+    # new package order, then removed repositories
+    names = list(
+        dict.fromkeys(
+            [x.name for x in new_manifest.repositories]
+            + [x.name for x in old_manifest.repositories]
+        )
+    )
+
+    def _archives(
+        repository: typing.Optional[ManifestRepository],
+    ) -> typing.List[ManifestArchive]:
+        return repository.archives if repository else list()
+
+    changes: typing.List[ArchiveChange] = list()
+    for name in names:
+        old_archives = _archives(old_repositories.get(name))
+        new_archives = _archives(new_repositories.get(name))
+        # the release reference usually changes between packages
+        changes.append(
+            ArchiveChange(
+                name=name,
+                old=old_archives[0] if old_archives else None,
+                new=new_archives[0] if new_archives else None,
+            )
+        )
+        old_refs = {x.ref: x for x in old_archives[1:]}
+        new_refs = {x.ref: x for x in new_archives[1:]}
+        for ref in dict.fromkeys(list(new_refs) + list(old_refs)):
+            changes.append(
+                ArchiveChange(
+                    name=name, old=old_refs.get(ref), new=new_refs.get(ref)
+                )
+            )
+
+    return changes
+
+
+def _member_blobs(
+    package_path: pathlib.Path,
+    file_names: typing.Set[str],
+    encryption_key: typing.Optional[bytes],
+) -> typing.Dict[str, typing.Dict[str, str]]:
+    """Identify the files of package archives, streaming the package once."""
+    blobs: typing.Dict[str, typing.Dict[str, str]] = dict()
+    with package_path.open(mode="rb") as f:
+        with _open_package(package_path, f, encryption_key) as package:
+            for member in package:
+                name = pathlib.PurePosixPath(member.name).name
+                member_file = package.extractfile(member)
+                if (name in file_names) and member_file:
+                    log.info(f"reading archive files, {name}")
+                    blobs[name] = archive_blobs(
+                        typing.cast(typing.BinaryIO, member_file)
+                    )
+                    if len(blobs) == len(file_names):
+                        break
+    missing = file_names - set(blobs)
+    if missing:
+        raise DiffError(
+            f"archives missing from package, {package_path}, {sorted(missing)}"
+        )
+
+    return blobs
+
+
+def _holding_package(
+    package_path: pathlib.Path, archive: ManifestArchive
+) -> pathlib.Path:
+    """Locate the package holding an archive, alongside the package."""
+    if not archive.package:
+        return package_path
+
+    holding_path = package_path.parent / archive.package
+    if not holding_path.is_file():
+        raise DiffError(f"referenced package not found, {holding_path}")
+
+    return holding_path
+
+
+def _file_changes(
+    old_blobs: typing.Dict[str, str], new_blobs: typing.Dict[str, str]
+) -> typing.List[FileChange]:
+    changes: typing.List[FileChange] = list()
+    for path in sorted(set(old_blobs) | set(new_blobs)):
+        if path not in old_blobs:
+            changes.append(FileChange(path=path, status="added"))
+        elif path not in new_blobs:
+            changes.append(FileChange(path=path, status="removed"))
+        elif old_blobs[path] != new_blobs[path]:
+            changes.append(FileChange(path=path, status="modified"))
+
+    return changes
+
+
+def diff_packages(
+    old_package: pathlib.Path,
+    new_package: pathlib.Path,
+    files: bool = False,
+    encryption_key: typing.Optional[bytes] = None,
+) -> typing.List[ArchiveChange]:
+    """
+    Compare the repository archives of two backup packages.
+
+    Archives are compared by the references, commits and hashes recorded in
+    the package manifests. File level detail decompresses only the changed
+    archives, hashing their files as git blobs; the packages are read in
+    parallel. Archives that a differential package references are read from
+    the package holding them, alongside it.
+
+    Args:
+        old_package: Path to earlier backup package file.
+        new_package: Path to later backup package file.
+        files: Also compare the files of changed archives.
+        encryption_key: Key to decrypt encrypted packages.
+
+    Returns:
+        Archives of each repository reference, in package order.
+    Raises:
+        DiffError: If a package does not have a manifest, or a referenced
+                   package is missing.
+        EncryptionError: If an encrypted package fails authentication.
+    """
+    changes = _archive_changes(
+        read_package_manifest(old_package, encryption_key),
+        read_package_manifest(new_package, encryption_key),
+    )
+    # bundles do not have file level detail
+    changed = [
+        x
+        for x in changes
+        if files
+        and x.old
+        and x.new
+        and (x.status == "changed")
+        and x.old.file_name.endswith(ARCHIVE_SUFFIX)
+        and x.new.file_name.endswith(ARCHIVE_SUFFIX)
+    ]
+    if changed:
+        file_names: typing.Dict[pathlib.Path, typing.Set[str]] = dict()
+        for x in changed:
+            for package_path, archive in [
+                (old_package, x.old),
+                (new_package, x.new),
+            ]:
+                if archive:
+                    file_names.setdefault(
+                        _holding_package(package_path, archive), set()
+                    ).add(archive.file_name)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(file_names)
+        ) as executor:
+            futures = {
+                x: executor.submit(_member_blobs, x, y, encryption_key)
+                for x, y in file_names.items()
+            }
+            blobs = {x: y.result() for x, y in futures.items()}
+        for x in changed:
+            if x.old and x.new:
+                x.files = _file_changes(
+                    blobs[_holding_package(old_package, x.old)][
+                        x.old.file_name
+                    ],
+                    blobs[_holding_package(new_package, x.new)][
+                        x.new.file_name
+                    ],
+                )
+
+    return changes
+
+
+def main(
+    old_package: pathlib.Path,
+    new_package: pathlib.Path,
+    files: bool = False,
+    encryption_key: typing.Optional[bytes] = None,
+) -> typing.List[ArchiveChange]:
+    """
+    Compare two backup packages.
+
+    Args:
+        old_package: Earlier backup package file.
+        new_package: Later backup package file.
+        files: Also compare the files of changed archives.
+        encryption_key: Key to decrypt encrypted packages.
+
+    Returns:
+        Archives of each repository reference, in package order.
+    """
+    changes = diff_packages(old_package, new_package, files, encryption_key)
+
+    return changes
+
+
+def _describe(archive: ManifestArchive) -> str:
+    return f"{archive.ref} ({archive.sha[:12]})"
+
+
+@click.command()
+@click.argument(
+    "old_package",
+    type=click.Path(
+        dir_okay=False, exists=True, file_okay=True, path_type=pathlib.Path
+    ),
+)
+@click.argument(
+    "new_package",
+    type=click.Path(
+        dir_okay=False, exists=True, file_okay=True, path_type=pathlib.Path
+    ),
+)
+@click.option(
+    "--files",
+    default=False,
+    help="""Also compare the files of changed archives.
+
+Only the changed archives are decompressed.
+""",
+    is_flag=True,
+)
+@encryption_options
+def click_entry(
+    old_package: pathlib.Path,
+    new_package: pathlib.Path,
+    files: bool,
+    encryption_key_file: typing.Optional[pathlib.Path],
+    encryption_key_secret: typing.Optional[str],
+    azure_subscription: typing.Optional[str],
+) -> None:
+    """
+    Compare two backup packages.
+
+    Repository archives in OLD_PACKAGE and NEW_PACKAGE are compared by the
+    references, commits and hashes recorded in the package manifests, without
+    reading the archives. Added (+), removed (-) and changed (~) archives are
+    listed, and with --files the added (A), removed (D) and modified (M)
+    files of changed archives.
+    """
+    try:
+        encryption_key = load_encryption_key(
+            encryption_key_file, encryption_key_secret, azure_subscription
+        )
+        changes = main(old_package, new_package, files, encryption_key)
+
+        unchanged = 0
+        for x in changes:
+            if x.old and x.new:
+                if x.status == "unchanged":
+                    unchanged += 1
+                    continue
+                click.echo(
+                    f"~ {x.name} {_describe(x.old)} -> {_describe(x.new)}"
+                )
+            elif x.new:
+                click.echo(f"+ {x.name} {_describe(x.new)}")
+            elif x.old:
+                click.echo(f"- {x.name} {_describe(x.old)}")
+            for y in x.files:
+                click.echo(f"    {FILE_MARKERS[y.status]} {y.path}")
+        click.echo(f"{unchanged} unchanged")
+    except (DiffError, EncryptionError) as e:
+        click.echo(f"Diff failed, {str(e)}", err=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        click.echo("User aborted execution. Exiting.")
@@ -0,0 +1,388 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Streaming authenticated encryption of backup packages."""
+
+import base64
+import binascii
+import collections
+import concurrent.futures
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import struct
+import typing
+
+import click
+
+from .azure import AzureKeyvaultError, get_kv_secret
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    CRYPTOGRAPHY_AVAILABLE = True
+except ImportError:
+    CRYPTOGRAPHY_AVAILABLE = False
+
+log = logging.getLogger(__name__)
+
+ENCRYPTED_SUFFIX = ".enc"
+
+KEY_SIZE = 32
+CHUNK_SIZE = 0x100000
+
+# header is magic, per package salt and plaintext chunk size
+MAGIC = b"FXBSENC1"
+SALT_SIZE = 16
+_HEADER_FORMAT = f">{len(MAGIC)}s{SALT_SIZE}sI"
+HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+TAG_SIZE = 16
+
+_KDF_INFO = b"foodx_backup_source package encryption"
+
+
+class EncryptionError(Exception):
+    """Problem encrypting or decrypting a backup package."""
+
+
+def _check_available() -> None:
+    if not CRYPTOGRAPHY_AVAILABLE:
+        raise EncryptionError(
+            "package encryption requires the cryptography package, "
+            "install foodx_backup_source[encrypt]"
+        )
+
+
+def _package_cipher(key: bytes, salt: bytes) -> "AESGCM":
+    """Derive the package key from the master key, unique to each package."""
+    kdf = HKDF(
+        algorithm=hashes.SHA256(), length=KEY_SIZE, salt=salt, info=_KDF_INFO
+    )
+
+    return AESGCM(kdf.derive(key))
+
+
+def _chunk_nonce(index: int, is_last: bool) -> bytes:
+    # the final chunk flag detects truncation at a chunk boundary
+    return index.to_bytes(11, "big") + (b"\x01" if is_last else b"\x00")
+
+
+def parse_key(text: str) -> bytes:
+    """
+    Decode base64 encoded key material, as from ``openssl rand -base64 32``.
+
+    Args:
+        text: Encoded key.
+
+    Returns:
+        Key bytes.
+    Raises:
+        EncryptionError: If the key is malformed or the wrong size.
+    """
+    try:
+        key = base64.b64decode(text.strip(), validate=True)
+    except binascii.Error as e:
+        raise EncryptionError("encryption key is not valid base64") from e
+    if len(key) != KEY_SIZE:
+        raise EncryptionError(
+            f"encryption key must be {KEY_SIZE} bytes, got {len(key)}"
+        )
+
+    return key
+
+
+def load_encryption_key(
+    key_file: typing.Optional[pathlib.Path],
+    key_secret: typing.Optional[str],
+    subscription: typing.Optional[str],
+) -> typing.Optional[bytes]:
+    """
+    Acquire package encryption key material from a file or a keyvault.
+
+    Args:
+        key_file: File containing the base64 encoded key.
+        key_secret: Keyvault secret containing the base64 encoded key, in the
+                    form ``<keyvault fqdn>/<secret name>``.
+        subscription: Name or GUID of subscription where keyvault is deployed.
+
+    Returns:
+        Key bytes, or None if encryption is not enabled.
+    Raises:
+        EncryptionError: If the key cannot be acquired or is malformed.
+    """
+    if key_file and key_secret:
+        raise EncryptionError("specify only one encryption key source")
+    elif key_file:
+        log.info(f"reading encryption key file, {key_file}")
+        text = key_file.read_text()
+    elif key_secret:
+        keyvault_fqdn, _, secret_name = key_secret.partition("/")
+        if not (keyvault_fqdn and secret_name and subscription):
+            raise EncryptionError(
+                "keyvault encryption key requires "
+                "<keyvault fqdn>/<secret name> and a subscription"
+            )
+        try:
+            secret_value = get_kv_secret(
+                secret_name, keyvault_fqdn, typing.cast(str, subscription)
+            )
+        except AzureKeyvaultError as e:
+            raise EncryptionError(str(e)) from e
+        if not secret_value:
+            raise EncryptionError(f"encryption key secret empty, {key_secret}")
+        text = secret_value
+    else:
+        return None
+
+    _check_available()
+    return parse_key(text)
+
+
+class EncryptingWriter(io.RawIOBase):
+    """
+    Encrypt content written to a binary file object in AES-GCM chunks.
+
+    Chunks are encrypted in parallel on a thread pool and written in order;
+    the file content is hashed as it is written so the encrypted package does
+    not need to be read back to create its hash file.
+    """
+
+    def __init__(
+        self,
+        fileobj: typing.BinaryIO,
+        key: bytes,
+        jobs: typing.Optional[int] = None,
+        chunk_size: int = CHUNK_SIZE,
+    ) -> None:
+        """
+        Construct ``EncryptingWriter`` object.
+
+        Args:
+            fileobj: Binary file object to write encrypted content to.
+            key: Master key.
+            jobs: Number of encryption threads, or None for the CPU count.
+            chunk_size: Plaintext chunk size.
+        """
+        super().__init__()
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._index = 0
+        self._jobs = jobs or os.cpu_count() or 1
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._jobs
+        )
+        self._pending: typing.Deque[concurrent.futures.Future] = (
+            collections.deque()
+        )
+        self.hash = hashlib.sha256()
+
+        _check_available()
+
+        salt = os.urandom(SALT_SIZE)
+        self._header = struct.pack(_HEADER_FORMAT, MAGIC, salt, chunk_size)
+        self._cipher = _package_cipher(key, salt)
+        self._write_out(self._header)
+
+    def writable(self) -> bool:
+        """Indicate the object supports writing."""
+        return True
+
+    def _write_out(self, data: bytes) -> None:
+        self._fileobj.write(data)
+        self.hash.update(data)
+
+    def _submit(self, chunk: bytes, is_last: bool) -> None:
+        self._pending.append(
+            self._executor.submit(
+                self._cipher.encrypt,
+                _chunk_nonce(self._index, is_last),
+                chunk,
+                self._header,
+            )
+        )
+        self._index += 1
+        # bound the memory used by chunks waiting to be written
+        while len(self._pending) > (2 * self._jobs):
+            self._write_out(self._pending.popleft().result())
+
+    def write(self, data: typing.Any) -> int:
+        """
+        Buffer content, encrypting each complete chunk.
+
+        Args:
+            data: Bytes-like content to write.
+
+        Returns:
+            Number of bytes written.
+        """
+        self._buffer += data
+        # a chunk is only submitted once more content follows it, so that
+        # the final chunk is always encrypted as the last chunk.
+        while len(self._buffer) > self._chunk_size:
+            self._submit(bytes(self._buffer[: self._chunk_size]), False)
+            del self._buffer[: self._chunk_size]
+
+        return len(data)
+
+    def finish(self) -> str:
+        """
+        Encrypt the final chunk and write all pending chunks.
+
+        Returns:
+            Hex digest of the encrypted content.
+        """
+        self._submit(bytes(self._buffer), True)
+        self._buffer.clear()
+        while self._pending:
+            self._write_out(self._pending.popleft().result())
+        self.close()
+
+        return self.hash.hexdigest()
+
+    def close(self) -> None:
+        """Stop the encryption threads, discarding any pending chunks."""
+        for x in self._pending:
+            x.cancel()
+        self._pending.clear()
+        self._executor.shutdown()
+        super().close()
+
+
+class DecryptingReader(io.RawIOBase):
+    """Decrypt and authenticate AES-GCM chunks read from a file object."""
+
+    def __init__(
+        self, fileobj: typing.Union[typing.BinaryIO, io.RawIOBase], key: bytes
+    ) -> None:
+        """
+        Construct ``DecryptingReader`` object.
+
+        Args:
+            fileobj: Binary file object of encrypted content.
+            key: Master key.
+        Raises:
+            EncryptionError: If the content is not an encrypted package.
+        """
+        _check_available()
+        super().__init__()
+        self._fileobj = fileobj
+        self._header = self._read_exact(HEADER_SIZE)
+        if len(self._header) != HEADER_SIZE:
+            raise EncryptionError("encrypted package header truncated")
+        magic, salt, chunk_size = struct.unpack(_HEADER_FORMAT, self._header)
+        if magic != MAGIC:
+            raise EncryptionError("not an encrypted backup package")
+        self._cipher = _package_cipher(key, salt)
+        self._encrypted_size = chunk_size + TAG_SIZE
+        self._index = 0
+        self._buffer = bytearray()
+        self._next = self._read_exact(self._encrypted_size)
+        self._done = False
+
+    def readable(self) -> bool:
+        """Indicate the object supports reading."""
+        return True
+
+    def _read_exact(self, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            this_data = self._fileobj.read(size - len(data))
+            if not this_data:
+                break
+            data += this_data
+
+        return bytes(data)
+
+    def _decrypt_next(self) -> None:
+        current = self._next
+        self._next = self._read_exact(self._encrypted_size)
+        is_last = not self._next
+        try:
+            self._buffer += self._cipher.decrypt(
+                _chunk_nonce(self._index, is_last), current, self._header
+            )
+        except InvalidTag as e:
+            raise EncryptionError(
+                f"encrypted package corrupt or truncated at chunk "
+                f"{self._index}, or wrong key"
+            ) from e
+        self._index += 1
+        self._done = is_last
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read decrypted content.
+
+        Args:
+            size: Maximum number of bytes to read.
+
+        Returns:
+            Bytes read.
+        Raises:
+            EncryptionError: If a chunk fails authentication.
+        """
+        while (not self._done) and ((size < 0) or (len(self._buffer) < size)):
+            self._decrypt_next()
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+
+        return data
+
+    def drain(self) -> None:
+        """
+        Authenticate any content remaining in the wrapped file object.
+
+        Raises:
+            EncryptionError: If a chunk fails authentication.
+        """
+        while not self._done:
+            self._decrypt_next()
+            self._buffer.clear()
+
+
+def encryption_options(function: typing.Callable) -> typing.Callable:
+    """Apply package encryption key options to a click command."""
+    function = click.option(
+        "--encryption-key-file",
+        default=None,
+        help="""File containing a base64 encoded 256 bit package encryption key.
+
+The backup package is encrypted with chunked AES-256-GCM if a key is
+specified.
+""",
+        type=click.Path(
+            dir_okay=False, exists=True, file_okay=True, path_type=pathlib.Path
+        ),
+    )(function)
+    function = click.option(
+        "--encryption-key-secret",
+        default=None,
+        help="""Keyvault secret containing a base64 encoded package encryption
+key.
+
+Specified in the form `<keyvault fqdn>/<secret name>`. Requires
+--azure-subscription.
+""",
+        type=str,
+    )(function)
+    function = click.option(
+        "--azure-subscription",
+        default=None,
+        help="Name or GUID of subscription where the keyvault is deployed.",
+        type=str,
+    )(function)
+
+    return function
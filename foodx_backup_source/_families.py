@@ -0,0 +1,232 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Shared object stores for families of related repositories."""
+
+import logging
+import os
+import pathlib
+import threading
+import typing
+
+import git
+import pydantic
+
+from ._bundle import bundle_key
+from .schema import ApplicationDefinition
+
+log = logging.getLogger(__name__)
+
+# family stores only take the objects of these references from each member
+FAMILY_REFSPECS = ["+refs/heads/*:{0}/heads/*", "+refs/tags/*:{0}/tags/*"]
+
+DEFAULT_FAMILY_ROOTS_FILE = "family-roots.json"
+
+
+def is_filtered(definition: ApplicationDefinition) -> bool:
+    """Path filtered definitions only snapshot part of a repository."""
+    backup = definition.configuration.backup
+    return bool(backup.include_paths or backup.exclude_paths)
+
+
+class FamilyRoots(pydantic.BaseModel):
+    """Root commits of repositories, recorded between runs for families."""
+
+    roots: typing.Dict[str, typing.List[str]] = dict()
+
+    @classmethod
+    def load(cls, roots_path: pathlib.Path) -> "FamilyRoots":
+        """
+        Load recorded root commits from file.
+
+        Args:
+            roots_path: Path to family roots file.
+
+        Returns:
+            Recorded root commits; empty if the file does not exist.
+        """
+        if roots_path.is_file():
+            log.info(f"loading family roots, {roots_path}")
+            return cls.parse_file(roots_path)
+        else:
+            return cls()
+
+    def save(self, roots_path: pathlib.Path) -> None:
+        """
+        Save recorded root commits to file, replacing it atomically.
+
+        Args:
+            roots_path: Path to family roots file.
+        """
+        log.info(f"saving family roots, {roots_path}")
+        temporary_path = roots_path.parent / f".{roots_path.name}.tmp"
+        with temporary_path.open("w") as f:
+            f.write(self.json(indent=2))
+        os.replace(temporary_path, roots_path)
+
+    def record(
+        self, definition: ApplicationDefinition, roots: typing.List[str]
+    ) -> bool:
+        """
+        Record the root commits of a repository.
+
+        Args:
+            definition: Application definition of the repository.
+            roots: Root commits.
+
+        Returns:
+            True if the recorded root commits changed.
+        """
+        key = bundle_key(definition)
+        if (not roots) or (self.roots.get(key) == roots):
+            return False
+
+        self.roots[key] = roots
+        return True
+
+
+def family_roots_path(state_path: pathlib.Path) -> pathlib.Path:
+    """
+    Locate the family roots file, alongside the bundle state file.
+
+    Args:
+        state_path: Path to bundle state file.
+
+    Returns:
+        Path to family roots file.
+    """
+    return state_path.parent / DEFAULT_FAMILY_ROOTS_FILE
+
+
+def assign_families(
+    definitions: typing.Iterable[ApplicationDefinition],
+    roots: typing.Optional[typing.Dict[str, typing.List[str]]] = None,
+) -> typing.Dict[str, str]:
+    """
+    Group repositories into object sharing families.
+
+    A family is either declared by the ``object_family`` of a definition, or
+    detected from the recorded root commits of repositories; repositories
+    that share a root commit, directly or through other repositories, are a
+    family. Path filtered definitions are excluded because a family store
+    holds complete objects, and a family of a single repository is pointless.
+
+    Args:
+        definitions: Application definitions of a snapshot run.
+        roots: Recorded root commits of repositories, if detecting families.
+
+    Returns:
+        Family names, by bundle key of the member definitions.
+    """
+    candidates = [x for x in definitions if not is_filtered(x)]
+    assigned = {
+        bundle_key(x): x.configuration.backup.object_family
+        for x in candidates
+        if x.configuration.backup.object_family
+    }
+
+    if roots:
+        # merge repositories into groups that share a root commit
+        groups: typing.List[typing.Tuple[typing.Set[str], typing.List[str]]]
+        groups = list()
+        for key in sorted({bundle_key(x) for x in candidates} - set(assigned)):
+            group_roots = set(roots.get(key, list()))
+            if not group_roots:
+                continue
+            group_keys = [key]
+            unrelated = list()
+            for other_roots, other_keys in groups:
+                if other_roots & group_roots:
+                    group_roots |= other_roots
+                    group_keys += other_keys
+                else:
+                    unrelated.append((other_roots, other_keys))
+            groups = unrelated + [(group_roots, group_keys)]
+        for group_roots, group_keys in groups:
+            for key in group_keys:
+                assigned[key] = f"roots-{min(group_roots)[:12]}"
+
+    sizes: typing.Dict[str, int] = dict()
+    for x in assigned.values():
+        sizes[x] = sizes.get(x, 0) + 1
+
+    return {x: y for x, y in assigned.items() if sizes[y] > 1}
+
+
+class ObjectFamilies:
+    """
+    Shared object stores of the repository families of a snapshot run.
+
+    Each family has a bare repository that its members fetch into, one at a
+    time, so that objects common to the family cross the network and the
+    disk only once; each member then clones with the family store as a
+    reference.
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        families: typing.Dict[str, str],
+        detect: bool = False,
+    ) -> None:
+        """
+        Construct ``ObjectFamilies`` object.
+
+        Args:
+            directory: Directory of the family stores, for the run.
+            families: Family names, by bundle key of the member definitions.
+            detect: Report the root commits of snapshots for detection.
+        """
+        self.directory = directory
+        self.families = families
+        self.detect = detect
+        self._lock = threading.Lock()
+        self._family_locks: typing.Dict[str, threading.Lock] = dict()
+        self._stores: typing.Dict[str, pathlib.Path] = dict()
+        # reference namespace of each member, by family
+        self._namespaces: typing.Dict[str, typing.Dict[str, str]] = dict()
+
+    def family(self, definition: ApplicationDefinition) -> typing.Optional[str]:
+        """Family of a definition, if any."""
+        return self.families.get(bundle_key(definition))
+
+    def lock(self, family: str) -> threading.Lock:
+        """Lock serializing the fetches of a family into its store."""
+        with self._lock:
+            return self._family_locks.setdefault(family, threading.Lock())
+
+    def store(self, family: str) -> pathlib.Path:
+        """
+        Path of a family store, initialized on first use.
+
+        Must be called with the family lock held.
+        """
+        with self._lock:
+            if family not in self._stores:
+                self._stores[family] = (
+                    self.directory / f"family-{len(self._stores)}.git"
+                )
+                self._namespaces[family] = dict()
+            store_path = self._stores[family]
+        if not store_path.is_dir():
+            log.info(f"initializing object family store, {family}")
+            git.Repo.init(store_path, bare=True).close()
+
+        return store_path
+
+    def refspecs(self, family: str, key: str) -> typing.List[str]:
+        """
+        Fetch refspecs of a family member, in its own reference namespace.
+
+        Must be called with the family lock held.
+        """
+        namespaces = self._namespaces[family]
+        namespace = namespaces.setdefault(
+            key, f"refs/members/{len(namespaces)}"
+        )
+
+        return [x.format(namespace) for x in FAMILY_REFSPECS]
@@ -0,0 +1,271 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Per-host limits on concurrent git transfers and transfer rate."""
+
+import contextlib
+import contextvars
+import datetime
+import email.utils
+import logging
+import pathlib
+import re
+import threading
+import time
+import typing
+from urllib.parse import urlparse
+
+log = logging.getLogger(__name__)
+
+# hosts that throttle without saying for how long are paused exponentially
+DEFAULT_THROTTLE_SECONDS = 1.0
+THROTTLE_LIMIT_SECONDS = 300.0
+
+# a waiting transfer checks for cancellation at this interval
+POLL_SECONDS = 0.25
+
+RETRY_AFTER_PATTERN = re.compile(
+    r"recv header:\s*retry-after:\s*(.+?)\s*$", re.IGNORECASE
+)
+
+# git reports the status, but not the headers, of a throttling response
+THROTTLED_ERROR_PATTERN = re.compile(
+    r"(returned error: 429)|(unexpected http resp 429)", re.IGNORECASE
+)
+
+
+# notified with True when a transfer of the current snapshot waits for its
+# host, and with False once it is admitted, so that the snapshot time limit
+# does not run while it is queued; threads running transfers must run in a
+# copy of the snapshot context
+transfer_queued: contextvars.ContextVar[
+    typing.Optional[typing.Callable[[bool], None]]
+] = contextvars.ContextVar("transfer_queued", default=None)
+
+
+class TransferCancelledError(Exception):
+    """A transfer was cancelled while waiting for its host."""
+
+
+class _HostState:
+    def __init__(self) -> None:
+        self.active = 0
+        # transfers don't start before this time; throttled or rate limited
+        self.resume_at = 0.0
+        self.strikes = 0
+
+
+def transfer_host(url: str) -> str:
+    """
+    Identify the host of a repository URL, for transfer governance.
+
+    Args:
+        url: Repository URL, which may include a token.
+
+    Returns:
+        Host, as ``netloc`` of the URL without credentials.
+    """
+    return urlparse(url).netloc.rpartition("@")[2]
+
+
+def directory_size(directory: pathlib.Path) -> int:
+    """Total size of the files in a directory, to measure a transfer."""
+    if not directory.is_dir():
+        return 0
+
+    return sum(x.stat().st_size for x in directory.rglob("*") if x.is_file())
+
+
+def parse_retry_after(
+    value: str, now: typing.Optional[datetime.datetime] = None
+) -> typing.Optional[float]:
+    """
+    Convert a ``Retry-After`` header value to seconds.
+
+    Args:
+        value: Header value; delay seconds or an HTTP date.
+        now: Current time, for an HTTP date.
+
+    Returns:
+        Seconds to wait, or None if the value is malformed.
+    """
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    this_now = now or datetime.datetime.now(datetime.timezone.utc)
+
+    return max(0.0, (retry_time - this_now).total_seconds())
+
+
+def read_retry_after(trace_path: pathlib.Path) -> typing.Optional[float]:
+    """
+    Find the last ``Retry-After`` response header in a git curl trace.
+
+    Args:
+        trace_path: ``GIT_TRACE_CURL`` output file.
+
+    Returns:
+        Seconds to wait, or None if no header was received.
+    """
+    retry_after: typing.Optional[float] = None
+    if trace_path.is_file():
+        with trace_path.open(errors="replace") as f:
+            for line in f:
+                match = RETRY_AFTER_PATTERN.search(line)
+                if match:
+                    retry_after = parse_retry_after(match.group(1))
+
+    return retry_after
+
+
+class TransferGovernor:
+    """
+    Govern git transfers to each host.
+
+    Transfers run in executor threads, so the governor is thread safe and
+    transfers wait for their host in the thread. Each host is limited to a
+    maximum number of concurrent transfers, is paused after a throttling
+    response for the time the host requested, and is optionally held to an
+    average transfer rate. The transfer rate can't be shaped within a git
+    process, so a host that has received data faster than the cap is paused
+    before its next transfer instead.
+    """
+
+    def __init__(
+        self,
+        max_connections: typing.Optional[int] = None,
+        bytes_per_second: typing.Optional[float] = None,
+    ) -> None:
+        """
+        Construct ``TransferGovernor`` object.
+
+        Args:
+            max_connections: Concurrent transfers per host; None is unlimited.
+            bytes_per_second: Average transfer rate per host; None is
+                              unlimited.
+        """
+        self.max_connections = max_connections
+        self.bytes_per_second = bytes_per_second
+        self._condition = threading.Condition()
+        self._hosts: typing.Dict[str, _HostState] = dict()
+
+    def _state(self, host: str) -> _HostState:
+        if host not in self._hosts:
+            self._hosts[host] = _HostState()
+
+        return self._hosts[host]
+
+    @contextlib.contextmanager
+    def transfer(
+        self,
+        host: str,
+        is_cancelled: typing.Callable[[], bool] = lambda: False,
+    ) -> typing.Iterator[None]:
+        """
+        Wait for the host to allow a transfer, then hold a connection slot.
+
+        Args:
+            host: Host, as ``netloc`` of the repository URL.
+            is_cancelled: Report whether the waiting transfer is cancelled.
+
+        Raises:
+            TransferCancelledError: If cancelled while waiting.
+        """
+        queued = transfer_queued.get()
+        waiting = False
+        with self._condition:
+            state = self._state(host)
+            while True:
+                if is_cancelled():
+                    raise TransferCancelledError(
+                        f"transfer cancelled waiting for host, {host}"
+                    )
+                wait_seconds = state.resume_at - time.monotonic()
+                if (wait_seconds <= 0) and (
+                    (not self.max_connections)
+                    or (state.active < self.max_connections)
+                ):
+                    break
+                if queued and not waiting:
+                    queued(True)
+                    waiting = True
+                self._condition.wait(
+                    min(wait_seconds, POLL_SECONDS)
+                    if wait_seconds > 0
+                    else POLL_SECONDS
+                )
+            state.active += 1
+        try:
+            if queued and waiting:
+                queued(False)
+            yield
+        finally:
+            with self._condition:
+                state.active -= 1
+                self._condition.notify_all()
+
+    def throttle(self, host: str, retry_after: typing.Optional[float]) -> None:
+        """
+        Pause new transfers to a host that has throttled a transfer.
+
+        Args:
+            host: Host, as ``netloc`` of the repository URL.
+            retry_after: Seconds requested by the host, if any.
+        """
+        with self._condition:
+            state = self._state(host)
+            if retry_after is None:
+                retry_after = min(
+                    THROTTLE_LIMIT_SECONDS,
+                    DEFAULT_THROTTLE_SECONDS * (2**state.strikes),
+                )
+            state.strikes += 1
+            log.warning(f"host throttled, pausing {retry_after:.1f}s, {host}")
+            state.resume_at = max(
+                state.resume_at, time.monotonic() + retry_after
+            )
+
+    def throttle_failed(
+        self, host: str, error_text: str, trace_path: pathlib.Path
+    ) -> None:
+        """
+        Pause a host if a failed transfer was throttled.
+
+        Args:
+            host: Host, as ``netloc`` of the repository URL.
+            error_text: Error output of the failed transfer.
+            trace_path: ``GIT_TRACE_CURL`` output file of the transfer.
+        """
+        # a 503 may also carry a retry-after
+        retry_after = read_retry_after(trace_path)
+        if (retry_after is not None) or THROTTLED_ERROR_PATTERN.search(
+            error_text
+        ):
+            self.throttle(host, retry_after)
+
+    def record(self, host: str, size: int, start_time: float) -> None:
+        """
+        Record a completed transfer, pausing the host if it exceeded its rate.
+
+        Args:
+            host: Host, as ``netloc`` of the repository URL.
+            size: Bytes transferred.
+            start_time: ``time.monotonic`` start time of the transfer.
+        """
+        with self._condition:
+            state = self._state(host)
+            state.strikes = 0
+            if self.bytes_per_second:
+                # the earliest time the transfer would finish at the cap
+                state.resume_at = max(state.resume_at, start_time) + (
+                    size / self.bytes_per_second
+                )
+            self._condition.notify_all()
@@ -8,12 +8,64 @@
 """Managing generation of hashes of archive files."""
 
 import hashlib
+import io
 import logging
 import pathlib
+import typing
 
 log = logging.getLogger(__name__)
 
 
+class HashMismatchError(Exception):
+    """A file hash does not match its recorded hash."""
+
+
+class HashingReader(io.RawIOBase):
+    """Wrap a binary file object, hashing content as it is read."""
+
+    def __init__(self, fileobj: typing.BinaryIO) -> None:
+        """
+        Construct ``HashingReader`` object.
+
+        Args:
+            fileobj: Binary file object to be read.
+        """
+        super().__init__()
+        self._fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def readable(self) -> bool:
+        """Indicate the object supports reading."""
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read from the wrapped file object, updating the hash.
+
+        Args:
+            size: Maximum number of bytes to read.
+
+        Returns:
+            Bytes read.
+        """
+        data = self._fileobj.read(size)
+        self.hash.update(data)
+
+        return data
+
+    def drain(self) -> str:
+        """
+        Read any content remaining in the wrapped file object.
+
+        Returns:
+            Hex digest of all the content read.
+        """
+        while self.read(0x40000):
+            pass
+
+        return self.hash.hexdigest()
+
+
 def create_file_hash(file_path: pathlib.Path) -> str:
     """
     Create a hash of a file.
@@ -35,23 +87,92 @@ def create_file_hash(file_path: pathlib.Path) -> str:
     return this_hash.hexdigest()
 
 
-def create_hash_file(reference_file_path: pathlib.Path) -> pathlib.Path:
+def format_hash_content(hash_hexdigest: str, file_name: str) -> str:
     """
-    Record file hash in a file.
+    Format a file hash as ``sha256sum`` text.
+
+    Args:
+        hash_hexdigest: Hash to be recorded.
+        file_name: Name of the file that was hashed.
+
+    Returns:
+        Hash file content.
+    """
+    return f"{hash_hexdigest}  {file_name}"
+
+
+def write_hash_file(
+    hash_hexdigest: str, reference_file_path: pathlib.Path
+) -> pathlib.Path:
+    """
+    Record a file hash in a file.
 
     Args:
         hash_hexdigest: Hash to be recorded.
         reference_file_path: Path to file that was hashed.
+
+    Returns:
+        Path of hash file created.
     """
     # co-locate the hash file with the reference file.
-    hash_hexdigest = create_file_hash(reference_file_path)
     hash_file = (
         reference_file_path.parent / f"{reference_file_path.name}.sha256"
     )
 
-    hash_file_content = f"{hash_hexdigest}  {reference_file_path.name}"
+    hash_file_content = format_hash_content(
+        hash_hexdigest, reference_file_path.name
+    )
     log.info(f"creating hash file, {hash_file} ({hash_file_content} )")
     with hash_file.open("w") as h:
         h.write(hash_file_content)
 
     return hash_file
+
+
+def create_hash_file(reference_file_path: pathlib.Path) -> pathlib.Path:
+    """
+    Record file hash in a file.
+
+    Args:
+        reference_file_path: Path to file to be hashed.
+
+    Returns:
+        Path of hash file created.
+    """
+    hash_hexdigest = create_file_hash(reference_file_path)
+    hash_file = write_hash_file(hash_hexdigest, reference_file_path)
+
+    return hash_file
+
+
+def parse_hash_content(content: str) -> str:
+    """
+    Extract the hex digest from ``sha256sum`` formatted text.
+
+    Args:
+        content: Hash file content.
+
+    Returns:
+        Hex digest recorded in the content.
+    Raises:
+        HashMismatchError: If the content is not a valid hash record.
+    """
+    tokens = content.split()
+    if (not tokens) or (len(tokens[0]) != 64):
+        raise HashMismatchError(f"malformed hash content, {content}")
+
+    return tokens[0].lower()
+
+
+def read_hash_file(hash_file_path: pathlib.Path) -> str:
+    """
+    Read the hex digest recorded in a hash file.
+
+    Args:
+        hash_file_path: Path of ``sha256sum`` formatted file.
+
+    Returns:
+        Hex digest recorded in the file.
+    """
+    with hash_file_path.open("r") as h:
+        return parse_hash_content(h.read())
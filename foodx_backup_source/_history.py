@@ -0,0 +1,129 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Snapshot history of repositories, recorded between runs for planning."""
+
+import logging
+import os
+import pathlib
+import typing
+
+import pydantic
+
+from ._bundle import bundle_key
+from ._snapshot import SnapshotResult
+from .schema import ApplicationDefinition
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_FILE = "snapshot-history.json"
+
+
+class SnapshotHistory(pydantic.BaseModel):
+    """Measurements of the last snapshot of a repository, for planning."""
+
+    sha: str
+    transfer_bytes: int
+    clone_bytes: int
+    archive_bytes: int
+    clone_seconds: float
+    archive_seconds: float
+
+
+class PlanHistory(pydantic.BaseModel):
+    """Last snapshot of repositories, recorded between backup runs."""
+
+    snapshots: typing.Dict[str, SnapshotHistory] = dict()
+
+    @classmethod
+    def load(cls, history_path: pathlib.Path) -> "PlanHistory":
+        """
+        Load snapshot history from file.
+
+        Args:
+            history_path: Path to history file.
+
+        Returns:
+            Recorded snapshot history; empty if the file does not exist.
+        """
+        if history_path.is_file():
+            log.info(f"loading snapshot history, {history_path}")
+            return cls.parse_file(history_path)
+        else:
+            return cls()
+
+    def save(self, history_path: pathlib.Path) -> None:
+        """
+        Save snapshot history to file, replacing it atomically.
+
+        Args:
+            history_path: Path to history file.
+        """
+        log.info(f"saving snapshot history, {history_path}")
+        temporary_path = history_path.parent / f".{history_path.name}.tmp"
+        with temporary_path.open("w") as f:
+            f.write(self.json(indent=2))
+        os.replace(temporary_path, history_path)
+
+    def get(
+        self, definition: ApplicationDefinition
+    ) -> typing.Optional[SnapshotHistory]:
+        """
+        Look up the last snapshot of a repository.
+
+        Args:
+            definition: Application definition of the repository.
+
+        Returns:
+            Measurements of the last snapshot, if any.
+        """
+        return self.snapshots.get(bundle_key(definition))
+
+    def record(
+        self,
+        snapshots: typing.Iterable[
+            typing.Tuple[ApplicationDefinition, SnapshotResult]
+        ],
+    ) -> bool:
+        """
+        Record the measurements of snapshots.
+
+        Snapshots without clone measurements are not recorded.
+
+        Args:
+            snapshots: Application definitions and their snapshots.
+
+        Returns:
+            True if the history changed.
+        """
+        recorded = False
+        for definition, result in snapshots:
+            if result.clone_bytes:
+                self.snapshots[bundle_key(definition)] = SnapshotHistory(
+                    sha=result.sha,
+                    transfer_bytes=result.transfer_bytes,
+                    clone_bytes=result.clone_bytes,
+                    archive_bytes=result.archive_bytes,
+                    clone_seconds=result.timings.clone_seconds,
+                    archive_seconds=result.timings.archive_seconds,
+                )
+                recorded = True
+
+        return recorded
+
+
+def history_path(state_path: pathlib.Path) -> pathlib.Path:
+    """
+    Locate the snapshot history file, alongside the bundle state file.
+
+    Args:
+        state_path: Path to bundle state file.
+
+    Returns:
+        Path to history file.
+    """
+    return state_path.parent / DEFAULT_HISTORY_FILE
@@ -8,59 +8,132 @@
 """Primary execution path."""
 
 import asyncio
-import datetime
+import concurrent.futures
+import contextlib
 import io
 import logging
 import pathlib
-import tarfile
+import sys
 import tempfile
 import typing
 
 import click
 
+from ._backend import GitBackendName
+from ._bundle import DEFAULT_BUNDLE_STATE_FILE, BundleState
+from ._catalog import CatalogError, catalog_option, catalog_package
+from ._diff import DiffError, read_base_package
+from ._encrypt import EncryptionError, encryption_options, load_encryption_key
+from ._families import (
+    DEFAULT_FAMILY_ROOTS_FILE,
+    FamilyRoots,
+    family_roots_path,
+)
 from ._file_io import (
     BackupDefinitions,
     PathSet,
     discover_backup_definitions,
     load_backup_definitions,
 )
-from ._hash import create_hash_file
-from ._snapshot import do_snapshot
+from ._history import DEFAULT_HISTORY_FILE, PlanHistory, history_path
+from ._package import PackageFormat, PackageWriter
+from ._plan import BackupPlan, format_plan, plan_backup
+from ._profile import profile_option, profile_phase, profile_run
+from ._run import (
+    GitReferences,
+    apply_user_refs,
+    construct_snapshot_options,
+    record_bundles,
+    record_history,
+    record_roots,
+)
+from ._snapshot import (
+    ExecutorMode,
+    SnapshotError,
+    SnapshotOptions,
+    SnapshotResult,
+    construct_spool,
+    iter_snapshots,
+)
+from ._spool import DEFAULT_SPOOL_BUDGET_BYTES
+from ._store import ObjectStore, StoreError
+from ._tree_hash import TREE_HASH_SUFFIX
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 DEFAULT_OUTPUT_PATH = pathlib.Path(".")
 
-GitReferences = typing.Dict[str, str]
+# completed snapshots waiting for the package writer
+PACKAGING_QUEUE_SIZE = 2
 
 
-def _strip_paths(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
-    """Ensure source filesystem absolute paths are not reflected in tar file."""
-    original_path = pathlib.Path(tarinfo.name)
-    tarinfo.name = f"{original_path.name}"
+async def _load_definitions(
+    project_directory: pathlib.Path, git_refs: GitReferences
+) -> BackupDefinitions:
+    files: PathSet = discover_backup_definitions(project_directory)
+    data: BackupDefinitions = await load_backup_definitions(files)
 
-    return tarinfo
+    data = apply_user_refs(data, git_refs)
 
+    return data
 
-def _isoformat_now() -> str:
-    """Generate an iso format date for tar file naming."""
-    return datetime.datetime.utcnow().isoformat()[:-3] + "Z"
 
+async def _append_snapshots(
+    snapshots: typing.AsyncGenerator[SnapshotResult, None],
+    writer: PackageWriter,
+) -> typing.List[SnapshotResult]:
+    """
+    Append snapshots to a package as they complete, on a single writer.
 
-def _apply_user_refs(
-    data: BackupDefinitions, git_refs: GitReferences
-) -> BackupDefinitions:
-    if git_refs:
-        names = git_refs.keys()
-        for x in data:
-            if x.name in names:
-                log.info(
-                    f"applying user git reference, {x.name}, {git_refs[x.name]}"
-                )
-                x.configuration.release.ref = git_refs[x.name]
+    Snapshots wait in a bounded queue while the writer is behind, with their
+    archives held in the spool, within its budget, or on disk.
 
-    return data
+    Returns:
+        Snapshot results in completion order.
+    """
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[typing.Optional[SnapshotResult]]" = asyncio.Queue(
+        maxsize=PACKAGING_QUEUE_SIZE
+    )
+    results: typing.List[SnapshotResult] = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+
+        async def _write() -> None:
+            while True:
+                result = await queue.get()
+                if result is None:
+                    return
+                await loop.run_in_executor(executor, writer.append, result)
+
+        writer_task = asyncio.ensure_future(_write())
+
+        async def _put(result: typing.Optional[SnapshotResult]) -> None:
+            put_task = asyncio.ensure_future(queue.put(result))
+            await asyncio.wait(
+                {put_task, writer_task}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not put_task.done():
+                put_task.cancel()
+                # the writer failed
+                writer_task.result()
+
+        try:
+            async for x in snapshots:
+                results.append(x)
+                await _put(x)
+            await _put(None)
+            await writer_task
+        finally:
+            # snapshots still running are cancelled if the writer failed
+            await snapshots.aclose()
+            if not writer_task.done():
+                # an append in progress finishes as the executor shuts down
+                writer_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await writer_task
+
+    return results
 
 
 async def _launch_packaging(
@@ -69,31 +142,117 @@ async def _launch_packaging(
     output_directory: pathlib.Path,
     token: typing.Optional[str],
     git_refs: GitReferences,
+    options: SnapshotOptions,
+    bundle_state_path: typing.Optional[pathlib.Path] = None,
+    package_format: PackageFormat = "tar.gz",
+    encryption_key: typing.Optional[bytes] = None,
+    tree_hash: bool = False,
+    store_directory: typing.Optional[pathlib.Path] = None,
+    catalog_path: typing.Optional[pathlib.Path] = None,
+    base_path: typing.Optional[pathlib.Path] = None,
 ) -> typing.List[pathlib.Path]:
-    files: PathSet = discover_backup_definitions(project_directory)
-    data: BackupDefinitions = await load_backup_definitions(files)
-
-    data = _apply_user_refs(data, git_refs)
+    if store_directory and encryption_key:
+        raise StoreError("encryption of store objects is not supported")
+    if store_directory and catalog_path:
+        raise StoreError("catalog of store snapshots is not supported")
+    if store_directory and base_path:
+        raise StoreError("differential store snapshots are not supported")
+    # an unreadable base package fails the run before any cloning
+    base = read_base_package(base_path, encryption_key) if base_path else None
+    with profile_phase("load-definitions"):
+        data = await _load_definitions(project_directory, git_refs)
+    state_path = bundle_state_path or (
+        output_directory / DEFAULT_BUNDLE_STATE_FILE
+    )
+    bundle_state = BundleState.load(state_path)
+    family_roots = FamilyRoots.load(family_roots_path(state_path))
+    options = options.copy(
+        update={
+            "bundle_tips": bundle_state.tips(),
+            "repository_roots": family_roots.roots,
+        }
+    )
 
-    with tempfile.TemporaryDirectory() as d:
+    # package members in definition order regardless of completion order
+    definition_order = {x.name: i for i, x in enumerate(data)}
+    with tempfile.TemporaryDirectory() as d, (
+        construct_spool(options) or contextlib.nullcontext()
+    ) as spool:
         archive_directory = pathlib.Path(d)
-
-        snapshot_packages = await asyncio.gather(
-            *[do_snapshot(x, archive_directory, token) for x in data]
+        snapshots = iter_snapshots(
+            data, archive_directory, token, options, spool=spool
         )
 
-        now = _isoformat_now()
-        tar_path = output_directory / f"{project_name}-{now}.tar.gz"
+        if store_directory:
+            snapshot_results = [x async for x in snapshots]
+            snapshot_results.sort(key=lambda x: definition_order[x.name])
+            with profile_phase(f"store-{project_name}"):
+                if spool:
+                    # the store reads archives from disk
+                    spool.spill(
+                        y for x in snapshot_results for y in x.archive_files()
+                    )
+                created_files = ObjectStore(store_directory).ingest(
+                    project_name, snapshot_results
+                )
+        else:
+            with PackageWriter(
+                project_name,
+                output_directory,
+                package_format,
+                encryption_key,
+                tree_hash,
+                spool,
+                base,
+                # the catalog reads archives once the package is written
+                release_archives=not catalog_path,
+            ) as writer:
+                snapshot_results = await _append_snapshots(snapshots, writer)
+                snapshot_results.sort(key=lambda x: definition_order[x.name])
+                created_files = writer.finish(snapshot_results)
+            if catalog_path:
+                try:
+                    with profile_phase(f"catalog-{project_name}"):
+                        # archives are read before they are cleaned up
+                        catalog_package(
+                            catalog_path,
+                            created_files[0],
+                            snapshot_results,
+                            encryption_key,
+                            spool,
+                            writer.manifest,
+                        )
+                except CatalogError as e:
+                    # the package is intact, so the backup still succeeds
+                    log.error(f"package not catalogued, {str(e)}")
+
+    # bundle chains only advance once the bundles are safely packaged
+    if record_bundles(bundle_state, zip(data, snapshot_results)):
+        bundle_state.save(state_path)
+    record_roots(family_roots, state_path, zip(data, snapshot_results))
+    record_history(bundle_state_path, state_path, zip(data, snapshot_results))
 
-        log.info(f"saving tar file package, {tar_path}")
-        with tarfile.open(tar_path, mode="w:gz") as f:
-            for package in snapshot_packages:
-                f.add(str(package), filter=_strip_paths)
-                f.add((str(package) + ".sha256"), filter=_strip_paths)
+    return created_files
 
-        hash_path = create_hash_file(tar_path)
 
-        return [tar_path, hash_path]
+async def _launch_planning(
+    project_directory: pathlib.Path,
+    output_directory: pathlib.Path,
+    token: typing.Optional[str],
+    git_refs: GitReferences,
+    options: SnapshotOptions,
+    bundle_state_path: typing.Optional[pathlib.Path] = None,
+    store_directory: typing.Optional[pathlib.Path] = None,
+) -> BackupPlan:
+    data = await _load_definitions(project_directory, git_refs)
+    state_path = bundle_state_path or (
+        output_directory / DEFAULT_BUNDLE_STATE_FILE
+    )
+    history = PlanHistory.load(history_path(state_path))
+
+    return await plan_backup(
+        data, token, options, history, package=not store_directory
+    )
 
 
 def _process_gitref_options(
@@ -117,6 +276,15 @@ def main(
     output_dir: pathlib.Path,
     git_ref: typing.Optional[typing.List[str]],
     token_value: typing.Optional[str],
+    options: typing.Optional[SnapshotOptions] = None,
+    bundle_state: typing.Optional[pathlib.Path] = None,
+    profile: typing.Optional[pathlib.Path] = None,
+    package_format: PackageFormat = "tar.gz",
+    encryption_key: typing.Optional[bytes] = None,
+    tree_hash: bool = False,
+    store: typing.Optional[pathlib.Path] = None,
+    catalog: typing.Optional[pathlib.Path] = None,
+    differential_against: typing.Optional[pathlib.Path] = None,
 ) -> typing.List[pathlib.Path]:
     """
     Package repositories for archiving.
@@ -127,22 +295,307 @@ def main(
         output_dir: Directory to output package files.
         git_ref: User overrides of application git references.
         token_value:
+        options: Repository snapshot execution controls.
+        bundle_state: Bundle chain state file; defaults to
+                      ``bundle-state.json`` in the output directory.
+        profile: Directory to write profiling results, if any.
+        package_format: Package file format.
+        encryption_key: Key to encrypt packages with, if any.
+        tree_hash: Also write a chunked tree hash file of each package.
+        store: Snapshot store directory to write instead of packages, if
+               any.
+        catalog: Catalog file to record packages in, if any.
+        differential_against: Earlier package, or its manifest, to package
+                              only the changed archives against, if any.
 
     Returns:
         List of files created.
+    Raises:
+        DiffError: If the base package of a differential package can't be
+                   read.
+        SnapshotError: If any repository snapshot failed or timed out.
+        StoreError: If the snapshots can't be stored.
     """
     processed_refs = _process_gitref_options(git_ref)
-    created_files = asyncio.run(
-        _launch_packaging(
-            project_name,
+    with profile_run(profile) as profiler:
+        # debug mode reports slow callbacks that block the event loop
+        created_files = asyncio.run(
+            _launch_packaging(
+                project_name,
+                project_directory,
+                output_dir,
+                token_value,
+                processed_refs,
+                options or SnapshotOptions(),
+                bundle_state,
+                package_format,
+                encryption_key,
+                tree_hash,
+                store,
+                catalog,
+                differential_against,
+            ),
+            debug=bool(profiler),
+        )
+
+    return created_files
+
+
+def plan(
+    project_directory: pathlib.Path,
+    output_dir: pathlib.Path,
+    git_ref: typing.Optional[typing.List[str]],
+    token_value: typing.Optional[str],
+    options: typing.Optional[SnapshotOptions] = None,
+    bundle_state: typing.Optional[pathlib.Path] = None,
+    store: typing.Optional[pathlib.Path] = None,
+) -> BackupPlan:
+    """
+    Estimate the resources of packaging repositories, without cloning.
+
+    Args:
+        project_directory: Directory
+        output_dir: Directory to output package files.
+        git_ref: User overrides of application git references.
+        token_value:
+        options: Repository snapshot execution controls.
+        bundle_state: Bundle chain state file, recording previous runs;
+                      defaults to ``bundle-state.json`` in the output
+                      directory.
+        store: Snapshot store directory to write instead of packages, if
+               any.
+
+    Returns:
+        Estimated resources of the run.
+    """
+    processed_refs = _process_gitref_options(git_ref)
+    this_plan = asyncio.run(
+        _launch_planning(
             project_directory,
             output_dir,
             token_value,
             processed_refs,
+            options or SnapshotOptions(),
+            bundle_state,
+            store,
         )
     )
 
-    return created_files
+    return this_plan
+
+
+def package_format_option(function: typing.Callable) -> typing.Callable:
+    """Apply the package format option to a click command."""
+    function = click.option(
+        "--package-format",
+        default="tar.gz",
+        help="""Format of the package file.
+
+The package members are already compressed, so an unencrypted "tar" package
+is written without passing the member data through Python.
+""",
+        show_default=True,
+        type=click.Choice(["tar.gz", "tar"]),
+    )(function)
+
+    return function
+
+
+def tree_hash_option(function: typing.Callable) -> typing.Callable:
+    """Apply the package tree hash option to a click command."""
+    function = click.option(
+        "--tree-hash",
+        default=False,
+        help=f"""Also write a chunked tree hash (`{TREE_HASH_SUFFIX}`) of each
+package.
+
+The package chunks can then be verified in parallel, spot checked, and any
+corruption located to a chunk.
+""",
+        is_flag=True,
+    )(function)
+
+    return function
+
+
+def store_option(function: typing.Callable) -> typing.Callable:
+    """Apply the snapshot store output option to a click command."""
+    function = click.option(
+        "--store",
+        default=None,
+        help="""Store snapshots in a content addressed store directory instead
+of writing packages.
+
+Files unchanged between runs are stored once. Use `store-source` to
+materialize packages from the store and to collect garbage.
+""",
+        type=click.Path(dir_okay=True, file_okay=False, path_type=pathlib.Path),
+    )(function)
+
+    return function
+
+
+def differential_option(function: typing.Callable) -> typing.Callable:
+    """Apply the differential package option to a click command."""
+    function = click.option(
+        "--differential-against",
+        default=None,
+        help="""Package only the archives changed since an earlier package.
+
+Specify the earlier package, or its extracted `manifest.json`. Unchanged
+archives are referenced in the package holding them, which `restore-source`
+expects alongside the differential package.
+""",
+        type=click.Path(
+            dir_okay=False, exists=True, file_okay=True, path_type=pathlib.Path
+        ),
+    )(function)
+
+    return function
+
+
+def bundle_state_option(function: typing.Callable) -> typing.Callable:
+    """Apply the bundle chain state file option to a click command."""
+    function = click.option(
+        "--bundle-state",
+        default=None,
+        help=f"""State file recording the bundle chain of each "bundle" format
+repository.
+
+Incremental bundles only contain commits since the recorded chain tip.
+Defaults to `{DEFAULT_BUNDLE_STATE_FILE}` in the output directory, where it is
+only saved once bundles are in use.
+
+The root commits of repositories are recorded for `--detect-families` in
+`{DEFAULT_FAMILY_ROOTS_FILE}` alongside the state file. The last snapshot of
+each repository is recorded for `--plan` in `{DEFAULT_HISTORY_FILE}`
+alongside the state file, once that file exists or the state file is given.
+""",
+        type=click.Path(dir_okay=False, file_okay=True, path_type=pathlib.Path),
+    )(function)
+
+    return function
+
+
+def spool_options(function: typing.Callable) -> typing.Callable:
+    """Apply the in-memory archive spool options to a click command."""
+    function = click.option(
+        "--spool-budget",
+        default=DEFAULT_SPOOL_BUDGET_BYTES,
+        help="""Memory limit in bytes for all the archives held in memory.
+
+Archives that would exceed the limit are written to disk.
+""",
+        show_default=True,
+        type=click.IntRange(min=1),
+    )(function)
+    function = click.option(
+        "--spool-size",
+        default=None,
+        help="""Hold archives up to this size in bytes in memory until they are
+packaged, rather than writing them to disk and reading them back.
+
+Archives that grow larger are written to disk. Only archives of the default
+git backend, created without the "process" executor, are held in memory.
+""",
+        type=click.IntRange(min=1),
+    )(function)
+
+    return function
+
+
+def snapshot_options(function: typing.Callable) -> typing.Callable:
+    """Apply repository snapshot execution options to a click command."""
+    function = click.option(
+        "--detect-families",
+        default=False,
+        help="""Share the objects of repositories with a common root commit.
+
+Repositories in the same family fetch into one object store in each run, so
+that common objects are only transferred once. Root commits are recorded in
+the bundle state file, so families are detected from the second run. Families
+can also be declared with `object_family` in the dependency files.
+""",
+        is_flag=True,
+    )(function)
+    function = click.option(
+        "--git-backend",
+        default="gitpython",
+        help="""Git implementation used to fetch and archive repositories.
+
+The `subprocess` and `dulwich` backends only support unfiltered archive
+snapshots. The `dulwich` backend requires the optional `dulwich` package.
+""",
+        show_default=True,
+        type=click.Choice(typing.get_args(GitBackendName)),
+    )(function)
+    function = click.option(
+        "--host-rate",
+        default=None,
+        help="""Average transfer rate limit in bytes per second for each git
+host.
+
+A host that has transferred faster than the limit is paused before its next
+transfer.
+""",
+        type=click.FloatRange(min=0, min_open=True),
+    )(function)
+    function = click.option(
+        "--host-connections",
+        default=None,
+        help="""Maximum number of concurrent transfers from each git host.
+
+Transfers from a host that throttles requests (HTTP 429) are also paused for
+the time it requests.
+""",
+        type=click.IntRange(min=1),
+    )(function)
+    function = click.option(
+        "--jobs",
+        default=None,
+        help="""Number of process pool workers for the "process" executor.
+
+Defaults to the CPU count.
+""",
+        type=click.IntRange(min=1),
+    )(function)
+    function = click.option(
+        "--executor",
+        default=SnapshotOptions().executor,
+        help="""Execution mode of the archive, compress and hash work.
+
+The "process" executor runs the work for each repository in a process pool so
+that it is not limited to one core; network fetches always run on threads.
+""",
+        show_default=True,
+        type=click.Choice(["thread", "process"]),
+    )(function)
+    function = click.option(
+        "--deadline",
+        default=None,
+        help="""Time limit in seconds for all repository snapshots.
+
+Snapshots still in progress at the deadline are cancelled and reported as
+timed out.
+""",
+        type=click.FloatRange(min=0, min_open=True),
+    )(function)
+    function = click.option(
+        "--retries",
+        default=SnapshotOptions().retries,
+        help="""Number of retries of a repository snapshot after a transient git
+transport failure.""",
+        show_default=True,
+        type=click.IntRange(min=0),
+    )(function)
+    function = click.option(
+        "--timeout",
+        default=None,
+        help="Time limit in seconds for each repository snapshot.",
+        type=click.FloatRange(min=0, min_open=True),
+    )(function)
+
+    return function
 
 
 @click.command()
@@ -182,12 +635,57 @@ backup.
 """,
     type=click.File(mode="r"),
 )
+@click.option(
+    "--plan",
+    "plan_only",
+    default=False,
+    help="""Estimate the transfer, disk usage and time of the backup, without
+cloning.
+
+References are resolved on the repository servers. Repository sizes are taken
+from previous runs recorded in the snapshot history, otherwise from the git
+host where it reports them. Exits with an error if a reference is not found.
+""",
+    is_flag=True,
+)
+@encryption_options
+@differential_option
+@catalog_option
+@store_option
+@tree_hash_option
+@package_format_option
+@bundle_state_option
+@spool_options
+@snapshot_options
+@profile_option
 def click_entry(
     project_name: str,
     project_directory: pathlib.Path,
     output_dir: pathlib.Path,
     git_ref: typing.Optional[typing.List[str]],
     token_file: typing.Optional[io.TextIOBase],
+    plan_only: bool,
+    timeout: typing.Optional[float],
+    retries: int,
+    deadline: typing.Optional[float],
+    executor: ExecutorMode,
+    jobs: typing.Optional[int],
+    host_connections: typing.Optional[int],
+    host_rate: typing.Optional[float],
+    git_backend: GitBackendName,
+    detect_families: bool,
+    spool_size: typing.Optional[int],
+    spool_budget: int,
+    bundle_state: typing.Optional[pathlib.Path],
+    profile: typing.Optional[pathlib.Path],
+    package_format: PackageFormat,
+    tree_hash: bool,
+    store: typing.Optional[pathlib.Path],
+    catalog: typing.Optional[pathlib.Path],
+    differential_against: typing.Optional[pathlib.Path],
+    encryption_key_file: typing.Optional[pathlib.Path],
+    encryption_key_secret: typing.Optional[str],
+    azure_subscription: typing.Optional[str],
 ) -> None:
     """
     Package repositories for archiving.
@@ -202,6 +700,56 @@ def click_entry(
         if token_file:
             token_value = token_file.read().strip()
 
-        main(project_name, project_directory, output_dir, git_ref, token_value)
+        encryption_key = load_encryption_key(
+            encryption_key_file, encryption_key_secret, azure_subscription
+        )
+        options = construct_snapshot_options(
+            timeout,
+            retries,
+            deadline,
+            executor,
+            jobs,
+            host_connections,
+            host_rate,
+            git_backend,
+            detect_families,
+            spool_size,
+            spool_budget,
+        )
+        if plan_only:
+            this_plan = plan(
+                project_directory,
+                output_dir,
+                git_ref,
+                token_value,
+                options,
+                bundle_state,
+                store,
+            )
+            for line in format_plan(this_plan, options):
+                click.echo(line)
+            if not all(x.resolved for x in this_plan.repositories):
+                sys.exit(1)
+            return
+
+        main(
+            project_name,
+            project_directory,
+            output_dir,
+            git_ref,
+            token_value,
+            options,
+            bundle_state,
+            profile,
+            package_format,
+            encryption_key,
+            tree_hash,
+            store,
+            catalog,
+            differential_against,
+        )
+    except (DiffError, EncryptionError, SnapshotError, StoreError) as e:
+        click.echo(f"Backup failed, {str(e)}", err=True)
+        sys.exit(1)
     except KeyboardInterrupt:
         click.echo("User aborted execution. Exiting.")
@@ -0,0 +1,757 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Packaging of repository snapshots into a backup package."""
+
+import contextlib
+import datetime
+import hashlib
+import io
+import logging
+import mmap
+import os
+import pathlib
+import stat
+import tarfile
+import tempfile
+import time
+import typing
+
+import pydantic
+
+from ._encrypt import ENCRYPTED_SUFFIX, EncryptingWriter
+from ._hash import write_hash_file
+from ._profile import profile_phase
+from ._snapshot import SnapshotResult
+from ._spool import ArchiveSpool
+from ._tree_hash import TreeHasher, write_tree_hash_file
+from .schema import BackupFormat
+
+log = logging.getLogger(__name__)
+
+SnapshotResults = typing.List[SnapshotResult]
+
+# "tar" is an uncompressed package of the already compressed members
+PackageFormat = typing.Literal["tar.gz", "tar"]
+
+COPY_CHUNK_SIZE = 0x1000000
+
+# last member of a package, so a package can be written as its snapshots
+# complete
+PACKAGE_MANIFEST_NAME = "manifest.json"
+
+# suffix of a package file until it is finished
+PARTIAL_SUFFIX = ".partial"
+
+
+class ManifestArchive(pydantic.BaseModel):
+    """An archive, or bundle, of a repository reference in a package."""
+
+    file_name: str
+    ref: str
+    sha: str
+    sha256: str
+    # package holding an archive unchanged since an earlier package, if not
+    # this package
+    package: typing.Optional[str] = None
+
+
+class ManifestRepository(pydantic.BaseModel):
+    """A repository snapshot in a package."""
+
+    name: str
+    format: BackupFormat = "archive"
+    # commit that an incremental bundle depends on
+    prerequisite: typing.Optional[str] = None
+    # archive of the release reference first
+    archives: typing.List[ManifestArchive]
+
+
+class PackageManifest(pydantic.BaseModel):
+    """Repository snapshots of a package, in package order."""
+
+    project_name: str
+    created: str
+    repositories: typing.List[ManifestRepository]
+    # file name of the package, so a manifest can stand in for its package
+    package_name: typing.Optional[str] = None
+    # package that a differential package was packaged against
+    base: typing.Optional[str] = None
+
+
+class BasePackage(pydantic.BaseModel):
+    """An earlier package that a differential package references."""
+
+    name: str
+    manifest: PackageManifest
+
+
+def package_manifest(
+    project_name: str,
+    created: str,
+    snapshot_results: SnapshotResults,
+    package_name: typing.Optional[str] = None,
+) -> PackageManifest:
+    """
+    Describe the repository snapshots of a package.
+
+    Args:
+        project_name: Name of project.
+        created: Package creation time, in ISO format.
+        snapshot_results: Repository snapshots in package order.
+        package_name: File name of the package, if known.
+
+    Returns:
+        Package manifest.
+    """
+    return PackageManifest(
+        project_name=project_name,
+        created=created,
+        package_name=package_name,
+        repositories=[
+            ManifestRepository(
+                name=x.name,
+                format=x.format,
+                prerequisite=x.prerequisite,
+                archives=[
+                    ManifestArchive(
+                        file_name=x.archive_path.name,
+                        ref=x.ref,
+                        sha=x.sha,
+                        sha256=x.sha256,
+                    )
+                ]
+                + [
+                    ManifestArchive(
+                        file_name=y.archive_path.name,
+                        ref=y.ref,
+                        sha=y.sha,
+                        sha256=y.sha256,
+                    )
+                    for y in x.ref_archives
+                ],
+            )
+            for x in snapshot_results
+        ],
+    )
+
+
+BaseArchives = typing.Dict[typing.Tuple[str, str], ManifestArchive]
+
+
+def _base_archives(base: BasePackage) -> BaseArchives:
+    """Archives of a base package, by repository and reference."""
+    return {
+        (x.name, y.ref): y
+        for x in base.manifest.repositories
+        for y in x.archives
+    }
+
+
+def _unchanged_archive(
+    base_archives: BaseArchives, name: str, ref: str, sha: str, sha256: str
+) -> typing.Optional[ManifestArchive]:
+    """Base archive of the same commit and content, if any."""
+    base_archive = base_archives.get((name, ref))
+    if base_archive and (
+        (base_archive.sha, base_archive.sha256) == (sha, sha256)
+    ):
+        return base_archive
+
+    return None
+
+
+def differential_manifest(
+    manifest: PackageManifest, base: BasePackage
+) -> PackageManifest:
+    """
+    Reference the archives unchanged since a base package, in a manifest.
+
+    An archive is unchanged if the base package has an archive of the same
+    repository reference with the same commit and content hash. Archives the
+    base package itself references are referenced in their own package, so
+    restoring a differential package only needs the packages it references
+    directly.
+
+    Args:
+        manifest: Manifest of all the snapshots of a package.
+        base: Base package.
+
+    Returns:
+        Manifest of the differential package.
+    """
+    base_archives = _base_archives(base)
+    differential = manifest.copy(deep=True)
+    differential.base = base.name
+    for x in differential.repositories:
+        for i, y in enumerate(x.archives):
+            base_archive = _unchanged_archive(
+                base_archives, x.name, y.ref, y.sha, y.sha256
+            )
+            if base_archive:
+                x.archives[i] = base_archive.copy(
+                    update={"package": base_archive.package or base.name}
+                )
+
+    return differential
+
+
+def write_manifest_files(
+    manifest: PackageManifest, directory: pathlib.Path
+) -> typing.List[pathlib.Path]:
+    """
+    Write a package manifest, and its hash file, for packaging.
+
+    Args:
+        manifest: Package manifest.
+        directory: Directory to write the files.
+
+    Returns:
+        Paths of the manifest file and its hash file.
+    """
+    manifest_path = directory / PACKAGE_MANIFEST_NAME
+    content = manifest.json(indent=2).encode()
+    manifest_path.write_bytes(content)
+    hash_path = write_hash_file(
+        hashlib.sha256(content).hexdigest(), manifest_path
+    )
+
+    return [manifest_path, hash_path]
+
+
+def _strip_paths(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+    """Ensure source filesystem absolute paths are not reflected in tar file."""
+    original_path = pathlib.Path(tarinfo.name)
+    tarinfo.name = f"{original_path.name}"
+
+    return tarinfo
+
+
+def _isoformat_now() -> str:
+    """Generate an iso format date for tar file naming."""
+    return datetime.datetime.utcnow().isoformat()[:-3] + "Z"
+
+
+def _member_tarinfo(
+    file_path: pathlib.Path, spool: typing.Optional[ArchiveSpool] = None
+) -> tarfile.TarInfo:
+    """Describe a regular file as a package member, like ``tarfile.add``."""
+    if spool and (file_path in spool):
+        tarinfo = tarfile.TarInfo(file_path.name)
+        tarinfo.mode = 0o644
+        tarinfo.size = spool.file_size(file_path)
+        tarinfo.mtime = int(time.time())
+
+        return tarinfo
+
+    file_stat = file_path.stat()
+    tarinfo = tarfile.TarInfo(file_path.name)
+    tarinfo.mode = stat.S_IMODE(file_stat.st_mode)
+    tarinfo.uid = file_stat.st_uid
+    tarinfo.gid = file_stat.st_gid
+    tarinfo.size = file_stat.st_size
+    tarinfo.mtime = int(file_stat.st_mtime)
+
+    return tarinfo
+
+
+def _copy_range(source_fd: int, destination_fd: int, count: int) -> int:
+    """
+    Copy bytes between files in the kernel where possible.
+
+    ``copy_file_range`` may reflink the data on filesystems that support it;
+    ``sendfile`` still avoids Python buffers. Either may be unsupported for a
+    pair of files, in which case the next method is used.
+
+    Returns:
+        Number of bytes copied.
+    """
+    remaining = count
+    if hasattr(os, "copy_file_range"):
+        try:
+            while remaining:
+                copied = os.copy_file_range(
+                    source_fd, destination_fd, min(remaining, COPY_CHUNK_SIZE)
+                )
+                if not copied:
+                    break
+                remaining -= copied
+        except OSError as e:
+            log.debug(f"copy_file_range unavailable, {str(e)}")
+    if remaining and hasattr(os, "sendfile"):
+        try:
+            while remaining:
+                copied = os.sendfile(
+                    destination_fd,
+                    source_fd,
+                    None,
+                    min(remaining, COPY_CHUNK_SIZE),
+                )
+                if not copied:
+                    break
+                remaining -= copied
+        except OSError as e:
+            log.debug(f"sendfile unavailable, {str(e)}")
+    if remaining:
+        with os.fdopen(source_fd, "rb", closefd=False) as s, os.fdopen(
+            destination_fd, "wb", closefd=False
+        ) as d:
+            while remaining:
+                data = s.read(min(remaining, 0x40000))
+                if not data:
+                    break
+                d.write(data)
+                remaining -= len(data)
+
+    return count - remaining
+
+
+def _add_member(
+    package: tarfile.TarFile,
+    file_path: pathlib.Path,
+    spool: typing.Optional[ArchiveSpool],
+) -> None:
+    if spool and (file_path in spool):
+        with spool.open(file_path) as f:
+            package.addfile(_member_tarinfo(file_path, spool), f)
+    else:
+        package.add(str(file_path), filter=_strip_paths)
+
+
+def _write_all(descriptor: int, data: bytes) -> int:
+    view = memoryview(data)
+    while view:
+        written = os.write(descriptor, view)
+        view = view[written:]
+
+    return len(data)
+
+
+class _PackageDigest:
+    """Hash package content as it is written."""
+
+    def __init__(self, tree_hash: bool) -> None:
+        self.hash = hashlib.sha256()
+        self.tree_hasher = TreeHasher() if tree_hash else None
+
+    def update(self, data: typing.Any) -> None:
+        """
+        Hash the next package content.
+
+        Args:
+            data: Content, in any object supporting the buffer protocol.
+        """
+        self.hash.update(data)
+        if self.tree_hasher:
+            self.tree_hasher.update(data)
+
+    def update_from_file(self, descriptor: int, size: int) -> None:
+        """
+        Hash the start of a file, mapping it rather than reading it.
+
+        Args:
+            descriptor: Open file descriptor.
+            size: Number of bytes to hash.
+        """
+        if not size:
+            # an empty file cannot be mapped
+            return
+        with mmap.mmap(descriptor, size, access=mmap.ACCESS_READ) as m:
+            self.update(m)
+
+
+class _UncompressedTar:
+    """
+    Write an uncompressed tar stream of regular files by base name.
+
+    Tar headers are written directly and member bodies are copied between
+    file descriptors so the kernel moves the data, rather than passing it
+    through Python buffers as ``tarfile`` does. Members held in memory by the
+    spool are written from memory. A copied member body is hashed from a
+    memory map of the member file.
+    """
+
+    def __init__(
+        self, descriptor: int, digest: typing.Optional[_PackageDigest] = None
+    ) -> None:
+        """
+        Construct ``_UncompressedTar`` object.
+
+        Args:
+            descriptor: File descriptor to write the tar stream to.
+            digest: Hash of the tar stream, if any.
+        """
+        self._descriptor = descriptor
+        self._digest = digest
+        self._offset = 0
+
+    def _write(self, data: bytes) -> None:
+        self._offset += _write_all(self._descriptor, data)
+        if self._digest:
+            self._digest.update(data)
+
+    def add(
+        self,
+        file_path: pathlib.Path,
+        spool: typing.Optional[ArchiveSpool] = None,
+    ) -> None:
+        """
+        Append a regular file to the tar stream.
+
+        Args:
+            file_path: File to append.
+            spool: Spool holding the file in memory, if any.
+        Raises:
+            OSError: If the file changes size while it is being copied.
+        """
+        tarinfo = _member_tarinfo(file_path, spool)
+        self._write(
+            tarinfo.tobuf(
+                tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape"
+            )
+        )
+
+        if spool and (file_path in spool):
+            with spool.open(file_path) as f:
+                data = f.read()
+            copied = len(data)
+            if copied == tarinfo.size:
+                self._write(data)
+        else:
+            source_fd = os.open(file_path, os.O_RDONLY)
+            try:
+                copied = _copy_range(source_fd, self._descriptor, tarinfo.size)
+                self._offset += copied
+                if self._digest and (copied == tarinfo.size):
+                    self._digest.update_from_file(source_fd, copied)
+            finally:
+                os.close(source_fd)
+        if copied != tarinfo.size:
+            raise OSError(f"package member changed during copy, {file_path}")
+
+        remainder = copied % tarfile.BLOCKSIZE
+        if remainder:
+            self._write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def close(self) -> None:
+        """Write the end of archive marker, padded to a whole record."""
+        end_size = 2 * tarfile.BLOCKSIZE
+        end_size += -(self._offset + end_size) % tarfile.RECORDSIZE
+        self._write(tarfile.NUL * end_size)
+
+    def abandon(self) -> None:
+        """Stop writing an unfinished tar stream."""
+
+
+class _TarStream:
+    """Write a tar stream through ``tarfile``, to compress or encrypt it."""
+
+    def __init__(self, fileobj: typing.BinaryIO, compressed: bool) -> None:
+        """
+        Construct ``_TarStream`` object.
+
+        Args:
+            fileobj: File object to write the tar stream to.
+            compressed: Gzip the tar stream.
+        """
+        self._package = tarfile.open(
+            fileobj=fileobj, mode="w|gz" if compressed else "w|"
+        )
+
+    def add(
+        self,
+        file_path: pathlib.Path,
+        spool: typing.Optional[ArchiveSpool] = None,
+    ) -> None:
+        """
+        Append a regular file to the tar stream.
+
+        Args:
+            file_path: File to append.
+            spool: Spool holding the file in memory, if any.
+        """
+        _add_member(self._package, file_path, spool)
+
+    def close(self) -> None:
+        """Finish the tar stream."""
+        self._package.close()
+
+    def abandon(self) -> None:
+        """Stop writing an unfinished tar stream, discarding its content."""
+        with contextlib.suppress(OSError):
+            self._package.close()
+
+
+def write_package(
+    project_name: str,
+    output_directory: pathlib.Path,
+    snapshot_results: SnapshotResults,
+    package_format: PackageFormat = "tar.gz",
+    encryption_key: typing.Optional[bytes] = None,
+    tree_hash: bool = False,
+    spool: typing.Optional[ArchiveSpool] = None,
+    base: typing.Optional[BasePackage] = None,
+) -> typing.List[pathlib.Path]:
+    """
+    Package repository snapshots into a single backup package.
+
+    The package holds the snapshot archives in package order, followed by a
+    manifest of the snapshots, and its hash file, as written by
+    ``PackageWriter``. Snapshot archives held in memory by the spool are
+    packaged from memory. A differential package only holds the archives
+    changed since its base package; its manifest references the others in
+    the packages holding them.
+
+    Args:
+        project_name: Name of project to use as file name prefix.
+        output_directory: Directory to output package files.
+        snapshot_results: Repository snapshots in package order.
+        package_format: Package file format.
+        encryption_key: Key to encrypt the package with, if any.
+        tree_hash: Also write a chunked tree hash file of the package.
+        spool: Spool holding snapshot archives in memory, if any.
+        base: Base package of a differential package, if any.
+
+    Returns:
+        Paths of the package file, its hash file and its tree hash file, if
+        any.
+    """
+    with PackageWriter(
+        project_name,
+        output_directory,
+        package_format,
+        encryption_key,
+        tree_hash,
+        spool,
+        base,
+    ) as writer:
+        with profile_phase(f"package-{project_name}"):
+            for x in snapshot_results:
+                writer.append(x)
+
+        return writer.finish(snapshot_results)
+
+
+class _PackageFile(io.RawIOBase):
+    """Write a package file, hashing its content as it is written."""
+
+    def __init__(
+        self, fileobj: typing.BinaryIO, digest: _PackageDigest
+    ) -> None:
+        super().__init__()
+        self._fileobj = fileobj
+        self._digest = digest
+
+    def writable(self) -> bool:
+        """Indicate the object supports writing."""
+        return True
+
+    def write(self, b: typing.Any) -> int:
+        """
+        Write content to the package file, hashing it.
+
+        Args:
+            b: Content to write.
+
+        Returns:
+            Number of bytes written.
+        """
+        data = bytes(b)
+        self._fileobj.write(data)
+        self._digest.update(data)
+
+        return len(data)
+
+
+class PackageWriter:
+    """
+    Write a package as its snapshots complete, on a single writer.
+
+    Snapshot archives are appended to the package file in completion order,
+    and compressed, encrypted and hashed as they are written, so finishing
+    the package only appends its manifest, in package order, as the last
+    member. The member bodies of an unencrypted "tar" package are copied to
+    the package file in the kernel, and hashed from memory maps of the member
+    files. The package file has a partial name until it is finished; an
+    unfinished package is removed when the writer is closed.
+    """
+
+    def __init__(
+        self,
+        project_name: str,
+        output_directory: pathlib.Path,
+        package_format: PackageFormat = "tar.gz",
+        encryption_key: typing.Optional[bytes] = None,
+        tree_hash: bool = False,
+        spool: typing.Optional[ArchiveSpool] = None,
+        base: typing.Optional[BasePackage] = None,
+        release_archives: bool = False,
+    ) -> None:
+        """
+        Construct ``PackageWriter`` object.
+
+        Args:
+            project_name: Name of project to use as file name prefix.
+            output_directory: Directory to output package files.
+            package_format: Package file format.
+            encryption_key: Key to encrypt the package with, if any.
+            tree_hash: Also write a chunked tree hash file of the package.
+            spool: Spool holding snapshot archives in memory, if any.
+            base: Base package of a differential package, if any.
+            release_archives: Release archives from the spool once they are
+                              appended.
+        """
+        self.project_name = project_name
+        self.spool = spool
+        self.base = base
+        self.release_archives = release_archives
+        self.manifest: typing.Optional[PackageManifest] = None
+
+        self.created = _isoformat_now()
+        self.package_path = (
+            output_directory / f"{project_name}-{self.created}.{package_format}"
+        )
+        if encryption_key:
+            self.package_path = (
+                self.package_path.parent
+                / f"{self.package_path.name}{ENCRYPTED_SUFFIX}"
+            )
+        self._partial_path = (
+            self.package_path.parent
+            / f"{self.package_path.name}{PARTIAL_SUFFIX}"
+        )
+        self._base_archives = _base_archives(base) if base else dict()
+        self._finished = False
+
+        log.info(f"saving tar file package, {self.package_path}")
+        self._file = self._partial_path.open(mode="wb")
+        self._digest = _PackageDigest(tree_hash)
+        self._encrypter: typing.Optional[EncryptingWriter] = None
+        self._package: typing.Union[_TarStream, _UncompressedTar]
+        if encryption_key:
+            self._encrypter = EncryptingWriter(
+                typing.cast(
+                    typing.BinaryIO, _PackageFile(self._file, self._digest)
+                ),
+                encryption_key,
+            )
+            self._package = _TarStream(
+                typing.cast(typing.BinaryIO, self._encrypter),
+                package_format == "tar.gz",
+            )
+        elif package_format == "tar.gz":
+            self._package = _TarStream(
+                typing.cast(
+                    typing.BinaryIO, _PackageFile(self._file, self._digest)
+                ),
+                True,
+            )
+        else:
+            # member bodies are copied to the package file in the kernel
+            self._package = _UncompressedTar(self._file.fileno(), self._digest)
+
+    def __enter__(self) -> "PackageWriter":
+        """Write a package."""
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        """Close the package file."""
+        self.close()
+
+    def close(self) -> None:
+        """Close the package file; an unfinished package is removed."""
+        if self._finished:
+            return
+        # close the package stream before its file, discarding its content
+        self._package.abandon()
+        if self._encrypter:
+            self._encrypter.close()
+        self._file.close()
+        self._partial_path.unlink(missing_ok=True)
+
+    def append(self, snapshot_result: SnapshotResult) -> None:
+        """
+        Append the archives of a snapshot to the package.
+
+        Archives unchanged since the base package of a differential package
+        are not appended.
+
+        Args:
+            snapshot_result: Repository snapshot.
+        """
+        archives = [
+            (x.ref, x.sha, x.sha256, x.archive_path, x.hash_path)
+            for x in [snapshot_result] + list(snapshot_result.ref_archives)
+        ]
+        for ref, sha, sha256, archive_path, hash_path in archives:
+            if _unchanged_archive(
+                self._base_archives, snapshot_result.name, ref, sha, sha256
+            ):
+                continue
+            log.info(f"appending archive to package, {archive_path.name}")
+            for x in [archive_path, hash_path]:
+                self._package.add(x, self.spool)
+                if self.spool and self.release_archives:
+                    self.spool.release(x)
+
+    def finish(
+        self, snapshot_results: SnapshotResults
+    ) -> typing.List[pathlib.Path]:
+        """
+        Append the package manifest, and finish the package file.
+
+        Args:
+            snapshot_results: Repository snapshots in package order.
+
+        Returns:
+            Paths of the package file, its hash file and its tree hash file,
+            if any.
+        """
+        manifest = package_manifest(
+            self.project_name,
+            self.created,
+            snapshot_results,
+            self.package_path.name,
+        )
+        if self.base:
+            manifest = differential_manifest(manifest, self.base)
+            unchanged = sum(
+                bool(y.package)
+                for x in manifest.repositories
+                for y in x.archives
+            )
+            log.info(
+                f"differential package against {self.base.name}, "
+                f"{unchanged} archives unchanged"
+            )
+
+        with profile_phase(f"package-{self.project_name}"):
+            with tempfile.TemporaryDirectory() as d:
+                for x in write_manifest_files(manifest, pathlib.Path(d)):
+                    self._package.add(x)
+            self._package.close()
+            if self._encrypter:
+                self._encrypter.finish()
+            self._file.close()
+        self._partial_path.rename(self.package_path)
+        self._finished = True
+        self.manifest = manifest
+
+        # the package content was hashed as it was written
+        created_files = [
+            self.package_path,
+            write_hash_file(self._digest.hash.hexdigest(), self.package_path),
+        ]
+        if self._digest.tree_hasher:
+            created_files.append(
+                write_tree_hash_file(
+                    self._digest.tree_hasher.manifest(self.package_path.name),
+                    self.package_path,
+                )
+            )
+
+        return created_files
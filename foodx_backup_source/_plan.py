@@ -0,0 +1,455 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Estimate the resources of a backup run without cloning."""
+
+import asyncio
+import heapq
+import logging
+import os
+import re
+import typing
+from urllib.parse import urlparse
+
+import aiohttp
+import git
+import pydantic
+
+from ._governor import transfer_host
+from ._history import PlanHistory, SnapshotHistory
+from ._snapshot import SnapshotOptions, authorized_url
+from .schema import ApplicationDefinition
+
+log = logging.getLogger(__name__)
+
+EstimateSource = typing.Literal["history", "server", "none"]
+
+# git hosts with an API reporting repository size, and the API URL
+SERVER_METADATA_APIS = {"github.com": "https://api.github.com"}
+SERVER_METADATA_TIMEOUT_SECONDS = 30.0
+
+# rough size of a clone, and of an archive, relative to the reported size of
+# the repository objects on the server
+SERVER_CLONE_RATIO = 2.0
+SERVER_ARCHIVE_RATIO = 1.0
+
+# throughput assumed when there is no history of previous runs
+DEFAULT_TRANSFER_BYTES_PER_SECOND = 10e6
+DEFAULT_ARCHIVE_BYTES_PER_SECOND = 20e6
+# the archives are already compressed, so packaging is mostly a copy
+DEFAULT_PACKAGE_BYTES_PER_SECOND = 100e6
+
+FULL_SHA_PATTERN = re.compile(r"[0-9a-f]{40}")
+
+
+class RepositoryPlan(pydantic.BaseModel):
+    """Resolved references and estimated resources of a repository."""
+
+    name: str
+    host: str
+    # resolved commit of each snapshot reference; None if not found
+    shas: typing.Dict[str, typing.Optional[str]]
+    error: typing.Optional[str] = None
+    source: EstimateSource = "none"
+    transfer_bytes: int = 0
+    clone_bytes: int = 0
+    archive_bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def resolved(self) -> bool:
+        """All the snapshot references were found."""
+        return (not self.error) and all(self.shas.values())
+
+
+class BackupPlan(pydantic.BaseModel):
+    """Estimated resources of a backup run."""
+
+    repositories: typing.List[RepositoryPlan]
+    # concurrent snapshots, and concurrent transfers from each host
+    concurrency: int
+    host_connections: typing.Optional[int]
+    transfer_bytes: int
+    archive_bytes: int
+    peak_bytes: int
+    seconds: float
+
+
+def ls_remote(url: str, refs: typing.List[str]) -> typing.Dict[str, str]:
+    """
+    Resolve references on a repository server, without cloning.
+
+    Args:
+        url: Repository URL, including any credentials.
+        refs: References to resolve.
+
+    Returns:
+        Commit SHA of each reference found on the server.
+    """
+    patterns: typing.List[str] = list()
+    for x in refs:
+        # annotated tags are peeled to their commit
+        patterns += [x, f"{x}^{{}}"]
+    output = str(git.Git().ls_remote(url, *patterns))
+
+    remote_refs: typing.Dict[str, str] = dict()
+    for line in output.splitlines():
+        sha, _, name = line.partition("\t")
+        remote_refs[name.strip()] = sha.strip()
+
+    return remote_refs
+
+
+def _resolve_remote_ref(
+    remote_refs: typing.Dict[str, str], ref: str
+) -> typing.Optional[str]:
+    if FULL_SHA_PATTERN.fullmatch(ref):
+        return ref
+    for x in [f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}", f"refs/heads/{ref}"]:
+        if x in remote_refs:
+            return remote_refs[x]
+
+    return remote_refs.get(ref)
+
+
+async def _resolve_refs(
+    definition: ApplicationDefinition, token: typing.Optional[str]
+) -> typing.Tuple[typing.Dict[str, typing.Optional[str]], typing.Optional[str]]:
+    """Resolve the snapshot references of a repository on its server."""
+    refs = definition.configuration.snapshot_refs()
+    url = definition.configuration.backup.repo_url
+    loop = asyncio.get_running_loop()
+    try:
+        remote_refs = await loop.run_in_executor(
+            None, ls_remote, authorized_url(url, token), refs
+        )
+    except git.GitCommandError as e:
+        message = str(e.stderr).strip()
+        if token:
+            message = message.replace(token, "***")
+        log.error(f"remote references failed, {definition.name}, {message}")
+        return {x: None for x in refs}, message
+
+    return {x: _resolve_remote_ref(remote_refs, x) for x in refs}, None
+
+
+async def _server_size(
+    session: aiohttp.ClientSession,
+    url: str,
+    token: typing.Optional[str],
+    metadata_apis: typing.Dict[str, str],
+) -> typing.Optional[int]:
+    """Size of the repository objects, reported by the git host API."""
+    api_url = metadata_apis.get(transfer_host(url))
+    if not api_url:
+        return None
+
+    path = urlparse(url).path.strip("/")
+    if path.endswith(".git"):
+        path = path[: -len(".git")]
+    headers = {"Accept": "application/vnd.github+json"}
+    if token:
+        headers["Authorization"] = f"token {token}"
+    try:
+        async with session.get(
+            f"{api_url}/repos/{path}", headers=headers
+        ) as response:
+            if response.status != 200:
+                log.warning(
+                    f"repository metadata unavailable, {url}, "
+                    f"HTTP {response.status}"
+                )
+                return None
+            data = await response.json()
+
+        # reported in KiB
+        return int(data["size"]) * 1024
+    except (
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+        KeyError,
+        TypeError,
+        ValueError,
+    ) as e:
+        log.warning(f"repository metadata unavailable, {url}, {str(e)}")
+        return None
+
+
+def _history_rates(
+    history: typing.Iterable[SnapshotHistory],
+) -> typing.Tuple[float, float]:
+    """Transfer and archive throughput observed in previous runs."""
+    records = list(history)
+    transfer_seconds = sum(x.clone_seconds for x in records)
+    archive_seconds = sum(x.archive_seconds for x in records)
+
+    return (
+        (
+            (sum(x.transfer_bytes for x in records) / transfer_seconds)
+            if transfer_seconds
+            else DEFAULT_TRANSFER_BYTES_PER_SECOND
+        ),
+        (
+            (sum(x.archive_bytes for x in records) / archive_seconds)
+            if archive_seconds
+            else DEFAULT_ARCHIVE_BYTES_PER_SECOND
+        ),
+    )
+
+
+async def _plan_repository(
+    definition: ApplicationDefinition,
+    token: typing.Optional[str],
+    history: typing.Optional[SnapshotHistory],
+    session: aiohttp.ClientSession,
+    metadata_apis: typing.Dict[str, str],
+    rates: typing.Tuple[float, float],
+    host_rate: typing.Optional[float],
+) -> RepositoryPlan:
+    url = definition.configuration.backup.repo_url
+    shas, error = await _resolve_refs(definition, token)
+    this_plan = RepositoryPlan(
+        name=definition.name, host=transfer_host(url), shas=shas, error=error
+    )
+    transfer_rate, archive_rate = rates
+    if host_rate:
+        transfer_rate = min(transfer_rate, host_rate)
+
+    if history:
+        this_plan.source = "history"
+        this_plan.transfer_bytes = history.transfer_bytes
+        this_plan.clone_bytes = history.clone_bytes
+        this_plan.archive_bytes = history.archive_bytes
+        clone_seconds = history.clone_seconds
+        if host_rate:
+            clone_seconds = max(
+                clone_seconds, history.transfer_bytes / host_rate
+            )
+        this_plan.seconds = clone_seconds + history.archive_seconds
+    elif not error:
+        server_size = await _server_size(session, url, token, metadata_apis)
+        if server_size is not None:
+            this_plan.source = "server"
+            this_plan.transfer_bytes = server_size
+            this_plan.clone_bytes = int(server_size * SERVER_CLONE_RATIO)
+            this_plan.archive_bytes = int(server_size * SERVER_ARCHIVE_RATIO)
+            this_plan.seconds = (server_size / transfer_rate) + (
+                this_plan.archive_bytes / archive_rate
+            )
+
+    return this_plan
+
+
+def _simulate_run(
+    repositories: typing.List[RepositoryPlan],
+    concurrency: int,
+    host_connections: typing.Optional[int],
+) -> typing.Tuple[float, int]:
+    """
+    Simulate the snapshots of a run in definition order.
+
+    A snapshot holds its clone and archive on disk while it runs; its archive
+    is kept until the run is packaged.
+
+    Returns:
+        Elapsed seconds, and peak temporary disk usage in bytes.
+    """
+    waiting = list(repositories)
+    running: typing.List[typing.Tuple[float, int, RepositoryPlan]] = list()
+    active: typing.Dict[str, int] = dict()
+    now = 0.0
+    disk_bytes = 0
+    peak_bytes = 0
+    while waiting or running:
+        while len(running) < concurrency:
+            startable = [
+                x
+                for x in waiting
+                if (host_connections is None)
+                or (active.get(x.host, 0) < host_connections)
+            ]
+            if not startable:
+                break
+            this_plan = startable[0]
+            waiting.remove(this_plan)
+            active[this_plan.host] = active.get(this_plan.host, 0) + 1
+            disk_bytes += this_plan.clone_bytes + this_plan.archive_bytes
+            heapq.heappush(
+                running, (now + this_plan.seconds, id(this_plan), this_plan)
+            )
+        peak_bytes = max(peak_bytes, disk_bytes)
+
+        now, _, this_plan = heapq.heappop(running)
+        active[this_plan.host] -= 1
+        disk_bytes -= this_plan.clone_bytes
+
+    return now, peak_bytes
+
+
+def _snapshot_concurrency(options: SnapshotOptions) -> typing.Optional[int]:
+    """
+    Number of snapshots that run at once, if limited.
+
+    GitPython snapshots run in the default executor of the event loop, which
+    is limited to this many threads; the other backends are not limited.
+    """
+    if options.backend == "gitpython":
+        return min(32, (os.cpu_count() or 1) + 4)
+
+    return None
+
+
+async def plan_backup(
+    definitions: typing.List[ApplicationDefinition],
+    token: typing.Optional[str] = None,
+    options: typing.Optional[SnapshotOptions] = None,
+    history: typing.Optional[PlanHistory] = None,
+    package: bool = True,
+    metadata_apis: typing.Optional[typing.Dict[str, str]] = None,
+) -> BackupPlan:
+    """
+    Estimate the transfer, disk usage and time of a backup run.
+
+    References are resolved on the repository servers without cloning.
+    Repository sizes are taken from the recorded snapshot history of previous
+    runs, otherwise from the git host API where there is one. The snapshots
+    are then simulated with the concurrency and host limits of the options.
+
+    Args:
+        definitions: Application definitions of the run.
+        token: Personal access token for repository access.
+        options: Snapshot execution controls of the run.
+        history: Recorded snapshot history of previous runs, if any.
+        package: The archives are packaged at the end of the run.
+        metadata_apis: API URLs by git host, for repository sizes; defaults
+                       to ``SERVER_METADATA_APIS``.
+
+    Returns:
+        Estimated resources of the run.
+    """
+    this_options = options or SnapshotOptions()
+    this_history = history or PlanHistory()
+    apis = SERVER_METADATA_APIS if metadata_apis is None else metadata_apis
+    rates = _history_rates(this_history.snapshots.values())
+
+    timeout = aiohttp.ClientTimeout(total=SERVER_METADATA_TIMEOUT_SECONDS)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        repositories = list(
+            await asyncio.gather(
+                *[
+                    _plan_repository(
+                        x,
+                        token,
+                        this_history.get(x),
+                        session,
+                        apis,
+                        rates,
+                        this_options.host_bytes_per_second,
+                    )
+                    for x in definitions
+                ]
+            )
+        )
+
+    concurrency = min(
+        _snapshot_concurrency(this_options) or len(repositories),
+        len(repositories),
+    )
+    seconds, peak_bytes = _simulate_run(
+        repositories, concurrency, this_options.host_connections
+    )
+    transfer_bytes = sum(x.transfer_bytes for x in repositories)
+    archive_bytes = sum(x.archive_bytes for x in repositories)
+    if this_options.host_bytes_per_second:
+        # transfers from a host share its rate limit
+        for host in {x.host for x in repositories}:
+            host_bytes = sum(
+                x.transfer_bytes for x in repositories if x.host == host
+            )
+            seconds = max(
+                seconds, host_bytes / this_options.host_bytes_per_second
+            )
+    if package:
+        # the package is written alongside the archives
+        peak_bytes = max(peak_bytes, 2 * archive_bytes)
+        seconds += archive_bytes / DEFAULT_PACKAGE_BYTES_PER_SECOND
+
+    return BackupPlan(
+        repositories=repositories,
+        concurrency=concurrency,
+        host_connections=this_options.host_connections,
+        transfer_bytes=transfer_bytes,
+        archive_bytes=archive_bytes,
+        peak_bytes=peak_bytes,
+        seconds=seconds,
+    )
+
+
+def _megabytes(value: int) -> str:
+    return f"{value / 1e6:.1f} MB"
+
+
+def format_plan(
+    plan: BackupPlan, options: typing.Optional[SnapshotOptions] = None
+) -> typing.List[str]:
+    """
+    Describe a backup plan.
+
+    Args:
+        plan: Backup plan.
+        options: Snapshot execution controls of the run, to check limits.
+
+    Returns:
+        Report lines.
+    """
+    this_options = options or SnapshotOptions()
+    lines = [f"Backup plan, {len(plan.repositories)} repositories"]
+    for x in plan.repositories:
+        refs = ", ".join(
+            f"{y} ({z[:12] if z else 'not found'})" for y, z in x.shas.items()
+        )
+        if x.error:
+            lines.append(f"  {x.name}: {refs}, failed, {x.error}")
+        elif x.source == "none":
+            lines.append(f"  {x.name}: {refs}, no estimate")
+        else:
+            lines.append(
+                f"  {x.name}: {refs}, transfer "
+                f"{_megabytes(x.transfer_bytes)}, archive "
+                f"{_megabytes(x.archive_bytes)}, {x.seconds:.1f}s "
+                f"({x.source})"
+            )
+            if (
+                this_options.timeout_seconds is not None
+                and x.seconds > this_options.timeout_seconds
+            ):
+                lines.append(
+                    f"    exceeds timeout of {this_options.timeout_seconds}s"
+                )
+
+    limits = f"{plan.concurrency} concurrent snapshots"
+    if plan.host_connections:
+        limits += f", {plan.host_connections} per host"
+    lines += [
+        f"Projected transfer {_megabytes(plan.transfer_bytes)}, archives "
+        f"{_megabytes(plan.archive_bytes)}",
+        f"Projected peak temporary disk usage {_megabytes(plan.peak_bytes)}",
+        f"Projected wall time {plan.seconds:.1f}s with {limits}",
+    ]
+    if (
+        this_options.deadline_seconds is not None
+        and plan.seconds > this_options.deadline_seconds
+    ):
+        lines.append(f"  exceeds deadline of {this_options.deadline_seconds}s")
+    unestimated = [x.name for x in plan.repositories if x.source == "none"]
+    if unestimated:
+        lines.append(
+            f"No estimate for {', '.join(unestimated)}; projections are lower "
+            f"bounds"
+        )
+
+    return lines
@@ -0,0 +1,224 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Optional CPU and memory profiling of execution phases."""
+
+import contextlib
+import cProfile
+import logging
+import pathlib
+import re
+import threading
+import time
+import tracemalloc
+import typing
+
+import click
+
+log = logging.getLogger(__name__)
+
+SLOW_CALLBACK_LOG = "asyncio-slow-callbacks.log"
+MEMORY_SNAPSHOT_FILE = "memory.snapshot"
+SUMMARY_FILE = "summary.txt"
+
+TOP_ALLOCATIONS = 25
+
+_active_profiler: typing.Optional["Profiler"] = None
+
+T = typing.TypeVar("T")
+
+
+class Profiler:
+    """Collect cProfile statistics for each execution phase of a run."""
+
+    def __init__(self, output_directory: pathlib.Path) -> None:
+        """
+        Construct ``Profiler`` object.
+
+        Args:
+            output_directory: Directory to write profiling results.
+        """
+        self.output_directory = output_directory
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._thread_state = threading.local()
+        self._phases: typing.List[typing.Tuple[str, float, int]] = list()
+
+    def _stack(self) -> typing.List[cProfile.Profile]:
+        if not hasattr(self._thread_state, "stack"):
+            self._thread_state.stack = list()
+
+        return self._thread_state.stack
+
+    def _stats_path(self, name: str) -> pathlib.Path:
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        safe_name = re.sub(r"[^\w.-]", "_", name)
+
+        return self.output_directory / f"{sequence:03d}-{safe_name}.prof"
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        """
+        Profile an execution phase in the current thread.
+
+        A profile can only be active once in a thread, so a nested phase
+        suspends the enclosing phase; the time spent in the nested phase is
+        only reported in the nested phase statistics.
+
+        Args:
+            name: Phase name, used in the statistics file name.
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1].disable()
+        profile = cProfile.Profile()
+        stack.append(profile)
+        start_time = time.monotonic()
+        try:
+            profile.enable()
+        except ValueError:
+            # newer Python versions only allow one active profile per process
+            log.warning(f"profiler busy, phase not profiled, {name}")
+            stack.pop()
+            if stack:
+                stack[-1].enable()
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.monotonic() - start_time
+            stack.pop()
+            if stack:
+                stack[-1].enable()
+
+            stats_path = self._stats_path(name)
+            profile.dump_stats(str(stats_path))
+            _, peak = tracemalloc.get_traced_memory()
+            with self._lock:
+                self._phases.append((stats_path.name, elapsed, peak))
+
+    def write_summary(self) -> None:
+        """Write phase timings and memory allocation results."""
+        memory_snapshot = tracemalloc.take_snapshot()
+        memory_snapshot.dump(str(self.output_directory / MEMORY_SNAPSHOT_FILE))
+        current, peak = tracemalloc.get_traced_memory()
+
+        lines = ["phases (stats file, elapsed seconds, run peak bytes so far):"]
+        lines += [f"  {x}, {y:.3f}, {z}" for x, y, z in self._phases]
+        lines += [
+            "",
+            f"traced memory: {current} bytes current, {peak} bytes peak",
+            "",
+            f"top {TOP_ALLOCATIONS} allocations by line:",
+        ]
+        lines += [
+            f"  {x}"
+            for x in memory_snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+        ]
+        summary_path = self.output_directory / SUMMARY_FILE
+        summary_path.write_text("\n".join(lines) + "\n")
+        log.info(f"profiling results written, {self.output_directory}")
+
+
+@contextlib.contextmanager
+def profile_run(
+    output_directory: typing.Optional[pathlib.Path],
+) -> typing.Iterator[typing.Optional[Profiler]]:
+    """
+    Enable profiling of a run, if an output directory is specified.
+
+    Memory allocations are traced for the whole run and slow asyncio
+    callbacks, which block the event loop, are logged to a file. The event
+    loop must be run in debug mode for slow callbacks to be reported.
+
+    Args:
+        output_directory: Directory to write profiling results, or None to
+                          disable profiling.
+
+    Yields:
+        The run profiler, or None if profiling is disabled.
+    """
+    global _active_profiler
+
+    if not output_directory:
+        yield None
+        return
+
+    output_directory.mkdir(parents=True, exist_ok=True)
+    profiler = Profiler(output_directory)
+    asyncio_log = logging.getLogger("asyncio")
+    slow_callback_handler = logging.FileHandler(
+        output_directory / SLOW_CALLBACK_LOG
+    )
+    slow_callback_handler.setLevel(logging.WARNING)
+    asyncio_log.addHandler(slow_callback_handler)
+    tracemalloc.start()
+    _active_profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _active_profiler = None
+        profiler.write_summary()
+        tracemalloc.stop()
+        asyncio_log.removeHandler(slow_callback_handler)
+        slow_callback_handler.close()
+
+
+@contextlib.contextmanager
+def profile_phase(name: str) -> typing.Iterator[None]:
+    """
+    Profile an execution phase if profiling is enabled for the run.
+
+    Args:
+        name: Phase name.
+    """
+    profiler = _active_profiler
+    if profiler:
+        with profiler.phase(name):
+            yield
+    else:
+        yield
+
+
+def call_in_phase(
+    name: str, function: typing.Callable[..., T], *args: typing.Any
+) -> T:
+    """
+    Call a function, profiling it as an execution phase if enabled.
+
+    Args:
+        name: Phase name.
+        function: Function to call.
+        args: Function arguments.
+
+    Returns:
+        Function return value.
+    """
+    with profile_phase(name):
+        return function(*args)
+
+
+def profile_option(function: typing.Callable) -> typing.Callable:
+    """Apply the profiling option to a click command."""
+    function = click.option(
+        "--profile",
+        default=None,
+        help="""Directory to write profiling results.
+
+cProfile statistics of each execution phase (loadable with pstats or
+snakeviz), tracemalloc allocation results and asyncio slow callback warnings
+are written to the directory.
+""",
+        type=click.Path(dir_okay=True, file_okay=False, path_type=pathlib.Path),
+    )(function)
+
+    return function
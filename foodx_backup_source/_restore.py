@@ -0,0 +1,517 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Restore application source from backup packages."""
+
+import concurrent.futures
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import typing
+
+import click
+import pydantic
+
+from ._encrypt import (
+    ENCRYPTED_SUFFIX,
+    DecryptingReader,
+    EncryptionError,
+    encryption_options,
+    load_encryption_key,
+)
+from ._hash import HashingReader, parse_hash_content, read_hash_file
+from ._package import PACKAGE_MANIFEST_NAME, PackageManifest
+
+log = logging.getLogger(__name__)
+
+ApplicationNames = typing.Optional[typing.Set[str]]
+
+ARCHIVE_SUFFIX = ".tar.gz"
+HASH_SUFFIX = ".sha256"
+
+# Python versions with tarfile extraction filters get the "data" filter as a
+# second line of defence; the explicit member checks below apply to all
+# versions.
+_EXTRACT_OPTIONS: typing.Dict[str, typing.Any] = (
+    {"filter": "data"} if hasattr(tarfile, "data_filter") else dict()
+)
+
+
+class RestoreError(Exception):
+    """Problem restoring application source from a backup package."""
+
+
+class RestoreRecord(pydantic.BaseModel):
+    """Outcome of restoring a single repository archive."""
+
+    archive_name: str
+    applications: typing.List[str]
+    files: int
+    size: int
+    elapsed_seconds: float
+
+    @property
+    def rate(self) -> float:
+        """Restore rate of the archive in bytes per second."""
+        if self.elapsed_seconds:
+            return self.size / self.elapsed_seconds
+        else:
+            return 0.0
+
+
+def _is_within(path: str, root: str) -> bool:
+    return (path == root) or path.startswith(root + os.sep)
+
+
+def _check_member(member: tarfile.TarInfo, root: str) -> None:
+    """Reject archive members that would be written outside ``root``."""
+    if os.path.isabs(member.name):
+        raise RestoreError(f"absolute path in archive, {member.name}")
+    if member.isdev():
+        raise RestoreError(f"device file in archive, {member.name}")
+
+    destination = os.path.join(root, member.name)
+    # resolve symbolic links already extracted from the archive
+    parent = os.path.realpath(os.path.dirname(destination))
+    if not _is_within(
+        os.path.join(parent, os.path.basename(destination)), root
+    ):
+        raise RestoreError(f"path escapes restore directory, {member.name}")
+
+    if member.issym():
+        if os.path.isabs(member.linkname):
+            raise RestoreError(
+                f"absolute symbolic link in archive, {member.name}"
+            )
+        link_target = os.path.realpath(os.path.join(parent, member.linkname))
+        if not _is_within(link_target, root):
+            raise RestoreError(
+                f"symbolic link escapes restore directory, {member.name}"
+            )
+    elif member.islnk():
+        link_target = os.path.realpath(os.path.join(root, member.linkname))
+        if not _is_within(link_target, root):
+            raise RestoreError(
+                f"hard link escapes restore directory, {member.name}"
+            )
+
+
+def _restore_archive(
+    archive_path: pathlib.Path,
+    expected_hash: str,
+    staging_directory: pathlib.Path,
+    applications: ApplicationNames,
+) -> typing.Tuple[RestoreRecord, str]:
+    """
+    Extract a repository archive, verifying its hash as it is streamed.
+
+    Content is extracted into its own directory in the staging directory, to
+    be promoted into the target directory once the package holding the
+    archive has also been verified.
+
+    Returns:
+        Record of the archive, and the directory of its extracted content.
+    """
+    start_time = time.monotonic()
+    files = 0
+    size = 0
+    restored: typing.Set[str] = set()
+    staging_root = os.path.realpath(
+        tempfile.mkdtemp(dir=staging_directory, prefix=".restore-")
+    )
+    with archive_path.open(mode="rb") as f:
+        reader = HashingReader(f)
+        with tarfile.open(fileobj=reader, mode="r|gz") as archive:
+            for member in archive:
+                parts = pathlib.PurePosixPath(member.name).parts
+                if (not parts) or (
+                    applications and (parts[0] not in applications)
+                ):
+                    continue
+
+                _check_member(member, staging_root)
+                archive.extract(member, staging_root, **_EXTRACT_OPTIONS)
+                restored.add(parts[0])
+                if member.isfile():
+                    files += 1
+                    size += member.size
+        actual_hash = reader.drain()
+    archive_path.unlink()
+
+    if actual_hash != expected_hash:
+        raise RestoreError(
+            f"archive hash mismatch, {archive_path.name} "
+            f"(expected {expected_hash}, actual {actual_hash})"
+        )
+
+    record = RestoreRecord(
+        archive_name=archive_path.name,
+        applications=sorted(restored),
+        files=files,
+        size=size,
+        elapsed_seconds=time.monotonic() - start_time,
+    )
+
+    return record, staging_root
+
+
+def _promote_archive(
+    record: RestoreRecord, staging_root: str, target_directory: pathlib.Path
+) -> None:
+    """Move the extracted content of a verified archive into the target."""
+    for x in record.applications:
+        destination = target_directory / x
+        if destination.exists():
+            raise RestoreError(
+                f"restore destination already exists, {destination}"
+            )
+        shutil.move(os.path.join(staging_root, x), str(destination))
+
+
+def _is_selected(archive_name: str, applications: ApplicationNames) -> bool:
+    # archive names are "<name>-<ref>.tar.gz"; the selection is refined by
+    # top level directory name during extraction.
+    return (not applications) or any(
+        archive_name.startswith(f"{x}-") for x in applications
+    )
+
+
+def open_decrypter(
+    package_path: pathlib.Path,
+    reader: HashingReader,
+    encryption_key: typing.Optional[bytes],
+) -> typing.Optional[DecryptingReader]:
+    """
+    Decrypt an encrypted package as it is read.
+
+    Args:
+        package_path: Path to backup package file.
+        reader: Package file reader.
+        encryption_key: Key to decrypt an encrypted package.
+
+    Returns:
+        Decrypting reader, or None if the package is not encrypted.
+    Raises:
+        RestoreError: If the package is encrypted and there is no key.
+    """
+    if not package_path.name.endswith(ENCRYPTED_SUFFIX):
+        return None
+    if not encryption_key:
+        raise RestoreError(
+            f"package is encrypted, key required, {package_path}"
+        )
+
+    return DecryptingReader(reader, encryption_key)
+
+
+def _read_package(
+    package_path: pathlib.Path,
+    staging_directory: pathlib.Path,
+    applications: ApplicationNames,
+    executor: concurrent.futures.Executor,
+    encryption_key: typing.Optional[bytes],
+    archive_hashes: typing.Optional[typing.Dict[str, str]] = None,
+) -> typing.Tuple[
+    typing.List[concurrent.futures.Future], typing.Optional[PackageManifest]
+]:
+    """
+    Stream a package, handing each selected archive to the executor.
+
+    Archives are only extracted into the staging directory; the package hash,
+    or the authentication of an encrypted package, is verified once the whole
+    package is read, before any content is restored. The manifest, the last
+    member of the package, is also only used then.
+
+    Args:
+        archive_hashes: Expected hashes of the only archives to restore, by
+                        archive name; otherwise all selected archives.
+
+    Returns:
+        Restore futures of the archives, and the package manifest, if any.
+    """
+    expected_package_hash: typing.Optional[str] = None
+    package_hash_path = (
+        package_path.parent / f"{package_path.name}{HASH_SUFFIX}"
+    )
+    if package_hash_path.is_file():
+        expected_package_hash = read_hash_file(package_hash_path)
+
+    manifest: typing.Optional[PackageManifest] = None
+    pending: typing.Dict[str, pathlib.Path] = dict()
+    futures: typing.List[concurrent.futures.Future] = list()
+    log.info(f"reading backup package, {package_path}")
+    with package_path.open(mode="rb") as f:
+        reader = HashingReader(f)
+        decrypter = open_decrypter(package_path, reader, encryption_key)
+        with tarfile.open(fileobj=decrypter or reader, mode="r|*") as package:
+            for member in package:
+                # only the base name is used so package members cannot
+                # be staged outside the staging directory.
+                name = pathlib.PurePosixPath(member.name).name
+                if not member.isfile():
+                    continue
+                member_file = package.extractfile(member)
+                if member_file is None:
+                    continue
+
+                if name.endswith(HASH_SUFFIX):
+                    archive_name = name[: -len(HASH_SUFFIX)]
+                    if archive_name in pending:
+                        expected_hash = parse_hash_content(
+                            member_file.read().decode()
+                        )
+                        if archive_hashes and (
+                            archive_hashes[archive_name] != expected_hash
+                        ):
+                            raise RestoreError(
+                                f"referenced archive differs, {archive_name}"
+                                f", {package_path}"
+                            )
+                        futures.append(
+                            executor.submit(
+                                _restore_archive,
+                                pending.pop(archive_name),
+                                expected_hash,
+                                staging_directory,
+                                applications,
+                            )
+                        )
+                elif (name == PACKAGE_MANIFEST_NAME) and not archive_hashes:
+                    manifest = PackageManifest.parse_raw(member_file.read())
+                elif (
+                    name.endswith(ARCHIVE_SUFFIX)
+                    and _is_selected(name, applications)
+                    and ((not archive_hashes) or (name in archive_hashes))
+                ):
+                    staged_path = staging_directory / name
+                    with staged_path.open(mode="wb") as s:
+                        shutil.copyfileobj(member_file, s)
+                    pending[name] = staged_path
+        if decrypter:
+            decrypter.drain()
+        actual_package_hash = reader.drain()
+
+    if pending:
+        raise RestoreError(
+            f"archives missing hash files in package, {sorted(pending)}"
+        )
+    if expected_package_hash and (actual_package_hash != expected_package_hash):
+        raise RestoreError(f"package hash mismatch, {package_path}")
+
+    return futures, manifest
+
+
+def _referenced_archives(
+    manifest: PackageManifest, applications: ApplicationNames
+) -> typing.Dict[str, typing.Dict[str, str]]:
+    """Selected archives held by other packages, by package name."""
+    referenced: typing.Dict[str, typing.Dict[str, str]] = dict()
+    for x in manifest.repositories:
+        for y in x.archives:
+            if (
+                y.package
+                and y.file_name.endswith(ARCHIVE_SUFFIX)
+                and _is_selected(y.file_name, applications)
+            ):
+                referenced.setdefault(y.package, dict())[y.file_name] = y.sha256
+
+    return referenced
+
+
+def restore_package(
+    package_path: pathlib.Path,
+    target_directory: pathlib.Path,
+    applications: ApplicationNames,
+    jobs: typing.Optional[int],
+    encryption_key: typing.Optional[bytes] = None,
+) -> typing.List[RestoreRecord]:
+    """
+    Restore repository archives from a backup package.
+
+    The package is streamed once; each selected repository archive is handed
+    to a process pool for decompression and extraction into a staging
+    directory as soon as its hash file has been read from the package. An
+    encrypted package is decrypted in the same stream. Extracted content is
+    only moved into the target directory once the package, and any package
+    it references, has been verified.
+
+    Archives that a differential package references in earlier packages are
+    restored from those packages, which must be alongside it.
+
+    Args:
+        package_path: Path to backup package file.
+        target_directory: Directory to restore application source into.
+        applications: Names of applications to restore, or None for all.
+        jobs: Number of worker processes, or None for the CPU count.
+        encryption_key: Key to decrypt an encrypted package.
+
+    Returns:
+        Records of the restored repository archives.
+    Raises:
+        RestoreError: If a hash does not match, an archive is unsafe, or a
+                      referenced package is missing.
+        EncryptionError: If an encrypted package fails authentication.
+    """
+    target_directory.mkdir(parents=True, exist_ok=True)
+    records: typing.List[RestoreRecord] = list()
+    with tempfile.TemporaryDirectory(
+        dir=target_directory, prefix=".staging-"
+    ) as d, concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs
+    ) as executor:
+        staging_directory = pathlib.Path(d)
+        futures, manifest = _read_package(
+            package_path,
+            staging_directory,
+            applications,
+            executor,
+            encryption_key,
+        )
+        referenced = (
+            _referenced_archives(manifest, applications) if manifest else dict()
+        )
+        for package_name, archive_hashes in referenced.items():
+            base_path = package_path.parent / package_name
+            if not base_path.is_file():
+                raise RestoreError(f"referenced package not found, {base_path}")
+            base_futures, _ = _read_package(
+                base_path,
+                staging_directory,
+                applications,
+                executor,
+                encryption_key,
+                archive_hashes,
+            )
+            if len(base_futures) != len(archive_hashes):
+                raise RestoreError(
+                    f"referenced archives not found, {base_path}"
+                )
+            futures += base_futures
+
+        extracted: typing.List[typing.Tuple[RestoreRecord, str]] = list()
+        for future in concurrent.futures.as_completed(futures):
+            record, staging_root = future.result()
+            log.info(
+                f"extracted {record.archive_name}, {record.files} files, "
+                f"{record.size} bytes in {record.elapsed_seconds:.2f}s "
+                f"({record.rate / 1e6:.1f} MB/s)"
+            )
+            extracted.append((record, staging_root))
+
+        # every package has been verified by now, so content is only
+        # restored from intact packages
+        for record, staging_root in extracted:
+            _promote_archive(record, staging_root, target_directory)
+            records.append(record)
+
+    missing = (applications or set()) - {
+        x for y in records for x in y.applications
+    }
+    if missing:
+        raise RestoreError(
+            f"applications not found in package, {sorted(missing)}"
+        )
+
+    return records
+
+
+def main(
+    package_file: pathlib.Path,
+    target_dir: pathlib.Path,
+    application: typing.Optional[typing.List[str]],
+    jobs: typing.Optional[int],
+    encryption_key: typing.Optional[bytes] = None,
+) -> typing.List[RestoreRecord]:
+    """
+    Restore application source from a backup package.
+
+    Args:
+        package_file: Backup package file to restore from.
+        target_dir: Directory to restore application source into.
+        application: Names of applications to restore; all if not specified.
+        jobs: Number of worker processes, or None for the CPU count.
+        encryption_key: Key to decrypt an encrypted package.
+
+    Returns:
+        Records of the restored repository archives.
+    """
+    applications = set(application) if application else None
+    records = restore_package(
+        package_file, target_dir, applications, jobs, encryption_key
+    )
+
+    return records
+
+
+@click.command()
+@click.argument(
+    "package_file",
+    type=click.Path(
+        dir_okay=False, exists=True, file_okay=True, path_type=pathlib.Path
+    ),
+)
+@click.argument(
+    "target_dir",
+    type=click.Path(dir_okay=True, file_okay=False, path_type=pathlib.Path),
+)
+@click.option(
+    "--application",
+    default=None,
+    help="""Name of an application to restore from the package.
+
+May be specified multiple times. All applications are restored if not
+specified.
+""",
+    multiple=True,
+    type=str,
+)
+@click.option(
+    "--jobs",
+    default=None,
+    help="Number of worker processes. Defaults to the number of CPUs.",
+    type=click.IntRange(min=1),
+)
+@encryption_options
+def click_entry(
+    package_file: pathlib.Path,
+    target_dir: pathlib.Path,
+    application: typing.Optional[typing.List[str]],
+    jobs: typing.Optional[int],
+    encryption_key_file: typing.Optional[pathlib.Path],
+    encryption_key_secret: typing.Optional[str],
+    azure_subscription: typing.Optional[str],
+) -> None:
+    """
+    Restore application source from a backup package.
+
+    Repository archives in the backup package are verified against their
+    sha256sum files and extracted into TARGET_DIR in parallel. Encrypted
+    (".enc") packages are decrypted with the specified key.
+    """
+    try:
+        encryption_key = load_encryption_key(
+            encryption_key_file, encryption_key_secret, azure_subscription
+        )
+        records = main(
+            package_file, target_dir, application, jobs, encryption_key
+        )
+
+        for x in records:
+            click.echo(
+                f"{x.archive_name}: {x.size} bytes in "
+                f"{x.elapsed_seconds:.2f}s ({x.rate / 1e6:.1f} MB/s)"
+            )
+    except (EncryptionError, RestoreError) as e:
+        click.echo(f"Restore failed, {str(e)}", err=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        click.echo("User aborted execution. Exiting.")
@@ -0,0 +1,185 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Steps shared by the single project, batch and serve runs."""
+
+import logging
+import pathlib
+import typing
+
+from ._backend import GitBackendName
+from ._bundle import BundleRecord, BundleState, bundle_key
+from ._families import FamilyRoots, family_roots_path
+from ._file_io import BackupDefinitions
+from ._history import PlanHistory, history_path
+from ._snapshot import ExecutorMode, SnapshotOptions, SnapshotResult
+from ._spool import DEFAULT_SPOOL_BUDGET_BYTES
+from .schema import ApplicationDefinition
+
+log = logging.getLogger(__name__)
+
+GitReferences = typing.Dict[str, str]
+SnapshotKey = typing.Tuple[str, ...]
+DefinitionSnapshots = typing.Iterable[
+    typing.Tuple[ApplicationDefinition, SnapshotResult]
+]
+
+
+def apply_user_refs(
+    data: BackupDefinitions, git_refs: GitReferences
+) -> BackupDefinitions:
+    """
+    Override the release references of definitions with user references.
+
+    Args:
+        data: Application definitions.
+        git_refs: User git references, by definition name.
+
+    Returns:
+        The application definitions, updated in place.
+    """
+    if git_refs:
+        names = git_refs.keys()
+        for x in data:
+            if x.name in names:
+                log.info(
+                    f"applying user git reference, {x.name}, {git_refs[x.name]}"
+                )
+                x.configuration.release.ref = git_refs[x.name]
+
+    return data
+
+
+def construct_snapshot_options(
+    timeout: typing.Optional[float],
+    retries: int,
+    deadline: typing.Optional[float],
+    executor: ExecutorMode,
+    jobs: typing.Optional[int],
+    host_connections: typing.Optional[int] = None,
+    host_rate: typing.Optional[float] = None,
+    git_backend: GitBackendName = "gitpython",
+    detect_families: bool = False,
+    spool_size: typing.Optional[int] = None,
+    spool_budget: int = DEFAULT_SPOOL_BUDGET_BYTES,
+) -> SnapshotOptions:
+    """Construct snapshot options from the values of ``snapshot_options``."""
+    return SnapshotOptions(
+        timeout_seconds=timeout,
+        retries=retries,
+        deadline_seconds=deadline,
+        executor=executor,
+        jobs=jobs,
+        host_connections=host_connections,
+        host_bytes_per_second=host_rate,
+        backend=git_backend,
+        detect_families=detect_families,
+        spool_file_bytes=spool_size,
+        spool_budget_bytes=spool_budget,
+    )
+
+
+def snapshot_key(definition: ApplicationDefinition) -> SnapshotKey:
+    """
+    Identify the snapshot of a definition.
+
+    Entries naming the same repository differently share one archive
+    snapshot, which is renamed for each entry when it is packaged; bundle
+    chains are recorded by name, so bundles are taken for each name.
+
+    Args:
+        definition: Application definition.
+
+    Returns:
+        Key of the snapshot.
+    """
+    backup = definition.configuration.backup
+    return (
+        str(backup.repo_url),
+        ",".join(definition.configuration.snapshot_refs()),
+        backup.format,
+        definition.name if backup.format == "bundle" else "",
+        ",".join(backup.include_paths),
+        ",".join(backup.exclude_paths),
+        str(backup.compression_level),
+    )
+
+
+def record_bundles(state: BundleState, snapshots: DefinitionSnapshots) -> bool:
+    """
+    Record bundle snapshots in their chains.
+
+    Args:
+        state: Bundle state to update.
+        snapshots: Application definitions and their snapshots.
+
+    Returns:
+        True if the state changed.
+    """
+    recorded = False
+    for definition, result in snapshots:
+        if result.format == "bundle":
+            state.record(
+                bundle_key(definition),
+                BundleRecord(
+                    file_name=result.archive_path.name,
+                    tip=result.sha,
+                    prerequisite=result.prerequisite,
+                    sha256=result.sha256,
+                ),
+            )
+            recorded = True
+
+    return recorded
+
+
+def record_roots(
+    family_roots: FamilyRoots,
+    state_path: pathlib.Path,
+    snapshots: DefinitionSnapshots,
+) -> None:
+    """
+    Record the root commits of repositories, for detecting families.
+
+    Args:
+        family_roots: Recorded root commits to update.
+        state_path: Path to bundle state file.
+        snapshots: Application definitions and their snapshots.
+    """
+    recorded = False
+    for definition, result in snapshots:
+        if family_roots.record(definition, result.root_commits):
+            recorded = True
+
+    if recorded:
+        family_roots.save(family_roots_path(state_path))
+
+
+def record_history(
+    bundle_state_path: typing.Optional[pathlib.Path],
+    state_path: pathlib.Path,
+    snapshots: DefinitionSnapshots,
+) -> None:
+    """
+    Record the snapshot history of a run, for planning runs.
+
+    Plain archive runs only leave their packages in the output directory, so
+    history is only recorded once its file exists, or the bundle state file
+    is given.
+
+    Args:
+        bundle_state_path: Bundle state file given by the user, if any.
+        state_path: Path to bundle state file.
+        snapshots: Application definitions and their snapshots.
+    """
+    this_path = history_path(state_path)
+    if (bundle_state_path is None) and not this_path.is_file():
+        return
+
+    history = PlanHistory.load(this_path)
+    if history.record(snapshots):
+        history.save(this_path)
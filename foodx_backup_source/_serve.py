@@ -0,0 +1,821 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Long running backup daemon with a local status and trigger API."""
+
+import asyncio
+import datetime
+import functools
+import io
+import logging
+import pathlib
+import signal
+import sys
+import tempfile
+import typing
+
+import click
+import git
+import pydantic
+from aiohttp import web
+
+from ._backend import GitBackendName
+from ._bundle import DEFAULT_BUNDLE_STATE_FILE, BundleState, bundle_key
+from ._encrypt import EncryptionError, encryption_options, load_encryption_key
+from ._families import (
+    FamilyRoots,
+    ObjectFamilies,
+    assign_families,
+    family_roots_path,
+    is_filtered,
+)
+from ._file_io import (
+    BackupDefinitions,
+    PathSet,
+    discover_backup_definitions,
+    load_backup_definitions,
+)
+from ._main import (
+    DEFAULT_OUTPUT_PATH,
+    _process_gitref_options,
+    bundle_state_option,
+    package_format_option,
+    snapshot_options,
+    tree_hash_option,
+)
+from ._package import PackageFormat, write_package
+from ._plan import ls_remote
+from ._run import (
+    GitReferences,
+    SnapshotKey,
+    apply_user_refs,
+    construct_snapshot_options,
+    record_bundles,
+    record_history,
+    record_roots,
+    snapshot_key,
+)
+from ._snapshot import (
+    ExecutorMode,
+    SnapshotError,
+    SnapshotOptions,
+    SnapshotResult,
+    archive_executor_scope,
+    authorized_url,
+    construct_governor,
+    iter_snapshots,
+)
+from .schema import ApplicationDefinition
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LISTEN = "127.0.0.1:8470"
+DEFAULT_POLL_SECONDS = 10.0
+
+FileSignature = typing.FrozenSet[typing.Tuple[str, int, int]]
+
+
+class ServeError(Exception):
+    """The daemon could not complete a requested operation."""
+
+
+class SnapshotStatus(pydantic.BaseModel):
+    """Cached snapshot of a repository."""
+
+    name: str
+    ref: str
+    sha: str
+    sha256: str
+
+
+class DaemonStatus(pydantic.BaseModel):
+    """Current state of the daemon."""
+
+    project_name: str
+    snapshots: typing.List[SnapshotStatus]
+    # definitions without a cached snapshot
+    pending: typing.List[str]
+    last_refresh: typing.Optional[datetime.datetime]
+    last_package: typing.Optional[datetime.datetime]
+    packages: typing.List[str]
+    error: typing.Optional[str]
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _file_signature(files: PathSet) -> FileSignature:
+    signature = set()
+    for x in files:
+        stat = x.stat()
+        signature.add((str(x), stat.st_mtime_ns, stat.st_size))
+
+    return frozenset(signature)
+
+
+def _snapshot_shas(result: SnapshotResult) -> typing.Dict[str, str]:
+    """Commits of the references of a snapshot."""
+    shas = {result.ref: result.sha}
+    shas.update({x.ref: x.sha for x in result.ref_archives})
+
+    return shas
+
+
+def _mirror_families(
+    definitions: BackupDefinitions,
+) -> typing.Dict[str, str]:
+    """Warm mirror of each repository, unless it declares a family."""
+    families = {
+        bundle_key(x): f"mirror-{bundle_key(x)}"
+        for x in definitions
+        if not is_filtered(x)
+    }
+    families.update(assign_families(definitions))
+
+    return families
+
+
+class BackupDaemon:
+    """
+    Keep the snapshots of a project current between packaging runs.
+
+    Definitions, the archive process pool, the transfer governor and the
+    repository snapshots stay loaded for the life of the daemon. The
+    dependency files are polled for changes, and the branches of cached
+    snapshots are polled for new commits; only definitions that have no
+    snapshot at their current repository, reference and commit are
+    snapshot, and failed snapshots are retried at each poll. Packages are
+    written from the cached snapshots.
+
+    With the GitPython backend each repository is fetched into a mirror that
+    is kept for the life of the daemon, so a new snapshot only fetches the
+    objects added since the last one.
+    """
+
+    def __init__(
+        self,
+        project_name: str,
+        project_directory: pathlib.Path,
+        output_directory: pathlib.Path,
+        archive_directory: pathlib.Path,
+        token: typing.Optional[str] = None,
+        git_refs: typing.Optional[GitReferences] = None,
+        options: typing.Optional[SnapshotOptions] = None,
+        bundle_state_path: typing.Optional[pathlib.Path] = None,
+        package_format: PackageFormat = "tar.gz",
+        encryption_key: typing.Optional[bytes] = None,
+        tree_hash: bool = False,
+        archive_executor: typing.Optional[typing.Any] = None,
+    ) -> None:
+        """
+        Construct ``BackupDaemon`` object.
+
+        Must be constructed in the event loop the daemon runs in.
+
+        Args:
+            project_name: Name of project to use as package file name prefix.
+            project_directory: Directory of the dependencies YAML files.
+            output_directory: Directory to output package files.
+            archive_directory: Directory to keep snapshot archives in.
+            token: Personal access token for repository access.
+            git_refs: User overrides of application git references.
+            options: Repository snapshot execution controls.
+            bundle_state_path: Bundle chain state file; defaults to
+                               ``bundle-state.json`` in the output directory.
+            package_format: Package file format.
+            encryption_key: Key to encrypt packages with, if any.
+            tree_hash: Also write a chunked tree hash file of each package.
+            archive_executor: Process pool for archive work, if any.
+        """
+        self.project_name = project_name
+        self.project_directory = project_directory
+        self.output_directory = output_directory
+        self.archive_directory = archive_directory
+        self.token = token
+        self.git_refs = git_refs or dict()
+        self.options = options or SnapshotOptions()
+        self.package_format = package_format
+        self.encryption_key = encryption_key
+        self.tree_hash = tree_hash
+        self.archive_executor = archive_executor
+        self.governor = construct_governor(self.options)
+        self.bundle_state_path = bundle_state_path
+        self.state_path = bundle_state_path or (
+            output_directory / DEFAULT_BUNDLE_STATE_FILE
+        )
+        self.bundle_state = BundleState.load(self.state_path)
+        self.family_roots = FamilyRoots.load(family_roots_path(self.state_path))
+        self.mirrors = (
+            ObjectFamilies(
+                archive_directory / "mirrors",
+                dict(),
+                self.options.detect_families,
+            )
+            if self.options.backend == "gitpython"
+            else None
+        )
+
+        self.last_refresh: typing.Optional[datetime.datetime] = None
+        self.last_package: typing.Optional[datetime.datetime] = None
+        self.packages: typing.List[pathlib.Path] = list()
+        self.error: typing.Optional[str] = None
+
+        self._lock = asyncio.Lock()
+        self._signature: typing.Optional[FileSignature] = None
+        self._definitions: BackupDefinitions = list()
+        self._snapshots: typing.Dict[SnapshotKey, SnapshotResult] = dict()
+        # bundle snapshots already recorded in their chains
+        self._recorded: typing.Set[SnapshotKey] = set()
+        # references of cached snapshots that are branches
+        self._branches: typing.Dict[SnapshotKey, typing.List[str]] = dict()
+        self._rounds = 0
+
+    def _evict(self, keys: typing.Iterable[SnapshotKey]) -> None:
+        for x in keys:
+            result = self._snapshots.pop(x)
+            self._recorded.discard(x)
+            self._branches.pop(x, None)
+            for this_path in result.archive_files():
+                if this_path.is_file():
+                    this_path.unlink()
+
+    async def _resolve_branches(
+        self, definition: ApplicationDefinition
+    ) -> typing.Dict[str, str]:
+        """Commits of the branch references of a definition, if reachable."""
+        loop = asyncio.get_running_loop()
+        refs = definition.configuration.snapshot_refs()
+        try:
+            remote_refs = await loop.run_in_executor(
+                None,
+                ls_remote,
+                authorized_url(
+                    definition.configuration.backup.repo_url, self.token
+                ),
+                refs,
+            )
+        except git.GitCommandError as e:
+            message = str(e.stderr).strip()
+            if self.token:
+                message = message.replace(self.token, "***")
+            log.warning(
+                f"remote references failed, {definition.name}, {message}"
+            )
+            return dict()
+
+        # a tag takes precedence over a branch of the same name
+        return {
+            x: remote_refs[f"refs/heads/{x}"]
+            for x in refs
+            if (f"refs/heads/{x}" in remote_refs)
+            and (f"refs/tags/{x}" not in remote_refs)
+        }
+
+    async def _moved(
+        self, current: typing.Dict[SnapshotKey, ApplicationDefinition]
+    ) -> typing.Set[SnapshotKey]:
+        """Cached snapshots with branches that have moved on since."""
+        keys = [x for x in current if self._branches.get(x)]
+        resolved = await asyncio.gather(
+            *[self._resolve_branches(current[x]) for x in keys]
+        )
+        moved: typing.Set[SnapshotKey] = set()
+        for key, branch_shas in zip(keys, resolved):
+            snapshot_shas = _snapshot_shas(self._snapshots[key])
+            if any(snapshot_shas.get(x) != y for x, y in branch_shas.items()):
+                log.info(f"branch moved, {current[key].name}")
+                moved.add(key)
+
+        return moved
+
+    async def refresh(self, force: bool = False) -> typing.List[str]:
+        """
+        Snapshot definitions whose repository, reference or commit changed.
+
+        The dependency files are only reloaded if they have changed, or if
+        forced. Snapshots of definitions that no longer exist are discarded,
+        snapshots of branches that have moved on are replaced, and pending
+        snapshots are retried.
+
+        Args:
+            force: Reload the definitions even if the dependency files have
+                   not changed.
+
+        Returns:
+            Names of the definitions snapshot.
+        """
+        async with self._lock:
+            files = discover_backup_definitions(self.project_directory)
+            signature = _file_signature(files)
+            reload = force or (signature != self._signature)
+            if reload:
+                self._definitions = apply_user_refs(
+                    await load_backup_definitions(files), self.git_refs
+                )
+                self._signature = signature
+            current = {snapshot_key(x): x for x in self._definitions}
+            self._evict(set(self._snapshots) - set(current))
+
+            # branches move on without any change to the dependency files
+            moved = await self._moved(current)
+            changed = {
+                x.name: x
+                for key, x in current.items()
+                if (key not in self._snapshots) or (key in moved)
+            }
+            if not (reload or changed):
+                return list()
+
+            snapshot_names: typing.List[str] = list()
+            self.error = None
+            if changed:
+                log.info(f"snapshots required, {sorted(changed)}")
+                # each round has its own directory so that archive file names
+                # never collide with cached snapshots
+                round_directory = self.archive_directory / f"{self._rounds}"
+                round_directory.mkdir()
+                self._rounds += 1
+                options = self.options.copy(
+                    update={
+                        "bundle_tips": self.bundle_state.tips(),
+                        "repository_roots": self.family_roots.roots,
+                    }
+                )
+                if self.mirrors:
+                    self.mirrors.families = _mirror_families(
+                        list(changed.values())
+                    )
+                new_keys: typing.List[SnapshotKey] = list()
+                try:
+                    async for result in iter_snapshots(
+                        changed.values(),
+                        round_directory,
+                        self.token,
+                        options,
+                        self.archive_executor,
+                        self.governor,
+                        families=self.mirrors,
+                    ):
+                        key = snapshot_key(changed[result.name])
+                        if key in self._snapshots:
+                            # the snapshot of a moved branch
+                            self._evict([key])
+                        self._snapshots[key] = result
+                        new_keys.append(key)
+                        snapshot_names.append(result.name)
+                except SnapshotError as e:
+                    self.error = str(e)
+                branches = await asyncio.gather(
+                    *[self._resolve_branches(current[x]) for x in new_keys]
+                )
+                self._branches.update(
+                    (x, list(y)) for x, y in zip(new_keys, branches)
+                )
+            self.last_refresh = _now()
+
+        return snapshot_names
+
+    async def package(self) -> typing.List[pathlib.Path]:
+        """
+        Package the cached snapshots of the current definitions.
+
+        Returns:
+            List of files created.
+        Raises:
+            ServeError: If the definitions have not been loaded, or any
+                        definition does not have a snapshot.
+        """
+        async with self._lock:
+            if self._signature is None:
+                raise ServeError("definitions not loaded")
+            pending = self._pending()
+            if pending:
+                raise ServeError(f"snapshots pending, {pending}")
+
+            results = [
+                self._snapshots[snapshot_key(x)] for x in self._definitions
+            ]
+            loop = asyncio.get_running_loop()
+            created_files = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    write_package,
+                    self.project_name,
+                    self.output_directory,
+                    results,
+                    self.package_format,
+                    self.encryption_key,
+                    self.tree_hash,
+                ),
+            )
+
+            # a cached bundle is only recorded the first time it is packaged
+            unrecorded = [
+                (x, y)
+                for x, y in zip(self._definitions, results)
+                if snapshot_key(x) not in self._recorded
+            ]
+            if record_bundles(self.bundle_state, unrecorded):
+                self.bundle_state.save(self.state_path)
+            record_roots(self.family_roots, self.state_path, unrecorded)
+            record_history(self.bundle_state_path, self.state_path, unrecorded)
+            self._recorded.update(snapshot_key(x) for x, _ in unrecorded)
+
+            self.packages = created_files
+            self.last_package = _now()
+
+        return created_files
+
+    def _pending(self) -> typing.List[str]:
+        return [
+            x.name
+            for x in self._definitions
+            if snapshot_key(x) not in self._snapshots
+        ]
+
+    def status(self) -> DaemonStatus:
+        """Report the current state of the daemon."""
+        return DaemonStatus(
+            project_name=self.project_name,
+            snapshots=[
+                SnapshotStatus(
+                    name=x.name, ref=x.ref, sha=x.sha, sha256=x.sha256
+                )
+                for x in self._snapshots.values()
+            ],
+            pending=self._pending(),
+            last_refresh=self.last_refresh,
+            last_package=self.last_package,
+            packages=[str(x) for x in self.packages],
+            error=self.error,
+        )
+
+    async def run(
+        self,
+        stop: asyncio.Event,
+        poll_seconds: float = DEFAULT_POLL_SECONDS,
+        package_seconds: typing.Optional[float] = None,
+    ) -> None:
+        """
+        Poll for definition changes, and package on schedule, until stopped.
+
+        Failures are logged and reported in the status; the daemon continues.
+
+        Args:
+            stop: Stop the daemon when set.
+            poll_seconds: Interval between checks of the dependency files.
+            package_seconds: Interval between packages, if any.
+        """
+        loop = asyncio.get_running_loop()
+        next_package = (
+            (loop.time() + package_seconds) if package_seconds else None
+        )
+        while not stop.is_set():
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.exception("definitions refresh failed")
+                self.error = str(e)
+
+            if (next_package is not None) and (loop.time() >= next_package):
+                next_package = loop.time() + typing.cast(float, package_seconds)
+                try:
+                    await self.package()
+                except Exception as e:
+                    log.exception("scheduled package failed")
+                    self.error = str(e)
+
+            wait_seconds = (
+                poll_seconds
+                if next_package is None
+                else min(poll_seconds, max(0, next_package - loop.time()))
+            )
+            try:
+                await asyncio.wait_for(stop.wait(), wait_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+
+def make_application(daemon: BackupDaemon) -> web.Application:
+    """
+    Construct the daemon status and trigger API.
+
+    * ``GET /status``: Daemon status.
+    * ``POST /refresh``: Reload the definitions and snapshot any changes.
+    * ``POST /package``: Package the cached snapshots.
+
+    Args:
+        daemon: Daemon to serve.
+
+    Returns:
+        Web application.
+    """
+
+    async def _status(request: web.Request) -> web.Response:
+        return web.json_response(text=daemon.status().json())
+
+    async def _refresh(request: web.Request) -> web.Response:
+        try:
+            names = await daemon.refresh(force=True)
+        except Exception as e:
+            log.exception("definitions refresh failed")
+            daemon.error = str(e)
+            return web.json_response({"error": daemon.error}, status=500)
+        return web.json_response({"snapshots": names, "error": daemon.error})
+
+    async def _package(request: web.Request) -> web.Response:
+        try:
+            created_files = await daemon.package()
+        except ServeError as e:
+            return web.json_response({"error": str(e)}, status=409)
+        return web.json_response({"packages": [str(x) for x in created_files]})
+
+    application = web.Application()
+    application.add_routes(
+        [
+            web.get("/status", _status),
+            web.post("/refresh", _refresh),
+            web.post("/package", _package),
+        ]
+    )
+
+    return application
+
+
+def _parse_listen(listen: str) -> typing.Tuple[str, int]:
+    host, _, port = listen.rpartition(":")
+    if (not host) or (not port.isdigit()):
+        raise ServeError(f"Malformed listen address, {listen}")
+
+    return host, int(port)
+
+
+async def _launch_daemon(
+    project_name: str,
+    project_directory: pathlib.Path,
+    output_directory: pathlib.Path,
+    token: typing.Optional[str],
+    git_refs: GitReferences,
+    options: SnapshotOptions,
+    bundle_state_path: typing.Optional[pathlib.Path],
+    package_format: PackageFormat,
+    encryption_key: typing.Optional[bytes],
+    tree_hash: bool,
+    listen: str,
+    unix_socket: typing.Optional[pathlib.Path],
+    poll_seconds: float,
+    package_seconds: typing.Optional[float],
+) -> None:
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    handled_signals = list()
+    for x in [signal.SIGINT, signal.SIGTERM]:
+        try:
+            loop.add_signal_handler(x, stop.set)
+            handled_signals.append(x)
+        except NotImplementedError:
+            # not supported on Windows; KeyboardInterrupt still stops
+            pass
+
+    with tempfile.TemporaryDirectory() as d:
+        async with archive_executor_scope(options) as archive_executor:
+            daemon = BackupDaemon(
+                project_name,
+                project_directory,
+                output_directory,
+                pathlib.Path(d),
+                token,
+                git_refs,
+                options,
+                bundle_state_path,
+                package_format,
+                encryption_key,
+                tree_hash,
+                archive_executor,
+            )
+            runner = web.AppRunner(make_application(daemon))
+            await runner.setup()
+            site: web.BaseSite
+            if unix_socket:
+                site = web.UnixSite(runner, str(unix_socket))
+            else:
+                host, port = _parse_listen(listen)
+                site = web.TCPSite(runner, host, port)
+            await site.start()
+            log.info(f"daemon serving, {site.name}")
+            try:
+                await daemon.run(stop, poll_seconds, package_seconds)
+            finally:
+                await runner.cleanup()
+                for x in handled_signals:
+                    loop.remove_signal_handler(x)
+                log.info("daemon stopped")
+
+
+def main(
+    project_name: str,
+    project_directory: pathlib.Path,
+    output_dir: pathlib.Path,
+    git_ref: typing.Optional[typing.List[str]],
+    token_value: typing.Optional[str],
+    options: typing.Optional[SnapshotOptions] = None,
+    bundle_state: typing.Optional[pathlib.Path] = None,
+    package_format: PackageFormat = "tar.gz",
+    encryption_key: typing.Optional[bytes] = None,
+    tree_hash: bool = False,
+    listen: str = DEFAULT_LISTEN,
+    unix_socket: typing.Optional[pathlib.Path] = None,
+    poll_interval: float = DEFAULT_POLL_SECONDS,
+    package_interval: typing.Optional[float] = None,
+) -> None:
+    """
+    Run the backup daemon until stopped.
+
+    Args:
+        project_name: Name of project to use as file name prefix.
+        project_directory: Directory of the dependencies YAML files.
+        output_dir: Directory to output package files.
+        git_ref: User overrides of application git references.
+        token_value: Personal access token for repository access.
+        options: Repository snapshot execution controls.
+        bundle_state: Bundle chain state file; defaults to
+                      ``bundle-state.json`` in the output directory.
+        package_format: Package file format.
+        encryption_key: Key to encrypt packages with, if any.
+        tree_hash: Also write a chunked tree hash file of each package.
+        listen: API address in the form ``<host>:<port>``.
+        unix_socket: API Unix socket path; replaces ``listen``.
+        poll_interval: Seconds between checks of the dependency files.
+        package_interval: Seconds between scheduled packages, if any.
+    """
+    processed_refs = _process_gitref_options(git_ref)
+    asyncio.run(
+        _launch_daemon(
+            project_name,
+            project_directory,
+            output_dir,
+            token_value,
+            processed_refs,
+            options or SnapshotOptions(),
+            bundle_state,
+            package_format,
+            encryption_key,
+            tree_hash,
+            listen,
+            unix_socket,
+            poll_interval,
+            package_interval,
+        )
+    )
+
+
+@click.command()
+@click.argument("project_name", type=str)
+@click.argument(
+    "project_directory",
+    type=click.Path(
+        dir_okay=True, exists=True, file_okay=False, path_type=pathlib.Path
+    ),
+)
+@click.option(
+    "--output-dir",
+    default=DEFAULT_OUTPUT_PATH,
+    help="Directory path to save output tar file and SHA.",
+    type=click.Path(
+        dir_okay=True, exists=True, file_okay=False, path_type=pathlib.Path
+    ),
+)
+@click.option(
+    "--git-ref",
+    default=None,
+    help="""Specify a git reference for the named repo.
+
+The reference is specified in the form `<name>=<gitref>` where the name is
+an entry in the dependencies YAML files acquired from PROJECT_DIRECTORY.
+""",
+    multiple=True,
+    type=str,
+)
+@click.option(
+    "--token-file",
+    default=None,
+    help="""Personal access token for authenticating against repositories.
+
+A single token must have read access to all the repositories defined in the
+backup.
+""",
+    type=click.File(mode="r"),
+)
+@click.option(
+    "--listen",
+    default=DEFAULT_LISTEN,
+    help="Address of the status and trigger API, `<host>:<port>`.",
+    show_default=True,
+    type=str,
+)
+@click.option(
+    "--unix-socket",
+    default=None,
+    help="Serve the status and trigger API on a Unix socket instead.",
+    type=click.Path(dir_okay=False, file_okay=True, path_type=pathlib.Path),
+)
+@click.option(
+    "--poll-interval",
+    default=DEFAULT_POLL_SECONDS,
+    help="Seconds between checks of the dependencies YAML files for changes.",
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+)
+@click.option(
+    "--package-interval",
+    default=None,
+    help="""Seconds between scheduled packages.
+
+Without a schedule, packages are only written on request to the API.
+""",
+    type=click.FloatRange(min=0, min_open=True),
+)
+@encryption_options
+@tree_hash_option
+@package_format_option
+@bundle_state_option
+@snapshot_options
+def click_entry(
+    project_name: str,
+    project_directory: pathlib.Path,
+    output_dir: pathlib.Path,
+    git_ref: typing.Optional[typing.List[str]],
+    token_file: typing.Optional[io.TextIOBase],
+    listen: str,
+    unix_socket: typing.Optional[pathlib.Path],
+    poll_interval: float,
+    package_interval: typing.Optional[float],
+    timeout: typing.Optional[float],
+    retries: int,
+    deadline: typing.Optional[float],
+    executor: ExecutorMode,
+    jobs: typing.Optional[int],
+    host_connections: typing.Optional[int],
+    host_rate: typing.Optional[float],
+    git_backend: GitBackendName,
+    detect_families: bool,
+    bundle_state: typing.Optional[pathlib.Path],
+    package_format: PackageFormat,
+    tree_hash: bool,
+    encryption_key_file: typing.Optional[pathlib.Path],
+    encryption_key_secret: typing.Optional[str],
+    azure_subscription: typing.Optional[str],
+) -> None:
+    """
+    Run a backup daemon for a project.
+
+    The dependencies YAML files in PROJECT_DIRECTORY are watched, and each
+    repository is snapshot when its repository or release reference changes.
+    Packages of the snapshots are written on a schedule, or on request to the
+    local HTTP API (`GET /status`, `POST /refresh`, `POST /package`).
+    """
+    try:
+        token_value = None
+        if token_file:
+            token_value = token_file.read().strip()
+
+        encryption_key = load_encryption_key(
+            encryption_key_file, encryption_key_secret, azure_subscription
+        )
+        options = construct_snapshot_options(
+            timeout,
+            retries,
+            deadline,
+            executor,
+            jobs,
+            host_connections,
+            host_rate,
+            git_backend,
+            detect_families,
+        )
+        main(
+            project_name,
+            project_directory,
+            output_dir,
+            git_ref,
+            token_value,
+            options,
+            bundle_state,
+            package_format,
+            encryption_key,
+            tree_hash,
+            listen,
+            unix_socket,
+            poll_interval,
+            package_interval,
+        )
+    except (EncryptionError, ServeError) as e:
+        click.echo(f"Daemon failed, {str(e)}", err=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        click.echo("User aborted execution. Exiting.")
@@ -5,86 +5,1653 @@
 #  You should have received a copy of the MIT License along with
 #  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
 
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
 import logging
+import multiprocessing
+import os
 import pathlib
+import random
+import re
+import shutil
+import signal
+import sys
 import tempfile
+import threading
+import time
 import typing
 from urllib.parse import urlparse
 
 import git
+import pydantic
 
-from ._hash import create_hash_file
-from .schema import ApplicationDefinition
+from ._backend import (
+    DulwichBackend,
+    GitBackend,
+    GitBackendError,
+    GitBackendName,
+    SubprocessBackend,
+)
+from ._bundle import bundle_key, write_empty_bundle
+from ._compress import (
+    DEFAULT_COMPRESSION_LEVEL,
+    compress_tar_file,
+    reprefix_archive,
+)
+from ._families import ObjectFamilies, assign_families
+from ._governor import (
+    TransferGovernor,
+    directory_size,
+    transfer_host,
+    transfer_queued,
+)
+from ._hash import create_file_hash, write_hash_file
+from ._profile import call_in_phase
+from ._spool import DEFAULT_SPOOL_BUDGET_BYTES, ArchiveSpool
+from .schema import ApplicationDefinition, BackupFormat
 
 log = logging.getLogger(__name__)
 
+# git transport failures that are worth retrying
+TRANSIENT_ERROR_PATTERN = re.compile(
+    r"(returned error: (408|429|5\d\d))"
+    r"|(could not resolve host)"
+    r"|(failed to connect)"
+    r"|(connection (reset|refused|timed out))"
+    r"|(operation timed out)"
+    r"|(unexpected http resp (408|429|5\d\d))"
+    r"|(early eof)"
+    r"|(rpc failed)"
+    r"|(remote end hung up unexpectedly)"
+    r"|(gnutls_handshake|ssl_error)",
+    re.IGNORECASE,
+)
+
+ExecutorMode = typing.Literal["thread", "process"]
+
+T = typing.TypeVar("T")
+
+
+class SnapshotError(Exception):
+    """Problem acquiring one or more repository snapshots."""
+
+    def __init__(
+        self,
+        message: str,
+        timed_out: typing.Optional[typing.List[str]] = None,
+        failed: typing.Optional[typing.Dict[str, str]] = None,
+    ) -> None:
+        """
+        Construct ``SnapshotError`` object.
+
+        Args:
+            message: Error message.
+            timed_out: Names of applications whose snapshots timed out.
+            failed: Error messages of failed snapshots by application name.
+        """
+        super().__init__(message)
+        self.timed_out = timed_out or list()
+        self.failed = failed or dict()
+
+
+class SnapshotTimeoutError(Exception):
+    """A repository snapshot did not complete within its time limit."""
+
+
+class SnapshotOptions(pydantic.BaseModel):
+    """Execution controls for repository snapshots."""
+
+    # time limit for each repository, including retries
+    timeout_seconds: typing.Optional[float] = None
+    # number of retries after a transient git transport failure
+    retries: int = 2
+    # exponential backoff base and limit for retry delays
+    backoff_seconds: float = 1.0
+    backoff_limit_seconds: float = 60.0
+    # time limit for all the snapshots of a run
+    deadline_seconds: typing.Optional[float] = None
+    # "process" runs archive, compress and hash work in a process pool
+    executor: ExecutorMode = "thread"
+    # process pool size; defaults to the CPU count
+    jobs: typing.Optional[int] = None
+    # recorded tips of bundle chains, for incremental bundles
+    bundle_tips: typing.Dict[str, str] = dict()
+    # concurrent transfers, and average transfer rate, for each git host
+    host_connections: typing.Optional[int] = None
+    host_bytes_per_second: typing.Optional[float] = None
+    # git backend to fetch, resolve and archive repositories
+    backend: GitBackendName = "gitpython"
+    # share objects between repositories with a common root commit, using
+    # the root commits recorded by previous runs
+    detect_families: bool = False
+    repository_roots: typing.Dict[str, typing.List[str]] = dict()
+    # archives up to this size are held in memory until packaged, within a
+    # budget for all the archives of a run
+    spool_file_bytes: typing.Optional[int] = None
+    spool_budget_bytes: int = DEFAULT_SPOOL_BUDGET_BYTES
+
+
+class SnapshotTimings(pydantic.BaseModel):
+    """Elapsed time of repository snapshot phases."""
+
+    clone_seconds: float
+    archive_seconds: float
+    total_seconds: float
+
+
+class ArchiveRecord(pydantic.BaseModel):
+    """Outcome of archiving a cloned repository, returned from a worker."""
+
+    sha256: str
+    size: int
+
+
+class RefArchive(pydantic.BaseModel):
+    """Archive of an additional reference of a repository snapshot."""
+
+    ref: str
+    sha: str
+    archive_path: pathlib.Path
+    hash_path: pathlib.Path
+    sha256: str
+
+
+class SnapshotResult(pydantic.BaseModel):
+    """Outcome of a repository snapshot."""
+
+    name: str
+    ref: str
+    sha: str
+    archive_path: pathlib.Path
+    hash_path: pathlib.Path
+    sha256: str
+    timings: SnapshotTimings
+    format: BackupFormat = "archive"
+    # commit that an incremental bundle depends on
+    prerequisite: typing.Optional[str] = None
+    # archives of further references, from the same fetch
+    ref_archives: typing.List[RefArchive] = list()
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL
+    # root commits of the snapshot references, when detecting families
+    root_commits: typing.List[str] = list()
+    # sizes of the fetched objects, the clone and the archives, for planning
+    transfer_bytes: int = 0
+    clone_bytes: int = 0
+    archive_bytes: int = 0
+
+    def archive_files(self) -> typing.List[pathlib.Path]:
+        """List the archive and hash files of all the snapshot references."""
+        files = [self.archive_path, self.hash_path]
+        for x in self.ref_archives:
+            files += [x.archive_path, x.hash_path]
+
+        return files
+
+
+def _kill_process(process: git.cmd.Git.AutoInterrupt) -> None:
+    if process.proc and (process.proc.poll() is None):
+        log.info(f"killing git process, {process.proc.pid}")
+        if hasattr(os, "killpg"):
+            # git runs transport helpers (git-remote-https) as its own child
+            # processes, so kill the whole process group.
+            os.killpg(process.proc.pid, signal.SIGKILL)
+        else:
+            process.proc.kill()
+
+
+def _kill_published_process(pid_path: pathlib.Path) -> None:
+    """Kill a git process started in a process pool worker, by its pid file."""
+    try:
+        # the worker kills its git process itself if this file exists first
+        with pid_path.open(mode="x"):
+            return
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        # the archive is complete and its pid directory removed
+        return
+    with contextlib.suppress(FileNotFoundError):
+        content = pid_path.read_text()
+        if content:
+            pid = int(content)
+            log.info(f"killing git process, {pid}")
+            with contextlib.suppress(ProcessLookupError):
+                if hasattr(os, "killpg"):
+                    os.killpg(pid, signal.SIGKILL)
+                else:
+                    os.kill(pid, signal.SIGTERM)
+
+
+def _publish_pid(pid_path: pathlib.Path, pid: int) -> bool:
+    """
+    Publish the id of a git process to its pid file, unless already claimed.
+
+    Returns:
+        Whether the process id was published.
+    """
+    temporary_path = pid_path.parent / f"{pid_path.name}.partial"
+    temporary_path.write_text(str(pid))
+    try:
+        os.link(temporary_path, pid_path)
+    except FileExistsError:
+        return False
+    finally:
+        temporary_path.unlink()
+
+    return True
+
+
+class _ProcessTracker:
+    """
+    Track git child processes so they can be killed on cancellation.
+
+    A process pool worker cannot be reached by the tracker of the snapshot,
+    so the tracker of the worker publishes the id of its git process to a pid
+    file that the tracker of the snapshot follows. The pid file is linked
+    into place once written, so the tracker of the snapshot either reads a
+    whole process id, or claims the pid file first, in which case the worker
+    kills its git process as soon as it is started.
+    """
+
+    def __init__(self, pid_path: typing.Optional[pathlib.Path] = None) -> None:
+        """
+        Construct ``_ProcessTracker`` object.
+
+        Args:
+            pid_path: File to publish the id of the git process to, in a
+                      process pool worker.
+        """
+        self._lock = threading.Lock()
+        self._processes: typing.List[git.cmd.Git.AutoInterrupt] = list()
+        self._pid_path = pid_path
+        self._pid_paths: typing.List[pathlib.Path] = list()
+        self._cancelled = False
+
+    @property
+    def cancelled(self) -> bool:
+        """Indicate the tracked processes have been killed."""
+        return self._cancelled
+
+    def start(
+        self,
+        git_command: git.Git,
+        arguments: typing.List[str],
+        env: typing.Optional[typing.Dict[str, str]] = None,
+    ) -> git.cmd.Git.AutoInterrupt:
+        """Start a git process in a new process group, tracking it."""
+        with self._lock:
+            process = git_command.execute(
+                ["git"] + arguments,
+                as_process=True,
+                start_new_session=True,
+                env=env,
+            )
+            self._processes.append(process)
+            if (
+                self._pid_path
+                and process.proc
+                and not _publish_pid(self._pid_path, process.proc.pid)
+            ):
+                # claimed by the tracker of the snapshot as it was cancelled
+                self._cancelled = True
+            if self._cancelled:
+                _kill_process(process)
+
+        return process
+
+    def track_pid_file(self, pid_path: pathlib.Path) -> None:
+        """Track the git process of a process pool worker by its pid file."""
+        with self._lock:
+            self._pid_paths.append(pid_path)
+            if self._cancelled:
+                _kill_published_process(pid_path)
+
+    def kill_all(self) -> None:
+        """Kill all the tracked git processes that are still running."""
+        with self._lock:
+            self._cancelled = True
+            for x in self._processes:
+                _kill_process(x)
+            for y in self._pid_paths:
+                _kill_published_process(y)
+
 
 def _construct_tarfile_path(
     name: str,
     git_ref: str,
     archive_path: pathlib.Path,
 ) -> pathlib.Path:
-    file_path = archive_path / f"{name}-{git_ref}.tar.gz"
+    # branch names may contain slashes
+    file_path = archive_path / f"{name}-{git_ref.replace('/', '_')}.tar.gz"
 
     return file_path
 
 
-def _create_tarfile(
-    name: str, git_ref: str, tarfile_path: pathlib.Path, this_repo: git.Repo
+def _construct_bundle_path(
+    name: str,
+    git_ref: str,
+    archive_path: pathlib.Path,
+) -> pathlib.Path:
+    # branch names may contain slashes
+    file_path = archive_path / f"{name}-{git_ref.replace('/', '_')}.bundle"
+
+    return file_path
+
+
+def _run_transfer(
+    git_command: git.Git,
+    arguments: typing.List[str],
+    tracker: _ProcessTracker,
+    governor: TransferGovernor,
+    host: str,
+    objects_directory: pathlib.Path,
 ) -> None:
-    with tarfile_path.open(mode="wb") as f:
-        this_repo.archive(
-            f,
-            git_ref,
-            format="tar.gz",
-            prefix=f"{name}/",
-        )
+    """
+    Run a git command that fetches from a host, as the governor allows.
 
-    create_hash_file(tarfile_path)
+    Response headers are traced to a file so that the ``Retry-After`` of a
+    throttled transfer can pause the host; git does not report it. The
+    transfer size is measured by the growth of the object store.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        trace_path = pathlib.Path(d) / "curl-trace.log"
+        # authorization headers are redacted from the trace by git
+        env = {"GIT_TRACE_CURL": str(trace_path), "GIT_TRACE_CURL_NO_DATA": "1"}
+        with governor.transfer(host, lambda: tracker.cancelled):
+            start_time = time.monotonic()
+            start_size = directory_size(objects_directory)
+            process = tracker.start(git_command, arguments, env=env)
+            try:
+                process.wait()
+            except git.GitCommandError as e:
+                governor.throttle_failed(host, str(e.stderr), trace_path)
+                raise
+            governor.record(
+                host,
+                directory_size(objects_directory) - start_size,
+                start_time,
+            )
 
 
-async def do_snapshot(
+def _clone_repository(
+    url: str,
+    working_directory: pathlib.Path,
+    tracker: _ProcessTracker,
+    sparse: bool = False,
+    governor: typing.Optional[TransferGovernor] = None,
+    reference: typing.Optional[pathlib.Path] = None,
+) -> git.Repo:
+    arguments = ["clone"]
+    if sparse:
+        # a partial clone without blobs; only the blobs needed by the sparse
+        # checkout are fetched later.
+        arguments += ["--filter=blob:none", "--no-checkout"]
+    if reference:
+        # objects of the reference are borrowed via alternates, not fetched
+        arguments.append(f"--reference={reference}")
+    _run_transfer(
+        git.Git(working_directory),
+        arguments + ["--", url, str(working_directory)],
+        tracker,
+        governor or TransferGovernor(),
+        transfer_host(url),
+        working_directory / ".git" / "objects",
+    )
+
+    return git.Repo(working_directory)
+
+
+def _fetch_family(
+    families: ObjectFamilies,
+    family: str,
     definition: ApplicationDefinition,
-    archive_directory: pathlib.Path,
-    token: typing.Optional[str],
+    url: str,
+    tracker: _ProcessTracker,
+    governor: typing.Optional[TransferGovernor] = None,
 ) -> pathlib.Path:
     """
-    Take a snapshot of the specified git repository for backup purposes.
+    Fetch a repository into the object store of its family.
+
+    Fetches of a family are serialized so that each fetch negotiates with all
+    the objects already fetched by the other members.
+
+    Returns:
+        Path of the family store.
+    """
+    with families.lock(family):
+        store_path = families.store(family)
+        log.info(f"fetching into object family, {family}, {definition.name}")
+        _run_transfer(
+            git.Git(store_path),
+            ["fetch", "--quiet", "--no-tags", "--", url]
+            + families.refspecs(family, bundle_key(definition)),
+            tracker,
+            governor or TransferGovernor(),
+            transfer_host(url),
+            store_path / "objects",
+        )
+
+    return store_path
+
+
+def _root_commits(
+    this_repo: git.Repo, shas: typing.List[str]
+) -> typing.List[str]:
+    """List the root commits of resolved commits."""
+    return sorted(set(this_repo.git.rev_list("--max-parents=0", *shas).split()))
+
+
+def _sparse_patterns(
+    include_paths: typing.List[str], exclude_paths: typing.List[str]
+) -> typing.List[str]:
+    """Convert path filters to non-cone sparse checkout patterns."""
+    patterns = [f"/{x.strip('/')}" for x in include_paths] or ["/*"]
+    # the archive takes attributes (export-ignore etc.) from the checkout
+    patterns.append("/.gitattributes")
+    patterns += [f"!/{x.strip('/')}" for x in exclude_paths]
+
+    return patterns
+
+
+def _archive_pathspecs(
+    include_paths: typing.List[str], exclude_paths: typing.List[str]
+) -> typing.List[str]:
+    """Convert path filters to ``git archive`` pathspecs."""
+    pathspecs = [x.strip("/") for x in include_paths]
+    pathspecs += [f":(exclude){x.strip('/')}" for x in exclude_paths]
+
+    return pathspecs
+
+
+def _sparse_checkout(
+    this_repo: git.Repo,
+    sha: str,
+    patterns: typing.List[str],
+    tracker: _ProcessTracker,
+    governor: typing.Optional[TransferGovernor] = None,
+) -> None:
+    """
+    Check out only the filtered paths of a partial clone.
+
+    The checkout fetches the missing blobs of the filtered paths in a single
+    batch, so that ``git archive`` finds them locally.
+    """
+    this_repo.git.config("core.sparseCheckout", "true")
+    git_directory = pathlib.Path(this_repo.git_dir)
+    info_directory = git_directory / "info"
+    info_directory.mkdir(exist_ok=True)
+    (info_directory / "sparse-checkout").write_text("\n".join(patterns) + "\n")
+
+    _run_transfer(
+        this_repo.git,
+        ["checkout", "--detach", sha],
+        tracker,
+        governor or TransferGovernor(),
+        transfer_host(this_repo.remotes.origin.url),
+        git_directory / "objects",
+    )
+
+
+def _create_tarfile(
+    name: str,
+    git_ref: str,
+    tarfile_path: pathlib.Path,
+    this_repo: git.Repo,
+    tracker: typing.Optional[_ProcessTracker] = None,
+    pathspecs: typing.Optional[typing.List[str]] = None,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    spool: typing.Optional[ArchiveSpool] = None,
+) -> str:
+    this_tracker = tracker or _ProcessTracker()
+    # compressed here so that content which is already compressed is stored
+    arguments = ["archive", "--format=tar", f"--prefix={name}/"]
+    if pathspecs:
+        # the tree attributes of a pathspec limited archive are read via a
+        # temporary index of the whole tree, which fetches every missing blob
+        # of a partial clone; read them from the sparse checkout instead.
+        arguments += ["--worktree-attributes", git_ref, "--"] + pathspecs
+    else:
+        arguments.append(git_ref)
+    process = this_tracker.start(this_repo.git, arguments)
+    hash_hexdigest, stored_size = compress_tar_file(
+        process.stdout, tarfile_path, compression_level, spool
+    )
+    process.wait()
+    log.info(
+        f"archive created, {tarfile_path.name}, "
+        f"{stored_size} bytes stored uncompressed"
+        f"{' (in memory)' if spool and (tarfile_path in spool) else ''}"
+    )
+
+    if spool:
+        spool.write_hash_file(hash_hexdigest, tarfile_path)
+    else:
+        write_hash_file(hash_hexdigest, tarfile_path)
+
+    return hash_hexdigest
+
+
+def _create_bundle(
+    ref_name: str,
+    sha: str,
+    since: typing.Optional[str],
+    bundle_path: pathlib.Path,
+    this_repo: git.Repo,
+    tracker: typing.Optional[_ProcessTracker] = None,
+) -> str:
+    """
+    Create a full, or incremental, git bundle of a resolved commit.
 
     Args:
-        definition: application definitions
-        archive_directory: directory to write tar and SHA sum files
+        ref_name: Full reference name to record in the bundle.
+        sha: Commit SHA to bundle.
+        since: Tip of the previous bundle, for an incremental bundle.
+        bundle_path: Path of bundle file to create.
+        this_repo: Cloned repository.
+        tracker: Git process tracker.
+
+    Returns:
+        Hex digest of the bundle file hash.
+    """
+    # bundles only contain references, so name the resolved commit
+    this_repo.git.update_ref(ref_name, sha)
+    if since == sha:
+        log.info(f"no new commits, writing empty bundle, {bundle_path}")
+        write_empty_bundle(bundle_path, ref_name, sha)
+    else:
+        this_tracker = tracker or _ProcessTracker()
+        arguments = ["bundle", "create", str(bundle_path.resolve()), ref_name]
+        if since:
+            arguments.append(f"^{since}")
+        process = this_tracker.start(this_repo.git, arguments)
+        process.wait()
+
+    hash_hexdigest = create_file_hash(bundle_path)
+    write_hash_file(hash_hexdigest, bundle_path)
+
+    return hash_hexdigest
+
+
+def _is_ancestor(this_repo: git.Repo, ancestor: str, sha: str) -> bool:
+    try:
+        this_repo.git.merge_base("--is-ancestor", ancestor, sha)
+    except git.GitCommandError:
+        # not an ancestor, or not in the repository at all
+        return False
+
+    return True
+
+
+def _archive_repository(
+    name: str,
+    git_ref: str,
+    tarfile_path: pathlib.Path,
+    repository_directory: pathlib.Path,
+    pathspecs: typing.List[str],
+    compression_level: int,
+    pid_path: typing.Optional[pathlib.Path] = None,
+) -> ArchiveRecord:
+    """
+    Archive a cloned repository in a process pool worker.
+
+    Only picklable arguments and results cross the process boundary; the
+    repository is re-opened from its directory in the worker. The id of the
+    git process is published to the pid file, if any, until it is complete.
+    """
+    try:
+        with git.Repo(repository_directory) as this_repo:
+            hash_hexdigest = _create_tarfile(
+                name,
+                git_ref,
+                tarfile_path,
+                this_repo,
+                _ProcessTracker(pid_path),
+                pathspecs=pathspecs,
+                compression_level=compression_level,
+            )
+    finally:
+        if pid_path:
+            # the git process has exited, so its id may be reused
+            with contextlib.suppress(FileNotFoundError):
+                pid_path.unlink()
+
+    return ArchiveRecord(
+        sha256=hash_hexdigest, size=tarfile_path.stat().st_size
+    )
+
+
+def _resolve_ref(this_repo: git.Repo, ref: str) -> str:
+    try:
+        return this_repo.commit(ref).hexsha
+    except (git.BadName, ValueError):
+        # a branch other than the default only exists as a remote branch
+        return this_repo.commit(f"origin/{ref}").hexsha
+
+
+def _archive_refs(
+    name: str,
+    refs: typing.List[str],
+    shas: typing.List[str],
+    archive_directory: pathlib.Path,
+    this_repo: git.Repo,
+    tracker: _ProcessTracker,
+    pathspecs: typing.List[str],
+    compression_level: int,
+    archive_executor: typing.Optional[concurrent.futures.Executor],
+    spool: typing.Optional[ArchiveSpool] = None,
+) -> typing.List[typing.Tuple[pathlib.Path, str]]:
+    """
+    Archive references of a cloned repository concurrently.
+
+    Each reference is archived at its resolved commit. The first reference
+    is archived under the application name; further references are archived
+    under ``<name>-<ref>`` so that they restore alongside it. Archives from a
+    process pool are always written to disk; otherwise they are held in the
+    spool, if any, where they fit.
 
     Returns:
-        Path of tar file created
+        Archive path and hash of each reference.
+    """
+    paths = [_construct_tarfile_path(name, x, archive_directory) for x in refs]
+    prefixes = [name] + [x.name[: -len(".tar.gz")] for x in paths[1:]]
+    if archive_executor:
+        with tempfile.TemporaryDirectory() as d:
+            # the workers publish their git process ids to the tracker
+            pid_paths = [pathlib.Path(d) / f"{x}.pid" for x in range(len(refs))]
+            for x in pid_paths:
+                tracker.track_pid_file(x)
+            futures = [
+                archive_executor.submit(
+                    _archive_repository,
+                    x,
+                    y,
+                    z,
+                    pathlib.Path(this_repo.working_dir),
+                    pathspecs,
+                    compression_level,
+                    w,
+                )
+                for x, y, z, w in zip(prefixes, shas, paths, pid_paths)
+            ]
+            try:
+                hashes = [x.result().sha256 for x in futures]
+            finally:
+                # the pid directory is only removed once no worker uses it
+                for y in futures:
+                    y.cancel()
+                concurrent.futures.wait(futures)
+    elif len(refs) == 1:
+        hashes = [
+            _create_tarfile(
+                name,
+                shas[0],
+                paths[0],
+                this_repo,
+                tracker,
+                pathspecs,
+                compression_level,
+                spool,
+            )
+        ]
+    else:
+        # git archive runs in its own process and zlib releases the GIL, so
+        # the references archive in parallel on threads.
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(refs)
+        ) as executor:
+            thread_futures = [
+                executor.submit(
+                    _create_tarfile,
+                    x,
+                    y,
+                    z,
+                    this_repo,
+                    tracker,
+                    pathspecs,
+                    compression_level,
+                    spool,
+                )
+                for x, y, z in zip(prefixes, shas, paths)
+            ]
+            hashes = [x.result() for x in thread_futures]
+
+    return list(zip(paths, hashes))
+
+
+class GitPythonBackend(GitBackend):
     """
-    this_url = definition.configuration.backup.repo_url
+    Git CLI processes run through GitPython on executor threads.
+
+    Snapshots with this backend run wholly on an executor thread, which also
+    supports path filters, bundles and the "process" executor; the methods
+    here serve other callers of the backend.
+    """
+
+    name = "gitpython"
+
+    async def _run_tracked(
+        self, function: typing.Callable[..., T], *args: typing.Any
+    ) -> T:
+        loop = asyncio.get_running_loop()
+        tracker = _ProcessTracker()
+        try:
+            return await loop.run_in_executor(
+                None, functools.partial(function, *args, tracker)
+            )
+        except asyncio.CancelledError:
+            tracker.kill_all()
+            raise
+
+    def _clone(
+        self, url: str, directory: pathlib.Path, tracker: _ProcessTracker
+    ) -> None:
+        _clone_repository(url, directory, tracker, False, self.governor).close()
+
+    async def fetch(self, url: str, directory: pathlib.Path) -> None:
+        """
+        Fetch all the branches and tags of a repository, as a clone.
+
+        Args:
+            url: Repository URL, which may include a token.
+            directory: Directory to create for the repository.
+        """
+        await self._run_tracked(self._clone, url, directory)
+
+    async def resolve(self, directory: pathlib.Path, ref: str) -> str:
+        """
+        Resolve a reference of a fetched repository.
+
+        Args:
+            directory: Fetched repository directory.
+            ref: Branch, tag or commit.
+
+        Returns:
+            Commit SHA.
+        """
+
+        def _resolve(tracker: _ProcessTracker) -> str:
+            with git.Repo(directory) as this_repo:
+                return _resolve_ref(this_repo, ref)
+
+        return await self._run_tracked(_resolve)
+
+    async def archive(
+        self,
+        directory: pathlib.Path,
+        prefix: str,
+        sha: str,
+        archive_path: pathlib.Path,
+        compression_level: int,
+    ) -> str:
+        """
+        Archive a commit of a fetched repository, and its hash file.
+
+        Args:
+            directory: Fetched repository directory.
+            prefix: Directory name of the archive content.
+            sha: Commit SHA to archive.
+            archive_path: Path of the ``tar.gz`` file to create.
+            compression_level: Deflate level of compressible content.
+
+        Returns:
+            Hex digest of the archive file.
+        """
+
+        def _archive(tracker: _ProcessTracker) -> str:
+            with git.Repo(directory) as this_repo:
+                return _create_tarfile(
+                    prefix,
+                    sha,
+                    archive_path,
+                    this_repo,
+                    tracker,
+                    compression_level=compression_level,
+                )
+
+        return await self._run_tracked(_archive)
+
+
+def construct_backend(
+    name: GitBackendName, governor: typing.Optional[TransferGovernor] = None
+) -> GitBackend:
+    """
+    Construct a git backend.
+
+    Args:
+        name: Name of the backend.
+        governor: Transfer governor shared by the snapshots of a run.
 
-    parsed_url = urlparse(this_url)
-    authorized_url = (
+    Returns:
+        Git backend.
+    Raises:
+        GitBackendError: If the backend is not available.
+    """
+    backends: typing.Dict[str, typing.Type[GitBackend]] = {
+        "gitpython": GitPythonBackend,
+        "subprocess": SubprocessBackend,
+        "dulwich": DulwichBackend,
+    }
+
+    return backends[name](governor)
+
+
+def _snapshot_result(
+    definition: ApplicationDefinition,
+    refs: typing.List[str],
+    shas: typing.List[str],
+    archives: typing.List[typing.Tuple[pathlib.Path, str]],
+    since: typing.Optional[str],
+    times: typing.Tuple[float, float, float],
+    root_commits: typing.Optional[typing.List[str]] = None,
+    clone_sizes: typing.Tuple[int, int] = (0, 0),
+    spool: typing.Optional[ArchiveSpool] = None,
+) -> SnapshotResult:
+    start_time, clone_time, end_time = times
+    tarfile_path, hash_hexdigest = archives[0]
+    transfer_bytes, clone_bytes = clone_sizes
+
+    return SnapshotResult(
+        name=definition.name,
+        ref=refs[0],
+        sha=shas[0],
+        archive_path=tarfile_path,
+        hash_path=tarfile_path.parent / f"{tarfile_path.name}.sha256",
+        sha256=hash_hexdigest,
+        timings=SnapshotTimings(
+            clone_seconds=clone_time - start_time,
+            archive_seconds=end_time - clone_time,
+            total_seconds=end_time - start_time,
+        ),
+        format=definition.configuration.backup.format,
+        prerequisite=since,
+        ref_archives=[
+            RefArchive(
+                ref=x,
+                sha=y,
+                archive_path=z,
+                hash_path=z.parent / f"{z.name}.sha256",
+                sha256=w,
+            )
+            for x, y, (z, w) in zip(refs[1:], shas[1:], archives[1:])
+        ],
+        compression_level=definition.configuration.backup.compression_level,
+        root_commits=root_commits or list(),
+        transfer_bytes=transfer_bytes,
+        clone_bytes=clone_bytes,
+        archive_bytes=sum(
+            spool.file_size(x) if spool else x.stat().st_size
+            for x, _ in archives
+        ),
+    )
+
+
+def rename_snapshot(
+    result: SnapshotResult, name: str, archive_directory: pathlib.Path
+) -> SnapshotResult:
+    """
+    Copy the archives of a snapshot for an entry naming it differently.
+
+    The application name is the leading directory of the archive members, so
+    the archives are copied under the new name, as if they were archived for
+    it. Only archive snapshots can be renamed.
+
+    Args:
+        result: Archive snapshot.
+        name: Application name of the copy.
+        archive_directory: Directory to write the copied archives.
+
+    Returns:
+        Snapshot of the copied archives.
+    """
+    archives = [(result.ref, result.archive_path)] + [
+        (x.ref, x.archive_path) for x in result.ref_archives
+    ]
+    copies: typing.List[typing.Tuple[pathlib.Path, str]] = list()
+    for index, (ref, archive_path) in enumerate(archives):
+        copy_path = _construct_tarfile_path(name, ref, archive_directory)
+        # further references are archived under their file names
+        prefixes = (
+            (result.name, name)
+            if index == 0
+            else (
+                archive_path.name[: -len(".tar.gz")],
+                copy_path.name[: -len(".tar.gz")],
+            )
+        )
+        log.info(f"renaming snapshot archive, {copy_path.name}")
+        hash_hexdigest = reprefix_archive(
+            archive_path, copy_path, *prefixes, result.compression_level
+        )
+        write_hash_file(hash_hexdigest, copy_path)
+        copies.append((copy_path, hash_hexdigest))
+
+    return result.copy(
+        update={
+            "name": name,
+            "archive_path": copies[0][0],
+            "hash_path": copies[0][0].parent / f"{copies[0][0].name}.sha256",
+            "sha256": copies[0][1],
+            "ref_archives": [
+                x.copy(
+                    update={
+                        "archive_path": y,
+                        "hash_path": y.parent / f"{y.name}.sha256",
+                        "sha256": z,
+                    }
+                )
+                for x, (y, z) in zip(result.ref_archives, copies[1:])
+            ],
+        }
+    )
+
+
+def authorized_url(url: str, token: typing.Optional[str]) -> str:
+    """Add a personal access token to a repository URL."""
+    parsed_url = urlparse(url)
+
+    return (
         f"{parsed_url.scheme}://:{token}@{parsed_url.netloc}"
         f"{parsed_url.path}"
     )
 
+
+async def _take_backend_snapshot(
+    definition: ApplicationDefinition,
+    archive_directory: pathlib.Path,
+    token: typing.Optional[str],
+    backend: GitBackend,
+) -> SnapshotResult:
+    """Fetch and archive a repository with the operations of a backend."""
+    start_time = time.monotonic()
+    backup = definition.configuration.backup
+    snapshot_refs = definition.configuration.snapshot_refs()
+    if (
+        (backup.format != "archive")
+        or backup.include_paths
+        or (backup.exclude_paths)
+    ):
+        raise GitBackendError(
+            f"{backend.name} backend only supports archives of the whole "
+            f"repository, {definition.name}"
+        )
+
+    with tempfile.TemporaryDirectory() as d:
+        repository_directory = pathlib.Path(d) / "repository"
+
+        log.info(f"fetching repo, {backup.repo_url} ({backend.name})")
+        await backend.fetch(
+            authorized_url(backup.repo_url, token), repository_directory
+        )
+        shas = [
+            await backend.resolve(repository_directory, x)
+            for x in snapshot_refs
+        ]
+        clone_time = time.monotonic()
+
+        paths = [
+            _construct_tarfile_path(definition.name, x, archive_directory)
+            for x in snapshot_refs
+        ]
+        prefixes = [definition.name] + [
+            x.name[: -len(".tar.gz")] for x in paths[1:]
+        ]
+        hashes = await asyncio.gather(
+            *[
+                backend.archive(
+                    repository_directory, x, y, z, backup.compression_level
+                )
+                for x, y, z in zip(prefixes, shas, paths)
+            ]
+        )
+        end_time = time.monotonic()
+        clone_bytes = directory_size(repository_directory)
+
+    return _snapshot_result(
+        definition,
+        snapshot_refs,
+        shas,
+        list(zip(paths, hashes)),
+        None,
+        (start_time, clone_time, end_time),
+        clone_sizes=(clone_bytes, clone_bytes),
+    )
+
+
+def _take_snapshot(
+    definition: ApplicationDefinition,
+    archive_directory: pathlib.Path,
+    token: typing.Optional[str],
+    tracker: _ProcessTracker,
+    archive_executor: typing.Optional[concurrent.futures.Executor] = None,
+    since: typing.Optional[str] = None,
+    governor: typing.Optional[TransferGovernor] = None,
+    families: typing.Optional[ObjectFamilies] = None,
+    spool: typing.Optional[ArchiveSpool] = None,
+) -> SnapshotResult:
+    """Clone and archive, or bundle, a repository; blocks until complete."""
+    start_time = time.monotonic()
+    backup = definition.configuration.backup
+    this_url = backup.repo_url
+    this_ref = definition.configuration.release.ref
+    snapshot_refs = definition.configuration.snapshot_refs()
+    is_sparse = bool(backup.include_paths or backup.exclude_paths)
+    clone_url = authorized_url(this_url, token)
+
+    family = families.family(definition) if families else None
+    reference = (
+        _fetch_family(
+            families, family, definition, clone_url, tracker, governor
+        )
+        if families and family
+        else None
+    )
     with tempfile.TemporaryDirectory() as d:
         working_directory = pathlib.Path(d)
 
         log.info(f"cloning repo, {this_url}")
-        cloned_repo = git.Repo.clone_from(
-            authorized_url,
+        cloned_repo = _clone_repository(
+            clone_url,
             working_directory,
+            tracker,
+            is_sparse,
+            governor,
+            reference,
+        )
+        try:
+            # all the references are resolved from the one clone
+            resolved_shas = [
+                _resolve_ref(cloned_repo, x) for x in snapshot_refs
+            ]
+            resolved_sha = resolved_shas[0]
+            root_commits = (
+                _root_commits(cloned_repo, resolved_shas)
+                if families and families.detect
+                else None
+            )
+            pathspecs = _archive_pathspecs(
+                backup.include_paths, backup.exclude_paths
+            )
+            if is_sparse:
+                log.info(f"sparse checkout, {definition.name}, {pathspecs}")
+                _sparse_checkout(
+                    cloned_repo,
+                    resolved_sha,
+                    _sparse_patterns(
+                        backup.include_paths, backup.exclude_paths
+                    ),
+                    tracker,
+                    governor,
+                )
+            clone_time = time.monotonic()
+
+            backup_format = definition.configuration.backup.format
+            if backup_format == "bundle":
+                if since and not _is_ancestor(cloned_repo, since, resolved_sha):
+                    log.warning(
+                        f"bundle chain tip is not an ancestor of "
+                        f"{resolved_sha}, starting new chain with a full "
+                        f"bundle, {definition.name}"
+                    )
+                    since = None
+                tarfile_path = _construct_bundle_path(
+                    definition.name,
+                    this_ref,
+                    archive_directory,
+                )
+                hash_hexdigest = _create_bundle(
+                    f"refs/heads/"
+                    f"{definition.configuration.backup.branch_name}",
+                    resolved_sha,
+                    since,
+                    tarfile_path,
+                    cloned_repo,
+                    tracker,
+                )
+                archives = [(tarfile_path, hash_hexdigest)]
+            else:
+                since = None
+                archives = _archive_refs(
+                    definition.name,
+                    snapshot_refs,
+                    resolved_shas,
+                    archive_directory,
+                    cloned_repo,
+                    tracker,
+                    pathspecs,
+                    backup.compression_level,
+                    archive_executor,
+                    spool,
+                )
+            end_time = time.monotonic()
+        finally:
+            cloned_repo.close()
+        # objects borrowed from a family store are not counted
+        clone_sizes = (
+            directory_size(working_directory / ".git" / "objects"),
+            directory_size(working_directory),
         )
 
-        tarfile_path = _construct_tarfile_path(
-            definition.name,
-            definition.configuration.release.ref,
+    return _snapshot_result(
+        definition,
+        snapshot_refs,
+        resolved_shas,
+        archives,
+        since,
+        (start_time, clone_time, end_time),
+        root_commits,
+        clone_sizes,
+        spool,
+    )
+
+
+def _is_transient(error: git.GitCommandError) -> bool:
+    return bool(TRANSIENT_ERROR_PATTERN.search(str(error.stderr)))
+
+
+def _backoff_delay(attempt: int, options: SnapshotOptions) -> float:
+    """Exponential backoff with "full jitter"."""
+    limit = min(
+        options.backoff_limit_seconds,
+        options.backoff_seconds * (2**attempt),
+    )
+
+    return random.uniform(0, limit)
+
+
+def _run_dequeued(function: typing.Callable[..., T], *args: typing.Any) -> T:
+    """Run a function on an executor thread, once the snapshot has a thread."""
+    queued = transfer_queued.get()
+    if queued:
+        queued(False)
+
+    return function(*args)
+
+
+async def _attempt_snapshot(
+    definition: ApplicationDefinition,
+    archive_directory: pathlib.Path,
+    token: typing.Optional[str],
+    archive_executor: typing.Optional[concurrent.futures.Executor],
+    since: typing.Optional[str],
+    governor: TransferGovernor,
+    backend: typing.Optional[GitBackend] = None,
+    families: typing.Optional[ObjectFamilies] = None,
+    spool: typing.Optional[ArchiveSpool] = None,
+) -> SnapshotResult:
+    if backend and not isinstance(backend, GitPythonBackend):
+        return await _take_backend_snapshot(
+            definition, archive_directory, token, backend
+        )
+
+    loop = asyncio.get_running_loop()
+    tracker = _ProcessTracker()
+    queued = transfer_queued.get()
+    if queued:
+        queued(True)
+    try:
+        result = await loop.run_in_executor(
+            None,
+            # transfers in the thread report to the snapshot
+            contextvars.copy_context().run,
+            functools.partial(
+                _run_dequeued,
+                call_in_phase,
+                f"snapshot-{definition.name}",
+                _take_snapshot,
+                definition,
+                archive_directory,
+                token,
+                tracker,
+                archive_executor,
+                since,
+                governor,
+                families,
+                spool,
+            ),
+        )
+    except asyncio.CancelledError:
+        # the executor thread can't be interrupted, but killing its git
+        # processes makes it finish promptly.
+        tracker.kill_all()
+        raise
+
+    return result
+
+
+async def _snapshot_with_retries(
+    definition: ApplicationDefinition,
+    archive_directory: pathlib.Path,
+    token: typing.Optional[str],
+    options: SnapshotOptions,
+    archive_executor: typing.Optional[concurrent.futures.Executor],
+    governor: TransferGovernor,
+    backend: typing.Optional[GitBackend] = None,
+    families: typing.Optional[ObjectFamilies] = None,
+    spool: typing.Optional[ArchiveSpool] = None,
+) -> SnapshotResult:
+    since = options.bundle_tips.get(bundle_key(definition))
+    attempt = 0
+    while True:
+        try:
+            result = await _attempt_snapshot(
+                definition,
+                archive_directory,
+                token,
+                archive_executor,
+                since,
+                governor,
+                backend,
+                families,
+                spool,
+            )
+
+            return result
+        except git.GitCommandError as e:
+            if (attempt >= options.retries) or (not _is_transient(e)):
+                raise
+
+            delay = _backoff_delay(attempt, options)
+            attempt += 1
+            log.warning(
+                f"transient git failure, {definition.name}, retry "
+                f"{attempt}/{options.retries} in {delay:.1f}s "
+                f"({str(e.stderr).strip()})"
+            )
+            await asyncio.sleep(delay)
+
+
+class _SnapshotClock:
+    """
+    Run a snapshot against its time limit, except while it is queued.
+
+    A snapshot is queued while it waits for an executor thread, or for its
+    host to admit a transfer; that is notified from any thread.
+    """
+
+    def __init__(self, timeout_seconds: typing.Optional[float]) -> None:
+        """
+        Construct ``_SnapshotClock`` object.
+
+        Args:
+            timeout_seconds: Time limit of the snapshot, if any.
+        """
+        self.remaining_seconds = timeout_seconds
+        self.queued = False
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+    def _set_queued(self, queued: bool) -> None:
+        self.queued = queued
+        self._changed.set()
+
+    def notify_queued(self, queued: bool) -> None:
+        """
+        Notify whether the snapshot is queued, from any thread.
+
+        Args:
+            queued: Whether the snapshot is queued.
+        """
+        self._loop.call_soon_threadsafe(self._set_queued, queued)
+
+    async def run(self, snapshot: asyncio.Future) -> None:
+        """
+        Wait for the snapshot until it completes, or its time runs out.
+
+        Args:
+            snapshot: Snapshot task.
+        """
+        while not snapshot.done():
+            queued = self.queued
+            timeout = None if queued else self.remaining_seconds
+            if timeout is not None and timeout <= 0:
+                return
+            self._changed.clear()
+            changed = asyncio.ensure_future(self._changed.wait())
+            start_time = self._loop.time()
+            try:
+                await asyncio.wait(
+                    {snapshot, changed},
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            finally:
+                changed.cancel()
+            if (not queued) and (self.remaining_seconds is not None):
+                self.remaining_seconds -= self._loop.time() - start_time
+
+
+async def do_snapshot(
+    definition: ApplicationDefinition,
+    archive_directory: pathlib.Path,
+    token: typing.Optional[str],
+    options: typing.Optional[SnapshotOptions] = None,
+    archive_executor: typing.Optional[concurrent.futures.Executor] = None,
+    governor: typing.Optional[TransferGovernor] = None,
+    backend: typing.Optional[GitBackend] = None,
+    families: typing.Optional[ObjectFamilies] = None,
+    spool: typing.Optional[ArchiveSpool] = None,
+) -> SnapshotResult:
+    """
+    Take a snapshot of the specified git repository for backup purposes.
+
+    The blocking git operations are run in the default executor so that
+    multiple snapshots proceed concurrently. The time limit does not run
+    while the snapshot waits for an executor thread, or for the governor to
+    admit a transfer to its host.
+    Transient git transport failures are retried with jittered exponential
+    backoff, and git child processes are killed if the snapshot is cancelled
+    or times out. A host that throttles a transfer is paused for the time it
+    requests.
+
+    Args:
+        definition: application definitions
+        archive_directory: directory to write tar and SHA sum files
+        token: Personal access token for repository access.
+        options: Snapshot execution controls.
+        archive_executor: Executor for the archive, compress and hash step,
+                          otherwise the step runs with the clone.
+        governor: Transfer governor shared with other snapshots; otherwise
+                  one is constructed from the options.
+        backend: Git backend shared with other snapshots; otherwise one is
+                 constructed from the options.
+        families: Object family stores shared with other snapshots, if any;
+                  only the GitPython backend uses them.
+        spool: Spool holding small archives in memory, shared with other
+               snapshots, if any; only the GitPython backend uses it.
+
+    Returns:
+        Snapshot result, including path of tar file created
+    Raises:
+        SnapshotTimeoutError: If the snapshot exceeds its time limit.
+    """
+    this_options = options or SnapshotOptions()
+    this_governor = governor or construct_governor(this_options)
+    this_backend = backend or construct_backend(
+        this_options.backend, this_governor
+    )
+    clock = _SnapshotClock(this_options.timeout_seconds)
+    transfer_queued.set(clock.notify_queued)
+    snapshot = asyncio.ensure_future(
+        _snapshot_with_retries(
+            definition,
             archive_directory,
+            token,
+            this_options,
+            archive_executor,
+            this_governor,
+            this_backend,
+            families,
+            spool,
+        )
+    )
+    try:
+        await clock.run(snapshot)
+        if not snapshot.done():
+            raise SnapshotTimeoutError(
+                f"snapshot timed out after {this_options.timeout_seconds}s, "
+                f"{definition.name}"
+            )
+        result = snapshot.result()
+    finally:
+        if not snapshot.done():
+            snapshot.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await snapshot
+        if not backend:
+            this_backend.close()
+
+    return result
+
+
+def construct_governor(options: SnapshotOptions) -> TransferGovernor:
+    """
+    Construct a transfer governor with the host limits of snapshot options.
+
+    Args:
+        options: Snapshot execution controls.
+
+    Returns:
+        Transfer governor.
+    """
+    return TransferGovernor(
+        options.host_connections, options.host_bytes_per_second
+    )
+
+
+def construct_spool(options: SnapshotOptions) -> typing.Optional[ArchiveSpool]:
+    """
+    Construct an archive spool with the spool limits of snapshot options.
+
+    Args:
+        options: Snapshot execution controls.
+
+    Returns:
+        Archive spool, if spooling is enabled.
+    """
+    if not options.spool_file_bytes:
+        return None
+
+    return ArchiveSpool(options.spool_file_bytes, options.spool_budget_bytes)
+
+
+def _shutdown_pool(pool: concurrent.futures.ProcessPoolExecutor) -> None:
+    if sys.version_info >= (3, 9):
+        pool.shutdown(cancel_futures=True)
+    else:
+        pool.shutdown()
+
+
+@contextlib.asynccontextmanager
+async def archive_executor_scope(
+    options: SnapshotOptions,
+) -> typing.AsyncIterator[typing.Optional[concurrent.futures.Executor]]:
+    """
+    Provide the executor for archive work selected by snapshot options.
+
+    A process pool is shut down on an executor thread, since waiting for its
+    workers to exit would block the event loop; archive work that has not
+    started is cancelled. The snapshots using the pool are expected to have
+    killed the git processes of its workers by then.
+
+    Args:
+        options: Snapshot execution controls.
+
+    Yields:
+        A process pool sized to the CPU count (or ``options.jobs``) for the
+        "process" executor, otherwise ``None``.
+    """
+    if options.executor == "process":
+        jobs = options.jobs or os.cpu_count()
+        log.info(f"archiving in process pool, {jobs} workers")
+        # workers are started on demand from executor threads while other
+        # threads are starting git processes; forking then can deadlock.
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("spawn")
         )
-        _create_tarfile(
-            definition.name,
-            definition.configuration.release.ref,
-            tarfile_path,
-            cloned_repo,
+        try:
+            yield pool
+        finally:
+            await asyncio.get_running_loop().run_in_executor(
+                None, _shutdown_pool, pool
+            )
+    else:
+        yield None
+
+
+def _construct_families(
+    definitions: typing.List[ApplicationDefinition],
+    options: SnapshotOptions,
+    exit_stack: contextlib.AsyncExitStack,
+) -> typing.Optional[ObjectFamilies]:
+    """Construct the object family stores of a run, if it has any families."""
+    families = assign_families(
+        definitions,
+        options.repository_roots if options.detect_families else None,
+    )
+    if not (families or options.detect_families):
+        return None
+
+    for family in sorted(set(families.values())):
+        members = sorted(x for x, y in families.items() if y == family)
+        log.info(f"object family, {family}, {members}")
+    # snapshots cancelled at exit may still be using a store, so ignore
+    # errors removing it
+    directory = pathlib.Path(tempfile.mkdtemp(prefix="families-"))
+    exit_stack.callback(shutil.rmtree, directory, ignore_errors=True)
+
+    return ObjectFamilies(directory, families, options.detect_families)
+
+
+def _summarize_failures(
+    timed_out: typing.List[str], failed: typing.Dict[str, str]
+) -> str:
+    summary = list()
+    if timed_out:
+        summary.append(f"timed out: {', '.join(sorted(timed_out))}")
+    if failed:
+        summary.append(
+            "failed: " + ", ".join(f"{x} ({failed[x]})" for x in sorted(failed))
         )
 
-        return tarfile_path
+    return "; ".join(summary)
+
+
+async def iter_snapshots(
+    definitions: typing.Iterable[ApplicationDefinition],
+    archive_directory: pathlib.Path,
+    token: typing.Optional[str] = None,
+    options: typing.Optional[SnapshotOptions] = None,
+    archive_executor: typing.Optional[concurrent.futures.Executor] = None,
+    governor: typing.Optional[TransferGovernor] = None,
+    spool: typing.Optional[ArchiveSpool] = None,
+    families: typing.Optional[ObjectFamilies] = None,
+) -> typing.AsyncGenerator[SnapshotResult, None]:
+    """
+    Take snapshots of repositories, yielding each result as it completes.
+
+    All snapshots are started immediately; results are yielded in completion
+    order so that downstream work on a snapshot (upload, verification,
+    notification) overlaps with the snapshots still in progress. Snapshots
+    still in progress are cancelled if the consumer stops iterating early, or
+    when the run deadline expires.
+
+    Network fetches always run on threads, governed by host so that all the
+    snapshots share each host's connection and rate limits; the governor is
+    shared with other runs if ``governor`` is specified. With the "process"
+    executor the CPU bound archive, compress and hash work runs in a process
+    pool, shared with other runs if ``archive_executor`` is specified. The
+    git backend of the options is shared by all the snapshots, as are the
+    object stores of repository families; the stores are shared with other
+    runs if ``families`` is specified. Archives are held in memory by
+    ``spool``, if specified, where they fit; the spool is owned by the
+    caller because the archives outlive the snapshots.
+
+    Args:
+        definitions: Application definitions to snapshot.
+        archive_directory: Directory to write tar and SHA sum files.
+        token: Personal access token for repository access.
+        options: Snapshot execution controls.
+        archive_executor: Process pool for archive work, if any.
+        governor: Transfer governor shared with other runs, if any.
+        spool: Spool holding small archives in memory, if any.
+        families: Object family stores shared with other runs, if any.
+
+    Yields:
+        Snapshot results in completion order.
+    Raises:
+        SnapshotError: After all successful snapshots have been yielded, if
+                       any snapshot failed or timed out.
+    """
+    this_options = options or SnapshotOptions()
+    loop = asyncio.get_running_loop()
+    deadline = (
+        (loop.time() + this_options.deadline_seconds)
+        if this_options.deadline_seconds is not None
+        else None
+    )
+    exit_stack = contextlib.AsyncExitStack()
+    if (archive_executor is None) and (this_options.executor == "process"):
+        archive_executor = await exit_stack.enter_async_context(
+            archive_executor_scope(this_options)
+        )
+    this_governor = governor or construct_governor(this_options)
+    backend = construct_backend(this_options.backend, this_governor)
+    exit_stack.callback(backend.close)
+    these_definitions = list(definitions)
+    if not families:
+        families = _construct_families(
+            these_definitions, this_options, exit_stack
+        )
+    tasks = {
+        asyncio.ensure_future(
+            do_snapshot(
+                x,
+                archive_directory,
+                token,
+                this_options,
+                archive_executor,
+                this_governor,
+                backend,
+                families,
+                spool,
+            )
+        ): x.name
+        for x in these_definitions
+    }
+    timed_out: typing.List[str] = list()
+    failed: typing.Dict[str, str] = dict()
+    try:
+        pending = set(tasks.keys())
+        while pending:
+            remaining_time = (
+                max(0, deadline - loop.time()) if deadline is not None else None
+            )
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=remaining_time,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                log.error(
+                    f"run deadline of {this_options.deadline_seconds}s "
+                    f"exceeded, cancelling {len(pending)} snapshots"
+                )
+                for x in pending:
+                    x.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                timed_out.extend(tasks[x] for x in pending)
+                pending = set()
+
+            for x in done:
+                name = tasks[x]
+                try:
+                    result = x.result()
+                except SnapshotTimeoutError as e:
+                    log.error(str(e))
+                    timed_out.append(name)
+                except Exception as e:
+                    log.error(f"snapshot failed, {name}, {str(e)}")
+                    failed[name] = str(e).strip()
+                else:
+                    log.info(
+                        f"snapshot complete, {result.name} ({result.sha}) "
+                        f"in {result.timings.total_seconds:.1f}s"
+                    )
+                    yield result
+    finally:
+        for x in tasks:
+            x.cancel()
+        # cancelled snapshots kill their git processes before the process
+        # pool, if any, is shut down
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await exit_stack.aclose()
+
+    if timed_out or failed:
+        summary = _summarize_failures(timed_out, failed)
+        log.error(f"snapshots incomplete, {summary}")
+        raise SnapshotError(
+            f"snapshots incomplete, {summary}", timed_out, failed
+        )
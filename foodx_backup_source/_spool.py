@@ -0,0 +1,265 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""In-memory archive files of snapshots, within a memory budget."""
+
+import io
+import logging
+import pathlib
+import threading
+import typing
+
+from ._hash import format_hash_content, write_hash_file
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_FILE_BYTES = 0x1000000
+DEFAULT_SPOOL_BUDGET_BYTES = 0x10000000
+
+
+class SpoolWriter(io.RawIOBase):
+    """
+    Write a file to memory, spilling it to disk if it outgrows its limit.
+
+    The file spills to disk when it exceeds the file limit of the spool, or
+    when the spool budget can't cover it.
+    """
+
+    def __init__(self, spool: "ArchiveSpool", file_path: pathlib.Path) -> None:
+        """
+        Construct ``SpoolWriter`` object.
+
+        Args:
+            spool: Spool holding the file.
+            file_path: Path of the file, if spilled to disk.
+        """
+        super().__init__()
+        self._spool = spool
+        self._file_path = file_path
+        self._buffer: typing.Optional[bytearray] = bytearray()
+        self._disk_file: typing.Optional[typing.BinaryIO] = None
+
+    def writable(self) -> bool:
+        """Indicate the object supports writing."""
+        return True
+
+    def _spill(self) -> None:
+        assert self._buffer is not None
+        log.info(f"spilling spooled file to disk, {self._file_path.name}")
+        self._disk_file = self._file_path.open(mode="wb")
+        self._disk_file.write(self._buffer)
+        self._spool._release(len(self._buffer))
+        self._buffer = None
+
+    def write(self, b: typing.Any) -> int:
+        """
+        Write content to memory, or disk once spilled.
+
+        Args:
+            b: Content to write.
+
+        Returns:
+            Number of bytes written.
+        """
+        data = bytes(b)
+        if self._buffer is not None:
+            if (
+                len(self._buffer) + len(data) <= self._spool.file_bytes
+            ) and self._spool._reserve(len(data)):
+                self._buffer += data
+                return len(data)
+            self._spill()
+        assert self._disk_file is not None
+        self._disk_file.write(data)
+
+        return len(data)
+
+    def close(self) -> None:
+        """Hold the file in the spool, or finish writing it to disk."""
+        if not self.closed:
+            if self._buffer is not None:
+                self._spool._hold(self._file_path, bytes(self._buffer))
+                self._buffer = None
+            if self._disk_file:
+                self._disk_file.close()
+        super().close()
+
+    def abort(self) -> None:
+        """Discard a failed file, rather than hold it in the spool."""
+        if not self.closed:
+            if self._buffer is not None:
+                self._spool._release(len(self._buffer))
+                self._buffer = None
+            if self._disk_file:
+                self._disk_file.close()
+                self._file_path.unlink()
+        super().close()
+
+
+class ArchiveSpool:
+    """
+    Archive files of a run held in memory, within a memory budget.
+
+    Files are named by the path they would have on disk, so a file that
+    outgrows the file limit, or the remaining budget, spills to its path and
+    is used from there. Held files count against the budget until they are
+    released, so the budget covers the archives of in-flight snapshots and
+    of snapshots waiting to be packaged.
+    """
+
+    def __init__(
+        self,
+        file_bytes: int = DEFAULT_SPOOL_FILE_BYTES,
+        budget_bytes: int = DEFAULT_SPOOL_BUDGET_BYTES,
+    ) -> None:
+        """
+        Construct ``ArchiveSpool`` object.
+
+        Args:
+            file_bytes: Size limit of a file held in memory.
+            budget_bytes: Size limit of all the files held in memory.
+        """
+        self.file_bytes = file_bytes
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._files: typing.Dict[pathlib.Path, bytes] = dict()
+        # held files, and files being written
+        self._used = 0
+
+    def __enter__(self) -> "ArchiveSpool":
+        """Use the spool for a run."""
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        """Release all the files of the run."""
+        self.close()
+
+    def __contains__(self, file_path: object) -> bool:
+        """Indicate the file is held in memory."""
+        with self._lock:
+            return file_path in self._files
+
+    @property
+    def used_bytes(self) -> int:
+        """Memory used by held files, and files being written."""
+        with self._lock:
+            return self._used
+
+    def _reserve(self, size: int) -> bool:
+        with self._lock:
+            if (self._used + size) > self.budget_bytes:
+                return False
+            self._used += size
+
+            return True
+
+    def _release(self, size: int) -> None:
+        with self._lock:
+            self._used -= size
+
+    def _hold(self, file_path: pathlib.Path, data: bytes) -> None:
+        """Hold a written file, replacing any previous attempt at it."""
+        with self._lock:
+            previous = self._files.pop(file_path, None)
+            if previous is not None:
+                self._used -= len(previous)
+            self._files[file_path] = data
+
+    def writer(self, file_path: pathlib.Path) -> typing.BinaryIO:
+        """
+        Write a file to the spool.
+
+        Args:
+            file_path: Path of the file, if spilled to disk.
+
+        Returns:
+            Writable file object; the file is held when it is closed.
+        """
+        self.release(file_path)
+
+        return typing.cast(typing.BinaryIO, SpoolWriter(self, file_path))
+
+    def write_hash_file(
+        self, hash_hexdigest: str, reference_file_path: pathlib.Path
+    ) -> pathlib.Path:
+        """
+        Record a file hash alongside the file, in memory if the file is.
+
+        Args:
+            hash_hexdigest: Hash to be recorded.
+            reference_file_path: Path to file that was hashed.
+
+        Returns:
+            Path of hash file.
+        """
+        if reference_file_path not in self:
+            return write_hash_file(hash_hexdigest, reference_file_path)
+
+        hash_file = (
+            reference_file_path.parent / f"{reference_file_path.name}.sha256"
+        )
+        with self.writer(hash_file) as f:
+            f.write(
+                format_hash_content(
+                    hash_hexdigest, reference_file_path.name
+                ).encode()
+            )
+
+        return hash_file
+
+    def file_size(self, file_path: pathlib.Path) -> int:
+        """Size of a file, in memory or on disk."""
+        with self._lock:
+            data = self._files.get(file_path)
+        if data is None:
+            return file_path.stat().st_size
+
+        return len(data)
+
+    def open(self, file_path: pathlib.Path) -> typing.BinaryIO:
+        """
+        Read a file, from memory or disk.
+
+        Args:
+            file_path: Path of the file.
+
+        Returns:
+            Readable file object.
+        """
+        with self._lock:
+            data = self._files.get(file_path)
+        if data is None:
+            return file_path.open(mode="rb")
+
+        return io.BytesIO(data)
+
+    def release(self, file_path: pathlib.Path) -> None:
+        """Release a file held in memory, if any."""
+        with self._lock:
+            data = self._files.pop(file_path, None)
+            if data is not None:
+                self._used -= len(data)
+
+    def spill(self, file_paths: typing.Iterable[pathlib.Path]) -> None:
+        """
+        Write files held in memory to disk, for consumers that need paths.
+
+        Args:
+            file_paths: Paths of the files.
+        """
+        for x in file_paths:
+            with self._lock:
+                data = self._files.get(x)
+            if data is not None:
+                x.write_bytes(data)
+                self.release(x)
+
+    def close(self) -> None:
+        """Release all the files held in memory."""
+        with self._lock:
+            self._used -= sum(len(x) for x in self._files.values())
+            self._files.clear()
@@ -0,0 +1,711 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Content addressed store of repository snapshots, deduplicated across runs."""
+
+import base64
+import datetime
+import gzip
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import typing
+import zlib
+
+import click
+import pydantic
+
+from ._compress import (
+    _SIZED_TYPES,
+    AdaptiveGzipWriter,
+    ChunkReader,
+    _read_exact,
+    compress_tar_stream,
+    is_compressible,
+)
+from ._hash import create_hash_file, write_hash_file
+from ._package import (
+    ManifestArchive,
+    ManifestRepository,
+    PackageManifest,
+    write_manifest_files,
+)
+from ._snapshot import SnapshotResult
+from .schema import BackupFormat
+
+log = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = ".json.gz"
+
+COPY_SIZE = 0x40000
+# blob content larger than this is spooled to disk while it is hashed
+SPOOL_SIZE = 0x1000000
+
+# objects younger than this are never collected, so that a backup storing
+# objects concurrently with collection does not lose them before its
+# manifest is written
+DEFAULT_GRACE_SECONDS = 3600.0
+
+
+class StoreError(Exception):
+    """A store object or manifest is missing, corrupt or unsupported."""
+
+
+class StoreSegment(pydantic.BaseModel):
+    """
+    A run of snapshot archive content.
+
+    Either tar blocks held in the manifest, or the content of a file held in
+    a store object, followed by zero padding to the tar block size.
+    """
+
+    data: typing.Optional[str] = None
+    blob: typing.Optional[str] = None
+    size: int = 0
+    path: typing.Optional[str] = None
+
+
+class StoreArchive(pydantic.BaseModel):
+    """An archive of a snapshot reference, as store segments."""
+
+    file_name: str
+    ref: str
+    sha: str
+    sha256: str
+    segments: typing.List[StoreSegment]
+
+
+class StoreManifest(pydantic.BaseModel):
+    """Snapshot of an application in a backup run of a project."""
+
+    project_name: str
+    run: str
+    name: str
+    # position of the snapshot in the project package
+    position: int
+    format: BackupFormat
+    compression_level: int
+    archives: typing.List[StoreArchive]
+
+    def blobs(self) -> typing.Set[str]:
+        """Identify the store objects referenced by the manifest."""
+        return {y.blob for x in self.archives for y in x.segments if y.blob}
+
+
+class StoreGarbage(pydantic.BaseModel):
+    """Outcome of a store garbage collection."""
+
+    removed_runs: typing.List[str] = list()
+    removed_objects: int = 0
+    removed_bytes: int = 0
+
+
+def _blob_header(size: int) -> bytes:
+    return b"blob %d\x00" % size
+
+
+def _run_name() -> str:
+    """Generate an iso format date for run naming, like package naming."""
+    return datetime.datetime.utcnow().isoformat()[:-3] + "Z"
+
+
+class ObjectStore:
+    """
+    Store snapshot archives as git blob addressed objects and manifests.
+
+    Each regular file in a snapshot archive is stored once as a zlib
+    compressed git loose object, named by its git blob id, so files that are
+    unchanged between backup runs, or shared between repositories, take no
+    further space. A small gzipped manifest per snapshot records the tar
+    blocks between the files, from which the original archive is
+    materialized on demand. Bundle snapshots are stored whole since a bundle
+    is already incremental.
+
+    The store layout is::
+
+        <root>/objects/<2 hex>/<38 hex>
+        <root>/manifests/<project>/<run>/<name>.json.gz
+    """
+
+    def __init__(self, root: pathlib.Path) -> None:
+        """
+        Construct ``ObjectStore`` object.
+
+        Args:
+            root: Store directory; created if it does not exist.
+        """
+        self.root = root
+        self.objects = root / "objects"
+        self.manifests = root / "manifests"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.manifests.mkdir(parents=True, exist_ok=True)
+
+    def _object_path(self, blob_id: str) -> pathlib.Path:
+        return self.objects / blob_id[:2] / blob_id[2:]
+
+    def _write_blob(self, source: typing.BinaryIO, size: int, name: str) -> str:
+        """Store content read from a stream, returning its blob id."""
+        this_hash = hashlib.sha1(_blob_header(size))  # nosec
+        sample = b""
+        with tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_SIZE, dir=str(self.objects)
+        ) as spool:
+            remaining = size
+            while remaining:
+                data = source.read(min(remaining, COPY_SIZE))
+                if not data:
+                    raise StoreError("snapshot archive truncated")
+                if not sample:
+                    sample = data
+                this_hash.update(data)
+                spool.write(data)
+                remaining -= len(data)
+            blob_id = this_hash.hexdigest()
+
+            object_path = self._object_path(blob_id)
+            if object_path.is_file():
+                # refreshed so that garbage collection spares it until the
+                # manifest referencing it is written
+                os.utime(object_path)
+                return blob_id
+
+            level = (
+                zlib.Z_DEFAULT_COMPRESSION
+                if is_compressible(name, sample)
+                else zlib.Z_NO_COMPRESSION
+            )
+            object_path.parent.mkdir(exist_ok=True)
+            spool.seek(0)
+            descriptor, temporary_name = tempfile.mkstemp(
+                dir=self.objects, prefix=".tmp-"
+            )
+            try:
+                with os.fdopen(descriptor, "wb") as f:
+                    compressor = zlib.compressobj(level)
+                    f.write(compressor.compress(_blob_header(size)))
+                    for data in iter(lambda: spool.read(COPY_SIZE), b""):
+                        f.write(compressor.compress(data))
+                    f.write(compressor.flush())
+                os.replace(temporary_name, object_path)
+            except BaseException:
+                os.unlink(temporary_name)
+                raise
+
+        return blob_id
+
+    def _iter_blob(self, blob_id: str) -> typing.Iterator[bytes]:
+        """Read the content of an object, checking its blob id."""
+        object_path = self._object_path(blob_id)
+        if not object_path.is_file():
+            raise StoreError(f"store object missing, {blob_id}")
+        this_hash = hashlib.sha1()  # nosec
+        decompressor = zlib.decompressobj()
+        header: typing.Optional[bytes] = b""
+        with object_path.open(mode="rb") as f:
+            for data in iter(lambda: f.read(COPY_SIZE), b""):
+                content = decompressor.decompress(data)
+                this_hash.update(content)
+                if header is not None:
+                    header += content
+                    if b"\x00" not in header:
+                        continue
+                    content = header.split(b"\x00", 1)[1]
+                    header = None
+                if content:
+                    yield content
+            content = decompressor.flush()
+            this_hash.update(content)
+            if content:
+                yield content
+        if this_hash.hexdigest() != blob_id:
+            raise StoreError(f"store object corrupt, {blob_id}")
+
+    def _store_tar(self, source: typing.BinaryIO) -> typing.List[StoreSegment]:
+        segments: typing.List[StoreSegment] = list()
+        inline = bytearray()
+
+        def _flush_inline() -> None:
+            if inline:
+                segments.append(
+                    StoreSegment(data=base64.b64encode(inline).decode())
+                )
+                inline.clear()
+
+        while True:
+            header = _read_exact(source, tarfile.BLOCKSIZE)
+            inline += header
+            if len(header) < tarfile.BLOCKSIZE:
+                break
+            try:
+                info = tarfile.TarInfo.frombuf(
+                    header, tarfile.ENCODING, "surrogateescape"
+                )
+            except tarfile.HeaderError:
+                # end of archive marker and record padding
+                for data in iter(lambda: source.read(COPY_SIZE), b""):
+                    inline += data
+                break
+
+            if not (
+                info.isreg()
+                or (info.type in _SIZED_TYPES)
+                or (info.type not in tarfile.SUPPORTED_TYPES)
+            ):
+                continue
+            padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            if info.isreg() and info.size:
+                _flush_inline()
+                segments.append(
+                    StoreSegment(
+                        blob=self._write_blob(source, info.size, info.name),
+                        size=info.size,
+                        path=info.name,
+                    )
+                )
+                # padding is restored as zeros
+                _read_exact(source, padded_size - info.size)
+            else:
+                inline += _read_exact(source, padded_size)
+        _flush_inline()
+
+        return segments
+
+    def _store_archive(
+        self,
+        archive_format: BackupFormat,
+        archive_path: pathlib.Path,
+        ref: str,
+        sha: str,
+        sha256: str,
+    ) -> StoreArchive:
+        if archive_format == "archive":
+            with gzip.open(archive_path, mode="rb") as f:
+                segments = self._store_tar(typing.cast(typing.BinaryIO, f))
+        else:
+            size = archive_path.stat().st_size
+            with archive_path.open(mode="rb") as f:
+                segments = [
+                    StoreSegment(
+                        blob=self._write_blob(f, size, archive_path.name),
+                        size=size,
+                        path=archive_path.name,
+                    )
+                ]
+
+        return StoreArchive(
+            file_name=archive_path.name,
+            ref=ref,
+            sha=sha,
+            sha256=sha256,
+            segments=segments,
+        )
+
+    def ingest(
+        self,
+        project_name: str,
+        snapshot_results: typing.List[SnapshotResult],
+        run: typing.Optional[str] = None,
+    ) -> typing.List[pathlib.Path]:
+        """
+        Store the snapshots of a backup run of a project.
+
+        Objects are written before the manifests that reference them, and
+        each manifest is replaced atomically, so an interrupted run does not
+        leave a manifest referencing missing objects.
+
+        Args:
+            project_name: Name of project.
+            snapshot_results: Repository snapshots in package order.
+            run: Name of the run; defaults to the current time.
+
+        Returns:
+            Paths of the manifest files created.
+        """
+        this_run = run or _run_name()
+        run_directory = self.manifests / project_name / this_run
+        run_directory.mkdir(parents=True, exist_ok=True)
+        log.info(f"storing snapshots, {project_name}, {this_run}")
+
+        manifest_paths: typing.List[pathlib.Path] = list()
+        for position, x in enumerate(snapshot_results):
+            archives = [
+                self._store_archive(
+                    x.format, x.archive_path, x.ref, x.sha, x.sha256
+                )
+            ] + [
+                self._store_archive(
+                    x.format, y.archive_path, y.ref, y.sha, y.sha256
+                )
+                for y in x.ref_archives
+            ]
+            manifest = StoreManifest(
+                project_name=project_name,
+                run=this_run,
+                name=x.name,
+                position=position,
+                format=x.format,
+                compression_level=x.compression_level,
+                archives=archives,
+            )
+            manifest_path = run_directory / f"{x.name}{MANIFEST_SUFFIX}"
+            temporary_path = run_directory / f".{x.name}{MANIFEST_SUFFIX}.tmp"
+            with gzip.open(temporary_path, mode="wt") as f:
+                f.write(manifest.json())
+            os.replace(temporary_path, manifest_path)
+            log.info(
+                f"snapshot stored, {manifest_path}, "
+                f"{len(manifest.blobs())} objects"
+            )
+            manifest_paths.append(manifest_path)
+
+        return manifest_paths
+
+    def runs(self, project_name: str) -> typing.List[str]:
+        """
+        List the backup runs of a project, oldest first.
+
+        Args:
+            project_name: Name of project.
+
+        Returns:
+            Run names.
+        """
+        project_directory = self.manifests / project_name
+        if not project_directory.is_dir():
+            return list()
+
+        return sorted(x.name for x in project_directory.iterdir() if x.is_dir())
+
+    def projects(self) -> typing.List[str]:
+        """List the projects with backup runs in the store."""
+        return sorted(x.name for x in self.manifests.iterdir() if x.is_dir())
+
+    def read_manifests(
+        self, project_name: str, run: str
+    ) -> typing.List[StoreManifest]:
+        """
+        Read the snapshot manifests of a backup run.
+
+        Args:
+            project_name: Name of project.
+            run: Name of the run.
+
+        Returns:
+            Snapshot manifests in package order.
+        Raises:
+            StoreError: If the run does not exist or a manifest is malformed.
+        """
+        run_directory = self.manifests / project_name / run
+        if not run_directory.is_dir():
+            raise StoreError(f"store run missing, {project_name}, {run}")
+        manifests: typing.List[StoreManifest] = list()
+        for x in run_directory.glob(f"*{MANIFEST_SUFFIX}"):
+            try:
+                with gzip.open(x, mode="rt") as f:
+                    manifests.append(StoreManifest.parse_raw(f.read()))
+            except (OSError, pydantic.ValidationError) as e:
+                raise StoreError(f"malformed store manifest, {x}") from e
+
+        return sorted(manifests, key=lambda x: x.position)
+
+    def _iter_archive(
+        self, archive: StoreArchive, padded: bool
+    ) -> typing.Iterator[bytes]:
+        for x in archive.segments:
+            if x.data is not None:
+                yield base64.b64decode(x.data)
+            elif x.blob:
+                size = 0
+                for data in self._iter_blob(x.blob):
+                    size += len(data)
+                    yield data
+                if size != x.size:
+                    raise StoreError(f"store object size mismatch, {x.blob}")
+                padding = -x.size % tarfile.BLOCKSIZE
+                if padding and padded:
+                    yield tarfile.NUL * padding
+
+    def materialize(
+        self, manifest: StoreManifest, output_directory: pathlib.Path
+    ) -> typing.List[pathlib.Path]:
+        """
+        Recreate the archive and hash files of a stored snapshot.
+
+        Archives are recompressed as they were created, so they are normally
+        identical to the original archives.
+
+        Args:
+            manifest: Snapshot manifest.
+            output_directory: Directory to write the files.
+
+        Returns:
+            Paths of the archive and hash files created.
+        Raises:
+            StoreError: If a store object is missing or corrupt.
+        """
+        created_files: typing.List[pathlib.Path] = list()
+        for x in manifest.archives:
+            archive_path = output_directory / x.file_name
+            log.info(f"materializing snapshot archive, {archive_path}")
+            reader = ChunkReader(
+                self._iter_archive(x, manifest.format == "archive")
+            )
+            with archive_path.open(mode="wb") as f:
+                if manifest.format == "archive":
+                    writer = AdaptiveGzipWriter(f, manifest.compression_level)
+                    compress_tar_stream(
+                        typing.cast(typing.BinaryIO, reader), writer
+                    )
+                    hash_hexdigest = writer.finish()
+                else:
+                    this_hash = hashlib.sha256()
+                    for data in iter(lambda: reader.read(COPY_SIZE), b""):
+                        this_hash.update(data)
+                        f.write(data)
+                    hash_hexdigest = this_hash.hexdigest()
+            if hash_hexdigest != x.sha256:
+                # the content is intact, but a different zlib may deflate it
+                # differently
+                log.warning(
+                    f"materialized archive differs from original, "
+                    f"{archive_path.name}"
+                )
+            created_files += [
+                archive_path,
+                write_hash_file(hash_hexdigest, archive_path),
+            ]
+
+        return created_files
+
+    def collect_garbage(
+        self,
+        keep: typing.Optional[int] = None,
+        grace_seconds: float = DEFAULT_GRACE_SECONDS,
+        dry_run: bool = False,
+    ) -> StoreGarbage:
+        """
+        Remove old runs and the objects no remaining manifest references.
+
+        Args:
+            keep: Number of the latest runs of each project to retain; None
+                  retains all runs.
+            grace_seconds: Objects modified more recently are retained.
+            dry_run: Report what would be removed without removing it.
+
+        Returns:
+            Outcome of the collection.
+        Raises:
+            StoreError: If a retained manifest is malformed.
+        """
+        garbage = StoreGarbage()
+        for project_name in self.projects():
+            runs = self.runs(project_name)
+            expired = runs[:-keep] if keep else list()
+            for run in expired:
+                log.info(f"removing store run, {project_name}, {run}")
+                garbage.removed_runs.append(f"{project_name}/{run}")
+                if not dry_run:
+                    shutil.rmtree(self.manifests / project_name / run)
+
+        retained: typing.Set[str] = set()
+        for project_name in self.projects():
+            for run in self.runs(project_name):
+                if f"{project_name}/{run}" in garbage.removed_runs:
+                    continue
+                for x in self.read_manifests(project_name, run):
+                    retained |= x.blobs()
+
+        cutoff = time.time() - grace_seconds
+        for object_path in self.objects.glob("*/*"):
+            blob_id = f"{object_path.parent.name}{object_path.name}"
+            object_stat = object_path.stat()
+            if (blob_id not in retained) and (object_stat.st_mtime < cutoff):
+                garbage.removed_objects += 1
+                garbage.removed_bytes += object_stat.st_size
+                if not dry_run:
+                    object_path.unlink()
+        for temporary_path in self.objects.glob(".tmp-*"):
+            # left by an interrupted run
+            if (temporary_path.stat().st_mtime < cutoff) and (not dry_run):
+                temporary_path.unlink()
+        log.info(
+            f"store garbage collected, {garbage.removed_objects} objects, "
+            f"{garbage.removed_bytes} bytes"
+        )
+
+        return garbage
+
+
+def materialize_package(
+    store: ObjectStore,
+    project_name: str,
+    run: typing.Optional[str],
+    output_directory: pathlib.Path,
+) -> typing.List[pathlib.Path]:
+    """
+    Recreate a standard backup package of a stored backup run.
+
+    Args:
+        store: Snapshot store.
+        project_name: Name of project.
+        run: Name of the run; None for the latest run.
+        output_directory: Directory to write the package files.
+
+    Returns:
+        Paths of the package file and its hash file.
+    Raises:
+        StoreError: If the run does not exist, or a store object is missing
+                    or corrupt.
+    """
+    runs = store.runs(project_name)
+    if not runs:
+        raise StoreError(f"no store runs of project, {project_name}")
+    this_run = run or runs[-1]
+    manifests = store.read_manifests(project_name, this_run)
+
+    package_path = output_directory / f"{project_name}-{this_run}.tar.gz"
+    log.info(f"materializing package, {package_path}")
+    package_manifest = PackageManifest(
+        project_name=project_name,
+        created=this_run,
+        repositories=[
+            ManifestRepository(
+                name=x.name,
+                format=x.format,
+                archives=[
+                    ManifestArchive(
+                        file_name=y.file_name,
+                        ref=y.ref,
+                        sha=y.sha,
+                        sha256=y.sha256,
+                    )
+                    for y in x.archives
+                ],
+            )
+            for x in manifests
+        ],
+    )
+    with tempfile.TemporaryDirectory() as d:
+        archive_directory = pathlib.Path(d)
+        with tarfile.open(package_path, mode="w:gz") as f:
+            for x in manifests:
+                for y in store.materialize(x, archive_directory):
+                    f.add(str(y), arcname=y.name)
+                    y.unlink()
+            # the manifest is the last member of a package
+            for z in write_manifest_files(package_manifest, archive_directory):
+                f.add(str(z), arcname=z.name)
+    hash_path = create_hash_file(package_path)
+
+    return [package_path, hash_path]
+
+
+@click.group()
+@click.argument(
+    "store_directory",
+    type=click.Path(
+        dir_okay=True, exists=True, file_okay=False, path_type=pathlib.Path
+    ),
+)
+@click.pass_context
+def click_entry(context: click.Context, store_directory: pathlib.Path) -> None:
+    """
+    Manage a content addressed snapshot store.
+
+    STORE_DIRECTORY is the store written by the `--store` option of the
+    backup commands.
+    """
+    context.obj = ObjectStore(store_directory)
+
+
+@click_entry.command(name="list")
+@click.pass_obj
+def list_runs(store: ObjectStore) -> None:
+    """List the stored backup runs of each project."""
+    for project_name in store.projects():
+        for run in store.runs(project_name):
+            click.echo(f"{project_name} {run}")
+
+
+@click_entry.command()
+@click.argument("project_name", type=str)
+@click.option(
+    "--run",
+    default=None,
+    help="Backup run to materialize; defaults to the latest run.",
+    type=str,
+)
+@click.option(
+    "--output-dir",
+    default=pathlib.Path("."),
+    help="Directory path to save output tar file and SHA.",
+    type=click.Path(
+        dir_okay=True, exists=True, file_okay=False, path_type=pathlib.Path
+    ),
+)
+@click.pass_obj
+def materialize(
+    store: ObjectStore,
+    project_name: str,
+    run: typing.Optional[str],
+    output_dir: pathlib.Path,
+) -> None:
+    """Materialize a standard backup package of a stored backup run."""
+    try:
+        created_files = materialize_package(
+            store, project_name, run, output_dir
+        )
+        for x in created_files:
+            click.echo(f"{x}")
+    except StoreError as e:
+        click.echo(f"Materialize failed, {str(e)}", err=True)
+        sys.exit(1)
+
+
+@click_entry.command()
+@click.option(
+    "--keep",
+    default=None,
+    help="Number of the latest backup runs of each project to retain.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--grace",
+    default=DEFAULT_GRACE_SECONDS,
+    help="""Objects modified within this many seconds are retained, so that
+a concurrent backup does not lose them.""",
+    show_default=True,
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--dry-run",
+    default=False,
+    help="Report what would be removed without removing it.",
+    is_flag=True,
+)
+@click.pass_obj
+def gc(
+    store: ObjectStore, keep: typing.Optional[int], grace: float, dry_run: bool
+) -> None:
+    """Remove old backup runs and the objects they alone reference."""
+    try:
+        garbage = store.collect_garbage(keep, grace, dry_run)
+        for x in garbage.removed_runs:
+            click.echo(f"removed run {x}")
+        click.echo(
+            f"removed {garbage.removed_objects} objects "
+            f"({garbage.removed_bytes} bytes)"
+        )
+    except StoreError as e:
+        click.echo(f"Garbage collection failed, {str(e)}", err=True)
+        sys.exit(1)
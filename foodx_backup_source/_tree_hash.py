@@ -0,0 +1,348 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Chunked tree hashes of large files, for parallel and partial checks."""
+
+import concurrent.futures
+import hashlib
+import logging
+import pathlib
+import typing
+
+import pydantic
+
+log = logging.getLogger(__name__)
+
+TREE_HASH_SUFFIX = ".sha256tree"
+
+DEFAULT_CHUNK_SIZE = 0x4000000
+READ_SIZE = 0x100000
+
+# distinguish leaf and node hashes so that a chunk hash can never be
+# presented as a node hash, or the reverse
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+
+
+class TreeHashError(Exception):
+    """A tree hash manifest is malformed or does not apply to a file."""
+
+
+class TreeHashManifest(pydantic.BaseModel):
+    """Chunk hashes of a file, and their Merkle root."""
+
+    algorithm: typing.Literal["sha256"] = "sha256"
+    file_name: str
+    size: int
+    chunk_size: int
+    root: str
+    chunks: typing.List[str]
+
+    def chunk_range(self, index: int) -> typing.Tuple[int, int]:
+        """Byte offset and size of a chunk."""
+        offset = index * self.chunk_size
+        return offset, max(0, min(self.chunk_size, self.size - offset))
+
+
+class CorruptChunk(pydantic.BaseModel):
+    """A chunk whose hash does not match the manifest."""
+
+    index: int
+    offset: int
+    size: int
+    expected: str
+    actual: str
+
+
+def _chunk_count(size: int, chunk_size: int) -> int:
+    # an empty file has a single empty chunk
+    return max(1, -(-size // chunk_size))
+
+
+def _hash_chunk(file_path: pathlib.Path, index: int, chunk_size: int) -> str:
+    this_hash = hashlib.sha256(LEAF_PREFIX)
+    with file_path.open(mode="rb") as f:
+        f.seek(index * chunk_size)
+        remaining = chunk_size
+        while remaining:
+            data = f.read(min(remaining, READ_SIZE))
+            if not data:
+                break
+            this_hash.update(data)
+            remaining -= len(data)
+
+    return this_hash.hexdigest()
+
+
+def _hash_chunks(
+    file_path: pathlib.Path,
+    indices: typing.Iterable[int],
+    chunk_size: int,
+    jobs: typing.Optional[int],
+) -> typing.Dict[int, str]:
+    # hashlib releases the GIL while hashing, so threads hash in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            x: executor.submit(_hash_chunk, file_path, x, chunk_size)
+            for x in indices
+        }
+        return {x: y.result() for x, y in futures.items()}
+
+
+def merkle_root(chunk_hashes: typing.List[str]) -> str:
+    """
+    Combine chunk hashes into a Merkle root.
+
+    Pairs of hashes are combined level by level; an odd hash at the end of a
+    level is carried up unchanged.
+
+    Args:
+        chunk_hashes: Hex digests of the chunks, in file order.
+
+    Returns:
+        Hex digest of the root.
+    Raises:
+        TreeHashError: If there are no chunk hashes.
+    """
+    if not chunk_hashes:
+        raise TreeHashError("no chunk hashes")
+    level = [bytes.fromhex(x) for x in chunk_hashes]
+    while len(level) > 1:
+        next_level = [
+            hashlib.sha256(NODE_PREFIX + level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+
+    return level[0].hex()
+
+
+def create_tree_hash(
+    file_path: pathlib.Path,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    jobs: typing.Optional[int] = None,
+) -> TreeHashManifest:
+    """
+    Hash a file in fixed size chunks, in parallel.
+
+    Args:
+        file_path: Path of file to hash.
+        chunk_size: Size of each chunk in bytes.
+        jobs: Number of hashing threads, or None for the default.
+
+    Returns:
+        Tree hash manifest of the file.
+    """
+    size = file_path.stat().st_size
+    hashes = _hash_chunks(
+        file_path, range(_chunk_count(size, chunk_size)), chunk_size, jobs
+    )
+    chunks = [hashes[x] for x in sorted(hashes)]
+
+    return TreeHashManifest(
+        file_name=file_path.name,
+        size=size,
+        chunk_size=chunk_size,
+        root=merkle_root(chunks),
+        chunks=chunks,
+    )
+
+
+class TreeHasher:
+    """Tree hash of content as it is written, without reading it back."""
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        """
+        Construct ``TreeHasher`` object.
+
+        Args:
+            chunk_size: Size of each chunk in bytes.
+        """
+        self.chunk_size = chunk_size
+        self.size = 0
+        self._chunks: typing.List[str] = list()
+        self._hash = hashlib.sha256(LEAF_PREFIX)
+        self._chunk_remaining = chunk_size
+
+    def update(self, data: bytes) -> None:
+        """Hash content following the content already hashed."""
+        view = memoryview(data)
+        while view:
+            size = min(len(view), self._chunk_remaining)
+            self._hash.update(view[:size])
+            self._chunk_remaining -= size
+            self.size += size
+            view = view[size:]
+            if not self._chunk_remaining:
+                self._chunks.append(self._hash.hexdigest())
+                self._hash = hashlib.sha256(LEAF_PREFIX)
+                self._chunk_remaining = self.chunk_size
+
+    def manifest(self, file_name: str) -> TreeHashManifest:
+        """
+        Tree hash manifest of the content hashed so far.
+
+        Args:
+            file_name: Name of the file holding the content.
+
+        Returns:
+            Tree hash manifest.
+        """
+        chunks = list(self._chunks)
+        if (self._chunk_remaining != self.chunk_size) or not chunks:
+            chunks.append(self._hash.hexdigest())
+
+        return TreeHashManifest(
+            file_name=file_name,
+            size=self.size,
+            chunk_size=self.chunk_size,
+            root=merkle_root(chunks),
+            chunks=chunks,
+        )
+
+
+def write_tree_hash_file(
+    manifest: TreeHashManifest, reference_file_path: pathlib.Path
+) -> pathlib.Path:
+    """
+    Record a tree hash manifest in a file co-located with the hashed file.
+
+    Args:
+        manifest: Tree hash manifest to be recorded.
+        reference_file_path: Path to file that was hashed.
+
+    Returns:
+        Path of tree hash file created.
+    """
+    tree_hash_path = (
+        reference_file_path.parent
+        / f"{reference_file_path.name}{TREE_HASH_SUFFIX}"
+    )
+    log.info(f"creating tree hash file, {tree_hash_path} ({manifest.root})")
+    with tree_hash_path.open("w") as f:
+        f.write(manifest.json(indent=2))
+
+    return tree_hash_path
+
+
+def create_tree_hash_file(
+    reference_file_path: pathlib.Path,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    jobs: typing.Optional[int] = None,
+) -> pathlib.Path:
+    """
+    Record file tree hash in a file.
+
+    Args:
+        reference_file_path: Path to file to be hashed.
+        chunk_size: Size of each chunk in bytes.
+        jobs: Number of hashing threads, or None for the default.
+
+    Returns:
+        Path of tree hash file created.
+    """
+    manifest = create_tree_hash(reference_file_path, chunk_size, jobs)
+    tree_hash_path = write_tree_hash_file(manifest, reference_file_path)
+
+    return tree_hash_path
+
+
+def read_tree_hash_file(tree_hash_path: pathlib.Path) -> TreeHashManifest:
+    """
+    Read a tree hash manifest, checking that it is self consistent.
+
+    Args:
+        tree_hash_path: Path of tree hash file.
+
+    Returns:
+        Tree hash manifest recorded in the file.
+    Raises:
+        TreeHashError: If the manifest is malformed, or its chunk hashes do
+                       not match its root.
+    """
+    try:
+        manifest = TreeHashManifest.parse_file(tree_hash_path)
+    except pydantic.ValidationError as e:
+        raise TreeHashError(
+            f"malformed tree hash file, {tree_hash_path}"
+        ) from e
+    if (manifest.chunk_size < 1) or (
+        len(manifest.chunks) != _chunk_count(manifest.size, manifest.chunk_size)
+    ):
+        raise TreeHashError(f"tree hash chunk count mismatch, {tree_hash_path}")
+    try:
+        root = merkle_root(manifest.chunks)
+    except ValueError as e:
+        raise TreeHashError(
+            f"malformed tree hash file, {tree_hash_path}"
+        ) from e
+    if root != manifest.root:
+        raise TreeHashError(f"tree hash root mismatch, {tree_hash_path}")
+
+    return manifest
+
+
+def verify_tree_hash(
+    file_path: pathlib.Path,
+    manifest: TreeHashManifest,
+    chunks: typing.Optional[typing.Iterable[int]] = None,
+    jobs: typing.Optional[int] = None,
+) -> typing.List[CorruptChunk]:
+    """
+    Check file chunks against a tree hash manifest, in parallel.
+
+    A subset of chunks may be checked to spot check a file, or to resume an
+    interrupted check.
+
+    Args:
+        file_path: Path of file to check.
+        manifest: Tree hash manifest of the file.
+        chunks: Indices of the chunks to check; None checks all chunks.
+        jobs: Number of hashing threads, or None for the default.
+
+    Returns:
+        Chunks that do not match the manifest, in file order.
+    Raises:
+        TreeHashError: If the file size does not match the manifest, or a
+                       chunk index is out of range.
+    """
+    size = file_path.stat().st_size
+    if size != manifest.size:
+        raise TreeHashError(
+            f"file size mismatch, {file_path} "
+            f"(expected {manifest.size}, actual {size})"
+        )
+    indices = (
+        sorted(set(chunks))
+        if chunks is not None
+        else range(len(manifest.chunks))
+    )
+    if any((x < 0) or (x >= len(manifest.chunks)) for x in indices):
+        raise TreeHashError(f"chunk index out of range, {file_path}")
+
+    hashes = _hash_chunks(file_path, indices, manifest.chunk_size, jobs)
+    corrupt: typing.List[CorruptChunk] = list()
+    for index in indices:
+        if hashes[index] != manifest.chunks[index]:
+            offset, chunk_size = manifest.chunk_range(index)
+            log.error(
+                f"chunk hash mismatch, {file_path}, "
+                f"bytes {offset}-{offset + chunk_size - 1}"
+            )
+            corrupt.append(
+                CorruptChunk(
+                    index=index,
+                    offset=offset,
+                    size=chunk_size,
+                    expected=manifest.chunks[index],
+                    actual=hashes[index],
+                )
+            )
+
+    return corrupt
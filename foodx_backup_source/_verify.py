@@ -0,0 +1,614 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""Verify backup packages without restoring them."""
+
+import asyncio
+import concurrent.futures
+import hashlib
+import io
+import logging
+import pathlib
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import typing
+
+import click
+import git
+import pydantic
+
+from ._encrypt import EncryptionError, encryption_options, load_encryption_key
+from ._file_io import (
+    BackupDefinitions,
+    discover_backup_definitions,
+    load_backup_definitions,
+)
+from ._hash import HashingReader, parse_hash_content, read_hash_file
+from ._restore import HASH_SUFFIX, RestoreError, open_decrypter
+from ._snapshot import authorized_url
+from ._tree_hash import (
+    TREE_HASH_SUFFIX,
+    TreeHashError,
+    read_tree_hash_file,
+    verify_tree_hash,
+)
+from .schema import ApplicationDefinition
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIX = ".tar.gz"
+
+# git tree entry modes
+FILE_MODE = b"100644"
+EXECUTABLE_MODE = b"100755"
+SYMLINK_MODE = b"120000"
+TREE_MODE = b"40000"
+
+# a directory of an archive, or a tree entry of its mode and object id
+TreeEntries = typing.Dict[bytes, typing.Any]
+
+
+class VerifyError(Exception):
+    """A backup package, or an archive in it, failed verification."""
+
+
+class VerifyRecord(pydantic.BaseModel):
+    """Outcome of verifying a single package member against its hash."""
+
+    archive_name: str
+    size: int
+    sha256: str
+
+
+class SourceRecord(pydantic.BaseModel):
+    """Outcome of verifying an archive against the tree of its source."""
+
+    archive_name: str
+    commit: str
+    tree: str
+
+
+def verify_package(
+    package_path: pathlib.Path,
+    encryption_key: typing.Optional[bytes] = None,
+) -> typing.List[VerifyRecord]:
+    """
+    Verify each archive in a backup package against its hash file.
+
+    The package is streamed once, decrypting an encrypted package, and the
+    package itself is verified against its co-located hash file, if any.
+
+    Args:
+        package_path: Path to backup package file.
+        encryption_key: Key to decrypt an encrypted package.
+
+    Returns:
+        Records of the verified archives.
+    Raises:
+        VerifyError: If a hash does not match or is missing.
+        EncryptionError: If an encrypted package fails authentication.
+    """
+    package_hash_path = (
+        package_path.parent / f"{package_path.name}{HASH_SUFFIX}"
+    )
+    archive_hashes: typing.Dict[str, typing.Tuple[str, int]] = dict()
+    expected_hashes: typing.Dict[str, str] = dict()
+    log.info(f"verifying backup package, {package_path}")
+    with package_path.open(mode="rb") as f:
+        reader = HashingReader(f)
+        try:
+            decrypter = open_decrypter(package_path, reader, encryption_key)
+        except RestoreError as e:
+            raise VerifyError(str(e)) from e
+        with tarfile.open(fileobj=decrypter or reader, mode="r|*") as package:
+            for member in package:
+                name = pathlib.PurePosixPath(member.name).name
+                member_file = package.extractfile(member)
+                if member_file is None:
+                    continue
+
+                if name.endswith(HASH_SUFFIX):
+                    expected_hashes[name[: -len(HASH_SUFFIX)]] = (
+                        parse_hash_content(member_file.read().decode())
+                    )
+                else:
+                    this_hash = hashlib.sha256()
+                    for data in iter(lambda: member_file.read(0x40000), b""):
+                        this_hash.update(data)
+                    archive_hashes[name] = (this_hash.hexdigest(), member.size)
+        if decrypter:
+            decrypter.drain()
+        actual_package_hash = reader.drain()
+
+    if package_hash_path.is_file() and (
+        read_hash_file(package_hash_path) != actual_package_hash
+    ):
+        raise VerifyError(f"package hash mismatch, {package_path}")
+
+    missing = sorted(set(archive_hashes) - set(expected_hashes))
+    if missing:
+        raise VerifyError(f"archives missing hash files in package, {missing}")
+
+    records: typing.List[VerifyRecord] = list()
+    for name, (actual_hash, size) in archive_hashes.items():
+        if actual_hash != expected_hashes[name]:
+            raise VerifyError(
+                f"archive hash mismatch, {name} "
+                f"(expected {expected_hashes[name]}, actual {actual_hash})"
+            )
+        log.info(f"archive verified, {name}")
+        records.append(
+            VerifyRecord(archive_name=name, size=size, sha256=actual_hash)
+        )
+
+    return records
+
+
+def verify_package_chunks(
+    package_path: pathlib.Path,
+    spot_check: typing.Optional[int] = None,
+    jobs: typing.Optional[int] = None,
+) -> int:
+    """
+    Verify a backup package against its tree hash file, in parallel.
+
+    The package content is not decrypted or read as a tar file, so this only
+    checks that the package is intact.
+
+    Args:
+        package_path: Path to backup package file.
+        spot_check: Number of randomly selected chunks to check; None checks
+                    all chunks.
+        jobs: Number of hashing threads, or None for the default.
+
+    Returns:
+        Number of chunks checked.
+    Raises:
+        VerifyError: If the tree hash file is missing or malformed, or any
+                     chunk hash does not match.
+    """
+    tree_hash_path = (
+        package_path.parent / f"{package_path.name}{TREE_HASH_SUFFIX}"
+    )
+    if not tree_hash_path.is_file():
+        raise VerifyError(f"tree hash file missing, {tree_hash_path}")
+    try:
+        manifest = read_tree_hash_file(tree_hash_path)
+        chunks = (
+            random.sample(
+                range(len(manifest.chunks)),
+                min(spot_check, len(manifest.chunks)),
+            )
+            if spot_check is not None
+            else list(range(len(manifest.chunks)))
+        )
+        log.info(f"verifying {len(chunks)} package chunks, {package_path}")
+        corrupt = verify_tree_hash(package_path, manifest, chunks, jobs)
+    except TreeHashError as e:
+        raise VerifyError(str(e)) from e
+
+    if corrupt:
+        ranges = ", ".join(
+            f"{x.offset}-{x.offset + x.size - 1}" for x in corrupt
+        )
+        raise VerifyError(f"package chunks corrupt, {package_path}, {ranges}")
+
+    return len(chunks)
+
+
+def _tree_id(entries: TreeEntries) -> bytes:
+    """Git object id of a tree, building its subtrees first."""
+    content = io.BytesIO()
+    # git orders trees as though their names end with "/"
+    for name in sorted(
+        entries, key=lambda x: x + b"/" if isinstance(entries[x], dict) else x
+    ):
+        entry = entries[name]
+        if isinstance(entry, dict):
+            if not entry:
+                # only submodules are archived as empty directories
+                continue
+            mode, object_id = TREE_MODE, _tree_id(entry)
+        else:
+            mode, object_id = entry
+        content.write(mode + b" " + name + b"\x00" + object_id)
+    data = content.getvalue()
+
+    return hashlib.sha1(b"tree %d\x00" % len(data) + data).digest()  # nosec
+
+
+def _iter_archive_entries(
+    archive: tarfile.TarFile,
+) -> typing.Iterator[
+    typing.Tuple[
+        typing.List[bytes], typing.Optional[typing.Tuple[bytes, bytes]], int
+    ]
+]:
+    """
+    Hash the files of a streamed repository archive as git blobs.
+
+    Yields:
+        Path components within the repository, the tree entry mode and blob
+        id of a file, or None for a directory, and the size of the file.
+    """
+    for member in archive:
+        # archive content is prefixed by the repository name
+        parts = [
+            x.encode(tarfile.ENCODING, "surrogateescape")
+            for x in pathlib.PurePosixPath(member.name).parts[1:]
+        ]
+        if not parts:
+            continue
+
+        if member.isdir():
+            yield parts, None, 0
+        elif member.issym():
+            target = member.linkname.encode(tarfile.ENCODING, "surrogateescape")
+            yield parts, (
+                SYMLINK_MODE,
+                hashlib.sha1(  # nosec
+                    b"blob %d\x00" % len(target) + target
+                ).digest(),
+            ), len(target)
+        elif member.isfile():
+            this_hash = hashlib.sha1(b"blob %d\x00" % member.size)  # nosec
+            member_file = archive.extractfile(member)
+            if member_file:
+                for data in iter(lambda: member_file.read(0x40000), b""):
+                    this_hash.update(data)
+            yield parts, (
+                EXECUTABLE_MODE if (member.mode & 0o100) else FILE_MODE,
+                this_hash.digest(),
+            ), member.size
+
+
+def archive_tree(
+    archive_file: typing.BinaryIO,
+) -> typing.Tuple[typing.Optional[str], str]:
+    """
+    Rebuild the git tree id of a repository archive from its content.
+
+    The archive is streamed once; each file is hashed as a git blob and the
+    trees are built from the blob ids. ``git archive`` records the commit it
+    archived in the archive.
+
+    Args:
+        archive_file: Gzipped tar archive created by ``git archive``.
+
+    Returns:
+        Commit recorded in the archive, if any, and the root tree id.
+    """
+    root: TreeEntries = dict()
+    with tarfile.open(fileobj=archive_file, mode="r|gz") as archive:
+        for parts, entry, _ in _iter_archive_entries(archive):
+            directory = root
+            for x in parts[:-1]:
+                directory = directory.setdefault(x, dict())
+            if entry:
+                directory[parts[-1]] = entry
+            else:
+                directory.setdefault(parts[-1], dict())
+        commit = archive.pax_headers.get("comment")
+
+    return commit, _tree_id(root).hex()
+
+
+def archive_blobs(archive_file: typing.BinaryIO) -> typing.Dict[str, str]:
+    """
+    Identify the files of a repository archive by their git blob ids.
+
+    Args:
+        archive_file: Gzipped tar archive created by ``git archive``.
+
+    Returns:
+        Tree entry mode and blob id, by file path within the repository.
+    """
+    with tarfile.open(fileobj=archive_file, mode="r|gz") as archive:
+        return {
+            b"/".join(x).decode("utf-8", "surrogateescape"): (
+                f"{y[0].decode()} {y[1].hex()}"
+            )
+            for x, y, _ in _iter_archive_entries(archive)
+            if y
+        }
+
+
+def archive_file_sizes(
+    archive_file: typing.BinaryIO,
+) -> typing.Dict[str, typing.Tuple[str, int]]:
+    """
+    Identify the files of a repository archive by blob id, with their sizes.
+
+    Args:
+        archive_file: Gzipped tar archive created by ``git archive``.
+
+    Returns:
+        Blob id and size, by file path within the repository.
+    """
+    with tarfile.open(fileobj=archive_file, mode="r|gz") as archive:
+        return {
+            b"/".join(x).decode("utf-8", "surrogateescape"): (y[1].hex(), z)
+            for x, y, z in _iter_archive_entries(archive)
+            if y
+        }
+
+
+def source_tree(url: str, commit: str) -> str:
+    """
+    Read the tree id of a commit from its source repository.
+
+    Only the commit object is fetched; a shallow fetch without trees.
+
+    Args:
+        url: Source repository URL.
+        commit: Commit SHA.
+
+    Returns:
+        Tree id of the commit.
+    Raises:
+        git.GitCommandError: If the commit cannot be fetched.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        with git.Repo.init(d, bare=True) as this_repo:
+            this_repo.create_remote("origin", url)
+            with this_repo.config_writer() as c:
+                c.set_value('remote "origin"', "promisor", "true")
+                c.set_value("extensions", "partialClone", "origin")
+            this_repo.git.fetch(
+                "--depth=1", "--filter=tree:0", "--no-tags", "origin", commit
+            )
+            tree: str = this_repo.commit(commit).tree.hexsha
+
+    return tree
+
+
+def _archive_definition(
+    archive_name: str, definitions: BackupDefinitions
+) -> typing.Optional[ApplicationDefinition]:
+    """Definition of an archive, by the longest matching name prefix."""
+    matches = [
+        x
+        for x in definitions
+        if archive_name.startswith(f"{x.name}-")
+        and archive_name.endswith(ARCHIVE_SUFFIX)
+    ]
+
+    return max(matches, key=lambda x: len(x.name)) if matches else None
+
+
+def _verify_archive_source(
+    archive_path: pathlib.Path,
+    archive_name: str,
+    url: str,
+) -> SourceRecord:
+    try:
+        with archive_path.open(mode="rb") as f:
+            commit, tree = archive_tree(f)
+    finally:
+        archive_path.unlink()
+    if not commit:
+        raise VerifyError(f"archive does not record its commit, {archive_name}")
+
+    try:
+        expected_tree = source_tree(url, commit)
+    except git.GitCommandError as e:
+        raise VerifyError(
+            f"commit not found in source, {archive_name}, {commit} "
+            f"({str(e.stderr).strip()})"
+        ) from e
+    if tree != expected_tree:
+        raise VerifyError(
+            f"archive content does not match source tree, {archive_name} "
+            f"(commit {commit}, expected tree {expected_tree}, "
+            f"archive tree {tree})"
+        )
+    log.info(f"archive verified against source, {archive_name}, {tree}")
+
+    return SourceRecord(archive_name=archive_name, commit=commit, tree=tree)
+
+
+def verify_source(
+    package_path: pathlib.Path,
+    definitions: BackupDefinitions,
+    token: typing.Optional[str] = None,
+    encryption_key: typing.Optional[bytes] = None,
+    jobs: typing.Optional[int] = None,
+) -> typing.List[SourceRecord]:
+    """
+    Verify the archives of a package against the trees of their sources.
+
+    The git tree id of each archive is rebuilt from its content and compared
+    with the tree of the archived commit, fetched from the source repository
+    without any of its trees or blobs. The package is streamed once; each
+    archive is verified in parallel with the rest of the package.
+
+    Bundles, and archives of path filtered definitions, are not verified.
+    Archives of repositories with submodules, or with ``export-ignore`` or
+    ``export-subst`` attributes, do not match their source tree.
+
+    Args:
+        package_path: Path to backup package file.
+        definitions: Application definitions of the archived repositories.
+        token: Personal access token for repository access.
+        encryption_key: Key to decrypt an encrypted package.
+        jobs: Number of archives verified concurrently, or None for the
+              default.
+
+    Returns:
+        Records of the verified archives, in package order.
+    Raises:
+        VerifyError: If an archive does not match its source, or the package
+                     has no archives of the definitions.
+        EncryptionError: If an encrypted package fails authentication.
+    """
+    futures: typing.List[concurrent.futures.Future] = list()
+    log.info(f"verifying backup package against sources, {package_path}")
+    with tempfile.TemporaryDirectory() as d, package_path.open(
+        mode="rb"
+    ) as f, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        reader = HashingReader(f)
+        try:
+            decrypter = open_decrypter(package_path, reader, encryption_key)
+        except RestoreError as e:
+            raise VerifyError(str(e)) from e
+        with tarfile.open(fileobj=decrypter or reader, mode="r|*") as package:
+            for member in package:
+                name = pathlib.PurePosixPath(member.name).name
+                definition = _archive_definition(name, definitions)
+                member_file = package.extractfile(member)
+                if (member_file is None) or (definition is None):
+                    continue
+                backup = definition.configuration.backup
+                if backup.include_paths or backup.exclude_paths:
+                    log.warning(f"path filtered archive not verified, {name}")
+                    continue
+
+                # the package stream moves on while the archive is verified
+                archive_path = pathlib.Path(d) / name
+                with archive_path.open(mode="wb") as archive_file:
+                    shutil.copyfileobj(member_file, archive_file, 0x40000)
+                futures.append(
+                    executor.submit(
+                        _verify_archive_source,
+                        archive_path,
+                        name,
+                        authorized_url(backup.repo_url, token),
+                    )
+                )
+        if decrypter:
+            decrypter.drain()
+        records = [x.result() for x in futures]
+
+    if not records:
+        raise VerifyError(
+            f"no archives of the definitions in package, {package_path}"
+        )
+
+    return records
+
+
+def main(
+    package_file: pathlib.Path,
+    encryption_key: typing.Optional[bytes] = None,
+) -> typing.List[VerifyRecord]:
+    """
+    Verify a backup package.
+
+    Args:
+        package_file: Backup package file to verify.
+        encryption_key: Key to decrypt an encrypted package.
+
+    Returns:
+        Records of the verified archives.
+    """
+    records = verify_package(package_file, encryption_key)
+
+    return records
+
+
+@click.command()
+@click.argument(
+    "package_file",
+    type=click.Path(
+        dir_okay=False, exists=True, file_okay=True, path_type=pathlib.Path
+    ),
+)
+@click.option(
+    "--chunks",
+    default=False,
+    help=f"""Only verify the package file against its chunked tree hash
+(`{TREE_HASH_SUFFIX}`) file, hashing chunks in parallel.
+
+Corrupt byte ranges of the package are reported.
+""",
+    is_flag=True,
+)
+@click.option(
+    "--spot-check",
+    default=None,
+    help="Number of randomly selected chunks to verify with --chunks.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--source",
+    default=None,
+    help="""Verify the repository archives against the trees of their source
+repositories, defined by the dependency files in this project directory.
+
+The git tree of each archive is rebuilt from its content, and compared with
+the tree of the archived commit; only the commit is fetched from the source.
+""",
+    type=click.Path(
+        dir_okay=True, exists=True, file_okay=False, path_type=pathlib.Path
+    ),
+)
+@click.option(
+    "--token-file",
+    default=None,
+    help="Personal access token for source repositories with --source.",
+    type=click.File(mode="r"),
+)
+@click.option(
+    "--jobs",
+    default=None,
+    help="""Number of hashing threads for --chunks, or archives verified
+concurrently for --source.""",
+    type=click.IntRange(min=1),
+)
+@encryption_options
+def click_entry(
+    package_file: pathlib.Path,
+    chunks: bool,
+    spot_check: typing.Optional[int],
+    source: typing.Optional[pathlib.Path],
+    token_file: typing.Optional[io.TextIOBase],
+    jobs: typing.Optional[int],
+    encryption_key_file: typing.Optional[pathlib.Path],
+    encryption_key_secret: typing.Optional[str],
+    azure_subscription: typing.Optional[str],
+) -> None:
+    """
+    Verify a backup package.
+
+    Repository archives in PACKAGE_FILE are verified against their sha256sum
+    files without being extracted. Encrypted (".enc") packages are decrypted
+    and authenticated with the specified key. With --source, the archives are
+    instead verified against their source repositories without cloning them.
+    """
+    try:
+        if chunks:
+            count = verify_package_chunks(package_file, spot_check, jobs)
+            click.echo(f"{package_file.name}: ok ({count} chunks)")
+            return
+
+        encryption_key = load_encryption_key(
+            encryption_key_file, encryption_key_secret, azure_subscription
+        )
+        if source:
+            definitions = asyncio.run(
+                load_backup_definitions(discover_backup_definitions(source))
+            )
+            token = token_file.read().strip() if token_file else None
+            source_records = verify_source(
+                package_file, definitions, token, encryption_key, jobs
+            )
+            for y in source_records:
+                click.echo(f"{y.archive_name}: ok (tree {y.tree})")
+            return
+
+        records = main(package_file, encryption_key)
+
+        for x in records:
+            click.echo(f"{x.archive_name}: ok ({x.size} bytes)")
+    except (EncryptionError, VerifyError) as e:
+        click.echo(f"Verify failed, {str(e)}", err=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        click.echo("User aborted execution. Exiting.")
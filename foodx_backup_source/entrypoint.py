@@ -7,4 +7,12 @@
 
 """Define flit script entrypoints."""
 
+from ._batch import click_entry as batch  # noqa: F401
+from ._bundle import click_entry as check_bundles  # noqa: F401
+from ._catalog import click_entry as search  # noqa: F401
+from ._diff import click_entry as diff  # noqa: F401
 from ._main import click_entry as main  # noqa: F401
+from ._restore import click_entry as restore  # noqa: F401
+from ._serve import click_entry as serve  # noqa: F401
+from ._store import click_entry as store  # noqa: F401
+from ._verify import click_entry as verify  # noqa: F401
@@ -11,12 +11,42 @@ import typing
 
 import pydantic
 
+from ._compress import DEFAULT_COMPRESSION_LEVEL
+
+# "archive" snapshots the tree at the release reference; "bundle" preserves
+# history as a chain of full and incremental git bundles.
+BackupFormat = typing.Literal["archive", "bundle"]
+
 
 class RepoBackupDefinition(pydantic.BaseModel):
     """Git repository definitions."""
 
     repo_url: pydantic.HttpUrl
     branch_name: str
+    format: BackupFormat = "archive"
+    # limit an archive to these repository paths, and/or exclude paths
+    include_paths: typing.List[str] = list()
+    exclude_paths: typing.List[str] = list()
+    # deflate level of compressible archive content; content that is already
+    # compressed is always stored
+    compression_level: int = pydantic.Field(
+        DEFAULT_COMPRESSION_LEVEL, ge=0, le=9
+    )
+    # repositories of the same family (forks, or repositories sharing most of
+    # their history) fetch their objects into one shared object store
+    object_family: typing.Optional[str] = None
+
+    @pydantic.root_validator(skip_on_failure=True)
+    def check_path_filters(cls, values: dict) -> dict:
+        """Path filters only apply to "archive" format backups."""
+        if (values["format"] != "archive") and (
+            values["include_paths"] or values["exclude_paths"]
+        ):
+            raise ValueError(
+                "include_paths and exclude_paths require archive format"
+            )
+
+        return values
 
 
 class DockerImageDefinition(pydantic.BaseModel):
@@ -27,9 +57,13 @@ class DockerImageDefinition(pydantic.BaseModel):
 
 
 class ReleaseReference(pydantic.BaseModel):
-    """Define git reference to be used for repository backup."""
+    """Define git references to be used for repository backup."""
 
     ref: str
+    # further references archived from the same fetch of the repository
+    additional_refs: typing.List[str] = list()
+    # also archive the head of the backup branch
+    branch_head: bool = False
 
 
 class ApplicationDependency(pydantic.BaseModel):
@@ -39,6 +73,36 @@ class ApplicationDependency(pydantic.BaseModel):
     docker: DockerImageDefinition
     release: ReleaseReference
 
+    @pydantic.root_validator(skip_on_failure=True)
+    def check_additional_refs(cls, values: dict) -> dict:
+        """Additional references only apply to unfiltered archive backups."""
+        backup = values["backup"]
+        release = values["release"]
+        if (release.additional_refs or release.branch_head) and (
+            (backup.format != "archive")
+            or backup.include_paths
+            or backup.exclude_paths
+        ):
+            raise ValueError(
+                "additional_refs and branch_head require archive format "
+                "without path filters"
+            )
+
+        return values
+
+    def snapshot_refs(self) -> typing.List[str]:
+        """
+        List the references to snapshot, release reference first.
+
+        Returns:
+            Unique references, in declaration order.
+        """
+        refs = [self.release.ref] + self.release.additional_refs
+        if self.release.branch_head:
+            refs.append(self.backup.branch_name)
+
+        return list(dict.fromkeys(refs))
+
 
 ApplicationDependencies = typing.Dict[str, ApplicationDependency]
 
@@ -5,9 +5,26 @@
 #  You should have received a copy of the MIT License along with
 #  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
 
+import http.server
+import io
+import os
+import pathlib
+import subprocess
+import tarfile
+import tempfile
+import threading
+import typing
+
+import git
 import pytest
 import ruamel.yaml
 
+from foodx_backup_source._hash import create_hash_file
+from foodx_backup_source.schema import (
+    ApplicationDefinition,
+    ApplicationDependency,
+)
+
 
 @pytest.fixture()
 def load_yaml_content():
@@ -18,3 +35,259 @@ def load_yaml_content():
         return content
 
     return _load
+
+
+@pytest.fixture()
+def build_package():
+    def _build(
+        directory: pathlib.Path,
+        applications: typing.Dict[str, typing.Dict[str, bytes]],
+        ref: str = "1.2.3",
+    ) -> pathlib.Path:
+        """Build a backup package in the same layout as ``backup-source``."""
+        archive_directory = directory / "archives"
+        archive_directory.mkdir(exist_ok=True)
+        package_path = directory / "project-today.tar.gz"
+        with tarfile.open(package_path, mode="w:gz") as package:
+            for name, files in applications.items():
+                archive_path = archive_directory / f"{name}-{ref}.tar.gz"
+                with tarfile.open(archive_path, mode="w:gz") as archive:
+                    for file_name, content in files.items():
+                        info = tarfile.TarInfo(f"{name}/{file_name}")
+                        info.size = len(content)
+                        archive.addfile(info, io.BytesIO(content))
+                hash_path = create_hash_file(archive_path)
+
+                package.add(str(archive_path), arcname=archive_path.name)
+                package.add(str(hash_path), arcname=hash_path.name)
+        create_hash_file(package_path)
+
+        return package_path
+
+    return _build
+
+
+@pytest.fixture()
+def make_git_repository():
+    def _make(
+        directory: pathlib.Path,
+        name: str,
+        files: typing.Dict[str, bytes],
+        tag: str = "1.0.0",
+    ) -> pathlib.Path:
+        """Create a bare git repository with a single tagged commit."""
+        bare_path = directory / f"{name}.git"
+        with tempfile.TemporaryDirectory() as d:
+            working = git.Repo.init(d)
+            with working.config_writer() as c:
+                c.set_value("user", "name", "test")
+                c.set_value("user", "email", "test@some.where")
+            for file_name, content in files.items():
+                file_path = pathlib.Path(d) / file_name
+                file_path.parent.mkdir(parents=True, exist_ok=True)
+                file_path.write_bytes(content)
+            working.git.add(A=True)
+            working.index.commit("initial commit")
+            working.create_tag(tag)
+            working.git.clone(d, str(bare_path), bare=True)
+            working.close()
+
+        return bare_path
+
+    return _make
+
+
+@pytest.fixture()
+def make_definition():
+    def _make(
+        name: str = "r1",
+        url: str = "https://some.where",
+        ref: str = "1.0.0",
+        **backup: typing.Any,
+    ) -> ApplicationDefinition:
+        """Define a repository of a git server, by name."""
+        return ApplicationDefinition(
+            name=name,
+            configuration=ApplicationDependency.parse_obj(
+                {
+                    "backup": {
+                        "repo_url": f"{url}/{name}.git",
+                        "branch_name": "main",
+                        **backup,
+                    },
+                    "docker": {"image_name": "some-image", "tag_prefix": "p-"},
+                    "release": {"ref": ref},
+                }
+            ),
+        )
+
+    return _make
+
+
+class _GitHttpHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length)
+
+    def _respond(
+        self,
+        status: int,
+        headers: typing.List[typing.Tuple[str, str]],
+        content: bytes,
+    ) -> None:
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self) -> None:
+        stand_in = self.server.stand_in  # type: ignore
+        body = self._read_body()
+        with stand_in.lock:
+            stand_in.requests.append(self.path)
+            fault = stand_in.faults.pop(0) if stand_in.faults else None
+            if (
+                (not fault)
+                and stand_in.throttle_above
+                and (stand_in.active >= stand_in.throttle_above)
+            ):
+                # simulate a secondary rate limit on concurrent requests
+                stand_in.throttled += 1
+                fault = (429, {"Retry-After": "1"})
+        if fault:
+            status, headers = fault
+            self._respond(status, list(headers.items()), b"")
+            return
+        with stand_in.lock:
+            stand_in.active += 1
+            stand_in.max_active = max(stand_in.max_active, stand_in.active)
+        try:
+            self._serve(stand_in, body)
+        finally:
+            with stand_in.lock:
+                stand_in.active -= 1
+
+    def _serve(self, stand_in: "GitHttpServer", body: bytes) -> None:
+        if stand_in.delay_seconds:
+            stand_in.released.wait(stand_in.delay_seconds)
+
+        path, _, query = self.path.partition("?")
+        env = dict(
+            os.environ,
+            GIT_PROJECT_ROOT=str(stand_in.project_root),
+            GIT_HTTP_EXPORT_ALL="1",
+            PATH_INFO=path,
+            QUERY_STRING=query,
+            REQUEST_METHOD=self.command,
+            CONTENT_TYPE=self.headers.get("Content-Type", ""),
+            CONTENT_LENGTH=str(len(body)),
+            REMOTE_ADDR="127.0.0.1",
+            # allow partial clones, and the lazy fetches they make
+            GIT_CONFIG_COUNT="2",
+            GIT_CONFIG_KEY_0="uploadpack.allowFilter",
+            GIT_CONFIG_VALUE_0="true",
+            GIT_CONFIG_KEY_1="uploadpack.allowAnySHA1InWant",
+            GIT_CONFIG_VALUE_1="true",
+        )
+        if self.headers.get("Content-Encoding"):
+            env["HTTP_CONTENT_ENCODING"] = self.headers["Content-Encoding"]
+        if self.headers.get("Git-Protocol"):
+            env["GIT_PROTOCOL"] = self.headers["Git-Protocol"]
+        result = subprocess.run(
+            ["git", "http-backend"], input=body, env=env, capture_output=True
+        )
+
+        separator = b"\r\n\r\n" if b"\r\n\r\n" in result.stdout else b"\n\n"
+        header_block, _, content = result.stdout.partition(separator)
+        status = 200
+        headers = list()
+        for line in header_block.decode().splitlines():
+            name, _, value = line.partition(":")
+            if name.lower() == "status":
+                status = int(value.split()[0])
+            elif name:
+                headers.append((name, value.strip()))
+        with stand_in.lock:
+            stand_in.bytes_sent += len(content)
+        self._respond(status, headers, content)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class GitHttpServer:
+    """Local smart HTTP git server stand-in with injectable faults."""
+
+    def __init__(self, project_root: pathlib.Path) -> None:
+        self.project_root = project_root
+        self.lock = threading.Lock()
+        self.faults: typing.List[typing.Tuple[int, typing.Dict[str, str]]] = (
+            list()
+        )
+        self.requests: typing.List[str] = list()
+        self.bytes_sent = 0
+        self.delay_seconds = 0.0
+        self.released = threading.Event()
+        # concurrent requests, and 429 responses above a concurrency limit
+        self.active = 0
+        self.max_active = 0
+        self.throttle_above: typing.Optional[int] = None
+        self.throttled = 0
+
+        self._httpd = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), _GitHttpHandler
+        )
+        self._httpd.daemon_threads = True
+        self._httpd.stand_in = self  # type: ignore
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def inject(
+        self,
+        status: int,
+        count: int = 1,
+        headers: typing.Optional[typing.Dict[str, str]] = None,
+    ) -> None:
+        """Fail the next ``count`` requests with the specified status."""
+        with self.lock:
+            self.faults.extend([(status, headers or dict())] * count)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.released.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture()
+def git_http_server():
+    with tempfile.TemporaryDirectory() as d:
+        server = GitHttpServer(pathlib.Path(d))
+        server.start()
+        try:
+            yield server
+        finally:
+            server.stop()
@@ -0,0 +1,103 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import pathlib
+import tarfile
+import tempfile
+
+import git
+import pytest
+
+from foodx_backup_source._backend import DULWICH_AVAILABLE, GitBackendError
+from foodx_backup_source._hash import create_file_hash, read_hash_file
+from foodx_backup_source._snapshot import (
+    SnapshotOptions,
+    construct_backend,
+    do_snapshot,
+)
+
+BACKENDS = [
+    "subprocess",
+    pytest.param(
+        "dulwich",
+        marks=pytest.mark.skipif(
+            not DULWICH_AVAILABLE, reason="dulwich not installed"
+        ),
+    ),
+]
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+class TestBackend:
+    @pytest.mark.asyncio
+    async def test_operations(self, name, git_http_server, make_git_repository):
+        bare_path = make_git_repository(
+            git_http_server.project_root,
+            "r1",
+            {"README.md": b"r1 readme", "sub/a.txt": b"a"},
+        )
+        with git.Repo(bare_path) as this_repo:
+            expected_sha = this_repo.commit("1.0.0").hexsha
+        backend = construct_backend(name)
+
+        with tempfile.TemporaryDirectory() as d:
+            directory = pathlib.Path(d) / "repository"
+            archive_path = pathlib.Path(d) / "r1-1.0.0.tar.gz"
+            await backend.fetch(f"{git_http_server.url}/r1.git", directory)
+            sha = await backend.resolve(directory, "1.0.0")
+            digest = await backend.archive(
+                directory, "r1", sha, archive_path, 6
+            )
+
+            assert sha == expected_sha
+            assert digest == create_file_hash(archive_path)
+            assert (
+                read_hash_file(
+                    archive_path.parent / f"{archive_path.name}.sha256"
+                )
+                == digest
+            )
+            with tarfile.open(archive_path, mode="r:gz") as f:
+                assert f.extractfile("r1/sub/a.txt").read() == b"a"
+            with pytest.raises(GitBackendError):
+                await backend.resolve(directory, "missing")
+        backend.close()
+
+    @pytest.mark.asyncio
+    async def test_snapshot_retry(
+        self, name, git_http_server, make_git_repository, make_definition
+    ):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+        git_http_server.inject(502, count=1)
+        options = SnapshotOptions(retries=2, backoff_seconds=0.01, backend=name)
+
+        with tempfile.TemporaryDirectory() as d:
+            result = await do_snapshot(
+                make_definition("r1", git_http_server.url),
+                pathlib.Path(d),
+                None,
+                options,
+            )
+
+            assert result.sha256 == create_file_hash(result.archive_path)
+            with tarfile.open(result.archive_path, mode="r:gz") as f:
+                assert "r1/README.md" in f.getnames()
+
+    @pytest.mark.asyncio
+    async def test_unsupported(self, name, git_http_server, make_definition):
+        options = SnapshotOptions(backend=name)
+
+        with tempfile.TemporaryDirectory() as d:
+            with pytest.raises(GitBackendError, match=r"only supports"):
+                await do_snapshot(
+                    make_definition("r1", git_http_server.url, format="bundle"),
+                    pathlib.Path(d),
+                    None,
+                    options,
+                )
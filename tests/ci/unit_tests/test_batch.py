@@ -0,0 +1,276 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import pathlib
+import tempfile
+
+import pytest
+from click.testing import CliRunner
+
+from foodx_backup_source._batch import (
+    _deduplicate,
+    _launch_batch_packaging,
+    _process_project_options,
+    click_entry,
+)
+from foodx_backup_source._snapshot import (
+    SnapshotOptions,
+    SnapshotResult,
+    SnapshotTimings,
+)
+
+
+@pytest.fixture()
+def mock_projects(make_definition, mocker):
+    projects = {
+        "p1": [
+            make_definition("r1", "https://some.where"),
+            make_definition("r2", "https://some.where"),
+        ],
+        "p2": [
+            make_definition("r2", "https://some.where"),
+            make_definition("r1", "https://some.where", ref="2.0.0"),
+        ],
+        "p3": [
+            make_definition("r2", "https://other.host"),
+        ],
+    }
+
+    async def _load(directory, git_refs):
+        return projects[directory.name]
+
+    mocker.patch(
+        "foodx_backup_source._batch._load_definitions", side_effect=_load
+    )
+
+    return projects
+
+
+@pytest.fixture()
+def mock_iter_snapshots(mocker):
+    async def _iter_snapshots(
+        definitions,
+        archive_directory,
+        token,
+        options,
+        archive_executor,
+        governor,
+    ):
+        for x in definitions:
+            yield SnapshotResult(
+                name=x.name,
+                ref=x.configuration.release.ref,
+                sha="0" * 40,
+                archive_path=archive_directory
+                / f"{x.name}-{x.configuration.release.ref}.tar.gz",
+                hash_path=archive_directory / f"{x.name}.tar.gz.sha256",
+                sha256="1" * 64,
+                timings=SnapshotTimings(
+                    clone_seconds=0, archive_seconds=0, total_seconds=0
+                ),
+            )
+
+    return mocker.patch(
+        "foodx_backup_source._batch.iter_snapshots",
+        side_effect=_iter_snapshots,
+    )
+
+
+class TestDeduplicate:
+    def test_clean(self, mock_projects):
+        rounds = _deduplicate(mock_projects)
+
+        assert [
+            [(x.name, x.configuration.release.ref) for x in y] for y in rounds
+        ] == [
+            [("r1", "1.0.0"), ("r2", "1.0.0"), ("r1", "2.0.0")],
+            [("r2", "1.0.0")],
+        ]
+        assert str(rounds[1][0].configuration.backup.repo_url) == (
+            "https://other.host/r2.git"
+        )
+
+    def test_additional_refs(self, make_definition):
+        r1 = make_definition("r1", "https://some.where")
+        r1.configuration.release.additional_refs = ["2.0.0"]
+
+        rounds = _deduplicate(
+            {
+                "p1": [r1],
+                "p2": [make_definition("r1", "https://some.where", "1.0.0")],
+                "p3": [make_definition("r1", "https://some.where", "2.0.0")],
+            }
+        )
+
+        # the additional reference makes a different snapshot, whose archive
+        # file names collide with both the other snapshots
+        assert [
+            [x.configuration.snapshot_refs() for x in y] for y in rounds
+        ] == [[["1.0.0", "2.0.0"]], [["1.0.0"], ["2.0.0"]]]
+
+    def test_renamed_entries(self, make_definition):
+        r1 = make_definition("r1", "https://some.where")
+        alias = make_definition("alias", "https://some.where")
+        alias.configuration.backup.repo_url = r1.configuration.backup.repo_url
+        bundles = [
+            make_definition(x, "https://some.where", format="bundle")
+            for x in ["b1", "b2"]
+        ]
+        bundles[1].configuration.backup.repo_url = bundles[
+            0
+        ].configuration.backup.repo_url
+
+        rounds = _deduplicate(
+            {"p1": [r1] + bundles[:1], "p2": [alias] + bundles[1:]}
+        )
+
+        # bundle chains are recorded by name, so bundles are not shared
+        assert [[x.name for x in y] for y in rounds] == [["r1", "b1", "b2"]]
+
+
+class TestLaunchBatchPackaging:
+    @pytest.mark.asyncio
+    async def test_clean(self, mock_projects, mock_iter_snapshots, mocker):
+        mock_package = mocker.patch(
+            "foodx_backup_source._batch.write_package",
+            side_effect=lambda name, output, *args: [output / f"{name}.tar.gz"],
+        )
+
+        result = await _launch_batch_packaging(
+            {x: pathlib.Path(x) for x in ["p1", "p2", "p3"]},
+            pathlib.Path("output"),
+            None,
+            dict(),
+            SnapshotOptions(),
+        )
+
+        assert sorted(result) == [
+            pathlib.Path(f"output/{x}.tar.gz") for x in ["p1", "p2", "p3"]
+        ]
+        # one snapshot per unique repository and ref
+        assert (
+            sum(len(x.args[0]) for x in mock_iter_snapshots.call_args_list) == 4
+        )
+        # all the rounds share host limits
+        governors = {id(x.args[5]) for x in mock_iter_snapshots.call_args_list}
+        assert len(mock_iter_snapshots.call_args_list) == 2
+        assert len(governors) == 1
+        packaged = {
+            x.args[0]: [y.archive_path.name for y in x.args[2]]
+            for x in mock_package.call_args_list
+        }
+        assert packaged == {
+            "p1": ["r1-1.0.0.tar.gz", "r2-1.0.0.tar.gz"],
+            "p2": ["r2-1.0.0.tar.gz", "r1-2.0.0.tar.gz"],
+            "p3": ["r2-1.0.0.tar.gz"],
+        }
+        # shared snapshots are the same archive in each package
+        p1_r2 = mock_package.call_args_list[0].args[2]
+        assert any(
+            p1_r2[1].archive_path == x.args[2][0].archive_path
+            for x in mock_package.call_args_list
+            if x.args[0] == "p2"
+        )
+
+    @pytest.mark.asyncio
+    async def test_renamed_entries(
+        self, make_definition, mock_iter_snapshots, mocker
+    ):
+        r1 = make_definition("r1", "https://some.where")
+        alias = make_definition("alias", "https://some.where")
+        alias.configuration.backup.repo_url = r1.configuration.backup.repo_url
+        projects = {"p1": [r1], "p2": [alias]}
+        mocker.patch(
+            "foodx_backup_source._batch._load_definitions",
+            side_effect=lambda directory, git_refs: projects[directory.name],
+        )
+        mock_rename = mocker.patch(
+            "foodx_backup_source._batch.rename_snapshot",
+            side_effect=lambda result, name, directory: result.copy(
+                update={"name": name}
+            ),
+        )
+        mock_package = mocker.patch(
+            "foodx_backup_source._batch.write_package",
+            side_effect=lambda name, output, *args: [output / f"{name}.tar.gz"],
+        )
+
+        await _launch_batch_packaging(
+            {x: pathlib.Path(x) for x in projects},
+            pathlib.Path("output"),
+            None,
+            dict(),
+            SnapshotOptions(),
+        )
+
+        # the repository is snapshot once, and renamed for the other entry
+        assert [
+            [y.name for y in x.args[0]]
+            for x in mock_iter_snapshots.call_args_list
+        ] == [["r1"]]
+        assert [x.args[1] for x in mock_rename.call_args_list] == ["alias"]
+        packaged = {
+            x.args[0]: [y.name for y in x.args[2]]
+            for x in mock_package.call_args_list
+        }
+        assert packaged == {"p1": ["r1"], "p2": ["alias"]}
+
+
+class TestProcessProjectOptions:
+    def test_clean(self):
+        with tempfile.TemporaryDirectory() as d:
+            result = _process_project_options([f"p1={d}", f" p2 = {d} "])
+
+        assert result == {"p1": pathlib.Path(d), "p2": pathlib.Path(d)}
+
+    def test_malformed(self):
+        with pytest.raises(RuntimeError, match=r"^Malformed project option"):
+            _process_project_options(["p1"])
+
+    def test_missing_directory(self):
+        with pytest.raises(
+            RuntimeError, match=r"^Project directory does not exist"
+        ):
+            _process_project_options(["p1=/no/such/directory"])
+
+    def test_duplicate(self):
+        with tempfile.TemporaryDirectory() as d:
+            with pytest.raises(RuntimeError, match=r"^Duplicate project name"):
+                _process_project_options([f"p1={d}", f"p1={d}"])
+
+
+class TestClickEntry:
+    def test_clean(self, mocker):
+        mock_launch = mocker.patch(
+            "foodx_backup_source._batch._launch_batch_packaging"
+        )
+        with tempfile.TemporaryDirectory() as d:
+            result = CliRunner().invoke(
+                click_entry,
+                [
+                    f"p1={d}",
+                    f"p2={d}",
+                    "--git-ref",
+                    "r1=abc123",
+                    "--timeout",
+                    "60",
+                ],
+            )
+
+        assert result.exit_code == 0
+        mock_launch.assert_awaited_once_with(
+            {"p1": pathlib.Path(d), "p2": pathlib.Path(d)},
+            pathlib.Path("."),
+            None,
+            {"r1": "abc123"},
+            SnapshotOptions(timeout_seconds=60),
+            None,
+            "tar.gz",
+            None,
+            False,
+            None,
+        )
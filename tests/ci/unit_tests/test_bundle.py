@@ -0,0 +1,207 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import os
+import pathlib
+import tempfile
+
+import git
+import pytest
+from click.testing import CliRunner
+
+from foodx_backup_source._bundle import (
+    BundleChainError,
+    BundleRecord,
+    BundleState,
+    bundle_key,
+    check_bundle_chain,
+    click_entry,
+)
+from foodx_backup_source._run import record_bundles
+from foodx_backup_source._snapshot import SnapshotOptions, do_snapshot
+
+
+def _add_commit(bare_path: pathlib.Path, file_name: str) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        working = git.Repo.clone_from(str(bare_path), d)
+        with working.config_writer() as c:
+            c.set_value("user", "name", "test")
+            c.set_value("user", "email", "test@some.where")
+        (pathlib.Path(d) / file_name).write_text(file_name)
+        working.git.add(A=True)
+        working.index.commit(f"add {file_name}")
+        working.git.push("origin", "HEAD")
+        working.close()
+
+
+@pytest.fixture()
+def bundle_repository(git_http_server, make_git_repository, make_definition):
+    bare_path = make_git_repository(
+        git_http_server.project_root,
+        "r1",
+        {"README.md": b"r1 readme", "data.bin": os.urandom(0x10000)},
+    )
+    definition = make_definition(
+        "r1", git_http_server.url, "HEAD", format="bundle"
+    )
+
+    return bare_path, definition
+
+
+async def _take_bundle(definition, state, directory):
+    options = SnapshotOptions(bundle_tips=state.tips())
+    result = await do_snapshot(definition, directory, None, options)
+    record_bundles(state, [(definition, result)])
+
+    return result
+
+
+class TestBundleState:
+    def test_load_missing(self):
+        with tempfile.TemporaryDirectory() as d:
+            state = BundleState.load(pathlib.Path(d) / "state.json")
+
+        assert state.chains == dict()
+
+    def test_save_load(self):
+        state = BundleState()
+        state.record(
+            "k1",
+            BundleRecord(
+                file_name="f1", tip="1" * 40, prerequisite=None, sha256="a"
+            ),
+        )
+        state.record(
+            "k1",
+            BundleRecord(
+                file_name="f2", tip="2" * 40, prerequisite="1" * 40, sha256="b"
+            ),
+        )
+        with tempfile.TemporaryDirectory() as d:
+            state_path = pathlib.Path(d) / "state.json"
+            state.save(state_path)
+
+            result = BundleState.load(state_path)
+
+        assert result == state
+        assert result.tips() == {"k1": "2" * 40}
+
+    def test_full_bundle_restarts_chain(self):
+        state = BundleState()
+        for x in ["1", "2"]:
+            state.record(
+                "k1",
+                BundleRecord(
+                    file_name="f", tip=x * 40, prerequisite=None, sha256="a"
+                ),
+            )
+
+        assert len(state.chains["k1"]) == 1
+
+
+class TestBundleChain:
+    @pytest.mark.asyncio
+    async def test_incremental(self, bundle_repository):
+        bare_path, definition = bundle_repository
+        state = BundleState()
+
+        with tempfile.TemporaryDirectory() as d:
+            bundles = list()
+            for index in range(3):
+                directory = pathlib.Path(d) / f"{index}"
+                directory.mkdir()
+                if index == 1:
+                    _add_commit(bare_path, "new_file")
+                result = await _take_bundle(definition, state, directory)
+                bundles.append(result)
+
+            # full, incremental, then empty as there are no new commits
+            assert [x.prerequisite for x in bundles] == [
+                None,
+                bundles[0].sha,
+                bundles[1].sha,
+            ]
+            assert bundles[1].sha != bundles[0].sha
+            assert bundles[2].sha == bundles[1].sha
+            assert (
+                bundles[1].archive_path.stat().st_size
+                < bundles[0].archive_path.stat().st_size
+            )
+            assert len(state.chains[bundle_key(definition)]) == 3
+
+            checked = check_bundle_chain([x.archive_path for x in bundles])
+
+            assert [x.refs for x in checked] == [
+                {"refs/heads/main": x.sha} for x in bundles
+            ]
+
+    @pytest.mark.asyncio
+    async def test_slashed_branch(self, bundle_repository):
+        bare_path, definition = bundle_repository
+        with git.Repo(bare_path) as this_repo:
+            this_repo.create_head("feature/x", "HEAD")
+        definition.configuration.backup.branch_name = "feature/x"
+        definition.configuration.release.ref = "feature/x"
+
+        with tempfile.TemporaryDirectory() as d:
+            result = await _take_bundle(
+                definition, BundleState(), pathlib.Path(d)
+            )
+            checked = check_bundle_chain([result.archive_path])
+
+            assert result.archive_path == (
+                pathlib.Path(d) / "r1-feature_x.bundle"
+            )
+        assert checked[0].refs == {"refs/heads/feature/x": result.sha}
+
+    @pytest.mark.asyncio
+    async def test_broken_chain(self, bundle_repository):
+        bare_path, definition = bundle_repository
+        state = BundleState()
+
+        with tempfile.TemporaryDirectory() as d:
+            first = pathlib.Path(d) / "first"
+            first.mkdir()
+            await _take_bundle(definition, state, first)
+            _add_commit(bare_path, "new_file")
+            second = pathlib.Path(d) / "second"
+            second.mkdir()
+            result = await _take_bundle(definition, state, second)
+
+            with pytest.raises(BundleChainError, match=r"chain broken"):
+                check_bundle_chain([result.archive_path])
+
+    @pytest.mark.asyncio
+    async def test_hash_mismatch(self, bundle_repository):
+        bare_path, definition = bundle_repository
+
+        with tempfile.TemporaryDirectory() as d:
+            result = await _take_bundle(
+                definition, BundleState(), pathlib.Path(d)
+            )
+            result.hash_path.write_text(f"{'0' * 64}  {result.archive_path}")
+
+            with pytest.raises(BundleChainError, match=r"hash mismatch"):
+                check_bundle_chain([result.archive_path])
+
+
+class TestClickEntry:
+    @pytest.mark.asyncio
+    async def test_clean(self, bundle_repository):
+        bare_path, definition = bundle_repository
+
+        with tempfile.TemporaryDirectory() as d:
+            result = await _take_bundle(
+                definition, BundleState(), pathlib.Path(d)
+            )
+
+            cli_result = CliRunner().invoke(
+                click_entry, [str(result.archive_path)]
+            )
+
+        assert cli_result.exit_code == 0
+        assert f"ok (refs/heads/main {result.sha})" in cli_result.output
@@ -0,0 +1,233 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import asyncio
+import datetime
+import os
+import pathlib
+import tempfile
+
+import git
+import pytest
+from click.testing import CliRunner
+
+from foodx_backup_source import _catalog
+from foodx_backup_source._catalog import (
+    CatalogError,
+    PackageCatalog,
+    catalog_package,
+    click_entry,
+)
+from foodx_backup_source._package import write_package
+from foodx_backup_source._snapshot import iter_snapshots
+from foodx_backup_source.schema import ApplicationDefinition
+
+PACKAGE_DATES = [
+    "2022-01-01T00:00:00.000Z",
+    "2022-02-01T00:00:00.000Z",
+    "2022-03-01T00:00:00.000Z",
+]
+
+
+@pytest.fixture()
+def catalogued(git_http_server, make_git_repository, make_definition, mocker):
+    """Catalog three packages of the same two repository snapshots."""
+
+    async def _build(directory: pathlib.Path, **kwargs):
+        blobs = dict()
+        for name in ["r1", "r2"]:
+            bare_path = make_git_repository(
+                git_http_server.project_root,
+                name,
+                {
+                    "README.md": f"{name} readme".encode(),
+                    "config/prod.yaml": f"{name}: prod".encode(),
+                },
+            )
+            with git.Repo(bare_path) as this_repo:
+                blobs[name] = this_repo.git.rev_parse("1.0.0:config/prod.yaml")
+        archive_directory = directory / "archives"
+        archive_directory.mkdir()
+        results = [
+            x
+            async for x in iter_snapshots(
+                [make_definition(x, git_http_server.url) for x in ["r1", "r2"]],
+                archive_directory,
+            )
+        ]
+        catalog_path = directory / "catalog.db"
+        mocker.patch(
+            "foodx_backup_source._package._isoformat_now",
+            side_effect=PACKAGE_DATES,
+        )
+        for _ in PACKAGE_DATES:
+            package_path = write_package(
+                "project", directory, results, **kwargs
+            )[0]
+            catalog_package(
+                catalog_path,
+                package_path,
+                results,
+                kwargs.get("encryption_key"),
+            )
+
+        return catalog_path, blobs
+
+    return _build
+
+
+class TestPackageCatalog:
+    @pytest.mark.asyncio
+    async def test_path(self, catalogued, mocker):
+        mock_files = mocker.spy(_catalog, "archive_file_sizes")
+        with tempfile.TemporaryDirectory() as d:
+            catalog_path, blobs = await catalogued(pathlib.Path(d))
+
+            with PackageCatalog(catalog_path) as catalog:
+                result = catalog.search(path="config/prod.yaml")
+                glob_result = catalog.search(path="config/*.yaml")
+                readme_result = catalog.search(
+                    path="README.md", repository="r2"
+                )
+
+        # the files of each commit are only read once
+        assert mock_files.call_count == 2
+        assert [(x.created, x.repository) for x in result] == [
+            (y, z) for y in PACKAGE_DATES for z in ["r1", "r2"]
+        ]
+        assert result[0].package == f"project-{PACKAGE_DATES[0]}.tar.gz"
+        assert result[0].project_name == "project"
+        assert result[0].ref == "1.0.0"
+        assert result[0].blob == blobs["r1"]
+        assert result[0].size == len(b"r1: prod")
+        assert glob_result == result
+        assert [x.repository for x in readme_result] == ["r2"] * 3
+
+    @pytest.mark.asyncio
+    async def test_blob(self, catalogued):
+        with tempfile.TemporaryDirectory() as d:
+            catalog_path, blobs = await catalogued(pathlib.Path(d))
+
+            with PackageCatalog(catalog_path) as catalog:
+                result = catalog.search(blob=blobs["r2"][:7])
+                dated_result = catalog.search(
+                    blob=blobs["r2"],
+                    since=datetime.datetime(2022, 2, 1),
+                    until=datetime.datetime(2022, 3, 1),
+                )
+                limited_result = catalog.search(blob=blobs["r2"], limit=1)
+
+        assert [(x.created, x.path) for x in result] == [
+            (x, "config/prod.yaml") for x in PACKAGE_DATES
+        ]
+        assert [x.created for x in dated_result] == [PACKAGE_DATES[1]]
+        assert limited_result == result[:1]
+
+    @pytest.mark.asyncio
+    async def test_encrypted(self, catalogued):
+        with tempfile.TemporaryDirectory() as d:
+            catalog_path, blobs = await catalogued(
+                pathlib.Path(d),
+                package_format="tar",
+                encryption_key=os.urandom(32),
+            )
+
+            with PackageCatalog(catalog_path) as catalog:
+                result = catalog.search(
+                    path="config/prod.yaml", repository="r1"
+                )
+
+        assert [x.blob for x in result] == [blobs["r1"]] * 3
+        assert result[0].package.endswith(".tar.enc")
+
+    @pytest.mark.asyncio
+    async def test_path_filtered(
+        self, git_http_server, make_git_repository, make_definition
+    ):
+        make_git_repository(
+            git_http_server.project_root,
+            "r1",
+            {"README.md": b"r1 readme", "config/prod.yaml": b"r1: prod"},
+        )
+        full = make_definition("r1", git_http_server.url)
+        filtered = ApplicationDefinition(
+            name="r1-config", configuration=full.configuration.copy(deep=True)
+        )
+        filtered.configuration.backup.include_paths = ["config"]
+        with tempfile.TemporaryDirectory() as d:
+            archive_directory = pathlib.Path(d) / "archives"
+            archive_directory.mkdir()
+            results = [
+                x
+                async for x in iter_snapshots(
+                    [full, filtered], archive_directory
+                )
+            ]
+            package_path = write_package("project", pathlib.Path(d), results)[0]
+            catalog_path = pathlib.Path(d) / "catalog.db"
+            catalog_package(catalog_path, package_path, results)
+
+            with PackageCatalog(catalog_path) as catalog:
+                readme_result = catalog.search(path="README.md")
+                config_result = catalog.search(path="config/prod.yaml")
+
+        # both archives are of the same commit, with different files
+        assert results[0].sha == results[1].sha
+        assert [x.repository for x in readme_result] == ["r1"]
+        assert sorted(x.repository for x in config_result) == [
+            "r1",
+            "r1-config",
+        ]
+
+    def test_search_error(self):
+        with tempfile.TemporaryDirectory() as d:
+            with PackageCatalog(pathlib.Path(d) / "catalog.db") as catalog:
+                with pytest.raises(CatalogError, match=r"path or blob id"):
+                    catalog.search(repository="r1")
+                with pytest.raises(CatalogError, match=r"malformed blob id"):
+                    catalog.search(blob="not-a-blob")
+
+
+class TestClickEntry:
+    def test_clean(self, catalogued):
+        with tempfile.TemporaryDirectory() as d:
+            catalog_path, blobs = asyncio.run(catalogued(pathlib.Path(d)))
+
+            result = CliRunner().invoke(
+                click_entry,
+                [
+                    str(catalog_path),
+                    "--path",
+                    "config/prod.yaml",
+                    "--since",
+                    "2022-03-01",
+                ],
+            )
+            missing = CliRunner().invoke(
+                click_entry, [str(catalog_path), "--path", "missing.txt"]
+            )
+
+        assert result.exit_code == 0
+        lines = result.output.splitlines()
+        assert len(lines) == 2
+        assert lines[0].startswith(f"{PACKAGE_DATES[2]} project-")
+        assert " r1 1.0.0 (" in lines[0]
+        assert lines[0].endswith(f" config/prod.yaml {blobs['r1'][:12]} 8")
+        assert missing.exit_code == 0
+        assert missing.output == "No files found\n"
+
+    def test_error(self):
+        with tempfile.TemporaryDirectory() as d:
+            catalog_path = pathlib.Path(d) / "catalog.db"
+            catalog_path.write_bytes(b"not a catalog")
+
+            result = CliRunner().invoke(
+                click_entry, [str(catalog_path), "--path", "README.md"]
+            )
+
+        assert result.exit_code == 1
+        assert "Search failed" in result.output
@@ -0,0 +1,106 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+from foodx_backup_source._compress import (
+    AdaptiveGzipWriter,
+    compress_tar_stream,
+    is_compressible,
+)
+
+TEXT = b"".join(f"line {i} of some source file\n".encode() for i in range(5000))
+RANDOM = os.urandom(0x30000)
+
+MEMBERS = {
+    "p/README.md": b"some readme",
+    "p/src/main.py": TEXT,
+    "p/assets/blob.bin": RANDOM,
+    "p/vendor/lib.jar": TEXT[:0x2000],
+    "p/empty": b"",
+    f"p/{'long' * 40}/name.txt": TEXT[:1000],
+}
+
+
+def _make_tar(members: dict) -> bytes:
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w", format=tarfile.PAX_FORMAT) as t:
+        info = tarfile.TarInfo("p/src")
+        info.type = tarfile.DIRTYPE
+        t.addfile(info)
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            t.addfile(info, io.BytesIO(content))
+
+    return f.getvalue()
+
+
+def _compress(data: bytes, level: int = 6):
+    f = io.BytesIO()
+    writer = AdaptiveGzipWriter(f, level)
+    compress_tar_stream(io.BytesIO(data), writer)
+    hash_hexdigest = writer.finish()
+
+    assert hash_hexdigest == hashlib.sha256(f.getvalue()).hexdigest()
+    return f.getvalue(), writer
+
+
+class TestIsCompressible:
+    def test_extension(self):
+        assert not is_compressible("p/image.PNG", TEXT)
+
+    def test_text(self):
+        assert is_compressible("p/main.py", TEXT[:0x10000])
+
+    def test_random(self):
+        assert not is_compressible("p/blob.bin", RANDOM[:0x10000])
+
+    def test_small(self):
+        assert is_compressible("p/blob.bin", RANDOM[:100])
+
+
+class TestCompressTarStream:
+    def test_round_trip(self):
+        tar_data = _make_tar(MEMBERS)
+
+        result, writer = _compress(tar_data)
+
+        assert gzip.decompress(result) == tar_data
+        with tarfile.open(fileobj=io.BytesIO(result), mode="r|gz") as t:
+            contents = {
+                x.name: t.extractfile(x).read() for x in t if x.isfile()
+            }
+        assert contents == MEMBERS
+        # the random and jar content is stored, along with the few headers
+        # that follow stored content
+        assert (
+            (len(RANDOM) + 0x2000)
+            < writer.stored_size
+            < (len(RANDOM) + 0x2000 + 0x1000)
+        )
+        assert len(result) < (len(RANDOM) + len(TEXT) / 5)
+
+    def test_store_all(self):
+        tar_data = _make_tar(MEMBERS)
+
+        result, _ = _compress(tar_data, 0)
+
+        assert gzip.decompress(result) == tar_data
+        assert len(result) > len(tar_data)
+
+    @pytest.mark.parametrize("data", [b"", b"not a tar stream" * 100])
+    def test_not_tar(self, data):
+        result, _ = _compress(data)
+
+        assert gzip.decompress(result) == data
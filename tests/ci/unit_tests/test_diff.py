@@ -0,0 +1,184 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import asyncio
+import os
+import pathlib
+import tarfile
+import tempfile
+
+import git
+import pytest
+from click.testing import CliRunner
+
+from foodx_backup_source._diff import (
+    DiffError,
+    click_entry,
+    diff_packages,
+    read_package_manifest,
+)
+from foodx_backup_source._package import write_package
+from foodx_backup_source._snapshot import iter_snapshots
+
+
+@pytest.fixture()
+def packages(git_http_server, make_git_repository, make_definition):
+    """Build two packages, with a changed, unchanged, added and removed repo."""
+
+    async def _build(directory: pathlib.Path, **kwargs):
+        for name in ["r1", "r2", "r3"]:
+            make_git_repository(
+                git_http_server.project_root,
+                name,
+                {"README.md": f"{name} readme".encode(), "a/b.txt": b"b"},
+            )
+        with tempfile.TemporaryDirectory() as d:
+            with git.Repo.clone_from(
+                str(git_http_server.project_root / "r1.git"), d
+            ) as working:
+                with working.config_writer() as c:
+                    c.set_value("user", "name", "test")
+                    c.set_value("user", "email", "test@some.where")
+                (pathlib.Path(d) / "README.md").write_text("changed")
+                (pathlib.Path(d) / "new.txt").write_text("new")
+                working.git.rm("a/b.txt")
+                working.git.add(A=True)
+                working.index.commit("second commit")
+                working.create_tag("1.0.1")
+                working.git.push("origin", "1.0.1")
+
+        url = git_http_server.url
+        runs = {
+            "old": [
+                make_definition("r1", url, "1.0.0"),
+                make_definition("r2", url, "1.0.0"),
+                make_definition("r3", url, "1.0.0"),
+            ],
+            "new": [
+                make_definition("r1", url, "1.0.1"),
+                make_definition("r2", url, "1.0.0"),
+            ],
+        }
+        paths = dict()
+        for run, definitions in runs.items():
+            run_directory = directory / run
+            archive_directory = run_directory / "archives"
+            archive_directory.mkdir(parents=True)
+            results = [
+                x async for x in iter_snapshots(definitions, archive_directory)
+            ]
+            paths[run] = write_package(
+                "project", run_directory, results, **kwargs
+            )[0]
+
+        return paths["old"], paths["new"]
+
+    return _build
+
+
+class TestDiffPackages:
+    @pytest.mark.asyncio
+    async def test_manifests(self, packages):
+        with tempfile.TemporaryDirectory() as d:
+            old_path, new_path = await packages(pathlib.Path(d))
+
+            manifest = read_package_manifest(new_path)
+            result = diff_packages(old_path, new_path)
+
+        assert sorted(x.name for x in manifest.repositories) == ["r1", "r2"]
+        changes = {x.name: x for x in result}
+        assert {x: y.status for x, y in changes.items()} == {
+            "r1": "changed",
+            "r2": "unchanged",
+            "r3": "removed",
+        }
+        # removed repositories follow the repositories of the new package
+        assert result[-1].name == "r3"
+        assert (changes["r1"].old.ref, changes["r1"].new.ref) == (
+            "1.0.0",
+            "1.0.1",
+        )
+        # file level detail is not read by default
+        assert changes["r1"].files == list()
+
+    @pytest.mark.asyncio
+    async def test_files(self, packages):
+        with tempfile.TemporaryDirectory() as d:
+            old_path, new_path = await packages(pathlib.Path(d))
+
+            result = diff_packages(old_path, new_path, files=True)
+
+        changes = {x.name: x for x in result}
+        assert [(x.path, x.status) for x in changes["r1"].files] == [
+            ("README.md", "modified"),
+            ("a/b.txt", "removed"),
+            ("new.txt", "added"),
+        ]
+        assert changes["r2"].files == list()
+
+    @pytest.mark.asyncio
+    async def test_encrypted(self, packages):
+        key = os.urandom(32)
+        with tempfile.TemporaryDirectory() as d:
+            old_path, new_path = await packages(
+                pathlib.Path(d), encryption_key=key
+            )
+
+            result = diff_packages(
+                old_path, new_path, files=True, encryption_key=key
+            )
+
+        changes = {x.name: x for x in result}
+        assert changes["r1"].status == "changed"
+        assert len(changes["r1"].files) == 3
+
+    def test_no_manifest(self):
+        with tempfile.TemporaryDirectory() as d:
+            archive_path = pathlib.Path(d) / "r1-1.0.0.tar.gz"
+            archive_path.write_bytes(b"not really an archive")
+            package_path = pathlib.Path(d) / "project.tar"
+            with tarfile.open(package_path, mode="w") as f:
+                f.add(str(archive_path), arcname=archive_path.name)
+
+            with pytest.raises(DiffError, match=r"package has no manifest"):
+                diff_packages(package_path, package_path)
+
+
+class TestClickEntry:
+    def test_clean(self, packages):
+        with tempfile.TemporaryDirectory() as d:
+            old_path, new_path = asyncio.run(packages(pathlib.Path(d)))
+
+            result = CliRunner().invoke(
+                click_entry, [str(old_path), str(new_path), "--files"]
+            )
+
+        assert result.exit_code == 0
+        lines = result.output.splitlines()
+        # the unchanged repository is only counted
+        assert lines[0].startswith("~ r1 1.0.0 (")
+        assert " -> 1.0.1 (" in lines[0]
+        assert lines[1:4] == [
+            "    M README.md",
+            "    D a/b.txt",
+            "    A new.txt",
+        ]
+        assert lines[4].startswith("- r3 1.0.0 (")
+        assert lines[5] == "1 unchanged"
+
+    def test_no_manifest(self):
+        with tempfile.TemporaryDirectory() as d:
+            package_path = pathlib.Path(d) / "project.tar"
+            with tarfile.open(package_path, mode="w"):
+                pass
+
+            result = CliRunner().invoke(
+                click_entry, [str(package_path), str(package_path)]
+            )
+
+        assert result.exit_code == 1
+        assert "package has no manifest" in result.output
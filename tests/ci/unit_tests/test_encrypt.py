@@ -0,0 +1,145 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import base64
+import hashlib
+import io
+import os
+import pathlib
+import tempfile
+
+import pytest
+
+from foodx_backup_source._encrypt import (
+    HEADER_SIZE,
+    TAG_SIZE,
+    DecryptingReader,
+    EncryptingWriter,
+    EncryptionError,
+    load_encryption_key,
+    parse_key,
+)
+from foodx_backup_source.azure import AzureKeyvaultError
+
+KEY = os.urandom(32)
+CHUNK_SIZE = 0x100
+
+
+def _encrypt(content: bytes, jobs: int = 4) -> bytes:
+    f = io.BytesIO()
+    writer = EncryptingWriter(f, KEY, jobs=jobs, chunk_size=CHUNK_SIZE)
+    # uneven writes straddle chunk boundaries
+    view = memoryview(content)
+    while view:
+        writer.write(view[:100])
+        view = view[100:]
+    writer.finish()
+
+    return f.getvalue()
+
+
+def _decrypt(encrypted: bytes, key: bytes = KEY) -> bytes:
+    reader = DecryptingReader(io.BytesIO(encrypted), key)
+    content = reader.read(7)
+    content += reader.read()
+    reader.drain()
+
+    return content
+
+
+class TestStreamEncryption:
+    @pytest.mark.parametrize(
+        "size", [0, 1, CHUNK_SIZE, CHUNK_SIZE + 1, 20 * CHUNK_SIZE]
+    )
+    def test_round_trip(self, size):
+        content = os.urandom(size)
+
+        encrypted = _encrypt(content)
+
+        assert _decrypt(encrypted) == content
+
+    def test_hash(self):
+        f = io.BytesIO()
+        writer = EncryptingWriter(f, KEY, chunk_size=CHUNK_SIZE)
+        writer.write(b"some content")
+
+        result = writer.finish()
+
+        assert result == hashlib.sha256(f.getvalue()).hexdigest()
+
+    def test_unique_per_package(self):
+        content = b"some content"
+
+        assert _encrypt(content) != _encrypt(content)
+
+    def test_tampered(self):
+        encrypted = bytearray(_encrypt(os.urandom(4 * CHUNK_SIZE)))
+        encrypted[HEADER_SIZE + CHUNK_SIZE + 5] ^= 1
+
+        with pytest.raises(EncryptionError, match=r"corrupt or truncated"):
+            _decrypt(bytes(encrypted))
+
+    def test_truncated_at_chunk(self):
+        encrypted = _encrypt(os.urandom(4 * CHUNK_SIZE))
+        truncated = encrypted[: HEADER_SIZE + 2 * (CHUNK_SIZE + TAG_SIZE)]
+
+        with pytest.raises(EncryptionError, match=r"corrupt or truncated"):
+            _decrypt(truncated)
+
+    def test_wrong_key(self):
+        encrypted = _encrypt(b"some content")
+
+        with pytest.raises(EncryptionError, match=r"wrong key"):
+            _decrypt(encrypted, os.urandom(32))
+
+    def test_not_encrypted(self):
+        with pytest.raises(EncryptionError, match=r"not an encrypted"):
+            _decrypt(b"0" * 100)
+
+
+class TestLoadEncryptionKey:
+    def test_none(self):
+        assert load_encryption_key(None, None, None) is None
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            key_file = pathlib.Path(d) / "key"
+            key_file.write_text(base64.b64encode(KEY).decode() + "\n")
+
+            result = load_encryption_key(key_file, None, None)
+
+        assert result == KEY
+
+    def test_keyvault(self, mocker):
+        mock_secret = mocker.patch(
+            "foodx_backup_source._encrypt.get_kv_secret",
+            return_value=base64.b64encode(KEY).decode(),
+        )
+
+        result = load_encryption_key(None, "kv.vault.azure.net/k1", "s1")
+
+        assert result == KEY
+        mock_secret.assert_called_once_with("k1", "kv.vault.azure.net", "s1")
+
+    def test_keyvault_error(self, mocker):
+        mocker.patch(
+            "foodx_backup_source._encrypt.get_kv_secret",
+            side_effect=AzureKeyvaultError("some error"),
+        )
+
+        with pytest.raises(EncryptionError, match=r"some error"):
+            load_encryption_key(None, "kv.vault.azure.net/k1", "s1")
+
+    def test_keyvault_subscription_missing(self):
+        with pytest.raises(EncryptionError, match=r"requires"):
+            load_encryption_key(None, "kv.vault.azure.net/k1", None)
+
+    def test_bad_key(self):
+        with pytest.raises(EncryptionError, match=r"must be 32 bytes"):
+            parse_key(base64.b64encode(b"short").decode())
+        with pytest.raises(EncryptionError, match=r"not valid base64"):
+            parse_key("not base64!")
@@ -0,0 +1,159 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import os
+import pathlib
+import tarfile
+import tempfile
+
+import git
+import pytest
+
+from foodx_backup_source._families import FamilyRoots, assign_families
+from foodx_backup_source._snapshot import SnapshotOptions, iter_snapshots
+
+
+def _key(name: str, url: str = "https://some.where") -> str:
+    return f"{name}@{url}/{name}.git"
+
+
+class TestFamilyRoots:
+    def test_record(self, make_definition):
+        roots = FamilyRoots()
+
+        assert roots.record(make_definition("r1"), ["1" * 40])
+        assert not roots.record(make_definition("r1"), ["1" * 40])
+        assert not roots.record(make_definition("r2"), list())
+        assert roots.roots == {_key("r1"): ["1" * 40]}
+
+    def test_save_load(self, make_definition):
+        roots = FamilyRoots()
+        roots.record(make_definition("r1"), ["1" * 40])
+        with tempfile.TemporaryDirectory() as d:
+            roots_path = pathlib.Path(d) / "roots.json"
+            roots.save(roots_path)
+
+            result = FamilyRoots.load(roots_path)
+
+        assert result == roots
+
+
+class TestAssignFamilies:
+    def test_declared(self, make_definition):
+        definitions = [
+            make_definition("r1", object_family="f1"),
+            make_definition("r2", object_family="f1"),
+            make_definition("r3", object_family="f2"),
+            make_definition("r4", object_family="f1", include_paths=["a"]),
+            make_definition("r5"),
+        ]
+
+        result = assign_families(definitions)
+
+        # single member families, and filtered definitions, are dropped
+        assert result == {_key("r1"): "f1", _key("r2"): "f1"}
+
+    def test_detected(self, make_definition):
+        definitions = [make_definition(x) for x in ["r1", "r2", "r3", "r4"]]
+        roots = {
+            _key("r1"): ["a" * 40],
+            _key("r2"): ["b" * 40],
+            # r3 joins the families of r1 and r2
+            _key("r3"): ["b" * 40, "a" * 40],
+            _key("r4"): ["c" * 40],
+        }
+
+        assert assign_families(definitions) == dict()
+        result = assign_families(definitions, roots)
+
+        assert result == {
+            _key("r1"): "roots-aaaaaaaaaaaa",
+            _key("r2"): "roots-aaaaaaaaaaaa",
+            _key("r3"): "roots-aaaaaaaaaaaa",
+        }
+
+
+@pytest.fixture()
+def forks(git_http_server, make_git_repository):
+    """An upstream repository and a fork with one more commit."""
+    upstream_path = make_git_repository(
+        git_http_server.project_root,
+        "upstream",
+        {f"f{i}.bin": os.urandom(0x10000) for i in range(8)},
+    )
+    fork_path = git_http_server.project_root / "fork.git"
+    with tempfile.TemporaryDirectory() as d:
+        with git.Repo.clone_from(str(upstream_path), d) as working:
+            with working.config_writer() as c:
+                c.set_value("user", "name", "test")
+                c.set_value("user", "email", "test@some.where")
+            (pathlib.Path(d) / "fork.txt").write_bytes(b"fork")
+            working.git.add(A=True)
+            working.index.commit("fork commit")
+            working.git.tag("-f", "1.0.0")
+            working.git.clone(d, str(fork_path), bare=True)
+
+    return git_http_server
+
+
+class TestSharedObjects:
+    async def _snapshot(self, server, make_definition, options, **backup):
+        definitions = [
+            make_definition(x, server.url, **backup)
+            for x in ["upstream", "fork"]
+        ]
+        server.bytes_sent = 0
+        with tempfile.TemporaryDirectory() as d:
+            results = {
+                x.name: x
+                async for x in iter_snapshots(
+                    definitions, pathlib.Path(d), None, options
+                )
+            }
+            with tarfile.open(results["fork"].archive_path) as f:
+                assert "fork/fork.txt" in f.getnames()
+
+        return results, server.bytes_sent
+
+    @pytest.mark.asyncio
+    async def test_declared(self, forks, make_definition):
+        options = SnapshotOptions()
+        _, unshared_bytes = await self._snapshot(
+            forks, make_definition, options
+        )
+
+        _, shared_bytes = await self._snapshot(
+            forks, make_definition, options, object_family="upstream"
+        )
+
+        # the common objects are only fetched once
+        assert shared_bytes < (unshared_bytes * 0.7)
+
+    @pytest.mark.asyncio
+    async def test_detected(self, forks, make_definition):
+        options = SnapshotOptions(detect_families=True)
+        results, unshared_bytes = await self._snapshot(
+            forks, make_definition, options
+        )
+        roots = results["upstream"].root_commits
+        assert len(roots) == 1
+        assert results["fork"].root_commits == roots
+
+        _, shared_bytes = await self._snapshot(
+            forks,
+            make_definition,
+            options.copy(
+                update={
+                    "repository_roots": {
+                        _key(x, forks.url): y.root_commits
+                        for x, y in results.items()
+                    }
+                }
+            ),
+        )
+
+        assert shared_bytes < (unshared_bytes * 0.7)
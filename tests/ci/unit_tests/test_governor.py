@@ -0,0 +1,132 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import concurrent.futures
+import datetime
+import pathlib
+import tempfile
+import threading
+import time
+
+import pytest
+
+from foodx_backup_source._governor import (
+    TransferCancelledError,
+    TransferGovernor,
+    parse_retry_after,
+    read_retry_after,
+)
+
+HOST = "some.where"
+
+
+class TestParseRetryAfter:
+    def test_seconds(self):
+        assert parse_retry_after(" 120 ") == 120
+
+    def test_date(self):
+        now = datetime.datetime(
+            2022, 3, 1, 12, 0, 0, tzinfo=datetime.timezone.utc
+        )
+
+        assert parse_retry_after("Tue, 01 Mar 2022 12:00:30 GMT", now) == 30
+        assert parse_retry_after("Tue, 01 Mar 2022 11:00:00 GMT", now) == 0
+
+    def test_malformed(self):
+        assert parse_retry_after("soon") is None
+
+
+class TestReadRetryAfter:
+    def test_header(self):
+        with tempfile.TemporaryDirectory() as d:
+            trace_path = pathlib.Path(d) / "trace"
+            trace_path.write_text(
+                "12:00:00.000000 http.c:664 <= Recv header: HTTP/1.1 429\n"
+                "12:00:00.000000 http.c:664 <= Recv header: Retry-After: 2\n"
+            )
+
+            assert read_retry_after(trace_path) == 2
+
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as d:
+            trace_path = pathlib.Path(d) / "trace"
+
+            assert read_retry_after(trace_path) is None
+            trace_path.write_text("<= Recv header: HTTP/1.1 200 OK\n")
+            assert read_retry_after(trace_path) is None
+
+
+class TestTransferGovernor:
+    def test_connection_limit(self):
+        governor = TransferGovernor(max_connections=2)
+        lock = threading.Lock()
+        counts = {"active": 0, "maximum": 0}
+
+        def _transfer(host: str) -> None:
+            with governor.transfer(host):
+                with lock:
+                    counts["active"] += 1
+                    counts["maximum"] = max(counts["maximum"], counts["active"])
+                time.sleep(0.05)
+                with lock:
+                    counts["active"] -= 1
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as e:
+            list(e.map(_transfer, [HOST] * 6))
+
+        assert counts["maximum"] == 2
+
+    def test_hosts_independent(self):
+        governor = TransferGovernor(max_connections=1)
+
+        with governor.transfer(HOST):
+            with governor.transfer("other.host"):
+                pass
+
+    def test_throttle(self):
+        governor = TransferGovernor()
+        governor.throttle(HOST, 0.3)
+
+        start_time = time.monotonic()
+        with governor.transfer(HOST):
+            assert (time.monotonic() - start_time) >= 0.3
+        start_time = time.monotonic()
+        with governor.transfer("other.host"):
+            assert (time.monotonic() - start_time) < 0.1
+
+    def test_throttle_default(self, mocker):
+        mocker.patch(
+            "foodx_backup_source._governor.DEFAULT_THROTTLE_SECONDS", 0.1
+        )
+        governor = TransferGovernor()
+        governor.throttle(HOST, None)
+        governor.throttle(HOST, None)
+
+        start_time = time.monotonic()
+        with governor.transfer(HOST):
+            # the second throttle doubled the pause
+            assert (time.monotonic() - start_time) >= 0.2
+
+    def test_rate(self):
+        governor = TransferGovernor(bytes_per_second=1000)
+        governor.record(HOST, 300, time.monotonic())
+
+        start_time = time.monotonic()
+        with governor.transfer(HOST):
+            assert (time.monotonic() - start_time) >= 0.25
+
+    def test_cancelled(self):
+        governor = TransferGovernor()
+        governor.throttle(HOST, 30)
+
+        start_time = time.monotonic()
+        with pytest.raises(TransferCancelledError, match=HOST):
+            with governor.transfer(
+                HOST, lambda: (time.monotonic() - start_time) > 0.2
+            ):
+                pass
+        assert (time.monotonic() - start_time) < 1
@@ -0,0 +1,58 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import pathlib
+import tempfile
+
+from foodx_backup_source._history import PlanHistory
+from foodx_backup_source._snapshot import SnapshotResult, SnapshotTimings
+
+
+def _result(name: str, clone_bytes: int) -> SnapshotResult:
+    return SnapshotResult(
+        name=name,
+        ref="1.0.0",
+        sha="1" * 40,
+        archive_path=pathlib.Path(f"{name}.tar.gz"),
+        hash_path=pathlib.Path(f"{name}.tar.gz.sha256"),
+        sha256="a" * 64,
+        timings=SnapshotTimings(
+            clone_seconds=1, archive_seconds=2, total_seconds=3
+        ),
+        transfer_bytes=clone_bytes // 2,
+        clone_bytes=clone_bytes,
+        archive_bytes=clone_bytes // 4,
+    )
+
+
+class TestPlanHistory:
+    def test_load_missing(self):
+        with tempfile.TemporaryDirectory() as d:
+            history = PlanHistory.load(pathlib.Path(d) / "history.json")
+
+        assert history.snapshots == dict()
+
+    def test_save_load(self, make_definition):
+        definitions = [
+            make_definition("r1", "https://this.host", "1.0.0"),
+            make_definition("r2", "https://this.host", "1.0.0"),
+        ]
+        history = PlanHistory()
+
+        assert history.record(
+            zip(definitions, [_result("r1", 1000), _result("r2", 0)])
+        )
+        with tempfile.TemporaryDirectory() as d:
+            history_path = pathlib.Path(d) / "history.json"
+            history.save(history_path)
+
+            result = PlanHistory.load(history_path)
+
+        assert result == history
+        assert result.get(definitions[0]).clone_bytes == 1000
+        # no clone measurements
+        assert result.get(definitions[1]) is None
@@ -6,6 +6,8 @@
 #  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
 
 import pathlib
+import tarfile
+import tempfile
 import typing
 
 import click
@@ -13,11 +15,19 @@ import pytest
 from click.testing import CliRunner
 
 from foodx_backup_source._file_io import BackupDefinitions
+from foodx_backup_source._history import DEFAULT_HISTORY_FILE
 from foodx_backup_source._main import (
     DEFAULT_OUTPUT_PATH,
     _launch_packaging,
     click_entry,
 )
+from foodx_backup_source._snapshot import (
+    SnapshotError,
+    SnapshotOptions,
+    SnapshotResult,
+    SnapshotTimings,
+)
+from foodx_backup_source._store import StoreError
 from foodx_backup_source.schema import ApplicationDefinition, DependencyFile
 
 
@@ -26,6 +36,35 @@ def mock_gather(mocker):
     return mocker.patch("foodx_backup_source._main._launch_packaging")
 
 
+@pytest.fixture()
+def mock_snapshots(mocker):
+    async def _iter_snapshots(
+        definitions, archive_directory, token, options, spool=None
+    ):
+        for x in definitions:
+            archive_path = archive_directory / f"{x.name}.tar.gz"
+            archive_path.write_bytes(b"archive")
+            (archive_directory / f"{x.name}.tar.gz.sha256").write_text(
+                f"{'1' * 64}  {x.name}.tar.gz"
+            )
+            yield SnapshotResult(
+                name=x.name,
+                ref=x.configuration.release.ref,
+                sha="0" * 40,
+                archive_path=archive_path,
+                hash_path=archive_directory / f"{x.name}.tar.gz.sha256",
+                sha256="1" * 64,
+                timings=SnapshotTimings(
+                    clone_seconds=1, archive_seconds=1, total_seconds=2
+                ),
+            )
+
+    return mocker.patch(
+        "foodx_backup_source._main.iter_snapshots",
+        side_effect=_iter_snapshots,
+    )
+
+
 @pytest.fixture()
 def mock_runner():
     return CliRunner()
@@ -76,58 +115,173 @@ context:
 
 class TestLaunchPackaging:
     @pytest.mark.asyncio
-    async def test_clean(self, mock_definitions, mocker):
-        mock_snapshot = mocker.patch("foodx_backup_source._main.do_snapshot")
-        mocker.patch("foodx_backup_source._main.tarfile.open")
+    async def test_clean(self, mock_definitions, mock_snapshots, mocker):
         mocker.patch("foodx_backup_source._main.discover_backup_definitions")
         mocker.patch(
-            "foodx_backup_source._main._isoformat_now", return_value="today"
+            "foodx_backup_source._package._isoformat_now", return_value="today"
         )
-        mock_hash_file = mocker.patch(
-            "foodx_backup_source._main.create_hash_file"
-        )
-        arguments = {
-            "project_name": "this_project",
-            "project_directory": pathlib.Path("some/project"),
-            "output_directory": pathlib.Path("some/output"),
-            "git_refs": dict(),
-            "token": None,
-        }
-
-        await _launch_packaging(**arguments)
+        with tempfile.TemporaryDirectory() as d:
+            arguments = {
+                "project_name": "this_project",
+                "project_directory": pathlib.Path("some/project"),
+                "output_directory": pathlib.Path(d),
+                "git_refs": dict(),
+                "token": None,
+                "options": SnapshotOptions(),
+            }
+
+            created_files = await _launch_packaging(**arguments)
+
+            assert created_files == [
+                pathlib.Path(d) / "this_project-today.tar.gz",
+                pathlib.Path(d) / "this_project-today.tar.gz.sha256",
+            ]
+            mock_snapshots.assert_called_once()
+            with tarfile.open(created_files[0], mode="r|gz") as f:
+                members = {x.name: f.extractfile(x).read() for x in f}
+
+        assert list(members) == [
+            "r1.tar.gz",
+            "r1.tar.gz.sha256",
+            "manifest.json",
+            "manifest.json.sha256",
+        ]
+        assert members["r1.tar.gz"] == b"archive"
 
-        mock_hash_file.assert_called_once_with(
-            pathlib.Path("some/output/this_project-today.tar.gz")
+    @pytest.mark.asyncio
+    async def test_history(self, mock_definitions, mock_snapshots, mocker):
+        mocker.patch("foodx_backup_source._main.discover_backup_definitions")
+        mocker.patch(
+            "foodx_backup_source._main.PlanHistory.record", return_value=True
         )
-        mock_snapshot.assert_called_once()
+        with tempfile.TemporaryDirectory() as d:
+            arguments = {
+                "project_name": "this_project",
+                "project_directory": pathlib.Path("some/project"),
+                "output_directory": pathlib.Path(d) / "output",
+                "git_refs": dict(),
+                "token": None,
+                "options": SnapshotOptions(),
+            }
+            arguments["output_directory"].mkdir()
+
+            created_files = await _launch_packaging(**arguments)
+
+            # a plain archive run only leaves the package
+            assert sorted(arguments["output_directory"].iterdir()) == sorted(
+                created_files
+            )
+
+            await _launch_packaging(
+                **arguments, bundle_state_path=pathlib.Path(d) / "state.json"
+            )
+
+            assert (pathlib.Path(d) / DEFAULT_HISTORY_FILE).is_file()
+            # no bundles or object families
+            assert not (pathlib.Path(d) / "state.json").exists()
 
     @pytest.mark.asyncio
-    async def test_git_ref(self, mock_definitions, mocker):
-        mock_snapshot = mocker.patch("foodx_backup_source._main.do_snapshot")
-        mocker.patch("foodx_backup_source._main.tarfile.open")
+    async def test_writer_error(self, mock_definitions, mock_snapshots, mocker):
         mocker.patch("foodx_backup_source._main.discover_backup_definitions")
         mocker.patch(
-            "foodx_backup_source._main._isoformat_now", return_value="today"
+            "foodx_backup_source._main.PackageWriter.append",
+            side_effect=OSError("disk full"),
         )
-        mock_hash_file = mocker.patch(
-            "foodx_backup_source._main.create_hash_file"
+        with tempfile.TemporaryDirectory() as d:
+            with pytest.raises(OSError, match=r"disk full"):
+                await _launch_packaging(
+                    "this_project",
+                    pathlib.Path("some/project"),
+                    pathlib.Path(d),
+                    None,
+                    dict(),
+                    SnapshotOptions(),
+                )
+
+            # no partial package is left behind
+            assert list(pathlib.Path(d).iterdir()) == list()
+
+    @pytest.mark.asyncio
+    async def test_store(self, mock_definitions, mock_snapshots, mocker):
+        mocker.patch("foodx_backup_source._main.discover_backup_definitions")
+        mock_store = mocker.patch("foodx_backup_source._main.ObjectStore")
+        mock_package = mocker.patch("foodx_backup_source._main.PackageWriter")
+
+        await _launch_packaging(
+            "this_project",
+            pathlib.Path("some/project"),
+            pathlib.Path("some/output"),
+            None,
+            dict(),
+            SnapshotOptions(),
+            store_directory=pathlib.Path("some/store"),
         )
-        arguments = {
-            "project_name": "this_project",
-            "project_directory": pathlib.Path("some/project"),
-            "output_directory": pathlib.Path("some/output"),
-            "token": None,
-            "git_refs": {"r1": "abc123"},
-        }
 
-        await _launch_packaging(**arguments)
+        mock_store.assert_called_once_with(pathlib.Path("some/store"))
+        mock_store.return_value.ingest.assert_called_once_with(
+            "this_project", mocker.ANY
+        )
+        mock_package.assert_not_called()
+
+        with pytest.raises(StoreError, match=r"encryption"):
+            await _launch_packaging(
+                "this_project",
+                pathlib.Path("some/project"),
+                pathlib.Path("some/output"),
+                None,
+                dict(),
+                SnapshotOptions(),
+                encryption_key=b"k" * 32,
+                store_directory=pathlib.Path("some/store"),
+            )
+        with pytest.raises(StoreError, match=r"catalog"):
+            await _launch_packaging(
+                "this_project",
+                pathlib.Path("some/project"),
+                pathlib.Path("some/output"),
+                None,
+                dict(),
+                SnapshotOptions(),
+                store_directory=pathlib.Path("some/store"),
+                catalog_path=pathlib.Path("some/catalog.db"),
+            )
+        with pytest.raises(StoreError, match=r"differential"):
+            await _launch_packaging(
+                "this_project",
+                pathlib.Path("some/project"),
+                pathlib.Path("some/output"),
+                None,
+                dict(),
+                SnapshotOptions(),
+                store_directory=pathlib.Path("some/store"),
+                base_path=pathlib.Path("some/package.tar.gz"),
+            )
 
-        mock_hash_file.assert_called_once_with(
-            pathlib.Path("some/output/this_project-today.tar.gz")
+    @pytest.mark.asyncio
+    async def test_git_ref(self, mock_definitions, mock_snapshots, mocker):
+        mocker.patch("foodx_backup_source._main.discover_backup_definitions")
+        mocker.patch(
+            "foodx_backup_source._package._isoformat_now", return_value="today"
+        )
+        with tempfile.TemporaryDirectory() as d:
+            arguments = {
+                "project_name": "this_project",
+                "project_directory": pathlib.Path("some/project"),
+                "output_directory": pathlib.Path(d),
+                "token": None,
+                "git_refs": {"r1": "abc123"},
+                "options": SnapshotOptions(),
+            }
+
+            created_files = await _launch_packaging(**arguments)
+
+        assert created_files[0] == (
+            pathlib.Path(d) / "this_project-today.tar.gz"
         )
-        mock_snapshot.assert_called_once()
+        mock_snapshots.assert_called_once()
         assert (
-            mock_snapshot.call_args[0][0].configuration.release.ref == "abc123"
+            mock_snapshots.call_args[0][0][0].configuration.release.ref
+            == "abc123"
         )
 
 
@@ -147,6 +301,14 @@ class TestMain:
             DEFAULT_OUTPUT_PATH,
             None,
             dict(),
+            SnapshotOptions(),
+            None,
+            "tar.gz",
+            None,
+            False,
+            None,
+            None,
+            None,
         )
 
     def test_token_file_stdin(
@@ -168,6 +330,14 @@ class TestMain:
             mocker.ANY,
             "deadb33f",
             mocker.ANY,
+            mocker.ANY,
+            None,
+            "tar.gz",
+            None,
+            False,
+            None,
+            None,
+            None,
         )
 
     def test_token_file_whitespace(
@@ -189,6 +359,14 @@ class TestMain:
             mocker.ANY,
             "deadb33f",
             mocker.ANY,
+            mocker.ANY,
+            None,
+            "tar.gz",
+            None,
+            False,
+            None,
+            None,
+            None,
         )
 
     def test_output(self, mock_gather, mock_runner, mock_path, mocker):
@@ -208,6 +386,14 @@ class TestMain:
             pathlib.Path("output/dir"),
             mocker.ANY,
             mocker.ANY,
+            mocker.ANY,
+            None,
+            "tar.gz",
+            None,
+            False,
+            None,
+            None,
+            None,
         )
 
     def test_git_ref(self, mock_gather, mock_runner, mock_path, mocker):
@@ -227,6 +413,14 @@ class TestMain:
             mocker.ANY,
             mocker.ANY,
             {"r1": "abc123"},
+            mocker.ANY,
+            None,
+            "tar.gz",
+            None,
+            False,
+            None,
+            None,
+            None,
         )
 
     def test_multiple_git_ref(
@@ -250,4 +444,101 @@ class TestMain:
             mocker.ANY,
             mocker.ANY,
             {"r1": "abc123", "r3": "123abc"},
+            mocker.ANY,
+            None,
+            "tar.gz",
+            None,
+            False,
+            None,
+            None,
+            None,
         )
+
+    def test_snapshot_options(
+        self, mock_gather, mock_runner, mock_path, mocker
+    ):
+        arguments = [
+            "this_project",
+            "some/path",
+            "--timeout",
+            "600",
+            "--retries",
+            "5",
+            "--deadline",
+            "3600",
+            "--executor",
+            "process",
+            "--jobs",
+            "4",
+            "--host-connections",
+            "2",
+            "--host-rate",
+            "1000000",
+            "--git-backend",
+            "subprocess",
+            "--detect-families",
+            "--spool-size",
+            "1000",
+            "--spool-budget",
+            "5000",
+        ]
+
+        result = mock_runner.invoke(click_entry, arguments)
+
+        assert result.exit_code == 0
+        mock_gather.assert_awaited_once_with(
+            mocker.ANY,
+            mocker.ANY,
+            mocker.ANY,
+            mocker.ANY,
+            mocker.ANY,
+            SnapshotOptions(
+                timeout_seconds=600,
+                retries=5,
+                deadline_seconds=3600,
+                executor="process",
+                jobs=4,
+                host_connections=2,
+                host_bytes_per_second=1000000,
+                backend="subprocess",
+                detect_families=True,
+                spool_file_bytes=1000,
+                spool_budget_bytes=5000,
+            ),
+            None,
+            "tar.gz",
+            None,
+            False,
+            None,
+            None,
+            None,
+        )
+
+    def test_profile(self, mock_gather, mock_runner, mock_path):
+        with tempfile.TemporaryDirectory() as d:
+            arguments = [
+                "this_project",
+                "some/path",
+                "--profile",
+                str(pathlib.Path(d) / "profile"),
+            ]
+
+            result = mock_runner.invoke(click_entry, arguments)
+
+            assert result.exit_code == 0
+            assert (pathlib.Path(d) / "profile" / "summary.txt").is_file()
+
+    def test_snapshot_error(self, mock_runner, mock_path, mocker):
+        mocker.patch(
+            "foodx_backup_source._main._launch_packaging",
+            side_effect=SnapshotError("snapshots incomplete, timed out: r1"),
+        )
+        arguments = [
+            "this_project",
+            "some/path",
+        ]
+
+        result = mock_runner.invoke(click_entry, arguments)
+
+        assert result.exit_code == 1
+        assert "timed out: r1" in result.output
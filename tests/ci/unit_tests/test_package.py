@@ -0,0 +1,527 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import hashlib
+import io
+import os
+import pathlib
+import tarfile
+import tempfile
+import typing
+
+import pytest
+
+from foodx_backup_source._diff import (
+    DiffError,
+    read_base_package,
+    read_package_manifest,
+)
+from foodx_backup_source._encrypt import EncryptionError
+from foodx_backup_source._hash import (
+    create_file_hash,
+    create_hash_file,
+    read_hash_file,
+)
+from foodx_backup_source._package import (
+    PACKAGE_MANIFEST_NAME,
+    PackageWriter,
+    _PackageDigest,
+    _UncompressedTar,
+    write_package,
+)
+from foodx_backup_source._restore import RestoreError, restore_package
+from foodx_backup_source._snapshot import SnapshotResult, SnapshotTimings
+from foodx_backup_source._spool import ArchiveSpool
+from foodx_backup_source._tree_hash import (
+    create_tree_hash,
+    read_tree_hash_file,
+    verify_tree_hash,
+)
+from foodx_backup_source._verify import verify_package
+
+MEMBERS = {
+    "empty": b"",
+    "small": b"some content",
+    "block": os.urandom(tarfile.BLOCKSIZE),
+    "large": os.urandom(0x30001),
+}
+
+
+def _write_members(directory: pathlib.Path) -> list:
+    paths = list()
+    for name, content in MEMBERS.items():
+        this_path = directory / name
+        this_path.write_bytes(content)
+        paths.append(this_path)
+
+    return paths
+
+
+def _read_members(tar_path: pathlib.Path) -> dict:
+    with tarfile.open(tar_path, mode="r:") as f:
+        return {x.name: f.extractfile(x).read() for x in f.getmembers()}
+
+
+def _raise_os_error(*args, **kwargs):
+    raise OSError("not supported")
+
+
+def _write_uncompressed_tar(tar_path: pathlib.Path, member_paths: list) -> str:
+    digest = _PackageDigest(False)
+    with tar_path.open(mode="wb") as f:
+        package = _UncompressedTar(f.fileno(), digest)
+        for x in member_paths:
+            package.add(x)
+        package.close()
+
+    return digest.hash.hexdigest()
+
+
+class TestUncompressedTar:
+    def test_clean(self):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            tar_path = dd / "package.tar"
+
+            hash_hexdigest = _write_uncompressed_tar(
+                tar_path, _write_members(dd)
+            )
+
+            assert _read_members(tar_path) == MEMBERS
+            assert tar_path.stat().st_size % tarfile.RECORDSIZE == 0
+            assert hash_hexdigest == create_file_hash(tar_path)
+
+    @pytest.mark.parametrize(
+        "unsupported", [["copy_file_range"], ["copy_file_range", "sendfile"]]
+    )
+    def test_fallback(self, unsupported, mocker):
+        for x in unsupported:
+            mocker.patch(
+                f"foodx_backup_source._package.os.{x}",
+                side_effect=_raise_os_error,
+                create=True,
+            )
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            tar_path = dd / "package.tar"
+
+            hash_hexdigest = _write_uncompressed_tar(
+                tar_path, _write_members(dd)
+            )
+
+            assert _read_members(tar_path) == MEMBERS
+            assert hash_hexdigest == create_file_hash(tar_path)
+
+
+def _snapshot_results(directory: pathlib.Path) -> list:
+    archive_path = directory / "r1-1.0.0.tar.gz"
+    with tarfile.open(archive_path, mode="w:gz") as archive:
+        info = tarfile.TarInfo("r1/README.md")
+        info.size = 9
+        archive.addfile(info, io.BytesIO(b"r1 readme"))
+    hash_path = create_hash_file(archive_path)
+
+    return [
+        SnapshotResult(
+            name="r1",
+            ref="1.0.0",
+            sha="0" * 40,
+            archive_path=archive_path,
+            hash_path=hash_path,
+            sha256="1" * 64,
+            timings=SnapshotTimings(
+                clone_seconds=0, archive_seconds=0, total_seconds=0
+            ),
+        )
+    ]
+
+
+class TestWritePackage:
+    def test_uncompressed(self):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            output_directory = dd / "output"
+            output_directory.mkdir()
+
+            package_path, _ = write_package(
+                "project", output_directory, _snapshot_results(dd), "tar"
+            )
+
+            assert package_path.name.endswith(".tar")
+            assert sorted(_read_members(package_path)) == [
+                "manifest.json",
+                "manifest.json.sha256",
+                "r1-1.0.0.tar.gz",
+                "r1-1.0.0.tar.gz.sha256",
+            ]
+
+            target = dd / "restored"
+            restore_package(package_path, target, None, 1)
+
+            assert (target / "r1" / "README.md").read_bytes() == b"r1 readme"
+
+    @pytest.mark.parametrize("package_format", ["tar.gz", "tar"])
+    @pytest.mark.parametrize("key", [None, os.urandom(32)])
+    def test_tree_hash(self, key, package_format):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            output_directory = dd / "output"
+            output_directory.mkdir()
+
+            package_path, hash_path, tree_hash_path = write_package(
+                "project",
+                output_directory,
+                _snapshot_results(dd),
+                package_format,
+                key,
+                True,
+            )
+
+            assert tree_hash_path.name == f"{package_path.name}.sha256tree"
+            assert read_hash_file(hash_path) == create_file_hash(package_path)
+            manifest = read_tree_hash_file(tree_hash_path)
+            assert manifest.size == package_path.stat().st_size
+            assert verify_tree_hash(package_path, manifest) == list()
+
+    @pytest.mark.parametrize("package_format", ["tar.gz", "tar"])
+    def test_encrypted(self, package_format):
+        key = os.urandom(32)
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            output_directory = dd / "output"
+            output_directory.mkdir()
+
+            package_path, hash_path = write_package(
+                "project",
+                output_directory,
+                _snapshot_results(dd),
+                package_format,
+                key,
+            )
+
+            assert package_path.name.endswith(f".{package_format}.enc")
+            assert hash_path.read_text().startswith(
+                create_file_hash(package_path)
+            )
+            with pytest.raises(tarfile.ReadError):
+                tarfile.open(package_path)
+            assert [
+                x.archive_name for x in verify_package(package_path, key)
+            ] == ["r1-1.0.0.tar.gz", "manifest.json"]
+
+            target = dd / "restored"
+            with pytest.raises(RestoreError, match=r"key required"):
+                restore_package(package_path, target, None, 1)
+            restore_package(package_path, target, None, 1, key)
+
+            assert (target / "r1" / "README.md").read_bytes() == b"r1 readme"
+
+    def test_encrypted_tampered(self):
+        key = os.urandom(32)
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            output_directory = dd / "output"
+            output_directory.mkdir()
+            results = _snapshot_results(dd)
+            # a large archive after the first moves the end of the package
+            # into a later chunk
+            large_path = dd / "r2-1.0.0.tar.gz"
+            with tarfile.open(large_path, mode="w:gz") as archive:
+                info = tarfile.TarInfo("r2/data.bin")
+                info.size = 0x200000
+                archive.addfile(info, io.BytesIO(os.urandom(info.size)))
+            results.append(
+                results[0].copy(
+                    update={
+                        "name": "r2",
+                        "archive_path": large_path,
+                        "hash_path": create_hash_file(large_path),
+                    }
+                )
+            )
+            package_path, hash_path = write_package(
+                "project", output_directory, results, "tar", key
+            )
+            content = bytearray(package_path.read_bytes())
+            content[-1] ^= 0xFF
+            package_path.write_bytes(bytes(content))
+            hash_path.unlink()
+            target = dd / "restored"
+
+            with pytest.raises(EncryptionError):
+                restore_package(package_path, target, None, 1, key)
+            # the archive read before the tampered chunk is not restored
+            assert list(target.iterdir()) == list()
+
+
+def _versioned_results(
+    directory: pathlib.Path, versions: typing.Dict[str, str]
+) -> list:
+    """Snapshot results of repositories at versions, with real hashes."""
+    results = list()
+    for name, ref in versions.items():
+        archive_path = directory / f"{name}-{ref}.tar.gz"
+        content = f"{name} {ref}".encode()
+        if not archive_path.is_file():
+            with tarfile.open(archive_path, mode="w:gz") as archive:
+                info = tarfile.TarInfo(f"{name}/README.md")
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+            create_hash_file(archive_path)
+        results.append(
+            SnapshotResult(
+                name=name,
+                ref=ref,
+                sha=hashlib.sha1(content).hexdigest(),  # nosec
+                archive_path=archive_path,
+                hash_path=directory / f"{archive_path.name}.sha256",
+                sha256=create_file_hash(archive_path),
+                timings=SnapshotTimings(
+                    clone_seconds=0, archive_seconds=0, total_seconds=0
+                ),
+            )
+        )
+
+    return results
+
+
+class TestDifferentialPackage:
+    @pytest.fixture()
+    def packages(self, mocker):
+        """Write a base package, and two differential packages in a chain."""
+        mocker.patch(
+            "foodx_backup_source._package._isoformat_now",
+            side_effect=["day1", "day2", "day3"],
+        )
+
+        def _write(dd: pathlib.Path, key: typing.Optional[bytes] = None):
+            output_directory = dd / "output"
+            output_directory.mkdir()
+            paths = list()
+            base = None
+            for versions in [
+                {"r1": "1.0.0", "r2": "1.0.0"},
+                {"r1": "1.0.1", "r2": "1.0.0"},
+                {"r1": "1.0.1", "r2": "1.0.0"},
+            ]:
+                package_path = write_package(
+                    "project",
+                    output_directory,
+                    _versioned_results(dd, versions),
+                    encryption_key=key,
+                    base=base,
+                )[0]
+                paths.append(package_path)
+                base = read_base_package(package_path, key)
+
+            return paths
+
+        return _write
+
+    def test_members(self, packages):
+        with tempfile.TemporaryDirectory() as d:
+            paths = packages(pathlib.Path(d))
+
+            members = list()
+            for x in paths:
+                with tarfile.open(x) as f:
+                    members.append(f.getnames())
+            manifests = [read_package_manifest(x) for x in paths]
+
+        assert sorted(members[1]) == [
+            "manifest.json",
+            "manifest.json.sha256",
+            "r1-1.0.1.tar.gz",
+            "r1-1.0.1.tar.gz.sha256",
+        ]
+        assert sorted(members[2]) == ["manifest.json", "manifest.json.sha256"]
+        assert [x.base for x in manifests] == [None] + [
+            x.name for x in paths[:2]
+        ]
+        assert [x.package_name for x in manifests] == [x.name for x in paths]
+        # references resolve to the package holding the archive
+        assert [
+            {y.name: y.archives[0].package for y in x.repositories}
+            for x in manifests
+        ] == [
+            {"r1": None, "r2": None},
+            {"r1": None, "r2": paths[0].name},
+            {"r1": paths[1].name, "r2": paths[0].name},
+        ]
+
+    def test_restore(self, packages):
+        key = os.urandom(32)
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            paths = packages(dd, key)
+            target = dd / "restored"
+
+            records = restore_package(paths[2], target, None, 1, key)
+
+            assert sorted(x.archive_name for x in records) == [
+                "r1-1.0.1.tar.gz",
+                "r2-1.0.0.tar.gz",
+            ]
+            assert (target / "r1" / "README.md").read_bytes() == b"r1 1.0.1"
+            assert (target / "r2" / "README.md").read_bytes() == b"r2 1.0.0"
+
+            paths[0].unlink()
+            with pytest.raises(RestoreError, match=r"referenced package"):
+                restore_package(paths[2], dd / "failed", None, 1, key)
+            # applications held by the differential package itself
+            restore_package(paths[1], dd / "selected", {"r1"}, 1, key)
+
+    def test_manifest_base(self, packages):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            paths = packages(dd)
+            with tarfile.open(paths[0]) as f:
+                f.extract(PACKAGE_MANIFEST_NAME, dd)
+            manifest_path = dd / PACKAGE_MANIFEST_NAME
+
+            base = read_base_package(manifest_path)
+
+            assert base.name == paths[0].name
+            assert base.manifest == read_package_manifest(paths[0])
+
+            manifest_path.write_text(
+                base.manifest.copy(update={"package_name": None}).json()
+            )
+            with pytest.raises(DiffError, match=r"does not name its package"):
+                read_base_package(manifest_path)
+
+
+class TestPackageWriter:
+    @pytest.mark.parametrize(
+        "package_format,key",
+        [
+            ("tar.gz", None),
+            ("tar", None),
+            ("tar.gz", os.urandom(32)),
+            ("tar", os.urandom(32)),
+        ],
+    )
+    def test_completion_order(self, package_format, key):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            results = _versioned_results(
+                dd, {"r1": "1.0.0", "r2": "1.0.0", "r3": "1.0.0"}
+            )
+            (dd / "output").mkdir()
+            with PackageWriter(
+                "project", dd / "output", package_format, key, tree_hash=True
+            ) as writer:
+                for x in reversed(results):
+                    writer.append(x)
+                    # archives are written to the package as they complete
+                    assert [x.suffix for x in (dd / "output").iterdir()] == [
+                        ".partial"
+                    ]
+                created_files = writer.finish(results)
+
+            package_path, hash_path, tree_hash_path = created_files
+            assert sorted((dd / "output").iterdir()) == sorted(created_files)
+            assert read_hash_file(hash_path) == create_file_hash(package_path)
+            assert read_tree_hash_file(tree_hash_path) == create_tree_hash(
+                package_path
+            )
+            manifest = read_package_manifest(package_path, key)
+            assert manifest == writer.manifest
+            assert [x.name for x in manifest.repositories] == [
+                "r1",
+                "r2",
+                "r3",
+            ]
+            assert manifest.package_name == package_path.name
+            # archives in completion order, followed by the manifest
+            assert [
+                x.archive_name for x in verify_package(package_path, key)
+            ] == [
+                "r3-1.0.0.tar.gz",
+                "r2-1.0.0.tar.gz",
+                "r1-1.0.0.tar.gz",
+                "manifest.json",
+            ]
+            if not key:
+                with tarfile.open(package_path) as f:
+                    assert f.getnames()[-1] == "manifest.json.sha256"
+                    assert (
+                        f.extractfile("r2-1.0.0.tar.gz").read()
+                        == results[1].archive_path.read_bytes()
+                    )
+
+            target = dd / "restored"
+            restore_package(package_path, target, None, 1, key)
+
+            assert sorted(x.name for x in target.iterdir()) == [
+                "r1",
+                "r2",
+                "r3",
+            ]
+            assert (target / "r2" / "README.md").read_bytes() == b"r2 1.0.0"
+
+    def test_abandoned(self):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            results = _versioned_results(dd, {"r1": "1.0.0"})
+            (dd / "output").mkdir()
+            with PackageWriter("project", dd / "output", "tar.gz") as writer:
+                writer.append(results[0])
+
+            assert list((dd / "output").iterdir()) == list()
+
+    def test_spool(self):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            results = _versioned_results(dd, {"r1": "1.0.0"})
+            spool = ArchiveSpool()
+            for x in results[0].archive_files():
+                with spool.writer(x) as f:
+                    f.write(x.read_bytes())
+                x.unlink()
+            with PackageWriter(
+                "project", dd, "tar", spool=spool, release_archives=True
+            ) as writer:
+                writer.append(results[0])
+
+                assert spool.used_bytes == 0
+
+                package_path = writer.finish(results)[0]
+
+            target = dd / "restored"
+            restore_package(package_path, target, None, 1)
+
+            assert (target / "r1" / "README.md").read_bytes() == b"r1 1.0.0"
+
+    def test_differential(self):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            base_path = write_package(
+                "project",
+                dd,
+                _versioned_results(dd, {"r1": "1.0.0", "r2": "1.0.0"}),
+            )[0]
+            results = _versioned_results(dd, {"r1": "1.0.1", "r2": "1.0.0"})
+            with PackageWriter(
+                "project", dd, base=read_base_package(base_path)
+            ) as writer:
+                for x in results:
+                    writer.append(x)
+                package_path = writer.finish(results)[0]
+
+            with tarfile.open(package_path) as f:
+                assert f.getnames() == [
+                    "r1-1.0.1.tar.gz",
+                    "r1-1.0.1.tar.gz.sha256",
+                    "manifest.json",
+                    "manifest.json.sha256",
+                ]
+            manifest = read_package_manifest(package_path)
+            assert manifest.base == base_path.name
+            assert manifest.repositories[1].archives[0].package == (
+                base_path.name
+            )
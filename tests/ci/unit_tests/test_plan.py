@@ -0,0 +1,191 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import os
+import pathlib
+import tempfile
+
+import git
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from click.testing import CliRunner
+
+from foodx_backup_source._history import PlanHistory
+from foodx_backup_source._main import click_entry
+from foodx_backup_source._plan import (
+    RepositoryPlan,
+    _simulate_run,
+    format_plan,
+    plan_backup,
+)
+from foodx_backup_source._snapshot import SnapshotOptions, iter_snapshots
+
+
+def _repository(name: str, seconds: float, host: str = "h1"):
+    return RepositoryPlan(
+        name=name,
+        host=host,
+        shas={"1.0.0": "a" * 40},
+        source="history",
+        clone_bytes=100,
+        archive_bytes=10,
+        seconds=seconds,
+    )
+
+
+class TestSimulateRun:
+    def test_concurrency(self):
+        repositories = [
+            _repository("r1", 5.0),
+            _repository("r2", 10.0),
+            _repository("r3", 10.0),
+        ]
+
+        seconds, peak_bytes = _simulate_run(repositories, 2, None)
+
+        assert seconds == 15.0
+        # the clones of r2 and r3, and all the archives
+        assert peak_bytes == 230
+
+    def test_host_connections(self):
+        repositories = [
+            _repository("r1", 10.0),
+            _repository("r2", 10.0),
+            _repository("r3", 5.0, host="h2"),
+        ]
+
+        seconds, _ = _simulate_run(repositories, 3, 1)
+
+        assert seconds == 20.0
+
+
+class TestPlanBackup:
+    @pytest.mark.asyncio
+    async def test_history(
+        self, git_http_server, make_git_repository, make_definition
+    ):
+        bare_path = make_git_repository(
+            git_http_server.project_root,
+            "r1",
+            {"README.md": b"r1 readme", "big.bin": os.urandom(0x40000)},
+        )
+        with git.Repo(bare_path) as this_repo:
+            with this_repo.config_writer() as c:
+                c.set_value("user", "name", "test")
+                c.set_value("user", "email", "test@some.where")
+            this_repo.create_tag("1.0.1", message="annotated")
+            expected_sha = this_repo.commit("1.0.0").hexsha
+        definitions = [make_definition("r1", git_http_server.url, "1.0.1")]
+        history = PlanHistory()
+        with tempfile.TemporaryDirectory() as d:
+            results = [
+                x async for x in iter_snapshots(definitions, pathlib.Path(d))
+            ]
+        assert history.record(zip(definitions, results))
+        git_http_server.bytes_sent = 0
+
+        result = await plan_backup(definitions, history=history)
+
+        # only references are transferred
+        assert git_http_server.bytes_sent < 0x1000
+        assert result.repositories[0].shas == {"1.0.1": expected_sha}
+        assert result.repositories[0].source == "history"
+        assert result.transfer_bytes == results[0].transfer_bytes > 0x40000
+        assert result.archive_bytes == results[0].archive_bytes
+        assert result.peak_bytes >= results[0].clone_bytes
+        assert result.peak_bytes >= 2 * result.archive_bytes
+        assert result.seconds > 0
+
+    @pytest.mark.asyncio
+    async def test_server(
+        self, git_http_server, make_git_repository, make_definition
+    ):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+
+        async def _repository_metadata(request: web.Request) -> web.Response:
+            assert request.headers["Authorization"] == "token some-token"
+            return web.json_response({"size": 1000})
+
+        application = web.Application()
+        application.router.add_get("/repos/r1", _repository_metadata)
+        async with TestServer(application) as server:
+            result = await plan_backup(
+                [make_definition("r1", git_http_server.url)],
+                "some-token",
+                SnapshotOptions(host_connections=1),
+                metadata_apis={
+                    git_http_server.url.partition("://")[2]: str(
+                        server.make_url("")
+                    ).rstrip("/")
+                },
+            )
+
+        assert result.repositories[0].source == "server"
+        assert result.transfer_bytes == 1000 * 1024
+        assert result.concurrency == 1
+        assert (
+            "with 1 concurrent snapshots, 1 per host" in format_plan(result)[-1]
+        )
+
+    @pytest.mark.asyncio
+    async def test_unresolved(
+        self, git_http_server, make_git_repository, make_definition
+    ):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+
+        result = await plan_backup(
+            [
+                make_definition("r1", git_http_server.url, "missing"),
+                make_definition("r2", git_http_server.url),
+            ],
+            metadata_apis=dict(),
+        )
+
+        assert [x.resolved for x in result.repositories] == [False, False]
+        assert result.repositories[0].shas == {"missing": None}
+        assert result.repositories[1].error
+        lines = format_plan(result)
+        assert "r1: missing (not found), no estimate" in lines[1]
+        assert lines[-1].startswith("No estimate for r1, r2;")
+
+
+class TestClickEntry:
+    def test_plan(self, git_http_server, make_git_repository):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+        with tempfile.TemporaryDirectory() as d:
+            (pathlib.Path(d) / "dependencies.yml").write_text(f"""---
+context:
+  dependencies:
+    r1:
+      backup:
+        repo_url: {git_http_server.url}/r1.git
+        branch_name: main
+      docker:
+        image_name: some-image
+        tag_prefix: p-
+      release:
+        ref: 1.0.0
+""")
+
+            result = CliRunner().invoke(
+                click_entry, ["project", d, "--output-dir", d, "--plan"]
+            )
+            created = sorted(x.name for x in pathlib.Path(d).iterdir())
+
+        assert result.exit_code == 0
+        assert result.output.startswith("Backup plan, 1 repositories")
+        assert "Projected wall time" in result.output
+        # nothing is cloned or packaged
+        assert created == ["dependencies.yml"]
+        assert git_http_server.bytes_sent < 0x1000
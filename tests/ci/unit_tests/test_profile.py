@@ -0,0 +1,75 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import asyncio
+import pathlib
+import pstats
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from foodx_backup_source._profile import (
+    MEMORY_SNAPSHOT_FILE,
+    SLOW_CALLBACK_LOG,
+    SUMMARY_FILE,
+    call_in_phase,
+    profile_phase,
+    profile_run,
+)
+
+
+def _busy(count: int) -> int:
+    return sum(x * x for x in range(count))
+
+
+class TestProfileRun:
+    def test_disabled(self):
+        with profile_run(None) as profiler:
+            with profile_phase("p1"):
+                _busy(10)
+
+        assert profiler is None
+        assert not tracemalloc.is_tracing()
+
+    def test_phases(self):
+        with tempfile.TemporaryDirectory() as d:
+            output = pathlib.Path(d) / "profile"
+            with profile_run(output):
+                with profile_phase("outer"):
+                    _busy(1000)
+                    with profile_phase("inner/nested"):
+                        _busy(1000)
+                thread = threading.Thread(
+                    target=call_in_phase, args=("threaded", _busy, 1000)
+                )
+                thread.start()
+                thread.join()
+
+            names = sorted(x.name for x in output.glob("*.prof"))
+            assert names == [
+                "001-inner_nested.prof",
+                "002-outer.prof",
+                "003-threaded.prof",
+            ]
+            for x in names:
+                stats = pstats.Stats(str(output / x))
+                assert any(y[2] == "_busy" for y in stats.stats.keys())
+            assert "002-outer.prof" in (output / SUMMARY_FILE).read_text()
+            assert tracemalloc.Snapshot.load(str(output / MEMORY_SNAPSHOT_FILE))
+        assert not tracemalloc.is_tracing()
+
+    def test_slow_callbacks(self):
+        async def _blocking() -> None:
+            time.sleep(0.2)
+
+        with tempfile.TemporaryDirectory() as d:
+            output = pathlib.Path(d)
+            with profile_run(output) as profiler:
+                asyncio.run(_blocking(), debug=bool(profiler))
+
+            assert "_blocking" in (output / SLOW_CALLBACK_LOG).read_text()
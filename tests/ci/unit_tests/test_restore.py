@@ -0,0 +1,185 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import io
+import pathlib
+import tarfile
+import tempfile
+
+import pytest
+from click.testing import CliRunner
+
+from foodx_backup_source._hash import create_hash_file
+from foodx_backup_source._restore import (
+    RestoreError,
+    _check_member,
+    click_entry,
+    restore_package,
+)
+
+APPLICATIONS = {
+    "r1": {"README.md": b"r1 readme", "src/main.py": b"print('r1')"},
+    "r2": {"README.md": b"r2 readme"},
+}
+
+
+def _rewrite_package(package_path: pathlib.Path, archive_name: str) -> None:
+    """Replace an inner archive with content that does not match its hash."""
+    directory = package_path.parent / "rewrite"
+    directory.mkdir()
+    with tarfile.open(package_path, mode="r:gz") as package:
+        package.extractall(directory)
+    with tarfile.open(directory / archive_name, mode="w:gz") as archive:
+        info = tarfile.TarInfo("r1/README.md")
+        info.size = 3
+        archive.addfile(info, io.BytesIO(b"bad"))
+    with tarfile.open(package_path, mode="w:gz") as package:
+        for x in sorted(directory.iterdir()):
+            package.add(str(x), arcname=x.name)
+    create_hash_file(package_path)
+
+
+class TestRestorePackage:
+    def test_clean(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            package_path = build_package(dd, APPLICATIONS)
+            target = dd / "restored"
+
+            records = restore_package(package_path, target, None, 2)
+
+            assert {"r1", "r2"} == {x for y in records for x in y.applications}
+            assert (target / "r1" / "src" / "main.py").read_bytes() == (
+                b"print('r1')"
+            )
+            assert (target / "r2" / "README.md").read_bytes() == b"r2 readme"
+            assert sorted(x.name for x in target.iterdir()) == ["r1", "r2"]
+            assert sum(x.files for x in records) == 3
+
+    def test_selected(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            package_path = build_package(dd, APPLICATIONS)
+            target = dd / "restored"
+
+            records = restore_package(package_path, target, {"r2"}, 1)
+
+            assert [x.applications for x in records] == [["r2"]]
+            assert sorted(x.name for x in target.iterdir()) == ["r2"]
+
+    def test_missing_application(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            package_path = build_package(dd, APPLICATIONS)
+
+            with pytest.raises(
+                RestoreError, match=r"^applications not found in package"
+            ):
+                restore_package(package_path, dd / "restored", {"r3"}, 1)
+
+    def test_hash_mismatch(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            package_path = build_package(dd, APPLICATIONS)
+            _rewrite_package(package_path, "r1-1.2.3.tar.gz")
+            target = dd / "restored"
+
+            with pytest.raises(RestoreError, match=r"^archive hash mismatch"):
+                restore_package(package_path, target, {"r1"}, 1)
+            assert not (target / "r1").exists()
+
+    def test_package_hash_mismatch(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            package_path = build_package(dd, APPLICATIONS)
+            hash_path = package_path.parent / f"{package_path.name}.sha256"
+            hash_path.write_text(f"{'0' * 64}  {package_path.name}")
+            target = dd / "restored"
+
+            with pytest.raises(RestoreError, match=r"^package hash mismatch"):
+                restore_package(package_path, target, None, 2)
+            # the intact archives of a tampered package are not restored
+            assert list(target.iterdir()) == list()
+
+
+class TestCheckMember:
+    def _member(self, name, type=tarfile.REGTYPE, linkname=""):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.linkname = linkname
+        return info
+
+    def test_clean(self):
+        with tempfile.TemporaryDirectory() as d:
+            _check_member(self._member("r1/a/b.txt"), d)
+            _check_member(
+                self._member("r1/a/l", type=tarfile.SYMTYPE, linkname="../c"),
+                d,
+            )
+
+    @pytest.mark.parametrize(
+        "name,type,linkname",
+        [
+            ("/etc/passwd", tarfile.REGTYPE, ""),
+            ("r1/../../evil", tarfile.REGTYPE, ""),
+            ("r1/l", tarfile.SYMTYPE, "/etc"),
+            ("r1/l", tarfile.SYMTYPE, "../../.."),
+            ("r1/h", tarfile.LNKTYPE, "../outside"),
+            ("r1/dev", tarfile.CHRTYPE, ""),
+        ],
+    )
+    def test_unsafe(self, name, type, linkname):
+        with tempfile.TemporaryDirectory() as d:
+            with pytest.raises(RestoreError):
+                _check_member(self._member(name, type, linkname), d)
+
+    def test_symlink_parent(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = pathlib.Path(d)
+            (root / "r1").mkdir()
+            # an extracted link to the root makes "r1/up/.." escape the root
+            (root / "r1" / "up").symlink_to("..")
+
+            with pytest.raises(RestoreError):
+                _check_member(
+                    self._member(
+                        "r1/up/l", type=tarfile.SYMTYPE, linkname="../x"
+                    ),
+                    d,
+                )
+
+
+class TestClickEntry:
+    def test_clean(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            package_path = build_package(dd, APPLICATIONS)
+
+            result = CliRunner().invoke(
+                click_entry,
+                [str(package_path), str(dd / "restored"), "--jobs", "1"],
+            )
+
+            assert result.exit_code == 0
+            assert "r1-1.2.3.tar.gz" in result.output
+
+    def test_failed(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            package_path = build_package(dd, APPLICATIONS)
+
+            result = CliRunner().invoke(
+                click_entry,
+                [
+                    str(package_path),
+                    str(dd / "restored"),
+                    "--application",
+                    "r3",
+                ],
+            )
+
+            assert result.exit_code == 1
@@ -48,3 +48,74 @@ context:
 """
     with pytest.raises(pydantic.ValidationError):
         DependencyFile.parse_obj(load_yaml_content(content_text))
+
+
+@pytest.mark.parametrize("level", ["-1", "10"])
+def test_bad_compression_level(load_yaml_content, level):
+    content_text = f"""
+---
+context:
+  dependencies:
+    r1:
+      backup:
+        repo_url: "https://this.host/path"
+        branch_name: master
+        compression_level: {level}
+      docker:
+        image_name: r1-image
+        tag_prefix: pp-
+      release:
+        ref: "3.1.4"
+"""
+    with pytest.raises(pydantic.ValidationError):
+        DependencyFile.parse_obj(load_yaml_content(content_text))
+
+
+def test_snapshot_refs(load_yaml_content):
+    content_text = """
+---
+context:
+  dependencies:
+    r1:
+      backup:
+        repo_url: "https://this.host/path"
+        branch_name: main
+      docker:
+        image_name: r1-image
+        tag_prefix: pp-
+      release:
+        ref: "3.1.4"
+        additional_refs: ["3.0.0", "3.1.4"]
+        branch_head: true
+"""
+    data = DependencyFile.parse_obj(load_yaml_content(content_text))
+
+    assert data.context.dependencies["r1"].snapshot_refs() == [
+        "3.1.4",
+        "3.0.0",
+        "main",
+    ]
+
+
+@pytest.mark.parametrize(
+    "backup_options", ["format: bundle", "include_paths: [src]"]
+)
+def test_additional_refs_unsupported(load_yaml_content, backup_options):
+    content_text = f"""
+---
+context:
+  dependencies:
+    r1:
+      backup:
+        repo_url: "https://this.host/path"
+        branch_name: main
+        {backup_options}
+      docker:
+        image_name: r1-image
+        tag_prefix: pp-
+      release:
+        ref: "3.1.4"
+        branch_head: true
+"""
+    with pytest.raises(pydantic.ValidationError, match=r"additional_refs"):
+        DependencyFile.parse_obj(load_yaml_content(content_text))
@@ -0,0 +1,329 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import asyncio
+import os
+import pathlib
+import tarfile
+import tempfile
+import typing
+
+import git
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from click.testing import CliRunner
+
+from foodx_backup_source._serve import (
+    BackupDaemon,
+    ServeError,
+    click_entry,
+    make_application,
+)
+from foodx_backup_source._snapshot import SnapshotOptions
+
+FAST_OPTIONS = SnapshotOptions(retries=0)
+
+
+def _write_dependencies(
+    project_directory: pathlib.Path, url: str, refs: typing.Dict[str, str]
+) -> None:
+    content = "context:\n  dependencies:\n"
+    for name, ref in refs.items():
+        content += (
+            f"    {name}:\n"
+            f"      backup:\n"
+            f"        repo_url: {url}/{name}.git\n"
+            f"        branch_name: main\n"
+            f"      docker:\n"
+            f"        image_name: {name}-image\n"
+            f"        tag_prefix: p-\n"
+            f"      release:\n"
+            f'        ref: "{ref}"\n'
+        )
+    file_path = project_directory / "dependencies.yaml"
+    mtime_ns = file_path.stat().st_mtime_ns if file_path.is_file() else 0
+    file_path.write_text(content)
+    # make sure the change is visible on file systems with coarse timestamps
+    os.utime(file_path, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+
+
+@pytest.fixture()
+def project(git_http_server, make_git_repository):
+    for x in ["r1", "r2"]:
+        bare_path = make_git_repository(
+            git_http_server.project_root,
+            x,
+            {"README.md": f"{x} readme".encode()},
+        )
+        with git.Repo(bare_path) as this_repo:
+            this_repo.create_tag("2.0.0", ref="1.0.0")
+    with tempfile.TemporaryDirectory() as d:
+        dd = pathlib.Path(d)
+        for x in ["project", "output", "archives"]:
+            (dd / x).mkdir()
+        _write_dependencies(
+            dd / "project", git_http_server.url, {"r1": "1.0.0", "r2": "1.0.0"}
+        )
+
+        yield dd
+
+
+def _daemon(directory: pathlib.Path) -> BackupDaemon:
+    return BackupDaemon(
+        "project",
+        directory / "project",
+        directory / "output",
+        directory / "archives",
+        options=FAST_OPTIONS,
+    )
+
+
+def _advance_branch(bare_path: pathlib.Path, content: bytes) -> str:
+    """Commit to the checked out branch of a bare repository."""
+    with tempfile.TemporaryDirectory() as d:
+        working = git.Repo.clone_from(str(bare_path), d)
+        with working.config_writer() as c:
+            c.set_value("user", "name", "test")
+            c.set_value("user", "email", "test@some.where")
+        (pathlib.Path(d) / "README.md").write_bytes(content)
+        working.git.add(A=True)
+        sha = working.index.commit("next commit").hexsha
+        working.git.push("origin", working.active_branch.name)
+        working.close()
+
+    return sha
+
+
+def _package_members(package_path: pathlib.Path) -> typing.List[str]:
+    with tarfile.open(package_path, mode="r:gz") as f:
+        return sorted(x for x in f.getnames() if not x.endswith(".sha256"))
+
+
+class TestBackupDaemon:
+    @pytest.mark.asyncio
+    async def test_changed_only(self, git_http_server, project):
+        daemon = _daemon(project)
+
+        assert sorted(await daemon.refresh()) == ["r1", "r2"]
+
+        request_count = len(git_http_server.requests)
+        assert await daemon.refresh() == list()
+        assert await daemon.refresh(force=True) == list()
+        assert len(git_http_server.requests) == request_count
+
+        _write_dependencies(
+            project / "project",
+            git_http_server.url,
+            {"r1": "2.0.0", "r2": "1.0.0"},
+        )
+
+        assert await daemon.refresh() == ["r1"]
+
+        package_path, _ = await daemon.package()
+
+        assert _package_members(package_path) == [
+            "manifest.json",
+            "r1-2.0.0.tar.gz",
+            "r2-1.0.0.tar.gz",
+        ]
+        # the replaced snapshot is discarded
+        assert sorted(x.name for x in project.glob("archives/*/*.gz")) == [
+            "r1-2.0.0.tar.gz",
+            "r2-1.0.0.tar.gz",
+        ]
+
+    @pytest.mark.asyncio
+    async def test_removed(self, git_http_server, project):
+        daemon = _daemon(project)
+        await daemon.refresh()
+        _write_dependencies(
+            project / "project", git_http_server.url, {"r2": "1.0.0"}
+        )
+
+        assert await daemon.refresh() == list()
+
+        status = daemon.status()
+        assert [x.name for x in status.snapshots] == ["r2"]
+        assert not status.pending
+
+    @pytest.mark.asyncio
+    async def test_pending(self, git_http_server, project):
+        _write_dependencies(
+            project / "project",
+            git_http_server.url,
+            {"r1": "1.0.0", "missing": "1.0.0"},
+        )
+        daemon = _daemon(project)
+
+        assert await daemon.refresh() == ["r1"]
+        status = daemon.status()
+        assert status.pending == ["missing"]
+        assert "missing" in status.error
+        with pytest.raises(ServeError, match=r"missing"):
+            await daemon.package()
+
+    @pytest.mark.asyncio
+    async def test_pending_retried(
+        self, git_http_server, make_git_repository, project
+    ):
+        _write_dependencies(
+            project / "project",
+            git_http_server.url,
+            {"r1": "1.0.0", "missing": "1.0.0"},
+        )
+        daemon = _daemon(project)
+        await daemon.refresh()
+        make_git_repository(
+            git_http_server.project_root, "missing", {"README.md": b"found"}
+        )
+
+        # retried without any change to the dependency files
+        assert await daemon.refresh() == ["missing"]
+        assert not daemon.status().pending
+        assert daemon.error is None
+
+    @pytest.mark.asyncio
+    async def test_branch_moved(
+        self, git_http_server, make_git_repository, project
+    ):
+        bare_path = make_git_repository(
+            git_http_server.project_root,
+            "r3",
+            {"README.md": b"r3 readme", "big.bin": os.urandom(0x40000)},
+        )
+        with git.Repo(bare_path) as this_repo:
+            branch = this_repo.active_branch.name
+        _write_dependencies(
+            project / "project",
+            git_http_server.url,
+            {"r1": "1.0.0", "r3": branch},
+        )
+        daemon = _daemon(project)
+        await daemon.refresh()
+        assert await daemon.refresh() == list()
+
+        git_http_server.bytes_sent = 0
+        sha = _advance_branch(bare_path, b"r3 next")
+
+        assert await daemon.refresh() == ["r3"]
+        # the repository mirror only fetches the new commit
+        assert git_http_server.bytes_sent < 0x40000
+        assert {x.name: x.sha for x in daemon.status().snapshots}["r3"] == sha
+        assert await daemon.refresh() == list()
+        assert len(list(project.glob("archives/*/r3-*.tar.gz"))) == 1
+
+    @pytest.mark.asyncio
+    async def test_scheduled_package(self, project):
+        daemon = _daemon(project)
+        stop = asyncio.Event()
+        task = asyncio.ensure_future(daemon.run(stop, 0.05, 0.1))
+        try:
+            for _ in range(200):
+                if daemon.last_package:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            stop.set()
+            await asyncio.wait_for(task, 5)
+
+        assert len(daemon.packages) == 2
+        assert daemon.error is None
+
+
+class TestApplication:
+    @pytest.mark.asyncio
+    async def test_endpoints(self, project):
+        daemon = _daemon(project)
+        async with TestClient(TestServer(make_application(daemon))) as client:
+            response = await client.post("/package")
+            assert response.status == 409
+
+            response = await client.post("/refresh")
+            assert response.status == 200
+            assert sorted((await response.json())["snapshots"]) == [
+                "r1",
+                "r2",
+            ]
+
+            response = await client.post("/package")
+            assert response.status == 200
+            packages = (await response.json())["packages"]
+            assert len(packages) == 2
+
+            response = await client.get("/status")
+            assert response.status == 200
+            status = await response.json()
+            assert status["project_name"] == "project"
+            assert status["packages"] == packages
+            assert sorted(x["name"] for x in status["snapshots"]) == [
+                "r1",
+                "r2",
+            ]
+
+    @pytest.mark.asyncio
+    async def test_refresh_error(self, project):
+        daemon = _daemon(project)
+        (project / "project" / "dependencies.yaml").write_text("context: [")
+        async with TestClient(TestServer(make_application(daemon))) as client:
+            response = await client.post("/refresh")
+
+            assert response.status == 500
+            error = (await response.json())["error"]
+            assert error
+
+            response = await client.get("/status")
+            assert (await response.json())["error"] == error
+
+
+class TestClickEntry:
+    def test_options(self, mocker):
+        mock_launch = mocker.patch("foodx_backup_source._serve._launch_daemon")
+        with tempfile.TemporaryDirectory() as d:
+            arguments = [
+                "project",
+                d,
+                "--output-dir",
+                d,
+                "--unix-socket",
+                str(pathlib.Path(d) / "socket"),
+                "--poll-interval",
+                "5",
+                "--package-interval",
+                "3600",
+                "--host-connections",
+                "2",
+            ]
+
+            result = CliRunner().invoke(click_entry, arguments)
+
+        assert result.exit_code == 0
+        mock_launch.assert_awaited_once_with(
+            "project",
+            pathlib.Path(d),
+            pathlib.Path(d),
+            None,
+            dict(),
+            mocker.ANY,
+            None,
+            "tar.gz",
+            None,
+            False,
+            "127.0.0.1:8470",
+            pathlib.Path(d) / "socket",
+            5,
+            3600,
+        )
+        assert mock_launch.call_args.args[5].host_connections == 2
+
+    def test_bad_listen(self):
+        with tempfile.TemporaryDirectory() as d:
+            result = CliRunner().invoke(
+                click_entry, ["project", d, "--listen", "no-port"]
+            )
+
+        assert result.exit_code == 1
+        assert "Malformed listen address" in result.output
@@ -5,13 +5,38 @@
 #  You should have received a copy of the MIT License along with
 #  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
 
+import asyncio
+import concurrent.futures
+import os
 import pathlib
+import pickle
+import tarfile
 import tempfile
+import time
+import typing
 
 import git
+import pydantic
 import pytest
 
-from foodx_backup_source._snapshot import _create_tarfile, do_snapshot
+from foodx_backup_source._governor import TransferGovernor, transfer_host
+from foodx_backup_source._hash import create_file_hash, read_hash_file
+from foodx_backup_source._snapshot import (
+    ArchiveRecord,
+    RefArchive,
+    SnapshotError,
+    SnapshotOptions,
+    SnapshotResult,
+    SnapshotTimeoutError,
+    SnapshotTimings,
+    _create_tarfile,
+    _ProcessTracker,
+    archive_executor_scope,
+    do_snapshot,
+    iter_snapshots,
+    rename_snapshot,
+)
+from foodx_backup_source._verify import archive_tree
 from foodx_backup_source.schema import (
     ApplicationDefinition,
     ApplicationDependency,
@@ -59,12 +84,664 @@ class TestDoSnapshot:
     @pytest.mark.asyncio
     async def test_clean(self, mock_definition, mocker):
 
+        def _create_tarfile(name, git_ref, tarfile_path, *args):
+            tarfile_path.write_bytes(b"archive")
+            return "1" * 64
+
         with tempfile.TemporaryDirectory() as d:
             mock_archive = pathlib.Path(d)
 
-            mocker.patch("foodx_backup_source._snapshot._create_tarfile")
-            mocker.patch("foodx_backup_source._snapshot.git.Repo.clone_from")
+            mocker.patch(
+                "foodx_backup_source._snapshot._create_tarfile",
+                side_effect=_create_tarfile,
+            )
+            mock_clone = mocker.patch(
+                "foodx_backup_source._snapshot._clone_repository"
+            )
+            mock_clone.return_value.commit.return_value.hexsha = "2" * 40
+
+            result = await do_snapshot(mock_definition, mock_archive, None)
+
+        assert result.archive_path == mock_archive / "n1-abc123.tar.gz"
+        assert result.hash_path == mock_archive / "n1-abc123.tar.gz.sha256"
+        assert result.sha == "2" * 40
+        assert result.sha256 == "1" * 64
+        assert result.archive_bytes == len(b"archive")
+        mock_clone.return_value.commit.assert_called_once_with("abc123")
+
+
+def _definition(
+    name: str, url: str = "https://some.where", ref: str = "abc123"
+) -> ApplicationDefinition:
+    return ApplicationDefinition(
+        name=name,
+        configuration=ApplicationDependency.parse_obj(
+            {
+                "backup": {
+                    "repo_url": f"{url}/{name}",
+                    "branch_name": "main",
+                },
+                "docker": {"image_name": "some-image", "tag_prefix": "p-"},
+                "release": {"ref": ref},
+            }
+        ),
+    )
+
+
+FAST_RETRIES = SnapshotOptions(retries=2, backoff_seconds=0.01)
+
+
+class TestSnapshotRecovery:
+    """Snapshots against a local git server stand-in with injected faults."""
+
+    @pytest.mark.asyncio
+    async def test_transient_retry(self, git_http_server, make_git_repository):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+        git_http_server.inject(502, count=2)
+        definition = _definition("r1.git", url=git_http_server.url, ref="1.0.0")
+
+        with tempfile.TemporaryDirectory() as d:
+            result = await do_snapshot(
+                definition, pathlib.Path(d), None, FAST_RETRIES
+            )
+
+            with tarfile.open(result.archive_path, mode="r:gz") as f:
+                assert "r1.git/README.md" in f.getnames()
+
+    @pytest.mark.asyncio
+    async def test_retries_exhausted(
+        self, git_http_server, make_git_repository
+    ):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+        git_http_server.inject(503, count=3)
+        definition = _definition("r1.git", url=git_http_server.url, ref="1.0.0")
+
+        with tempfile.TemporaryDirectory() as d:
+            with pytest.raises(git.GitCommandError, match=r"503"):
+                await do_snapshot(
+                    definition, pathlib.Path(d), None, FAST_RETRIES
+                )
+
+        assert len(git_http_server.requests) == 3
+
+    @pytest.mark.asyncio
+    async def test_permanent_not_retried(self, git_http_server):
+        definition = _definition("missing.git", url=git_http_server.url)
+
+        with tempfile.TemporaryDirectory() as d:
+            with pytest.raises(git.GitCommandError):
+                await do_snapshot(
+                    definition, pathlib.Path(d), None, FAST_RETRIES
+                )
+
+        assert len(git_http_server.requests) == 1
+
+    @pytest.mark.asyncio
+    async def test_stalled_server_timeout(
+        self, git_http_server, make_git_repository, mocker
+    ):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+        git_http_server.delay_seconds = 30
+        definition = _definition("r1.git", url=git_http_server.url, ref="1.0.0")
+        options = SnapshotOptions(timeout_seconds=0.5)
+
+        with tempfile.TemporaryDirectory() as d:
+            start_time = time.monotonic()
+            with pytest.raises(SnapshotTimeoutError, match=r"r1.git"):
+                await do_snapshot(definition, pathlib.Path(d), None, options)
+
+            assert (time.monotonic() - start_time) < 5
+
+
+class TestHostGovernor:
+    """Snapshots against a local git server stand-in that throttles."""
+
+    @pytest.mark.asyncio
+    async def test_retry_after(self, git_http_server, make_git_repository):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+        git_http_server.inject(429, count=1, headers={"Retry-After": "1"})
+        definition = _definition("r1.git", url=git_http_server.url, ref="1.0.0")
+
+        with tempfile.TemporaryDirectory() as d:
+            start_time = time.monotonic()
+            result = await do_snapshot(
+                definition, pathlib.Path(d), None, FAST_RETRIES
+            )
+
+            # the retry waited for the host rather than the fast backoff
+            assert (time.monotonic() - start_time) >= 1
+            assert result.sha256 == create_file_hash(result.archive_path)
+
+    @pytest.mark.asyncio
+    async def test_connection_limit(self, git_http_server, make_git_repository):
+        names = [f"r{x}" for x in range(4)]
+        for x in names:
+            make_git_repository(
+                git_http_server.project_root,
+                x,
+                {"README.md": f"{x} readme".encode()},
+            )
+        git_http_server.delay_seconds = 0.1
+        git_http_server.throttle_above = 1
+        definitions = [
+            _definition(f"{x}.git", url=git_http_server.url, ref="1.0.0")
+            for x in names
+        ]
+        options = SnapshotOptions(retries=0, host_connections=1)
+
+        with tempfile.TemporaryDirectory() as d:
+            results = [
+                x
+                async for x in iter_snapshots(
+                    definitions, pathlib.Path(d), None, options
+                )
+            ]
+
+        assert sorted(x.name for x in results) == [f"{x}.git" for x in names]
+        assert git_http_server.max_active == 1
+        assert git_http_server.throttled == 0
+
+    @pytest.mark.asyncio
+    async def test_timeout_after_admission(
+        self, git_http_server, make_git_repository
+    ):
+        make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+        definition = _definition("r1.git", url=git_http_server.url, ref="1.0.0")
+        options = SnapshotOptions(timeout_seconds=0.5, host_connections=1)
+        governor = TransferGovernor(max_connections=1)
+        host = transfer_host(git_http_server.url)
+
+        def _hold_host() -> None:
+            with governor.transfer(host):
+                time.sleep(1)
+
+        loop = asyncio.get_running_loop()
+        with tempfile.TemporaryDirectory() as d:
+            holding = loop.run_in_executor(None, _hold_host)
+            await asyncio.sleep(0.1)
+            start_time = time.monotonic()
+            result = await do_snapshot(
+                definition, pathlib.Path(d), None, options, governor=governor
+            )
+            await holding
+
+            # waiting for the host does not count against the time limit
+            assert (time.monotonic() - start_time) > 0.5
+            assert result.sha256 == create_file_hash(result.archive_path)
+
+    @pytest.mark.asyncio
+    async def test_timeout_before_admission(self, mock_definition, mocker):
+        def _hung_clone(
+            url, working_directory, tracker, sparse, governor, reference
+        ):
+            # stalls before any transfer is admitted
+            time.sleep(2)
+            raise git.GitCommandError("clone", 128, "fatal: stalled")
+
+        mocker.patch(
+            "foodx_backup_source._snapshot._clone_repository",
+            side_effect=_hung_clone,
+        )
+        options = SnapshotOptions(timeout_seconds=0.2, retries=0)
+
+        with tempfile.TemporaryDirectory() as d:
+            start_time = time.monotonic()
+            with pytest.raises(SnapshotTimeoutError):
+                await do_snapshot(
+                    mock_definition, pathlib.Path(d), None, options
+                )
+
+            assert (time.monotonic() - start_time) < 1
+
+
+def _sparse_definition(url: str, **filters) -> ApplicationDefinition:
+    return ApplicationDefinition(
+        name="r1.git",
+        configuration=ApplicationDependency.parse_obj(
+            {
+                "backup": {
+                    "repo_url": f"{url}/r1.git",
+                    "branch_name": "main",
+                    **filters,
+                },
+                "docker": {"image_name": "some-image", "tag_prefix": "p-"},
+                "release": {"ref": "1.0.0"},
+            }
+        ),
+    )
+
+
+@pytest.fixture()
+def monorepo(git_http_server, make_git_repository):
+    make_git_repository(
+        git_http_server.project_root,
+        "r1",
+        {
+            "deploy/main.yaml": b"deploy",
+            "deploy/secret/key.txt": b"secret",
+            "charts/Chart.yaml": b"chart",
+            "src/big.bin": os.urandom(0x40000),
+        },
+    )
+
+
+class TestSparseSnapshot:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("executor", ["thread", "process"])
+    async def test_include_exclude(self, git_http_server, monorepo, executor):
+        definition = _sparse_definition(
+            git_http_server.url,
+            include_paths=["deploy/", "charts"],
+            exclude_paths=["deploy/secret"],
+        )
+        options = SnapshotOptions(executor=executor, jobs=1)
+
+        with tempfile.TemporaryDirectory() as d:
+            async with archive_executor_scope(options) as pool:
+                result = await do_snapshot(
+                    definition, pathlib.Path(d), None, options, pool
+                )
+
+            with tarfile.open(result.archive_path, mode="r:gz") as f:
+                names = {x.name for x in f.getmembers() if x.isfile()}
+
+        assert names == {"r1.git/deploy/main.yaml", "r1.git/charts/Chart.yaml"}
+
+    @pytest.mark.asyncio
+    async def test_blobs_not_fetched(self, git_http_server, monorepo):
+        with tempfile.TemporaryDirectory() as d:
+            await do_snapshot(
+                _sparse_definition(git_http_server.url),
+                pathlib.Path(d),
+                None,
+            )
+            full_bytes = git_http_server.bytes_sent
+            git_http_server.bytes_sent = 0
+
+            await do_snapshot(
+                _sparse_definition(
+                    git_http_server.url, include_paths=["deploy"]
+                ),
+                pathlib.Path(d),
+                None,
+            )
+
+        assert git_http_server.bytes_sent < (full_bytes / 10)
+
+    def test_bundle_rejected(self):
+        with pytest.raises(pydantic.ValidationError, match=r"archive format"):
+            _sparse_definition(
+                "https://some.where", format="bundle", include_paths=["deploy"]
+            )
+
+
+class TestProcessExecutor:
+    def test_archive_record_picklable(self):
+        record = ArchiveRecord(sha256="1" * 64, size=10)
+
+        assert pickle.loads(pickle.dumps(record)) == record
+
+    @pytest.mark.asyncio
+    async def test_executor_scope(self):
+        async with archive_executor_scope(SnapshotOptions()) as x:
+            assert x is None
+        async with archive_executor_scope(
+            SnapshotOptions(executor="process", jobs=2)
+        ) as x:
+            assert isinstance(x, concurrent.futures.ProcessPoolExecutor)
+
+        with pytest.raises(RuntimeError):
+            x.submit(time.sleep, 0)
+
+    @pytest.mark.asyncio
+    async def test_process_archive(self, git_http_server, make_git_repository):
+        for x in ["r1", "r2"]:
+            make_git_repository(
+                git_http_server.project_root,
+                x,
+                {"README.md": f"{x} readme".encode()},
+            )
+        definitions = [
+            _definition(x, url=git_http_server.url, ref="1.0.0")
+            for x in ["r1.git", "r2.git"]
+        ]
+        options = SnapshotOptions(executor="process", jobs=2)
+
+        with tempfile.TemporaryDirectory() as d:
+            results = [
+                x
+                async for x in iter_snapshots(
+                    definitions, pathlib.Path(d), None, options
+                )
+            ]
+
+            assert sorted(x.name for x in results) == ["r1.git", "r2.git"]
+            for x in results:
+                assert x.sha256 == create_file_hash(x.archive_path)
+                assert read_hash_file(x.hash_path) == x.sha256
+                with tarfile.open(x.archive_path, mode="r:gz") as f:
+                    assert f"{x.name}/README.md" in f.getnames()
+
+
+@pytest.fixture()
+def released_repository(git_http_server, make_git_repository):
+    """A repository with two release tags and a release branch."""
+    bare_path = make_git_repository(
+        git_http_server.project_root, "r1", {"README.md": b"1.0.0 readme"}
+    )
+    with tempfile.TemporaryDirectory() as d:
+        working = git.Repo.clone_from(str(bare_path), d)
+        with working.config_writer() as c:
+            c.set_value("user", "name", "test")
+            c.set_value("user", "email", "test@some.where")
+        for x in ["2.0.0", "2.0.1"]:
+            (pathlib.Path(d) / "README.md").write_text(f"{x} readme")
+            working.git.add(A=True)
+            working.index.commit(f"release {x}")
+            working.create_tag(x)
+        working.git.push("origin", "HEAD:refs/heads/release/2", "--tags")
+        working.close()
+
+
+def _multiple_ref_definition(url: str) -> ApplicationDefinition:
+    return ApplicationDefinition(
+        name="r1",
+        configuration=ApplicationDependency.parse_obj(
+            {
+                "backup": {
+                    "repo_url": f"{url}/r1.git",
+                    "branch_name": "release/2",
+                },
+                "docker": {"image_name": "some-image", "tag_prefix": "p-"},
+                "release": {
+                    "ref": "1.0.0",
+                    "additional_refs": ["2.0.0"],
+                    "branch_head": True,
+                },
+            }
+        ),
+    )
+
+
+def _read_archive(archive_path: pathlib.Path) -> typing.Dict[str, bytes]:
+    with tarfile.open(archive_path, mode="r:gz") as f:
+        return {x.name: f.extractfile(x).read() for x in f if x.isfile()}
+
+
+class TestMultipleRefs:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("executor", ["thread", "process"])
+    async def test_single_fetch(
+        self, git_http_server, released_repository, executor
+    ):
+        definition = _multiple_ref_definition(git_http_server.url)
+        options = SnapshotOptions(executor=executor, jobs=2)
+
+        with tempfile.TemporaryDirectory() as d:
+            async with archive_executor_scope(options) as archive_executor:
+                result = await do_snapshot(
+                    definition, pathlib.Path(d), None, options, archive_executor
+                )
+
+            assert [x.name for x in result.archive_files()] == [
+                "r1-1.0.0.tar.gz",
+                "r1-1.0.0.tar.gz.sha256",
+                "r1-2.0.0.tar.gz",
+                "r1-2.0.0.tar.gz.sha256",
+                "r1-release_2.tar.gz",
+                "r1-release_2.tar.gz.sha256",
+            ]
+            assert _read_archive(result.archive_path) == {
+                "r1/README.md": b"1.0.0 readme"
+            }
+            assert [x.ref for x in result.ref_archives] == [
+                "2.0.0",
+                "release/2",
+            ]
+            assert _read_archive(result.ref_archives[0].archive_path) == {
+                "r1-2.0.0/README.md": b"2.0.0 readme"
+            }
+            assert _read_archive(result.ref_archives[1].archive_path) == {
+                "r1-release_2/README.md": b"2.0.1 readme"
+            }
+            for x in result.ref_archives:
+                assert x.sha256 == create_file_hash(x.archive_path)
+                assert read_hash_file(x.hash_path) == x.sha256
+
+        # a single clone fetches all the references
+        assert (
+            len([x for x in git_http_server.requests if "info/refs" in x]) == 1
+        )
+
+
+class TestRenameSnapshot:
+    def test_clean(self, make_git_repository):
+        long_name = "d/" * 60 + "long.txt"
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            bare_path = make_git_repository(
+                dd, "r1", {"README.md": b"r1 readme", long_name: b"long"}
+            )
+            with git.Repo(bare_path) as this_repo:
+                sha = this_repo.commit("1.0.0").hexsha
+                archives = [
+                    (x, dd / f"r1-{y}.tar.gz", z)
+                    for x, y, z in [
+                        ("r1", "1.0.0", sha),
+                        ("r1-2.0.0", "2.0.0", sha),
+                    ]
+                ]
+                hashes = [
+                    _create_tarfile(x, z, y, this_repo) for x, y, z in archives
+                ]
+            result = SnapshotResult(
+                name="r1",
+                ref="1.0.0",
+                sha=sha,
+                archive_path=archives[0][1],
+                hash_path=dd / "r1-1.0.0.tar.gz.sha256",
+                sha256=hashes[0],
+                timings=SnapshotTimings(
+                    clone_seconds=0, archive_seconds=0, total_seconds=0
+                ),
+                ref_archives=[
+                    RefArchive(
+                        ref="2.0.0",
+                        sha=sha,
+                        archive_path=archives[1][1],
+                        hash_path=dd / "r1-2.0.0.tar.gz.sha256",
+                        sha256=hashes[1],
+                    )
+                ],
+            )
+            renamed_directory = dd / "renamed"
+            renamed_directory.mkdir()
+
+            renamed = rename_snapshot(result, "alias", renamed_directory)
+
+            assert renamed.name == "alias"
+            assert [renamed.archive_path] + [
+                x.archive_path for x in renamed.ref_archives
+            ] == [
+                renamed_directory / "alias-1.0.0.tar.gz",
+                renamed_directory / "alias-2.0.0.tar.gz",
+            ]
+            for x, y in [(renamed.archive_path, "alias")] + [
+                (renamed.ref_archives[0].archive_path, "alias-2.0.0")
+            ]:
+                assert _read_archive(x) == {
+                    f"{y}/README.md": b"r1 readme",
+                    f"{y}/{long_name}": b"long",
+                }
+            assert renamed.sha256 == create_file_hash(renamed.archive_path)
+            assert read_hash_file(renamed.hash_path) == renamed.sha256
+            with result.archive_path.open(mode="rb") as f:
+                original_tree = archive_tree(f)
+            with renamed.archive_path.open(mode="rb") as f:
+                # the archived commit is retained
+                assert (
+                    archive_tree(f) == original_tree == (sha, original_tree[1])
+                )
+
+
+class TestProcessCancellation:
+    @pytest.mark.asyncio
+    async def test_kill_on_timeout(self, mock_definition, mocker):
+        processes = list()
+
+        def _hung_clone(
+            url, working_directory, tracker, sparse, governor, reference
+        ):
+            with governor.transfer("some.host"):
+                # a shell alias runs as a child of git, like a transport
+                # helper
+                process = tracker.start(
+                    git.Git(), ["-c", "alias.hang=!sleep 30", "hang"]
+                )
+                processes.append(process)
+                process.wait()
+
+        mocker.patch(
+            "foodx_backup_source._snapshot._clone_repository",
+            side_effect=_hung_clone,
+        )
+        options = SnapshotOptions(timeout_seconds=0.2)
+
+        with tempfile.TemporaryDirectory() as d:
+            with pytest.raises(SnapshotTimeoutError):
+                await do_snapshot(
+                    mock_definition, pathlib.Path(d), None, options
+                )
+
+        assert processes
+        processes[0].proc.wait(timeout=5)
+        assert processes[0].proc.returncode != 0
+
+    @pytest.mark.parametrize("cancel_first", [False, True])
+    def test_kill_worker_process(self, cancel_first):
+        with tempfile.TemporaryDirectory() as d:
+            pid_path = pathlib.Path(d) / "0.pid"
+            tracker = _ProcessTracker()
+            tracker.track_pid_file(pid_path)
+            # the tracker of a process pool worker
+            worker_tracker = _ProcessTracker(pid_path)
+            if cancel_first:
+                tracker.kill_all()
+
+            process = worker_tracker.start(
+                git.Git(), ["-c", "alias.hang=!sleep 30", "hang"]
+            )
+            if not cancel_first:
+                tracker.kill_all()
+
+            process.proc.wait(timeout=5)
+            assert process.proc.returncode != 0
+            assert worker_tracker.cancelled == cancel_first
+
+
+@pytest.fixture()
+def mock_delayed_snapshot(mocker):
+    delays = {"slow": 0.2, "medium": 0.1, "fast": 0}
+    cancelled = list()
+
+    async def _do_snapshot(
+        definition,
+        archive_directory,
+        token,
+        options,
+        archive_executor,
+        governor,
+        backend,
+        families,
+        spool,
+    ):
+        if definition.name == "broken":
+            raise git.GitCommandError("clone", 128, "fatal: not found")
+        try:
+            await asyncio.sleep(delays[definition.name])
+        except asyncio.CancelledError:
+            cancelled.append(definition.name)
+            raise
+        return SnapshotResult(
+            name=definition.name,
+            ref="abc123",
+            sha="2" * 40,
+            archive_path=archive_directory / f"{definition.name}.tar.gz",
+            hash_path=archive_directory / f"{definition.name}.tar.gz.sha256",
+            sha256="1" * 64,
+            timings=SnapshotTimings(
+                clone_seconds=0, archive_seconds=0, total_seconds=0
+            ),
+        )
+
+    mocker.patch(
+        "foodx_backup_source._snapshot.do_snapshot", side_effect=_do_snapshot
+    )
+
+    return cancelled
+
+
+class TestIterSnapshots:
+    @pytest.mark.asyncio
+    async def test_completion_order(self, mock_delayed_snapshot):
+        definitions = [_definition(x) for x in ["slow", "medium", "fast"]]
+
+        results = [
+            x
+            async for x in iter_snapshots(definitions, pathlib.Path("archives"))
+        ]
+
+        assert [x.name for x in results] == ["fast", "medium", "slow"]
+
+    @pytest.mark.asyncio
+    async def test_early_stop(self, mock_delayed_snapshot):
+        definitions = [_definition(x) for x in ["slow", "medium", "fast"]]
+
+        snapshots = iter_snapshots(definitions, pathlib.Path("archives"))
+        async for x in snapshots:
+            assert x.name == "fast"
+            break
+        await snapshots.aclose()
+        await asyncio.sleep(0)
+
+        assert set(mock_delayed_snapshot) == {"slow", "medium"}
+
+    @pytest.mark.asyncio
+    async def test_deadline(self, mock_delayed_snapshot):
+        definitions = [_definition(x) for x in ["slow", "medium", "fast"]]
+        options = SnapshotOptions(deadline_seconds=0.05)
+
+        results = list()
+        with pytest.raises(SnapshotError, match=r"timed out: medium, slow"):
+            async for x in iter_snapshots(
+                definitions, pathlib.Path("archives"), options=options
+            ):
+                results.append(x.name)
+
+        assert results == ["fast"]
+        assert set(mock_delayed_snapshot) == {"slow", "medium"}
+
+    @pytest.mark.asyncio
+    async def test_failure_summary(self, mock_delayed_snapshot):
+        definitions = [_definition(x) for x in ["broken", "medium", "fast"]]
 
-        result = await do_snapshot(mock_definition, mock_archive, None)
+        results = list()
+        with pytest.raises(SnapshotError) as e:
+            async for x in iter_snapshots(
+                definitions, pathlib.Path("archives")
+            ):
+                results.append(x.name)
 
-        assert result == mock_archive / "n1-abc123.tar.gz"
+        assert results == ["fast", "medium"]
+        assert list(e.value.failed.keys()) == ["broken"]
+        assert not e.value.timed_out
@@ -0,0 +1,200 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import io
+import os
+import pathlib
+import tarfile
+import tempfile
+
+import pytest
+
+from foodx_backup_source._compress import compress_tar_file
+from foodx_backup_source._hash import create_file_hash, read_hash_file
+from foodx_backup_source._package import write_package
+from foodx_backup_source._snapshot import (
+    SnapshotOptions,
+    construct_spool,
+    iter_snapshots,
+)
+from foodx_backup_source._spool import ArchiveSpool
+
+
+class TestArchiveSpool:
+    def test_in_memory(self):
+        spool = ArchiveSpool(100, 1000)
+        with tempfile.TemporaryDirectory() as d:
+            file_path = pathlib.Path(d) / "r1.tar.gz"
+            with spool.writer(file_path) as f:
+                f.write(b"a" * 50)
+                f.write(b"b" * 50)
+            hash_path = spool.write_hash_file("1" * 64, file_path)
+
+            assert not file_path.exists()
+            assert not hash_path.exists()
+            assert file_path in spool
+            assert spool.file_size(file_path) == 100
+            with spool.open(file_path) as f:
+                assert f.read() == (b"a" * 50) + (b"b" * 50)
+            with spool.open(hash_path) as f:
+                assert f.read() == f"{'1' * 64}  r1.tar.gz".encode()
+            assert spool.used_bytes == 100 + len(f"{'1' * 64}  r1.tar.gz")
+
+            spool.release(file_path)
+            spool.close()
+
+        assert file_path not in spool
+        assert spool.used_bytes == 0
+
+    def test_file_limit(self):
+        spool = ArchiveSpool(100, 1000)
+        with tempfile.TemporaryDirectory() as d:
+            file_path = pathlib.Path(d) / "r1.tar.gz"
+            with spool.writer(file_path) as f:
+                f.write(b"a" * 60)
+                f.write(b"b" * 60)
+            hash_path = spool.write_hash_file("1" * 64, file_path)
+
+            assert file_path not in spool
+            assert file_path.read_bytes() == (b"a" * 60) + (b"b" * 60)
+            assert read_hash_file(hash_path) == "1" * 64
+            assert spool.used_bytes == 0
+
+    def test_budget(self):
+        spool = ArchiveSpool(100, 100)
+        with tempfile.TemporaryDirectory() as d:
+            paths = [pathlib.Path(d) / f"r{i}.tar.gz" for i in range(3)]
+            for x in paths[:2]:
+                with spool.writer(x) as f:
+                    f.write(b"a" * 60)
+            spool.release(paths[0])
+            with spool.writer(paths[2]) as f:
+                f.write(b"a" * 60)
+
+            # the second file exceeded the budget held by the first
+            assert [x in spool for x in paths] == [False, False, True]
+            assert paths[1].is_file()
+            assert spool.used_bytes == 60
+
+            spool.spill(paths)
+
+            assert paths[2].read_bytes() == b"a" * 60
+            assert spool.used_bytes == 0
+
+    def test_abort(self):
+        spool = ArchiveSpool(100, 1000)
+        with tempfile.TemporaryDirectory() as d:
+            paths = [pathlib.Path(d) / f"r{i}.tar.gz" for i in range(2)]
+            for x, size in zip(paths, [50, 150]):
+                with spool.writer(x) as f:
+                    f.write(b"a" * size)
+                    f.abort()
+
+            # neither the buffered nor the spilled file is kept
+            assert [x in spool for x in paths] == [False, False]
+            assert [x.exists() for x in paths] == [False, False]
+            assert spool.used_bytes == 0
+
+    def test_failed_archive(self):
+        class _FailingSource(io.RawIOBase):
+            def readable(self) -> bool:
+                return True
+
+            def readinto(self, b) -> int:
+                raise OSError("source failed")
+
+        spool = ArchiveSpool(100, 1000)
+        with tempfile.TemporaryDirectory() as d:
+            file_path = pathlib.Path(d) / "r1.tar.gz"
+            with pytest.raises(OSError, match=r"source failed"):
+                compress_tar_file(_FailingSource(), file_path, 6, spool)
+
+            assert file_path not in spool
+            assert not file_path.exists()
+            assert spool.used_bytes == 0
+
+
+class TestSpooledSnapshots:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "package_format,key", [("tar.gz", None), ("tar", None), ("tar", b"k")]
+    )
+    async def test_package(
+        self,
+        package_format,
+        key,
+        git_http_server,
+        make_git_repository,
+        make_definition,
+    ):
+        make_git_repository(
+            git_http_server.project_root, "small", {"README.md": b"small"}
+        )
+        make_git_repository(
+            git_http_server.project_root,
+            "large",
+            {"big.bin": os.urandom(0x20000)},
+        )
+        definitions = [
+            make_definition(x, git_http_server.url) for x in ["small", "large"]
+        ]
+        encryption_key = (key * 32) if key else None
+        spool = construct_spool(SnapshotOptions(spool_file_bytes=0x10000))
+        assert spool
+
+        with tempfile.TemporaryDirectory() as d, spool:
+            archive_directory = pathlib.Path(d) / "archives"
+            archive_directory.mkdir()
+            results = {
+                x.name: x
+                async for x in iter_snapshots(
+                    definitions, archive_directory, spool=spool
+                )
+            }
+            # only the large repository archive is written to disk
+            assert sorted(x.name for x in archive_directory.iterdir()) == [
+                "large-1.0.0.tar.gz",
+                "large-1.0.0.tar.gz.sha256",
+            ]
+            assert results["small"].archive_bytes == spool.file_size(
+                results["small"].archive_path
+            )
+            package_path = write_package(
+                "project",
+                pathlib.Path(d),
+                [results["small"], results["large"]],
+                package_format,
+                encryption_key,
+                spool=spool,
+            )[0]
+            if encryption_key:
+                assert package_path.stat().st_size > 0x20000
+                return
+
+            with tarfile.open(package_path) as f:
+                names = f.getnames()
+                small_archive = f.extractfile("small-1.0.0.tar.gz").read()
+                small_hash = f.extractfile("small-1.0.0.tar.gz.sha256").read()
+                large_archive = f.extractfile("large-1.0.0.tar.gz").read()
+
+        assert names == [
+            "small-1.0.0.tar.gz",
+            "small-1.0.0.tar.gz.sha256",
+            "large-1.0.0.tar.gz",
+            "large-1.0.0.tar.gz.sha256",
+            "manifest.json",
+            "manifest.json.sha256",
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            archive_path = pathlib.Path(d) / "small.tar.gz"
+            archive_path.write_bytes(small_archive)
+            assert create_file_hash(archive_path) == results["small"].sha256
+            assert small_hash.decode().startswith(results["small"].sha256)
+            with tarfile.open(archive_path) as f:
+                assert f.extractfile("small/README.md").read() == b"small"
+            archive_path.write_bytes(large_archive)
+            assert create_file_hash(archive_path) == results["large"].sha256
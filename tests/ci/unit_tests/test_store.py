@@ -0,0 +1,233 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+import typing
+import zlib
+
+import git
+import pytest
+from click.testing import CliRunner
+
+from foodx_backup_source._hash import create_file_hash
+from foodx_backup_source._snapshot import (
+    SnapshotResult,
+    SnapshotTimings,
+    _create_tarfile,
+)
+from foodx_backup_source._store import ObjectStore, StoreError, click_entry
+
+TIMINGS = SnapshotTimings(clone_seconds=1, archive_seconds=1, total_seconds=2)
+
+
+@pytest.fixture()
+def workspace():
+    with tempfile.TemporaryDirectory() as d:
+        dd = pathlib.Path(d)
+        for x in ["repos", "archives", "store", "output"]:
+            (dd / x).mkdir()
+
+        yield dd
+
+
+def _snapshot(
+    workspace: pathlib.Path,
+    make_git_repository: typing.Callable,
+    name: str,
+    files: typing.Dict[str, bytes],
+) -> SnapshotResult:
+    bare_path = make_git_repository(workspace / "repos", name, files)
+    archive_path = workspace / "archives" / f"{name}-1.0.0.tar.gz"
+    with git.Repo(bare_path) as this_repo:
+        sha256 = _create_tarfile(name, "1.0.0", archive_path, this_repo)
+        sha = this_repo.commit("1.0.0").hexsha
+    shutil.rmtree(bare_path)
+
+    return SnapshotResult(
+        name=name,
+        ref="1.0.0",
+        sha=sha,
+        archive_path=archive_path,
+        hash_path=archive_path.parent / f"{archive_path.name}.sha256",
+        sha256=sha256,
+        timings=TIMINGS,
+    )
+
+
+def _object_count(store: ObjectStore) -> int:
+    return len(list(store.objects.glob("*/*")))
+
+
+class TestObjectStore:
+    def test_deduplicated(self, workspace, make_git_repository):
+        store = ObjectStore(workspace / "store")
+        shared = {"README.md": b"shared readme", "big.bin": os.urandom(0x3000)}
+        first = _snapshot(
+            workspace, make_git_repository, "r1", {**shared, "a.txt": b"a"}
+        )
+        store.ingest("project", [first], run="run1")
+        assert _object_count(store) == 3
+
+        second = _snapshot(
+            workspace, make_git_repository, "r1", {**shared, "a.txt": b"b"}
+        )
+        manifest_paths = store.ingest("project", [second], run="run2")
+
+        # only the changed file is stored again
+        assert _object_count(store) == 4
+        assert [x.name for x in manifest_paths] == ["r1.json.gz"]
+        assert store.runs("project") == ["run1", "run2"]
+
+    def test_materialize(self, workspace, make_git_repository):
+        store = ObjectStore(workspace / "store")
+        result = _snapshot(
+            workspace,
+            make_git_repository,
+            "r1",
+            {"README.md": b"readme", "empty": b"", "sub/x.gz": os.urandom(700)},
+        )
+        store.ingest("project", [result], run="run1")
+        (manifest,) = store.read_manifests("project", "run1")
+
+        created_files = store.materialize(manifest, workspace / "output")
+
+        archive_path = workspace / "output" / "r1-1.0.0.tar.gz"
+        assert created_files == [
+            archive_path,
+            archive_path.parent / "r1-1.0.0.tar.gz.sha256",
+        ]
+        # recompressed identically to the original archive
+        assert create_file_hash(archive_path) == result.sha256
+
+    def test_bundle(self, workspace):
+        store = ObjectStore(workspace / "store")
+        bundle_path = workspace / "archives" / "r1-1.0.0.bundle"
+        bundle_path.write_bytes(b"# v2 git bundle\n" + os.urandom(1000))
+        result = SnapshotResult(
+            name="r1",
+            ref="1.0.0",
+            sha="0" * 40,
+            archive_path=bundle_path,
+            hash_path=bundle_path.parent / f"{bundle_path.name}.sha256",
+            sha256=create_file_hash(bundle_path),
+            timings=TIMINGS,
+            format="bundle",
+        )
+        store.ingest("project", [result], run="run1")
+        (manifest,) = store.read_manifests("project", "run1")
+
+        store.materialize(manifest, workspace / "output")
+
+        assert (
+            workspace / "output" / bundle_path.name
+        ).read_bytes() == bundle_path.read_bytes()
+
+    def test_corrupt_object(self, workspace, make_git_repository):
+        store = ObjectStore(workspace / "store")
+        result = _snapshot(
+            workspace, make_git_repository, "r1", {"README.md": b"readme"}
+        )
+        store.ingest("project", [result], run="run1")
+        (manifest,) = store.read_manifests("project", "run1")
+        (blob_id,) = manifest.blobs()
+        object_path = store.objects / blob_id[:2] / blob_id[2:]
+        object_path.write_bytes(zlib.compress(b"blob 6\x00readm3"))
+
+        with pytest.raises(StoreError, match=r"corrupt"):
+            store.materialize(manifest, workspace / "output")
+
+        object_path.unlink()
+        with pytest.raises(StoreError, match=r"missing"):
+            store.materialize(manifest, workspace / "output")
+
+
+class TestCollectGarbage:
+    def test_keep(self, workspace, make_git_repository):
+        store = ObjectStore(workspace / "store")
+        for run, content in [("run1", b"one"), ("run2", b"two")]:
+            result = _snapshot(
+                workspace,
+                make_git_repository,
+                "r1",
+                {"README.md": b"readme", "a.txt": content},
+            )
+            store.ingest("project", [result], run=run)
+        assert _object_count(store) == 3
+
+        # recently written objects are spared
+        garbage = store.collect_garbage(keep=1)
+        assert garbage.removed_runs == ["project/run1"]
+        assert garbage.removed_objects == 0
+
+        garbage = store.collect_garbage(grace_seconds=0, dry_run=True)
+        assert garbage.removed_objects == 1
+        assert _object_count(store) == 3
+
+        garbage = store.collect_garbage(grace_seconds=0)
+        assert garbage.removed_objects == 1
+        assert _object_count(store) == 2
+        (manifest,) = store.read_manifests("project", "run2")
+        store.materialize(manifest, workspace / "output")
+
+
+class TestClickEntry:
+    def test_materialize(self, workspace, make_git_repository):
+        store = ObjectStore(workspace / "store")
+        results = [
+            _snapshot(workspace, make_git_repository, x, {"README.md": b"x"})
+            for x in ["r2", "r1"]
+        ]
+        store.ingest("project", results, run="run1")
+        runner = CliRunner()
+
+        result = runner.invoke(click_entry, [str(store.root), "list"])
+        assert result.exit_code == 0
+        assert result.output == "project run1\n"
+
+        result = runner.invoke(
+            click_entry,
+            [
+                str(store.root),
+                "materialize",
+                "project",
+                "--output-dir",
+                str(workspace / "output"),
+            ],
+        )
+
+        assert result.exit_code == 0
+        package_path = workspace / "output" / "project-run1.tar.gz"
+        with tarfile.open(package_path) as f:
+            # package order is retained
+            assert f.getnames() == [
+                "r2-1.0.0.tar.gz",
+                "r2-1.0.0.tar.gz.sha256",
+                "r1-1.0.0.tar.gz",
+                "r1-1.0.0.tar.gz.sha256",
+                "manifest.json",
+                "manifest.json.sha256",
+            ]
+
+        result = runner.invoke(
+            click_entry,
+            [str(store.root), "gc", "--keep", "1", "--grace", "0"],
+        )
+        assert result.exit_code == 0
+        assert result.output == "removed 0 objects (0 bytes)\n"
+
+    def test_missing_run(self, workspace):
+        result = CliRunner().invoke(
+            click_entry,
+            [str(workspace / "store"), "materialize", "project"],
+        )
+
+        assert result.exit_code == 1
+        assert "no store runs" in result.output
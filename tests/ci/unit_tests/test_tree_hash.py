@@ -0,0 +1,159 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import hashlib
+import os
+import pathlib
+import tempfile
+
+import pytest
+
+from foodx_backup_source._tree_hash import (
+    LEAF_PREFIX,
+    NODE_PREFIX,
+    TreeHasher,
+    TreeHashError,
+    create_tree_hash,
+    create_tree_hash_file,
+    merkle_root,
+    read_tree_hash_file,
+    verify_tree_hash,
+)
+
+CHUNK_SIZE = 0x1000
+
+
+def _leaf(data: bytes) -> str:
+    return hashlib.sha256(LEAF_PREFIX + data).hexdigest()
+
+
+def _node(left: str, right: str) -> str:
+    return hashlib.sha256(
+        NODE_PREFIX + bytes.fromhex(left) + bytes.fromhex(right)
+    ).hexdigest()
+
+
+@pytest.fixture()
+def data_file():
+    with tempfile.TemporaryDirectory() as d:
+        file_path = pathlib.Path(d) / "package.tar"
+        file_path.write_bytes(os.urandom(5 * CHUNK_SIZE + 100))
+
+        yield file_path
+
+
+class TestMerkleRoot:
+    def test_single(self):
+        assert merkle_root([_leaf(b"a")]) == _leaf(b"a")
+
+    def test_odd(self):
+        leaves = [_leaf(x) for x in [b"a", b"b", b"c"]]
+
+        # the odd leaf is carried up to the next level
+        assert merkle_root(leaves) == _node(
+            _node(leaves[0], leaves[1]), leaves[2]
+        )
+
+    def test_empty(self):
+        with pytest.raises(TreeHashError):
+            merkle_root(list())
+
+
+class TestCreateTreeHash:
+    def test_chunks(self, data_file):
+        data = data_file.read_bytes()
+
+        manifest = create_tree_hash(data_file, CHUNK_SIZE, 3)
+
+        assert manifest.size == len(data)
+        assert manifest.chunks == [
+            _leaf(data[x:][:CHUNK_SIZE])
+            for x in range(0, len(data), CHUNK_SIZE)
+        ]
+        assert manifest.root == merkle_root(manifest.chunks)
+        assert manifest.chunk_range(5) == (5 * CHUNK_SIZE, 100)
+
+    def test_empty_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            file_path = pathlib.Path(d) / "empty"
+            file_path.write_bytes(b"")
+
+            manifest = create_tree_hash(file_path, CHUNK_SIZE)
+
+        assert manifest.chunks == [_leaf(b"")]
+
+
+class TestTreeHasher:
+    @pytest.mark.parametrize("size", [0, CHUNK_SIZE, (3 * CHUNK_SIZE) + 10])
+    def test_matches_file(self, size):
+        data = os.urandom(size)
+        hasher = TreeHasher(CHUNK_SIZE)
+        # writes that straddle chunk boundaries
+        for offset in range(0, size, 1000):
+            hasher.update(data[offset:][:1000])
+        with tempfile.TemporaryDirectory() as d:
+            file_path = pathlib.Path(d) / "data.bin"
+            file_path.write_bytes(data)
+
+            expected = create_tree_hash(file_path, CHUNK_SIZE)
+
+        assert hasher.manifest("data.bin") == expected
+
+
+class TestVerifyTreeHash:
+    def test_clean(self, data_file):
+        manifest = read_tree_hash_file(
+            create_tree_hash_file(data_file, CHUNK_SIZE)
+        )
+
+        assert verify_tree_hash(data_file, manifest) == list()
+
+    def test_corrupt_range(self, data_file):
+        manifest = create_tree_hash(data_file, CHUNK_SIZE)
+        with data_file.open(mode="r+b") as f:
+            f.seek(3 * CHUNK_SIZE + 10)
+            f.write(b"corrupt")
+
+        corrupt = verify_tree_hash(data_file, manifest, jobs=2)
+
+        assert [(x.index, x.offset, x.size) for x in corrupt] == [
+            (3, 3 * CHUNK_SIZE, CHUNK_SIZE)
+        ]
+        # a spot check, or resumed check, of other chunks passes
+        assert verify_tree_hash(data_file, manifest, [0, 4, 5]) == list()
+
+    def test_size_mismatch(self, data_file):
+        manifest = create_tree_hash(data_file, CHUNK_SIZE)
+        with data_file.open(mode="ab") as f:
+            f.write(b"extra")
+
+        with pytest.raises(TreeHashError, match=r"size mismatch"):
+            verify_tree_hash(data_file, manifest)
+
+    def test_bad_index(self, data_file):
+        manifest = create_tree_hash(data_file, CHUNK_SIZE)
+
+        with pytest.raises(TreeHashError, match=r"out of range"):
+            verify_tree_hash(data_file, manifest, [6])
+
+
+class TestReadTreeHashFile:
+    def test_root_mismatch(self, data_file):
+        tree_hash_path = create_tree_hash_file(data_file, CHUNK_SIZE)
+        manifest = read_tree_hash_file(tree_hash_path)
+        manifest.chunks[1] = _leaf(b"tampered")
+        tree_hash_path.write_text(manifest.json())
+
+        with pytest.raises(TreeHashError, match=r"root mismatch"):
+            read_tree_hash_file(tree_hash_path)
+
+    def test_malformed(self, data_file):
+        tree_hash_path = create_tree_hash_file(data_file, CHUNK_SIZE)
+        tree_hash_path.write_text('{"size": 1}')
+
+        with pytest.raises(TreeHashError, match=r"malformed"):
+            read_tree_hash_file(tree_hash_path)
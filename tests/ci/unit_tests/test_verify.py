@@ -0,0 +1,245 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+import io
+import os
+import pathlib
+import tarfile
+import tempfile
+
+import git
+import pytest
+from click.testing import CliRunner
+
+from foodx_backup_source._hash import create_hash_file
+from foodx_backup_source._package import write_package
+from foodx_backup_source._snapshot import iter_snapshots
+from foodx_backup_source._tree_hash import create_tree_hash_file
+from foodx_backup_source._verify import (
+    VerifyError,
+    archive_tree,
+    click_entry,
+    verify_package,
+    verify_package_chunks,
+    verify_source,
+)
+
+APPLICATIONS = {
+    "r1": {"README.md": b"r1 readme"},
+    "r2": {"README.md": b"r2 readme"},
+}
+
+
+class TestVerifyPackage:
+    def test_clean(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            package_path = build_package(pathlib.Path(d), APPLICATIONS)
+
+            records = verify_package(package_path)
+
+        assert sorted(x.archive_name for x in records) == [
+            "r1-1.2.3.tar.gz",
+            "r2-1.2.3.tar.gz",
+        ]
+
+    def test_archive_mismatch(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            dd = pathlib.Path(d)
+            package_path = build_package(dd, APPLICATIONS)
+            (dd / "archives" / "r1-1.2.3.tar.gz.sha256").write_text(
+                f"{'0' * 64}  r1-1.2.3.tar.gz"
+            )
+            with tarfile.open(package_path, mode="w:gz") as package:
+                for x in sorted((dd / "archives").iterdir()):
+                    package.add(str(x), arcname=x.name)
+            create_hash_file(package_path)
+
+            with pytest.raises(VerifyError, match=r"archive hash mismatch"):
+                verify_package(package_path)
+
+    def test_package_mismatch(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            package_path = build_package(pathlib.Path(d), APPLICATIONS)
+            (package_path.parent / f"{package_path.name}.sha256").write_text(
+                f"{'0' * 64}  {package_path.name}"
+            )
+
+            with pytest.raises(VerifyError, match=r"package hash mismatch"):
+                verify_package(package_path)
+
+
+class TestClickEntry:
+    def test_clean(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            package_path = build_package(pathlib.Path(d), APPLICATIONS)
+
+            result = CliRunner().invoke(click_entry, [str(package_path)])
+
+        assert result.exit_code == 0
+        assert "r1-1.2.3.tar.gz: ok" in result.output
+
+    def test_chunks(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            package_path = build_package(pathlib.Path(d), APPLICATIONS)
+            create_tree_hash_file(package_path, 0x100)
+
+            result = CliRunner().invoke(
+                click_entry, [str(package_path), "--chunks", "--jobs", "2"]
+            )
+            assert result.exit_code == 0
+            assert "chunks)" in result.output
+
+            with package_path.open(mode="r+b") as f:
+                f.seek(0x110)
+                f.write(b"corrupt")
+            result = CliRunner().invoke(
+                click_entry, [str(package_path), "--chunks"]
+            )
+
+        assert result.exit_code == 1
+        assert "package chunks corrupt" in result.output
+        assert "256-511" in result.output
+
+    def test_source_unrelated(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            package_path = build_package(pathlib.Path(d), APPLICATIONS)
+            (pathlib.Path(d) / "dependencies.yml").write_text("""---
+context:
+  dependencies:
+    other:
+      backup:
+        repo_url: https://some.where/other.git
+        branch_name: main
+      docker:
+        image_name: some-image
+        tag_prefix: p-
+      release:
+        ref: 1.2.3
+""")
+
+            result = CliRunner().invoke(
+                click_entry, [str(package_path), "--source", d]
+            )
+
+        assert result.exit_code == 1
+        assert "no archives of the definitions" in result.output
+
+
+class TestVerifyPackageChunks:
+    def test_spot_check(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            package_path = build_package(pathlib.Path(d), APPLICATIONS)
+            create_tree_hash_file(package_path, 0x100)
+
+            assert verify_package_chunks(package_path, 2) == 2
+
+    def test_missing(self, build_package):
+        with tempfile.TemporaryDirectory() as d:
+            package_path = build_package(pathlib.Path(d), APPLICATIONS)
+
+            with pytest.raises(VerifyError, match=r"tree hash file missing"):
+                verify_package_chunks(package_path)
+
+
+@pytest.fixture()
+def source_repositories(git_http_server, make_git_repository, make_definition):
+    """Repositories served from a local server, and their release trees."""
+    bare_path = make_git_repository(
+        git_http_server.project_root,
+        "r1",
+        {
+            "README.md": b"r1 readme",
+            "empty": b"",
+            "a/b/c.txt": b"c",
+            "a/b-c.txt": b"ordered after the a/b tree",
+            "\u00fcnicode.txt": b"u",
+            "big.bin": os.urandom(0x50000),
+        },
+    )
+    # an executable file and a symlink, committed as a second release
+    with tempfile.TemporaryDirectory() as d:
+        with git.Repo.clone_from(str(bare_path), d) as working:
+            with working.config_writer() as c:
+                c.set_value("user", "name", "test")
+                c.set_value("user", "email", "test@some.where")
+            script_path = pathlib.Path(d) / "run.sh"
+            script_path.write_text("#!/bin/sh\n")
+            script_path.chmod(0o755)
+            os.symlink("a/b/c.txt", pathlib.Path(d) / "link")
+            working.git.add(A=True)
+            working.index.commit("second commit")
+            working.create_tag("1.0.1")
+            working.git.push("origin", "1.0.1")
+    extra_path = make_git_repository(
+        git_http_server.project_root, "r1-extra", {"README.md": b"x"}
+    )
+    definitions = [
+        make_definition(x, git_http_server.url) for x in ["r1", "r1-extra"]
+    ]
+    definitions[0].configuration.release.additional_refs = ["1.0.1"]
+    trees = dict()
+    for path, name, ref in [
+        (bare_path, "r1", "1.0.0"),
+        (bare_path, "r1", "1.0.1"),
+        (extra_path, "r1-extra", "1.0.0"),
+    ]:
+        with git.Repo(path) as this_repo:
+            trees[f"{name}-{ref}.tar.gz"] = this_repo.commit(ref).tree.hexsha
+
+    return definitions, trees
+
+
+class TestVerifySource:
+    @pytest.mark.asyncio
+    async def test_clean(self, source_repositories, git_http_server):
+        definitions, trees = source_repositories
+        with tempfile.TemporaryDirectory() as d:
+            archive_directory = pathlib.Path(d) / "archives"
+            archive_directory.mkdir()
+            results = [
+                x async for x in iter_snapshots(definitions, archive_directory)
+            ]
+            package_path = write_package("project", pathlib.Path(d), results)[0]
+            git_http_server.bytes_sent = 0
+
+            records = verify_source(package_path, definitions, jobs=2)
+
+            # only commit objects are fetched, not the repository content
+            assert git_http_server.bytes_sent < 0x10000
+
+        assert {x.archive_name: x.tree for x in records} == trees
+
+    def test_tampered(
+        self, git_http_server, make_git_repository, make_definition
+    ):
+        bare_path = make_git_repository(
+            git_http_server.project_root, "r1", {"README.md": b"r1 readme"}
+        )
+        with git.Repo(bare_path) as this_repo:
+            commit = this_repo.commit("1.0.0").hexsha
+        with tempfile.TemporaryDirectory() as d:
+            archive_path = pathlib.Path(d) / "r1-1.0.0.tar.gz"
+            with tarfile.open(
+                archive_path,
+                mode="w:gz",
+                format=tarfile.PAX_FORMAT,
+                pax_headers={"comment": commit},
+            ) as f:
+                info = tarfile.TarInfo("r1/README.md")
+                content = b"r1 readm3"
+                info.size = len(content)
+                f.addfile(info, io.BytesIO(content))
+            package_path = pathlib.Path(d) / "project.tar"
+            with tarfile.open(package_path, mode="w") as f:
+                f.add(str(archive_path), arcname=archive_path.name)
+
+            with archive_path.open(mode="rb") as f:
+                assert archive_tree(f)[0] == commit
+            with pytest.raises(VerifyError, match=r"does not match source"):
+                verify_source(
+                    package_path, [make_definition("r1", git_http_server.url)]
+                )
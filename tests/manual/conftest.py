@@ -0,0 +1,13 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+# share the local git server stand-in with the unit tests
+from tests.ci.unit_tests.conftest import (  # noqa: F401
+    git_http_server,
+    make_definition,
+    make_git_repository,
+)
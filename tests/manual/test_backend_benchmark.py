@@ -0,0 +1,76 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""
+Compare snapshot throughput of the git backends on the same local repos.
+
+Run with ``pytest -s tests/manual/test_backend_benchmark.py`` to see the
+results.
+"""
+
+import os
+import pathlib
+import tarfile
+import tempfile
+import time
+
+import pytest
+
+from foodx_backup_source._backend import DULWICH_AVAILABLE
+from foodx_backup_source._snapshot import SnapshotOptions, iter_snapshots
+
+REPOSITORY_COUNT = 8
+
+# mixed text and incompressible content
+REPOSITORY_FILES = {
+    **{f"src/s{i}.py": f"source {i}\n".encode() * 2000 for i in range(50)},
+    **{f"assets/a{i}.bin": os.urandom(0x80000) for i in range(8)},
+}
+
+
+@pytest.mark.asyncio
+async def test_backend_benchmark(
+    git_http_server, make_git_repository, make_definition
+):
+    names = [f"r{i}" for i in range(REPOSITORY_COUNT)]
+    for name in names:
+        make_git_repository(
+            git_http_server.project_root, name, REPOSITORY_FILES
+        )
+    definitions = [make_definition(x, git_http_server.url) for x in names]
+    backends = ["gitpython", "subprocess"]
+    if DULWICH_AVAILABLE:
+        backends.append("dulwich")
+
+    results = dict()
+    for backend in backends:
+        with tempfile.TemporaryDirectory() as d:
+            start_time = time.monotonic()
+            archived = 0
+            members = set()
+            async for result in iter_snapshots(
+                definitions,
+                pathlib.Path(d),
+                None,
+                SnapshotOptions(backend=backend),
+            ):
+                archived += result.archive_path.stat().st_size
+                with tarfile.open(result.archive_path, mode="r:gz") as f:
+                    members.update(x.name for x in f if x.isfile())
+            results[backend] = (
+                archived,
+                time.monotonic() - start_time,
+                frozenset(members),
+            )
+
+    for backend, (archived, elapsed, _) in results.items():
+        print(
+            f"{backend}: {len(names)} repositories, {archived} bytes archived "
+            f"in {elapsed:.2f}s ({archived / elapsed / 1e6:.1f} MB/s)"
+        )
+    # tar headers differ between backends, the archived files do not
+    assert len({x[2] for x in results.values()}) == 1
@@ -0,0 +1,90 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""
+Compare CPU time and archive size of git archive and adaptive compression.
+
+Run with ``pytest -s tests/manual/test_compression_benchmark.py`` to see the
+results.
+"""
+
+import os
+import pathlib
+import resource
+import tempfile
+import time
+import zipfile
+
+import git
+
+from foodx_backup_source._snapshot import _create_tarfile
+
+
+def _zip_content(size: int) -> bytes:
+    with tempfile.TemporaryDirectory() as d:
+        zip_path = pathlib.Path(d) / "a.zip"
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("data", os.urandom(size))
+        return zip_path.read_bytes()
+
+
+# a repository of source with vendored binaries, images and archives
+MIXED_FILES = {
+    **{
+        f"src/s{i}.py": "".join(
+            f"def function_{i}_{j}(x):\n    return x * {j}\n"
+            for j in range(2000)
+        ).encode()
+        for i in range(40)
+    },
+    **{f"vendor/v{i}.jar": _zip_content(0x200000) for i in range(10)},
+    **{f"images/i{i}.png": os.urandom(0x100000) for i in range(20)},
+    **{f"bin/b{i}.so": os.urandom(0x200000) for i in range(5)},
+}
+
+
+def _cpu_seconds() -> float:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def test_compression_benchmark(make_git_repository):
+    results = dict()
+    with tempfile.TemporaryDirectory() as d:
+        dd = pathlib.Path(d)
+        bare_path = make_git_repository(dd, "mixed", MIXED_FILES)
+        with git.Repo(bare_path) as this_repo:
+            start_cpu = _cpu_seconds()
+            archive_path = dd / "git-archive.tar.gz"
+            with archive_path.open(mode="wb") as f:
+                this_repo.archive(f, "1.0.0", format="tar.gz", prefix="mixed/")
+            results["git archive tar.gz"] = (
+                _cpu_seconds() - start_cpu,
+                archive_path.stat().st_size,
+            )
+
+            for level in [1, 6, 9]:
+                archive_path = dd / f"adaptive-{level}.tar.gz"
+                start_cpu = _cpu_seconds()
+                _create_tarfile(
+                    "mixed",
+                    "1.0.0",
+                    archive_path,
+                    this_repo,
+                    compression_level=level,
+                )
+                results[f"adaptive level {level}"] = (
+                    _cpu_seconds() - start_cpu,
+                    archive_path.stat().st_size,
+                )
+
+    for name, (cpu_seconds, size) in results.items():
+        print(f"{name}: {cpu_seconds:.2f} CPU seconds, {size} bytes")
+    assert results["adaptive level 6"][0] < results["git archive tar.gz"][0]
+    assert results["adaptive level 6"][1] < (
+        1.01 * results["git archive tar.gz"][1]
+    )
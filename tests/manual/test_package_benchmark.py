@@ -0,0 +1,88 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""
+Compare packaging throughput of each package format, with and without
+encryption.
+
+Run with ``pytest -s tests/manual/test_package_benchmark.py`` to see the
+results.
+"""
+
+import os
+import pathlib
+import tempfile
+import time
+
+from foodx_backup_source._hash import create_file_hash, create_hash_file
+from foodx_backup_source._package import write_package
+from foodx_backup_source._snapshot import SnapshotResult, SnapshotTimings
+
+MEMBER_COUNT = 8
+MEMBER_SIZE = 0x8000000
+
+
+def _snapshot_result(directory: pathlib.Path, index: int) -> SnapshotResult:
+    archive_path = directory / f"r{index}-1.0.0.tar.gz"
+    with archive_path.open(mode="wb") as f:
+        for _ in range(MEMBER_SIZE // 0x100000):
+            f.write(os.urandom(0x100000))
+
+    return SnapshotResult(
+        name=f"r{index}",
+        ref="1.0.0",
+        sha="0" * 40,
+        archive_path=archive_path,
+        hash_path=create_hash_file(archive_path),
+        sha256=create_file_hash(archive_path),
+        timings=SnapshotTimings(
+            clone_seconds=0, archive_seconds=0, total_seconds=0
+        ),
+    )
+
+
+def test_package_benchmark():
+    with tempfile.TemporaryDirectory() as d:
+        dd = pathlib.Path(d)
+        archive_directory = dd / "archives"
+        archive_directory.mkdir()
+        results = [
+            _snapshot_result(archive_directory, x) for x in range(MEMBER_COUNT)
+        ]
+        total_size = MEMBER_COUNT * MEMBER_SIZE
+
+        elapsed_seconds = dict()
+        for package_format, encryption_key in [
+            ("tar.gz", None),
+            ("tar", None),
+            ("tar.gz", os.urandom(32)),
+            ("tar", os.urandom(32)),
+        ]:
+            name = package_format + (" encrypted" if encryption_key else "")
+            output_directory = dd / "output"
+            output_directory.mkdir()
+            start_time = time.monotonic()
+            package_path = write_package(
+                "project",
+                output_directory,
+                results,
+                package_format,
+                encryption_key,
+            )[0]
+            elapsed = time.monotonic() - start_time
+            elapsed_seconds[name] = elapsed
+            print(
+                f"{name}: {total_size / elapsed / 0x100000:.0f} MiB/s, "
+                f"{elapsed:.2f}s, {package_path.stat().st_size} bytes"
+            )
+            for x in output_directory.iterdir():
+                x.unlink()
+            output_directory.rmdir()
+
+    # the members of an unencrypted "tar" package are copied in the kernel
+    assert elapsed_seconds["tar"] < elapsed_seconds["tar encrypted"]
+    assert elapsed_seconds["tar"] < elapsed_seconds["tar.gz"]
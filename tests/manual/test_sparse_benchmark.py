@@ -0,0 +1,67 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""
+Compare bytes fetched and archived by full and sparse snapshots.
+
+Run with ``pytest -s tests/manual/test_sparse_benchmark.py`` to see the
+results.
+"""
+
+import os
+import pathlib
+import tempfile
+import time
+
+import pytest
+
+from foodx_backup_source._snapshot import do_snapshot
+
+# a monorepo where the paths of interest are a small part of the content
+MONOREPO_FILES = {
+    **{f"deploy/d{i}.yaml": f"deploy {i}".encode() * 100 for i in range(20)},
+    **{f"charts/c{i}.yaml": f"chart {i}".encode() * 100 for i in range(20)},
+    **{f"src/s{i}.bin": os.urandom(0x40000) for i in range(40)},
+    **{f"assets/a{i}.bin": os.urandom(0x100000) for i in range(10)},
+}
+
+
+@pytest.mark.asyncio
+async def test_sparse_benchmark(
+    git_http_server, make_git_repository, make_definition
+):
+    make_git_repository(
+        git_http_server.project_root, "monorepo", MONOREPO_FILES
+    )
+    cases = {
+        "full": dict(),
+        "sparse": {"include_paths": ["deploy", "charts"]},
+    }
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as d:
+        for name, filters in cases.items():
+            git_http_server.bytes_sent = 0
+            start_time = time.monotonic()
+            result = await do_snapshot(
+                make_definition("monorepo", git_http_server.url, **filters),
+                pathlib.Path(d),
+                None,
+            )
+            results[name] = (
+                git_http_server.bytes_sent,
+                result.archive_path.stat().st_size,
+                time.monotonic() - start_time,
+            )
+
+    for name, (fetched, archived, elapsed) in results.items():
+        print(
+            f"{name}: {fetched} bytes fetched, {archived} bytes archived "
+            f"in {elapsed:.2f}s"
+        )
+    assert results["sparse"][0] < (results["full"][0] / 10)
+    assert results["sparse"][1] < (results["full"][1] / 10)
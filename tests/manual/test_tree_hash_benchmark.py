@@ -0,0 +1,45 @@
+#  Copyright (c) 2022 Food-X Technologies
+#
+#  This file is part of foodx_backup_source.
+#
+#  You should have received a copy of the MIT License along with
+#  foodx_backup_source. If not, see <https://opensource.org/licenses/MIT>.
+
+"""
+Compare wall time of serial and chunked tree hashing of a large file.
+
+Run with ``pytest -s tests/manual/test_tree_hash_benchmark.py`` to see the
+results.
+"""
+
+import os
+import pathlib
+import tempfile
+import time
+
+from foodx_backup_source._hash import create_file_hash
+from foodx_backup_source._tree_hash import create_tree_hash
+
+FILE_SIZE = 0x40000000
+
+
+def test_tree_hash_benchmark():
+    with tempfile.TemporaryDirectory() as d:
+        file_path = pathlib.Path(d) / "package.tar"
+        with file_path.open(mode="wb") as f:
+            block = os.urandom(0x1000000)
+            for _ in range(FILE_SIZE // len(block)):
+                f.write(block)
+
+        start_time = time.monotonic()
+        create_file_hash(file_path)
+        serial_seconds = time.monotonic() - start_time
+
+        start_time = time.monotonic()
+        create_tree_hash(file_path)
+        tree_seconds = time.monotonic() - start_time
+
+    print(f"serial sha256: {serial_seconds:.2f}s")
+    print(f"tree hash ({os.cpu_count()} CPUs): {tree_seconds:.2f}s")
+    if (os.cpu_count() or 1) > 1:
+        assert tree_seconds < serial_seconds